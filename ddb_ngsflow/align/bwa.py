@@ -5,11 +5,62 @@
 
 .. moduleauthor:: Daniel Gaston <daniel.gaston@dal.ca>
 
+A sample is aligned in chunks when config['bwa']['chunk_reads'] is set, splitting its FASTQ pair into chunks of that
+many read pairs, or when it lists per-lane FASTQ pairs:
+
+    samples[name]['lanes'] = [{'fastq1': "L001_R1.fastq.gz", 'fastq2': "L001_R2.fastq.gz"}, ...]
+
+Every chunk is aligned and coordinate sorted as its own job, so chunks run on as many nodes as are free, and the
+sorted chunks are gathered with a multi-threaded samtools merge into the same {name}.bwa.sorted.bam. The chunk and
+merge jobs are only added once the sample's job runs, so the sample's job has to come from bwa_mem_job, which
+encapsulates them, for the jobs after it to wait for the merged BAM:
+
+    align_job = job.addChild(bwa.bwa_mem_job(config, name, samples))
+    align_job.addChild(resources.job_fn(next_step, config, name, samples, align_job.rv()))
 
 """
+import os
+import gzip
+import shutil
+import threading
+
+import numpy
+
+from ddb_ngsflow import plan
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
+
+# Bytes of FASTQ read at a time when splitting
+SPLIT_BLOCK_SIZE = 16 << 20
+
+
+def chunked(config, name, samples):
+    """Whether a sample is aligned in chunks"""
+
+    return bool(config['bwa'].get('chunk_reads') or samples[name].get('lanes'))
+
+
+def bwa_mem_job(config, name, samples):
+    """Toil job aligning a sample with BWA. A chunked sample is aligned by an encapsulated split_fastq_chunks job,
+    whose successors only run once its chunks are merged, and any other sample by a run_bwa_mem job.
+
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param name: sample name.
+    :type name: str.
+    :param samples: samples configuration dictionary.
+    :type samples: dict.
+    :returns:  Job -- The job, whose rv() is the aligned and sorted BAM file name.
+    """
+
+    if chunked(config, name, samples):
+        return resources.job_fn(split_fastq_chunks, config, name, samples).encapsulate()
+
+    return resources.job_fn(run_bwa_mem, config, name, samples)
 
 
+@resources.declare(cores=resources.tool_cores('bwa'), memory=resources.tool_memory('bwa', "8G"),
+                   disk=resources.input_disk(3))
 def run_bwa_mem(job, config, name, samples):
     """Run GATK's DiagnoseTargets against the supplied region
 
@@ -22,15 +73,29 @@ def run_bwa_mem(job, config, name, samples):
     :param fastq2: Input FastQ File.
     :type fastq2: str.
     :returns:  str -- Aligned and sorted BAM file name.
+    :raises: ValueError
 
     """
 
+    if chunked(config, name, samples):
+        raise ValueError("Sample {} is aligned in chunks, which jobs after it only wait for when its job comes from "
+                         "bwa.bwa_mem_job".format(name))
+
     job.fileStore.logToMaster("Running BWA for sample {}\n".format(name))
 
     output_bam = "{}.bwa.sorted.bam".format(name)
     temp = "{}.bwa.sort.temp".format(name)
     logfile = "{}.bwa-align.log".format(name)
 
+    command = _bwa_mem_command(config, samples[name]['fastq1'], samples[name]['fastq2'], output_bam, temp)
+
+    job.fileStore.logToMaster("BWA Command: {}\n".format(pipeline.render_pipeline(command)))
+    pipeline.run_pipeline(command, logfile)
+
+    return output_bam
+
+
+def _bwa_mem_command(config, fastq1, fastq2, output_bam, temp):
     bwa_cmd = ["{}".format(config['bwa']['bin']),
                "mem",
                "-t",
@@ -39,8 +104,8 @@ def run_bwa_mem(job, config, name, samples):
                "-v",
                "2",
                "{}".format(config['reference']),
-               "{}".format(samples[name]['fastq1']),
-               "{}".format(samples[name]['fastq2'])]
+               "{}".format(fastq1),
+               "{}".format(fastq2)]
 
     view_cmd = ["{}".format(config['samtools']['bin']),
                 "view",
@@ -59,10 +124,221 @@ def run_bwa_mem(job, config, name, samples):
                 "{}".format(temp),
                 "-"]
 
-    command = "{} | {} | {}".format(" ".join(bwa_cmd), " ".join(view_cmd), " ".join(sort_cmd))
+    return [bwa_cmd, view_cmd, sort_cmd]
+
+
+def split_fastq(fastq, reads_per_chunk, prefix):
+    """Split a FASTQ file into chunks of a number of reads. The file is copied in large blocks and only cut at the
+    newline ending the last record of a chunk, so chunks of the two files of a pair hold the same reads. Chunks of a
+    gzipped FASTQ are written with fast gzip compression.
+
+    :param fastq: The FASTQ file name, plain or gzipped.
+    :type fastq: str.
+    :param reads_per_chunk: Reads per chunk.
+    :type reads_per_chunk: int.
+    :param prefix: Prefix of the chunk file names, which are numbered from {prefix}.0000.fastq.
+    :type prefix: str.
+    :returns:  tuple -- The chunk file names and the number of reads.
+    """
+
+    compressed = fastq.endswith(".gz")
+    lines_per_chunk = 4 * int(reads_per_chunk)
+    chunks = list()
+    output = None
+    remaining = 0
+    lines = 0
+    last_byte = b"\n"
+
+    with (gzip.open(fastq, 'rb') if compressed else open(fastq, 'rb')) as infile:
+        while True:
+            block = infile.read(SPLIT_BLOCK_SIZE)
+            if not block:
+                break
+            last_byte = block[-1:]
+            newlines = numpy.flatnonzero(numpy.frombuffer(block, dtype=numpy.uint8) == 10)
+            lines += len(newlines)
+            offset = 0
+            used = 0
+            while offset < len(block):
+                if output is None:
+                    chunks.append("{}.{:04d}.fastq{}".format(prefix, len(chunks), ".gz" if compressed else ""))
+                    output = gzip.open(chunks[-1], 'wb', 1) if compressed else open(chunks[-1], 'wb')
+                    remaining = lines_per_chunk
+                if len(newlines) - used < remaining:
+                    output.write(block[offset:])
+                    remaining -= len(newlines) - used
+                    break
+                cut = newlines[used + remaining - 1] + 1
+                output.write(block[offset:cut])
+                output.close()
+                output = None
+                offset = cut
+                used += remaining
+    if output is not None:
+        output.close()
+
+    if last_byte != b"\n":
+        lines += 1
+
+    return chunks, lines // 4
+
+
+def split_fastq_pair(fastq1, fastq2, reads_per_chunk, prefix):
+    """Split the two FASTQ files of a pair into chunks at the same time, each in its own thread, as zlib releases
+    the GIL while it decompresses and compresses
+
+    :param fastq1: Input FastQ File.
+    :type fastq1: str.
+    :param fastq2: Input FastQ File.
+    :type fastq2: str.
+    :param reads_per_chunk: Read pairs per chunk.
+    :type reads_per_chunk: int.
+    :param prefix: Prefix of the chunk file names, followed by .R1 and .R2.
+    :type prefix: str.
+    :returns:  list -- The (fastq1, fastq2) chunk file name pairs.
+    :raises: ValueError
+    """
+
+    results = [None, None]
+    errors = list()
+
+    def split(i, fastq):
+        try:
+            results[i] = split_fastq(fastq, reads_per_chunk, "{}.R{}".format(prefix, i + 1))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=split, args=(i, fastq)) for i, fastq in enumerate((fastq1, fastq2))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    (chunks1, reads1), (chunks2, reads2) = results
+    if reads1 != reads2:
+        raise ValueError("{} has {} reads but its mate file {} has {}".format(fastq1, reads1, fastq2, reads2))
+    if not reads1:
+        raise ValueError("{} and {} hold no reads".format(fastq1, fastq2))
 
-    job.fileStore.logToMaster("BWA Command: {}\n".format(command))
-    pipeline.run_and_log_command(command, logfile)
+    return list(zip(chunks1, chunks2))
+
+
+@resources.declare(cores=2, disk=resources.input_disk(2))
+def split_fastq_chunks(job, config, name, samples):
+    """Split the FASTQ pairs of a sample into chunks, align every chunk as a child job and gather the sorted chunks
+    in a follow-on job. The sample's lanes are taken as chunks as they are, unless config['bwa']['chunk_reads']
+    splits them further. The job must be encapsulated, as bwa_mem_job does, for the jobs after it to wait for the
+    merged BAM.
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param name: sample name.
+    :type name: str.
+    :param samples: samples configuration dictionary.
+    :type samples: dict.
+    :returns:  str -- Aligned and sorted BAM file name.
+    """
+
+    lanes = samples[name].get('lanes') or [{'fastq1': samples[name]['fastq1'], 'fastq2': samples[name]['fastq2']}]
+    chunk_reads = int(config['bwa'].get('chunk_reads') or 0)
+    chunk_dir = os.path.abspath("{}.bwa.chunks".format(name))
+
+    pairs = [(os.path.abspath(lane['fastq1']), os.path.abspath(lane['fastq2'])) for lane in lanes]
+    # In plan mode the FASTQs are not read, so every pair is planned as a single chunk
+    if chunk_reads and not plan.planning():
+        if not os.path.isdir(chunk_dir):
+            os.makedirs(chunk_dir)
+        split_pairs = list()
+        for i, (fastq1, fastq2) in enumerate(pairs):
+            prefix = os.path.join(chunk_dir, "{}.{:03d}".format(name, i))
+            split_pairs.extend(split_fastq_pair(fastq1, fastq2, chunk_reads, prefix))
+        pairs = split_pairs
+
+    job.fileStore.logToMaster("Aligning sample {} with BWA in {} chunks\n".format(name, len(pairs)))
+
+    chunk_bams = list()
+    for i, (fastq1, fastq2) in enumerate(pairs):
+        chunk_bams.append(resources.add_child_job_fn(job, align_chunk, config, name, i, fastq1, fastq2,
+                                                     chunk_dir).rv())
+
+    return resources.add_follow_on_job_fn(job, merge_chunk_bams, config, name, chunk_bams, chunk_dir).rv()
+
+
+@resources.declare(cores=resources.tool_cores('bwa'), memory=resources.tool_memory('bwa', "8G"),
+                   disk=resources.input_disk(3))
+def align_chunk(job, config, name, chunk, fastq1, fastq2, chunk_dir):
+    """Align and coordinate sort one chunk of a sample's reads
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param name: sample name.
+    :type name: str.
+    :param chunk: The chunk number.
+    :type chunk: int.
+    :param fastq1: Input FastQ File.
+    :type fastq1: str.
+    :param fastq2: Input FastQ File.
+    :type fastq2: str.
+    :param chunk_dir: Directory of the chunk files.
+    :type chunk_dir: str.
+    :returns:  str -- Aligned and sorted BAM file name of the chunk.
+    """
+
+    if not os.path.isdir(chunk_dir) and not plan.planning():
+        os.makedirs(chunk_dir)
+
+    output_bam = os.path.join(chunk_dir, "{}.{:04d}.bwa.sorted.bam".format(name, chunk))
+    temp = os.path.join(chunk_dir, "{}.{:04d}.bwa.sort.temp".format(name, chunk))
+    logfile = "{}.bwa-align.{:04d}.log".format(name, chunk)
+
+    command = _bwa_mem_command(config, fastq1, fastq2, output_bam, temp)
+
+    job.fileStore.logToMaster("BWA Command: {}\n".format(pipeline.render_pipeline(command)))
+    pipeline.run_pipeline(command, logfile)
+
+    return output_bam
+
+
+@resources.declare(cores=resources.tool_cores('bwa'), memory="4G", disk=resources.input_disk(2))
+def merge_chunk_bams(job, config, name, chunk_bams, chunk_dir):
+    """Gather the sorted chunk BAMs of a sample with a multi-threaded k-way samtools merge, then remove the chunks
+    unless config['bwa']['keep_chunks'] is set
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param name: sample name.
+    :type name: str.
+    :param chunk_bams: The sorted chunk BAM file names.
+    :type chunk_bams: list.
+    :param chunk_dir: Directory of the chunk files.
+    :type chunk_dir: str.
+    :returns:  str -- Aligned and sorted BAM file name.
+    :raises: ValueError
+    """
+
+    if not chunk_bams:
+        raise ValueError("No chunks of sample {} to merge".format(name))
+
+    output_bam = "{}.bwa.sorted.bam".format(name)
+    logfile = "{}.bwa-merge.log".format(name)
+
+    job.fileStore.logToMaster("Merging {} BWA chunks of sample {}\n".format(len(chunk_bams), name))
+
+    # Chunks share the header of the reference, so identical @RG and @PG lines are combined instead of renamed
+    command = ["{}".format(config['samtools']['bin']),
+               "merge",
+               "-@",
+               "{}".format(config['bwa']['num_cores']),
+               "-c",
+               "-p",
+               "-f",
+               "{}".format(output_bam)]
+    command.extend(chunk_bams)
+
+    job.fileStore.logToMaster("Samtools Command: {}\n".format(pipeline.render_pipeline([command])))
+    pipeline.run_pipeline([command], logfile)
+
+    if not config['bwa'].get('keep_chunks') and not plan.planning():
+        shutil.rmtree(chunk_dir, ignore_errors=True)
 
     return output_bam
 
@@ -82,21 +358,20 @@ def run_bedtools_filter(job, config, sample, samples, input_bam):
 
     """
 
-    job.fileStore.logToMaster("Running Bedtools for alignment {}\n".format(input_bam))
+    job.fileStore.logToMaster("Filtering alignment {} to target regions\n".format(input_bam))
 
     output_bam = "{}.on_target.bam".format(sample)
     logfile = "{}.bedtools.log".format(sample)
 
-    command = ["bedtools",
-               "intersect",
-               "-a",
-               "{}".format(input_bam),
+    # samtools looks the reads up in an in-memory index of the regions, without the temporary files of bedtools
+    command = ["{}".format(config['samtools']['bin']),
+               "view",
                "-b",
+               "-L",
                "{}".format(samples[sample]['regions']),
-               ">",
-               "{}".format(output_bam)]
+               "{}".format(input_bam)]
 
-    job.fileStore.logToMaster("Bedtools Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    job.fileStore.logToMaster("Samtools Command: {}\n".format(command))
+    pipeline.run_pipeline([command], logfile, stdout=output_bam)
 
     return output_bam
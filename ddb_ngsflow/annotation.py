@@ -10,8 +10,10 @@
 """
 
 import pipeline
+import resources
 
 
+@resources.declare(memory=resources.tool_memory('snpeff', "4G"), disk=resources.input_disk())
 def snpeff(job, config, name, input_vcf):
     """Annotate the specified VCF using snpEff
     :param config: The configuration dictionary.
@@ -28,19 +30,20 @@ def snpeff(job, config, name, input_vcf):
 
     snpeff_command = ["{}".format(config['snpeff']['bin']),
                       "-Xmx{}g".format(config['snpeff']['max_mem']),
-                      "-onlyTr {}".format(config['transcripts']),
+                      "-onlyTr",
+                      "{}".format(config['transcripts']),
                       "-v",
                       "{}".format(config['snpeff']['reference']),
-                      "{}".format(input_vcf),
-                      ">"
-                      "{}".format(output_vcf)]
+                      "{}".format(input_vcf)]
 
     job.fileStore.logToMaster("snpEff Command: {}\n".format(snpeff_command))
-    pipeline.run_and_log_command(" ".join(snpeff_command), logfile)
+    pipeline.run_pipeline([snpeff_command], logfile, stdout=output_vcf)
 
     return output_vcf
 
 
+@resources.declare(cores=resources.tool_cores('gemini'), memory=resources.tool_memory('gemini'),
+                   disk=resources.input_disk())
 def gemini(job, config, name, input_vcf):
     """Take the specified VCF and use GEMINI to add additional annotations and convert to database format
     :param config: The configuration dictionary.
@@ -67,11 +70,13 @@ def gemini(job, config, name, input_vcf):
                "{}".format(db)]
 
     job.fileStore.logToMaster("GEMINI Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return db
 
 
+@resources.declare(cores=resources.tool_cores('vcfanno'), memory=resources.tool_memory('vcfanno'),
+                   disk=resources.input_disk())
 def vcfanno(job, config, name, samples, input_vcf):
     """Take the specified VCF and use vcfanno to add additional annotations
     :param config: The configuration dictionary.
@@ -92,11 +97,9 @@ def vcfanno(job, config, name, samples, input_vcf):
                "--lua",
                "{}".format(config['vcfanno']['lua']),
                "{}".format(samples[name]['vcfanno_config']),
-               "{}".format(input_vcf),
-               ">",
-               "{}".format(output_vcf)]
+               "{}".format(input_vcf)]
 
     job.fileStore.logToMaster("VCFAnno Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, stdout=output_vcf)
 
     return output_vcf
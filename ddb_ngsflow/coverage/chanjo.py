@@ -1,15 +1,338 @@
 """
-.. module:: utilities
+.. module:: chanjo
    :platform: Unix, OSX
-   :synopsis: A module of methods for various utility functions. This is a general catch all module for methoods
-   not better implemented elsewhere.
+   :synopsis: A module for a local, chanjo-style coverage database: region coverage of many samples bulk loaded
+   from sambamba depth region output into SQLite, for queries such as the completeness of a gene across samples.
 
 .. moduleauthor:: Daniel Gaston <daniel.gaston@dal.ca>
 
+The database is a single SQLite file, e.g. config['chanjo']['db'], with the tables
+
+    sample(id, name, sample_group, loaded)
+    region(id, chrom, start, end, name, gene)
+    coverage(region_id, sample_id, read_count, mean_coverage)
+    completeness(region_id, threshold, sample_id, percentage)
+
+coverage and completeness are clustered on region, so the rows of a gene for every sample are read together, and
+indexed on sample. Queries from the command line:
+
+    python -m ddb_ngsflow.coverage.chanjo coverage.sqlite --genes BRCA1 BRCA2 --threshold 20
+
 """
 
+import re
 import sys
+import time
+import sqlite3
+import argparse
+
+from ddb_ngsflow import plan
+from ddb_ngsflow import resources
+
+# Rows are inserted with executemany in batches of this many regions
+BATCH_SIZE = 10000
+
+# Seconds a load waits for the loads of other samples to commit before it fails with "database is locked"
+LOCK_TIMEOUT = 3600
+
+# Gene of a region without an explicit gene: its name up to the first underscore, e.g. BRCA1 for BRCA1_exon2
+DEFAULT_GENE_PATTERN = r"^([^_]+)"
+
+_PERCENTAGE = re.compile(r"^percentage(\d+)$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sample (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    sample_group TEXT,
+    loaded REAL
+);
+CREATE TABLE IF NOT EXISTS region (
+    id INTEGER PRIMARY KEY,
+    chrom TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    gene TEXT,
+    UNIQUE (chrom, start, end, name)
+);
+CREATE INDEX IF NOT EXISTS region_gene ON region (gene);
+CREATE TABLE IF NOT EXISTS coverage (
+    region_id INTEGER NOT NULL,
+    sample_id INTEGER NOT NULL,
+    read_count INTEGER,
+    mean_coverage REAL,
+    PRIMARY KEY (region_id, sample_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS coverage_sample ON coverage (sample_id);
+CREATE TABLE IF NOT EXISTS completeness (
+    region_id INTEGER NOT NULL,
+    threshold INTEGER NOT NULL,
+    sample_id INTEGER NOT NULL,
+    percentage REAL,
+    PRIMARY KEY (region_id, threshold, sample_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS completeness_sample ON completeness (sample_id, threshold);
+"""
+
+
+def connect(db_file, timeout=LOCK_TIMEOUT):
+    """Open a coverage database, creating its tables if needed. The default rollback journal is kept, as WAL needs
+    shared memory that the network filesystems of a cluster do not provide, and concurrent loads wait for each
+    other's write lock for up to timeout seconds.
+
+    :param db_file: The SQLite database file name.
+    :type db_file: str.
+    :param timeout: Seconds to wait for a lock held by another connection.
+    :type timeout: float.
+    :returns:  sqlite3.Connection.
+    """
+
+    connection = sqlite3.connect(db_file, timeout=timeout)
+    connection.executescript(SCHEMA)
+
+    return connection
+
+
+def read_region_coverage(coverage_file):
+    """Read a sambamba depth region file, or the region output of depth.coverage_metrics
+
+    :param coverage_file: The region coverage file name.
+    :type coverage_file: str.
+    :returns:  tuple -- The thresholds of the percentage columns and a generator of (chrom, start, end, name,
+               read count, mean coverage, percentages, sample name) tuples.
+    :raises: ValueError
+    """
+
+    with open(coverage_file, 'r') as coverage:
+        header = coverage.readline().lstrip("#").strip().split("\t")
+    columns = [column.strip() for column in header]
+    percentage_columns = [(i, int(_PERCENTAGE.match(column).group(1))) for i, column in enumerate(columns)
+                          if _PERCENTAGE.match(column)]
+    try:
+        read_count = columns.index("readCount")
+        mean_coverage = columns.index("meanCoverage")
+    except ValueError:
+        raise ValueError("{} is not sambamba region coverage output".format(coverage_file))
+    sample_column = columns.index("sampleName") if "sampleName" in columns else None
+
+    def records():
+        with open(coverage_file, 'r') as coverage:
+            for line in coverage:
+                if line.startswith("#") or not line.strip():
+                    continue
+                fields = line.rstrip("\n").split("\t")
+                yield (fields[0], int(fields[1]), int(fields[2]), fields[3] if read_count > 3 else ".",
+                       int(fields[read_count]), float(fields[mean_coverage]),
+                       [float(fields[i]) for i, threshold in percentage_columns],
+                       fields[sample_column] if sample_column is not None else None)
+
+    return [threshold for i, threshold in percentage_columns], records()
+
+
+def _region_ids(connection):
+    return dict(((chrom, start, end, name), region_id) for region_id, chrom, start, end, name
+                in connection.execute("SELECT id, chrom, start, end, name FROM region"))
+
+
+def load_region_coverage(connection, coverage_file, sample=None, group=None, gene_pattern=DEFAULT_GENE_PATTERN,
+                         batch_size=BATCH_SIZE):
+    """Bulk load the region coverage of a sample. The whole sample is loaded in one transaction, which takes the
+    write lock up front, and rows are inserted with executemany per batch of regions. Loading a sample again
+    replaces its coverage, and a failed load leaves the database as it was.
+
+    :param connection: The database connection.
+    :type connection: sqlite3.Connection.
+    :param coverage_file: The region coverage file name.
+    :type coverage_file: str.
+    :param sample: The sample name, by default the sampleName column.
+    :type sample: str.
+    :param group: A group, e.g. the run, the sample belongs to.
+    :type group: str.
+    :param gene_pattern: Regular expression whose first group is the gene of a region name.
+    :type gene_pattern: str.
+    :param batch_size: Regions per executemany.
+    :type batch_size: int.
+    :returns:  int -- The number of regions loaded.
+    """
+
+    thresholds, records = read_region_coverage(coverage_file)
+    gene_of = re.compile(gene_pattern)
+    sample_id = None
+    loaded = 0
+
+    connection.execute("BEGIN IMMEDIATE")
+    with connection:
+        region_ids = _region_ids(connection)
+        while True:
+            batch = list()
+            for record in records:
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    break
+            if not batch:
+                break
+
+            if sample_id is None:
+                name = sample or batch[0][7]
+                connection.execute("INSERT OR IGNORE INTO sample (name) VALUES (?)", (name,))
+                sample_id = connection.execute("SELECT id FROM sample WHERE name = ?", (name,)).fetchone()[0]
+                connection.execute("DELETE FROM coverage WHERE sample_id = ?", (sample_id,))
+                connection.execute("DELETE FROM completeness WHERE sample_id = ?", (sample_id,))
+
+            new_regions = list()
+            for record in batch:
+                key = record[:4]
+                if key not in region_ids:
+                    region_ids[key] = None
+                    match = gene_of.search(record[3])
+                    new_regions.append(key + (match.group(1) if match else None,))
+            if new_regions:
+                connection.executemany("INSERT OR IGNORE INTO region (chrom, start, end, name, gene) "
+                                       "VALUES (?, ?, ?, ?, ?)", new_regions)
+                region_ids = _region_ids(connection)
+
+            connection.executemany("INSERT INTO coverage (region_id, sample_id, read_count, mean_coverage) "
+                                   "VALUES (?, ?, ?, ?)",
+                                   ((region_ids[record[:4]], sample_id, record[4], record[5]) for record in batch))
+            connection.executemany("INSERT INTO completeness (region_id, threshold, sample_id, percentage) "
+                                   "VALUES (?, ?, ?, ?)",
+                                   ((region_ids[record[:4]], threshold, sample_id, percentage)
+                                    for record in batch for threshold, percentage in zip(thresholds, record[6])))
+            loaded += len(batch)
+
+        if sample_id is not None:
+            connection.execute("UPDATE sample SET sample_group = ?, loaded = ? WHERE id = ?",
+                               (group, time.time(), sample_id))
+
+    return loaded
+
+
+def gene_completeness(connection, threshold, genes=None, samples=None):
+    """Completeness of genes per sample: the percentage of the bases of the gene's regions covered at or above the
+    threshold, weighting each region by its length, with the length weighted mean coverage
+
+    :param connection: The database connection.
+    :type connection: sqlite3.Connection.
+    :param threshold: The coverage threshold.
+    :type threshold: int.
+    :param genes: Genes to report, all if not given.
+    :type genes: list.
+    :param samples: Samples to report, all if not given.
+    :type samples: list.
+    :returns:  list -- Tuples of sample, gene, completeness and mean coverage.
+    """
+
+    conditions = ["completeness.threshold = ?"]
+    parameters = [int(threshold)]
+    if genes:
+        conditions.append("region.gene IN ({})".format(", ".join("?" * len(genes))))
+        parameters.extend(genes)
+    if samples:
+        conditions.append("sample.name IN ({})".format(", ".join("?" * len(samples))))
+        parameters.extend(samples)
+
+    query = ("SELECT sample.name, region.gene, "
+             "SUM(completeness.percentage * (region.end - region.start)) / SUM(region.end - region.start), "
+             "SUM(coverage.mean_coverage * (region.end - region.start)) / SUM(region.end - region.start) "
+             "FROM region "
+             "JOIN completeness ON completeness.region_id = region.id "
+             "JOIN coverage ON coverage.region_id = completeness.region_id "
+             "AND coverage.sample_id = completeness.sample_id "
+             "JOIN sample ON sample.id = completeness.sample_id "
+             "WHERE {} GROUP BY sample.name, region.gene ORDER BY region.gene, sample.name".format(
+                 " AND ".join(conditions)))
+
+    return connection.execute(query, parameters).fetchall()
+
+
+def incomplete_regions(connection, threshold, min_percentage=100.0, genes=None, samples=None):
+    """Regions below a completeness in any of the samples
+
+    :param connection: The database connection.
+    :type connection: sqlite3.Connection.
+    :param threshold: The coverage threshold.
+    :type threshold: int.
+    :param min_percentage: The completeness a region must reach.
+    :type min_percentage: float.
+    :param genes: Genes to report, all if not given.
+    :type genes: list.
+    :param samples: Samples to report, all if not given.
+    :type samples: list.
+    :returns:  list -- Tuples of sample, gene, chrom, start, end, region name and percentage.
+    """
+
+    conditions = ["completeness.threshold = ?", "completeness.percentage < ?"]
+    parameters = [int(threshold), float(min_percentage)]
+    if genes:
+        conditions.append("region.gene IN ({})".format(", ".join("?" * len(genes))))
+        parameters.extend(genes)
+    if samples:
+        conditions.append("sample.name IN ({})".format(", ".join("?" * len(samples))))
+        parameters.extend(samples)
+
+    query = ("SELECT sample.name, region.gene, region.chrom, region.start, region.end, region.name, "
+             "completeness.percentage FROM region "
+             "JOIN completeness ON completeness.region_id = region.id "
+             "JOIN sample ON sample.id = completeness.sample_id "
+             "WHERE {} ORDER BY region.chrom, region.start, sample.name".format(" AND ".join(conditions)))
+
+    return connection.execute(query, parameters).fetchall()
+
+
+@resources.declare(cores=1)
+def load_coverage(job, config, name, region_coverage):
+    """Load the region coverage of a sample into the coverage database config['chanjo']['db'], grouped under
+    config['run_id'] if set
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param name: sample/library name.
+    :type name: str.
+    :param region_coverage: The region coverage file of sambamba_region_coverage or depth.coverage_metrics.
+    :type region_coverage: str.
+    :returns:  str -- The database file name.
+    """
+
+    db_file = config['chanjo']['db']
+    if plan.record_function("chanjo.load_coverage", "{}.chanjo_load.log".format(name), [region_coverage],
+                            [db_file]):
+        return db_file
+
+    connection = connect(db_file, float(config['chanjo'].get('timeout', LOCK_TIMEOUT)))
+    try:
+        start = time.time()
+        loaded = load_region_coverage(connection, region_coverage, name, config.get('run_id'),
+                                      config['chanjo'].get('gene_pattern', DEFAULT_GENE_PATTERN),
+                                      int(config['chanjo'].get('batch_size', BATCH_SIZE)))
+    finally:
+        connection.close()
+    job.fileStore.logToMaster("Loaded coverage of {} regions of {} into {} in {:.1f}s\n".format(
+        loaded, name, db_file, time.time() - start))
+
+    return db_file
+
+
+def main(argv=None):
+    """Command line entry point: python -m ddb_ngsflow.coverage.chanjo DB [--genes GENE ...] [--threshold T]"""
+
+    parser = argparse.ArgumentParser(description="Query a local coverage database")
+    parser.add_argument('db', help="Coverage database file")
+    parser.add_argument('-g', '--genes', nargs='+', default=None, help="Genes to report")
+    parser.add_argument('-s', '--samples', nargs='+', default=None, help="Samples to report")
+    parser.add_argument('-t', '--threshold', type=int, default=20, help="Coverage threshold")
+    args = parser.parse_args(argv)
+
+    connection = connect(args.db)
+    try:
+        rows = gene_completeness(connection, args.threshold, args.genes, args.samples)
+    finally:
+        connection.close()
+    sys.stdout.write("sample\tgene\tcompleteness_{}x\tmean_coverage\n".format(args.threshold))
+    for sample, gene, completeness, mean_coverage in rows:
+        sys.stdout.write("{}\t{}\t{:.2f}\t{:.1f}\n".format(sample, gene, completeness, mean_coverage))
+
+    return rows
 
-from collections import defaultdict
 
-from ddb_ngsflow import pipeline
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+.. module:: cohort
+   :platform: Unix, OSX
+   :synopsis: A module for a cohort coverage store: the mean depth and coverage status of every target region in
+   every sample of every run, kept as memory mapped NumPy matrices that runs are appended to.
+
+.. moduleauthor:: Daniel Gaston <daniel.gaston@dal.ca>
+
+A store is a directory with regions.json, the region of every matrix column, runs.json, the runs and samples in the
+order they were appended, and depth.f4 and status.u1, the float32 depth and uint8 status matrices. Each sample is
+one row of the matrices, so a run is appended by writing its rows to the end of the files. Queries over samples and
+runs are reductions over row ranges:
+
+    python -m ddb_ngsflow.coverage.cohort STORE --last-runs 20 --min-fraction 0.1
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy
+
+PASS = 0
+LOW_COVERAGE = 1
+NO_READS = 2
+OTHER_FILTER = 3
+MISSING = 255
+
+STATUS_NAMES = {PASS: "PASS", LOW_COVERAGE: "LOW_COVERAGE", NO_READS: "NO_READS", OTHER_FILTER: "OTHER_FILTER",
+                MISSING: "MISSING"}
+
+_REGIONS_FILE = "regions.json"
+_RUNS_FILE = "runs.json"
+_DEPTH_FILE = "depth.f4"
+_STATUS_FILE = "status.u1"
+
+
+def status_code(filter_field):
+    """Status code of a DiagnoseTargets FILTER value. Filters mentioning COVERAGE or NO_READS are failures, as in
+    utilities.generate_coverage_summary.
+
+    :param filter_field: The FILTER value.
+    :type filter_field: str.
+    :returns:  int -- The status code.
+    """
+
+    if 'NO_READS' in filter_field:
+        return NO_READS
+    if 'COVERAGE' in filter_field:
+        return LOW_COVERAGE
+    if filter_field in ("PASS", "."):
+        return PASS
+
+    return OTHER_FILTER
+
+
+def _write_json(path, data):
+    with open("{}.tmp".format(path), 'w') as outfile:
+        json.dump(data, outfile)
+    os.rename("{}.tmp".format(path), path)
+
+
+class CohortCoverage(object):
+    """A cohort coverage store. The matrices are mapped read only; append_run writes through the files and maps
+    them again."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, _REGIONS_FILE), 'r') as regions:
+            self.regions = json.load(regions)
+        self.region_index = dict((region, i) for i, region in enumerate(self.regions))
+        self._load()
+
+    @classmethod
+    def create(cls, directory, regions):
+        """Create an empty store
+
+        :param directory: The store directory.
+        :type directory: str.
+        :param regions: The regions, e.g. the target names of read_coverage.
+        :type regions: list.
+        :returns:  CohortCoverage.
+        """
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in (_DEPTH_FILE, _STATUS_FILE):
+            open(os.path.join(directory, name), 'wb').close()
+        _write_json(os.path.join(directory, _REGIONS_FILE), list(regions))
+        _write_json(os.path.join(directory, _RUNS_FILE), list())
+
+        return cls(directory)
+
+    def _load(self):
+        with open(os.path.join(self.directory, _RUNS_FILE), 'r') as runs:
+            self.runs = json.load(runs)
+        self.samples = [sample for run in self.runs for sample in run['samples']]
+        rows = len(self.samples)
+        shape = (rows, len(self.regions))
+        if rows and self.regions:
+            self.depth = numpy.memmap(os.path.join(self.directory, _DEPTH_FILE), dtype=numpy.float32, mode='r',
+                                      shape=shape)
+            self.status = numpy.memmap(os.path.join(self.directory, _STATUS_FILE), dtype=numpy.uint8, mode='r',
+                                       shape=shape)
+        else:
+            self.depth = numpy.zeros(shape, dtype=numpy.float32)
+            self.status = numpy.zeros(shape, dtype=numpy.uint8)
+
+    def append_run(self, run_id, samples):
+        """Append the coverage of the samples of a run. Regions missing from a sample are stored as MISSING,
+        regions unknown to the store are ignored.
+
+        :param run_id: The run identifier.
+        :type run_id: str.
+        :param samples: Coverage by sample and region, with filter_field and depth_field, as from read_coverage.
+        :type samples: dict.
+        :returns:  int -- The number of regions of the run that are not in the store.
+        """
+
+        names = sorted(samples)
+        depth = numpy.full((len(names), len(self.regions)), numpy.nan, dtype=numpy.float32)
+        status = numpy.full((len(names), len(self.regions)), MISSING, dtype=numpy.uint8)
+        unknown = set()
+        for row, sample in enumerate(names):
+            for region, coverage in samples[sample].items():
+                column = self.region_index.get(region)
+                if column is None:
+                    unknown.add(region)
+                    continue
+                status[row, column] = status_code(coverage['filter_field'])
+                try:
+                    depth[row, column] = float(coverage['depth_field'])
+                except (KeyError, ValueError):
+                    pass
+
+        # Rows past the last recorded run are left overs of an interrupted append and are overwritten
+        rows = len(self.samples)
+        for name, matrix in ((_DEPTH_FILE, depth), (_STATUS_FILE, status)):
+            with open(os.path.join(self.directory, name), 'r+b') as outfile:
+                outfile.truncate(rows * len(self.regions) * matrix.itemsize)
+                outfile.seek(0, os.SEEK_END)
+                outfile.write(matrix.tobytes())
+
+        self.runs.append({'run': run_id, 'samples': names, 'time': time.time()})
+        _write_json(os.path.join(self.directory, _RUNS_FILE), self.runs)
+        self._load()
+
+        return len(unknown)
+
+    def run_rows(self, last_runs=None):
+        """Rows of the samples of the last runs, or of all runs
+
+        :param last_runs: Number of most recent runs.
+        :type last_runs: int.
+        :returns:  slice.
+        """
+
+        runs = self.runs[-last_runs:] if last_runs else self.runs
+
+        return slice(len(self.samples) - sum(len(run['samples']) for run in runs), len(self.samples))
+
+    def failure_fraction(self, last_runs=None):
+        """Fraction of the samples with a coverage result for each region that fail it
+
+        :param last_runs: Number of most recent runs to consider.
+        :type last_runs: int.
+        :returns:  numpy.ndarray -- The fraction per region, NaN where no sample has a result.
+        """
+
+        status = self.status[self.run_rows(last_runs)]
+        observed = (status != MISSING).sum(axis=0)
+        failed = ((status == LOW_COVERAGE) | (status == NO_READS)).sum(axis=0)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return numpy.where(observed > 0, failed / observed.astype(float), numpy.nan)
+
+    def failing_regions(self, min_fraction=0.1, last_runs=None):
+        """Regions failing in more than a fraction of the samples
+
+        :param min_fraction: The fraction of samples a region must fail in.
+        :type min_fraction: float.
+        :param last_runs: Number of most recent runs to consider.
+        :type last_runs: int.
+        :returns:  list -- Tuples of region and failure fraction, most often failing first.
+        """
+
+        fractions = self.failure_fraction(last_runs)
+        failing = numpy.flatnonzero(numpy.nan_to_num(fractions) > min_fraction)
+        failing = failing[numpy.argsort(-fractions[failing], kind='mergesort')]
+
+        return [(self.regions[i], float(fractions[i])) for i in failing]
+
+    def mean_depth(self, last_runs=None):
+        """Mean depth of each region over the samples with a result
+
+        :param last_runs: Number of most recent runs to consider.
+        :type last_runs: int.
+        :returns:  numpy.ndarray -- The mean depth per region.
+        """
+
+        depth = self.depth[self.run_rows(last_runs)]
+        observed = (~numpy.isnan(depth)).sum(axis=0)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return numpy.where(observed > 0, numpy.nansum(depth, axis=0) / observed, numpy.nan)
+
+    def sample_failures(self, last_runs=None):
+        """Number of failing regions of each sample
+
+        :param last_runs: Number of most recent runs to consider.
+        :type last_runs: int.
+        :returns:  list -- Tuples of sample name and failing region count.
+        """
+
+        rows = self.run_rows(last_runs)
+        status = self.status[rows]
+        counts = ((status == LOW_COVERAGE) | (status == NO_READS)).sum(axis=1)
+
+        return list(zip(self.samples[rows], counts.tolist()))
+
+
+def open_cohort(directory, regions):
+    """Open a store, creating it for the regions if it does not exist
+
+    :param directory: The store directory.
+    :type directory: str.
+    :param regions: The regions of a new store.
+    :type regions: list.
+    :returns:  CohortCoverage.
+    """
+
+    if os.path.exists(os.path.join(directory, _REGIONS_FILE)):
+        return CohortCoverage(directory)
+
+    return CohortCoverage.create(directory, regions)
+
+
+def main(argv=None):
+    """Command line entry point: python -m ddb_ngsflow.coverage.cohort STORE [--last-runs N] [--min-fraction F]"""
+
+    parser = argparse.ArgumentParser(description="Report regions failing coverage across a cohort")
+    parser.add_argument('store', help="Cohort coverage store directory")
+    parser.add_argument('-r', '--last-runs', type=int, default=None, help="Only consider the most recent runs")
+    parser.add_argument('-f', '--min-fraction', type=float, default=0.1, help="Report regions failing in more "
+                                                                             "than this fraction of samples")
+    args = parser.parse_args(argv)
+
+    store = CohortCoverage(args.store)
+    rows = store.run_rows(args.last_runs)
+    depth = store.mean_depth(args.last_runs)
+    failing = store.failing_regions(args.min_fraction, args.last_runs)
+    sys.stdout.write("# {} samples of {} runs, {} regions failing in more than {:.0%} of samples\n".format(
+        rows.stop - rows.start, len(store.runs[-args.last_runs:] if args.last_runs else store.runs), len(failing),
+        args.min_fraction))
+    sys.stdout.write("region\tfailure_fraction\tmean_depth\n")
+    for region, fraction in failing:
+        sys.stdout.write("{}\t{:.3f}\t{:.1f}\n".format(region, fraction, depth[store.region_index[region]]))
+
+    return failing
+
+
+if __name__ == "__main__":
+    main()
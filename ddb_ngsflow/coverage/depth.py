@@ -0,0 +1,903 @@
+"""
+.. module:: depth
+   :platform: Unix, OSX
+   :synopsis: A module computing coverage in process from the alignments samtools streams out of a BAM: per-base
+   depth over target regions, stored as one memory mapped array per contig, region coverage and genome-wide depth.
+
+.. moduleauthor:: Daniel Gaston <daniel.gaston@dal.ca>
+
+A depth store is a directory holding, for every contig with targets, {contig}.npy with the depth of each targeted
+base, the targets of the contig laid end to end, and index.json with the merged target intervals and their offsets
+into that array. Depth is accumulated with difference arrays in target coordinates: an alignment block covering
+[start, end) adds one at the number of target bases before start and subtracts one at the number before end, so
+untargeted bases cost nothing.
+
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+
+import numpy
+
+from ddb_ngsflow import plan
+from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
+from ddb_ngsflow import scatter
+from ddb_ngsflow.utils import bgzf
+from ddb_ngsflow.utils import intervals
+from ddb_ngsflow.utils import utilities
+
+INDEX_FILE = "index.json"
+DEPTH_DTYPE = numpy.uint32
+
+# Reads that are unmapped, secondary, QC failures or duplicates are not counted, and neither are reads of mapping
+# quality 0, as in the default filter of sambamba depth
+DEFAULT_EXCLUDE_FLAGS = 0x704
+DEFAULT_MIN_MAPQ = 1
+
+# Alignment blocks are collected into batches of this many before they are added to the difference array
+BATCH_SIZE = 1000000
+
+# SAM text is parsed in blocks of at least this many bytes, so that the array operations of a parse are shared by
+# thousands of alignments
+PARSE_BLOCK_SIZE = 4 << 20
+
+_CIGAR = re.compile(r"(\d+)([MIDNSHP=X])")
+_REFERENCE_COVERED = frozenset("MD=X")
+_REFERENCE_SKIPPED = frozenset("N")
+
+# The same operation classes as lookup tables over CIGAR bytes
+_COVERED_OPS = numpy.zeros(256, dtype=bool)
+_COVERED_OPS[[ord(operation) for operation in _REFERENCE_COVERED]] = True
+_SKIPPED_OPS = numpy.zeros(256, dtype=bool)
+_SKIPPED_OPS[[ord(operation) for operation in _REFERENCE_SKIPPED]] = True
+
+
+def read_targets(bed_file):
+    """Read the target regions of a BED file, merged and sorted per contig
+
+    :param bed_file: The BED file name.
+    :type bed_file: str.
+    :returns:  tuple -- Arrays of starts and ends by contig, and the contigs in file order.
+    """
+
+    targets = intervals.read_bed(bed_file)
+
+    return dict((contig, targets.merged(contig)) for contig in targets.contigs), targets.contigs
+
+
+def _target_offsets(starts, ends):
+    lengths = ends - starts
+    offsets = numpy.zeros(len(starts) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+
+    return offsets
+
+
+def _bases_before(positions, starts, ends, offsets):
+    """Number of target bases before each position"""
+
+    index = numpy.searchsorted(starts, positions, side='right') - 1
+    inside = numpy.minimum(positions - starts[numpy.maximum(index, 0)], (ends - starts)[numpy.maximum(index, 0)])
+
+    return numpy.where(index < 0, 0, offsets[numpy.maximum(index, 0)] + inside)
+
+
+def alignment_blocks(pos, cigar):
+    """Reference intervals an alignment covers: aligned bases and deletions count, splice gaps do not
+
+    :param pos: 1-based leftmost position from SAM.
+    :type pos: int.
+    :param cigar: The CIGAR string.
+    :type cigar: str.
+    :returns:  list -- 0-based, half open (start, end) tuples.
+    """
+
+    blocks = list()
+    start = pos - 1
+    end = start
+    for length, operation in _CIGAR.findall(cigar):
+        if operation in _REFERENCE_COVERED:
+            end += int(length)
+        elif operation in _REFERENCE_SKIPPED:
+            if end > start:
+                blocks.append((start, end))
+            start = end = end + int(length)
+    if end > start:
+        blocks.append((start, end))
+
+    return blocks
+
+
+def _span_positions(starts, ends):
+    """Positions of the bytes of many spans [start, end), laid end to end, and the index of the span of each"""
+
+    lengths = ends - starts
+    owners = numpy.repeat(numpy.arange(len(starts)), lengths)
+    positions = numpy.arange(int(lengths.sum())) + numpy.repeat(starts - (numpy.cumsum(lengths) - lengths), lengths)
+
+    return positions, owners
+
+
+def _parse_integers(data, starts, ends):
+    """Decimal integers written in the spans [start, end) of a byte array"""
+
+    positions, owners = _span_positions(starts, ends)
+    digits = data[positions].astype(numpy.int64) - ord("0")
+    powers = numpy.power(10, numpy.repeat(ends, ends - starts) - positions - 1)
+
+    return numpy.bincount(owners, weights=digits * powers, minlength=len(starts)).astype(numpy.int64)
+
+
+def _changes(data, starts, ends):
+    """Indices of the spans whose bytes differ from those of the span before"""
+
+    lengths = ends - starts
+    changed = numpy.ones(len(starts), dtype=bool)
+    changed[1:] = lengths[1:] != lengths[:-1]
+    same_length = numpy.flatnonzero(~changed)
+    positions, owners = _span_positions(starts[same_length], ends[same_length])
+    shifts = numpy.repeat(starts[same_length] - starts[same_length - 1], lengths[same_length])
+    differing = data[positions] != data[positions - shifts]
+    changed[same_length[numpy.unique(owners[differing])]] = True
+
+    return numpy.flatnonzero(changed)
+
+
+def parse_alignments(data):
+    """Parse the alignments of complete SAM lines at once with array operations. Only RNAME, POS and CIGAR are read:
+    the tab and newline positions give their spans, integers are summed from their digits and the reference spans
+    of all CIGAR operations come from one cumulative sum, so no Python code runs per alignment. Header lines and
+    alignments without a CIGAR are skipped.
+
+    :param data: SAM text ending with a newline.
+    :type data: bytes.
+    :returns:  dict -- contigs, with the contig names and the first alignment of each run of alignments on the same
+               contig, positions, the 1-based POS of every alignment, read_starts, read_ends and reads, the reference
+               span of every alignment with aligned blocks and its index, and block_starts, block_ends and
+               block_reads, the aligned blocks with the index of their alignment. Spans are 0-based and half open.
+    :raises: ValueError
+    """
+
+    data = numpy.frombuffer(data, dtype=numpy.uint8)
+    line_ends = numpy.flatnonzero(data == ord("\n"))
+    line_starts = numpy.concatenate(([0], line_ends[:-1] + 1)).astype(numpy.int64)
+    records = line_ends > line_starts
+    records[records] = data[line_starts[records]] != ord("@")
+    line_starts, line_ends = line_starts[records], line_ends[records]
+
+    tabs = numpy.flatnonzero(data == ord("\t"))
+    first = numpy.searchsorted(tabs, line_starts)
+    if len(first) and (first[-1] + 5 >= len(tabs) or (tabs[first + 5] > line_ends).any()):
+        raise ValueError("SAM records need at least six fields")
+    cigar_starts, cigar_ends = tabs[first + 4] + 1, tabs[first + 5]
+    mapped = (cigar_ends - cigar_starts != 1) | (data[cigar_starts] != ord("*"))
+    first, cigar_starts, cigar_ends = first[mapped], cigar_starts[mapped], cigar_ends[mapped]
+
+    name_starts, name_ends = tabs[first + 1] + 1, tabs[first + 2]
+    runs = _changes(data, name_starts, name_ends)
+    contigs = [(data[name_starts[i]:name_ends[i]].tobytes().decode("utf-8"), int(i)) for i in runs]
+    positions = _parse_integers(data, tabs[first + 2] + 1, tabs[first + 3])
+
+    # Operation bytes and the digits before each of them
+    cigar_positions, cigar_owners = _span_positions(cigar_starts, cigar_ends)
+    characters = data[cigar_positions]
+    digits = (characters >= ord("0")) & (characters <= ord("9"))
+    operation_positions = cigar_positions[~digits]
+    operation_reads = cigar_owners[~digits]
+    operations = characters[~digits]
+    operation_index = numpy.searchsorted(operation_positions, cigar_positions[digits])
+    values = (characters[digits].astype(numpy.int64) - ord("0")) * \
+        numpy.power(10, operation_positions[operation_index] - cigar_positions[digits] - 1)
+    lengths = numpy.bincount(operation_index, weights=values, minlength=len(operations)).astype(numpy.int64)
+
+    # Reference offset of every operation within its alignment
+    covered = _COVERED_OPS[operations]
+    consumed = covered | _SKIPPED_OPS[operations]
+    advance = numpy.where(consumed, lengths, 0)
+    before = numpy.cumsum(advance) - advance
+    read_first = numpy.minimum(numpy.searchsorted(operation_reads, numpy.arange(len(positions))),
+                               max(len(operations) - 1, 0))
+    operation_starts = positions[operation_reads] - 1 + before - before[read_first[operation_reads]]
+
+    # A block is a run of covering operations of one alignment, ended by a splice gap or the end of the alignment
+    index = numpy.flatnonzero(consumed)
+    reads = operation_reads[index]
+    covering = covered[index]
+    opens = numpy.ones(len(index), dtype=bool)
+    opens[1:] = (reads[1:] != reads[:-1]) | ~covering[:-1]
+    closes = numpy.ones(len(index), dtype=bool)
+    closes[:-1] = (reads[:-1] != reads[1:]) | ~covering[1:]
+    block_starts = operation_starts[index][covering & opens]
+    block_ends = (operation_starts + lengths)[index][covering & closes]
+    block_reads = reads[covering & opens]
+    nonempty = block_ends > block_starts
+    block_starts, block_ends, block_reads = block_starts[nonempty], block_ends[nonempty], block_reads[nonempty]
+
+    last = numpy.ones(len(block_reads), dtype=bool)
+    last[:-1] = block_reads[1:] != block_reads[:-1]
+    opening = numpy.ones(len(block_reads), dtype=bool)
+    opening[1:] = last[:-1]
+
+    return {'contigs': contigs, 'positions': positions, 'reads': block_reads[opening],
+            'read_starts': block_starts[opening], 'read_ends': block_ends[last],
+            'block_starts': block_starts, 'block_ends': block_ends, 'block_reads': block_reads}
+
+
+class AlignmentStream(object):
+    """Consumer of SAM text, e.g. the output of samtools view, that parses every alignment once and hands batches
+    of them to any number of coverage metrics. The alignments must be sorted by coordinate. Metrics implement
+    add(contig, read_starts, read_ends, block_starts, block_ends), called with arrays of the reference spans of the
+    reads and of their aligned blocks, finish_contig(contig), close() and abort(), which removes what a metric
+    wrote when the alignments could not all be read. The text is collected into blocks of parse_size bytes that
+    parse_alignments parses at once. The seconds spent in each metric are kept in seconds."""
+
+    def __init__(self, metrics, batch_size=BATCH_SIZE, parse_size=PARSE_BLOCK_SIZE):
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.parse_size = parse_size
+        self.seconds = [0.0] * len(metrics)
+        self.pending = list()
+        self.pending_bytes = 0
+        self.contig = None
+        self.position = 0
+        self.seen = set()
+        self._clear()
+
+    def _clear(self):
+        self.read_starts = list()
+        self.read_ends = list()
+        self.block_starts = list()
+        self.block_ends = list()
+        self.blocks = 0
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+        if self.pending_bytes >= self.parse_size:
+            self._parse()
+
+    def _parse(self, final=False):
+        data = b"".join(self.pending)
+        end = len(data) if final else data.rfind(b"\n") + 1
+        self.pending = [data[end:]] if end < len(data) else list()
+        self.pending_bytes = len(data) - end
+        data = data[:end]
+        if not data:
+            return
+        if not data.endswith(b"\n"):
+            data += b"\n"
+
+        alignments = parse_alignments(data)
+        bounds = [first for contig, first in alignments['contigs']] + [len(alignments['positions'])]
+        for (contig, first), last in zip(alignments['contigs'], bounds[1:]):
+            self._add(contig, alignments, first, last)
+
+    def _add(self, contig, alignments, first, last):
+        """Add the alignments first to last of a parse, which are all on contig"""
+
+        if contig != self.contig:
+            if contig in self.seen:
+                raise ValueError("Alignments are not sorted by coordinate: {} seen again".format(contig))
+            self._flush()
+            self._finish_contig()
+            self.contig = contig
+            self.seen.add(contig)
+        positions = numpy.concatenate(([self.position], alignments['positions'][first:last]))
+        unsorted = numpy.flatnonzero(positions[1:] < positions[:-1])
+        if len(unsorted):
+            raise ValueError("Alignments are not sorted by coordinate at {}:{}".format(contig,
+                                                                                      positions[unsorted[0] + 1]))
+        self.position = int(positions[-1])
+
+        low, high = numpy.searchsorted(alignments['reads'], [first, last])
+        self.read_starts.append(alignments['read_starts'][low:high])
+        self.read_ends.append(alignments['read_ends'][low:high])
+        low, high = numpy.searchsorted(alignments['block_reads'], [first, last])
+        self.block_starts.append(alignments['block_starts'][low:high])
+        self.block_ends.append(alignments['block_ends'][low:high])
+        self.blocks += high - low
+        if self.blocks >= self.batch_size:
+            self._flush()
+
+    def _call(self, method, *args):
+        for i, metric in enumerate(self.metrics):
+            start = time.time()
+            getattr(metric, method)(*args)
+            self.seconds[i] += time.time() - start
+
+    def _flush(self):
+        read_starts = numpy.concatenate(self.read_starts) if self.read_starts else list()
+        if len(read_starts):
+            self._call('add', self.contig, read_starts, numpy.concatenate(self.read_ends),
+                       numpy.concatenate(self.block_starts), numpy.concatenate(self.block_ends))
+        self._clear()
+
+    def _finish_contig(self):
+        if self.contig is not None:
+            self._call('finish_contig', self.contig)
+        self.contig = None
+        self.position = 0
+
+    def close(self):
+        self._parse(final=True)
+        self._flush()
+        self._finish_contig()
+        self._call('close')
+
+    def abort(self):
+        """Remove the outputs of every metric after a failure, so that no partial output is taken for a finished
+        one"""
+
+        for metric in self.metrics:
+            metric.abort()
+
+
+class TargetDepth(object):
+    """Per-base depth over the targets, written as a depth store. Only one contig's difference array is held in
+    memory: a contig is finished and saved as soon as the next one starts. The depths of the last finished contig
+    are kept in last_depth for metrics derived from them."""
+
+    def __init__(self, directory, targets, contig_order):
+        self.directory = directory
+        self.targets = targets
+        self.contig_order = contig_order
+        self.offsets = dict((contig, _target_offsets(*targets[contig])) for contig in contig_order)
+        self.diff = None
+        self.last_contig = None
+        self.last_depth = None
+        self.finished = set()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def add(self, contig, read_starts, read_ends, block_starts, block_ends):
+        if contig not in self.targets:
+            return
+        starts, ends = self.targets[contig]
+        offsets = self.offsets[contig]
+        if self.diff is None:
+            self.diff = numpy.zeros(int(offsets[-1]) + 1, dtype=numpy.int64)
+        size = len(self.diff)
+        self.diff += numpy.bincount(_bases_before(block_starts, starts, ends, offsets), minlength=size)
+        self.diff -= numpy.bincount(_bases_before(block_ends, starts, ends, offsets), minlength=size)
+
+    def finish_contig(self, contig):
+        if contig not in self.targets:
+            return
+        if self.diff is None:
+            depth = numpy.zeros(int(self.offsets[contig][-1]), dtype=DEPTH_DTYPE)
+        else:
+            depth = numpy.cumsum(self.diff[:-1]).astype(DEPTH_DTYPE)
+        numpy.save(os.path.join(self.directory, "{}.npy".format(contig)), depth)
+        self.finished.add(contig)
+        self.diff = None
+        self.last_contig = contig
+        self.last_depth = depth
+
+    def close(self):
+        index = list()
+        for contig in self.contig_order:
+            starts, ends = self.targets[contig]
+            if contig not in self.finished:
+                numpy.save(os.path.join(self.directory, "{}.npy".format(contig)),
+                           numpy.zeros(int(self.offsets[contig][-1]), dtype=DEPTH_DTYPE))
+            index.append({'contig': contig, 'starts': starts.tolist(), 'ends': ends.tolist()})
+        with open(os.path.join(self.directory, INDEX_FILE), 'w') as outfile:
+            json.dump(index, outfile)
+
+    def abort(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class RegionCoverage(object):
+    """Read count, mean depth and the percentage of bases at or above each threshold of every target region, in
+    the layout of sambamba depth region. Depths come from the TargetDepth metric, which must come first in the
+    metrics of the stream. A read overlaps a region if it starts before the region ends and does not end before
+    it starts, so read counts are differences of binary searches over the sorted read starts and ends."""
+
+    def __init__(self, output, regions, target_depth, thresholds, sample):
+        self.output = output
+        self.regions = regions
+        self.target_depth = target_depth
+        self.thresholds = thresholds
+        self.sample = sample
+        self.read_counts = dict((contig, numpy.zeros(len(regions.starts[contig]), dtype=numpy.int64))
+                                for contig in regions.contigs)
+        self.lines = dict()
+
+    def add(self, contig, read_starts, read_ends, block_starts, block_ends):
+        if contig not in self.read_counts:
+            return
+        self.read_counts[contig] += (numpy.searchsorted(read_starts, self.regions.ends[contig], side='left') -
+                                     numpy.searchsorted(numpy.sort(read_ends), self.regions.starts[contig],
+                                                        side='right'))
+
+    def finish_contig(self, contig):
+        if contig not in self.read_counts:
+            return
+        starts, ends = self.target_depth.targets[contig]
+        offsets = self.target_depth.offsets[contig]
+        depth = self.target_depth.last_depth if self.target_depth.last_contig == contig else None
+        if depth is None:
+            depth = numpy.zeros(int(offsets[-1]), dtype=DEPTH_DTYPE)
+
+        low = _bases_before(self.regions.starts[contig], starts, ends, offsets)
+        high = _bases_before(self.regions.ends[contig], starts, ends, offsets)
+        lengths = numpy.maximum(high - low, 1).astype(float)
+        totals = numpy.zeros(len(depth) + 1, dtype=numpy.float64)
+        numpy.cumsum(depth, out=totals[1:])
+        columns = [(totals[high] - totals[low]) / lengths]
+        for threshold in self.thresholds:
+            covered = numpy.zeros(len(depth) + 1, dtype=numpy.int64)
+            numpy.cumsum(depth >= threshold, out=covered[1:])
+            columns.append(100.0 * (covered[high] - covered[low]) / lengths)
+
+        lines = list()
+        for i, fields in enumerate(self.regions.fields[contig]):
+            lines.append("{}\t{}\t{}\t{}\t{}\t{:.4g}{}\t{}\n".format(
+                contig, fields[1], fields[2], fields[3] if len(fields) > 3 else ".", self.read_counts[contig][i],
+                columns[0][i], "".join("\t{:.4g}".format(column[i]) for column in columns[1:]), self.sample))
+        self.lines[contig] = lines
+
+    def close(self):
+        for contig in self.regions.contigs:
+            if contig not in self.lines:
+                self.finish_contig(contig)
+        with open(self.output, 'w') as outfile:
+            outfile.write("# chrom\tchromStart\tchromEnd\tF4\treadCount\tmeanCoverage{}\tsampleName\n".format(
+                "".join("\tpercentage{}".format(threshold) for threshold in self.thresholds)))
+            for contig in self.regions.contigs:
+                outfile.writelines(self.lines[contig])
+
+    def abort(self):
+        if os.path.exists(self.output):
+            os.remove(self.output)
+
+
+class CoverageRunWriter(object):
+    """Writes depth runs as a bgzipped, tabix indexed bedGraph (contig, start, end, depth). Adjacent runs of equal
+    depth are merged as they arrive, so callers may pass one run per base."""
+
+    def __init__(self, output):
+        self.output = bgzf.IndexedBedWriter(output)
+        self.held = None
+
+    def write_runs(self, contig, starts, ends, depths):
+        if not len(starts):
+            return
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        depths = numpy.asarray(depths, dtype=numpy.int64)
+        if self.held is not None and self.held[0] == contig:
+            starts = numpy.concatenate(([self.held[1]], starts))
+            ends = numpy.concatenate(([self.held[2]], ends))
+            depths = numpy.concatenate(([self.held[3]], depths))
+        else:
+            self._write_held()
+
+        first = numpy.ones(len(starts), dtype=bool)
+        first[1:] = (depths[1:] != depths[:-1]) | (starts[1:] != ends[:-1])
+        last = numpy.append(numpy.flatnonzero(first)[1:] - 1, len(starts) - 1)
+        starts, ends, depths = starts[first], ends[last], depths[first]
+        for start, end, depth in zip(starts[:-1].tolist(), ends[:-1].tolist(), depths[:-1].tolist()):
+            self.output.write_record(contig, start, end, "{}\t{}\t{}\t{}\n".format(contig, start, end, depth))
+        self.held = (contig, int(starts[-1]), int(ends[-1]), int(depths[-1]))
+
+    def _write_held(self):
+        if self.held is not None:
+            contig, start, end, depth = self.held
+            self.output.write_record(contig, start, end, "{}\t{}\t{}\t{}\n".format(contig, start, end, depth))
+            self.held = None
+
+    def close(self):
+        self._write_held()
+        self.output.close()
+
+    def abort(self):
+        self.held = None
+        self.output.abort()
+
+
+class SambambaBaseRuns(object):
+    """Consumer of sambamba depth base output, e.g. its stdout, passing the COV column of every base on to a
+    CoverageRunWriter as runs. Complete lines of each chunk are split into columns in one go and positions and
+    depths converted as arrays."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = b""
+        self.columns = None
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        data = self.pending + data
+        end = data.rfind(b"\n") + 1
+        self.pending = data[end:]
+        self._add_lines(data[:end])
+
+    def _add_lines(self, data):
+        while data.startswith((b"#", b"REF")):
+            header, data = data.split(b"\n", 1) if b"\n" in data else (data, b"")
+            self.columns = len(header.lstrip(b"#").split(b"\t"))
+        if not data.strip():
+            return
+        if self.columns is None:
+            self.columns = len(data.split(b"\n", 1)[0].split(b"\t"))
+        tokens = data.replace(b"\n", b"\t").rstrip(b"\t").split(b"\t")
+        contigs = tokens[0::self.columns]
+        positions = numpy.array(tokens[1::self.columns]).astype(numpy.int64)
+        depths = numpy.array(tokens[2::self.columns]).astype(numpy.int64)
+
+        boundaries = [0] + [i for i in range(1, len(contigs)) if contigs[i] != contigs[i - 1]] + [len(contigs)]
+        for first, last in zip(boundaries[:-1], boundaries[1:]):
+            self.writer.write_runs(contigs[first].decode("utf-8"), positions[first:last],
+                                   positions[first:last] + 1, depths[first:last])
+
+    def close(self):
+        if self.pending:
+            self._add_lines(self.pending + b"\n")
+            self.pending = b""
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+
+class CoverageRuns(object):
+    """Random access to a bgzipped, tabix indexed depth bedGraph, as written by CoverageRunWriter. Only the BGZF
+    blocks the index lists for a region are read."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = bgzf.read_tabix_index("{}.tbi".format(filename))
+
+    def runs(self, contig, start, end):
+        """Runs overlapping a region, clipped to it
+
+        :param contig: Contig name.
+        :type contig: str.
+        :param start: 0-based start.
+        :type start: int.
+        :param end: End, exclusive.
+        :type end: int.
+        :returns:  tuple -- Arrays of run starts, ends and depths.
+        """
+
+        fields = list()
+        with open(self.filename, 'rb') as handle:
+            for chunk_start, chunk_end in bgzf.query_chunks(self.index, contig, start, end):
+                for line in bgzf.read_chunk(handle, chunk_start, chunk_end).decode("utf-8").splitlines():
+                    record = line.split("\t")
+                    if record[0] == contig and int(record[1]) < end and int(record[2]) > start:
+                        fields.append((max(int(record[1]), start), min(int(record[2]), end), int(record[3])))
+        fields = numpy.array(sorted(set(fields)), dtype=numpy.int64).reshape(-1, 3)
+
+        return fields[:, 0], fields[:, 1], fields[:, 2]
+
+    def depth(self, contig, start, end):
+        """Per-base depth of a region, 0 for bases without a run
+
+        :param contig: Contig name.
+        :type contig: str.
+        :param start: 0-based start.
+        :type start: int.
+        :param end: End, exclusive.
+        :type end: int.
+        :returns:  numpy.ndarray -- The depths.
+        """
+
+        starts, ends, depths = self.runs(contig, start, end)
+        result = numpy.zeros(end - start, dtype=DEPTH_DTYPE)
+        for run_start, run_end, run_depth in zip(starts, ends, depths):
+            result[run_start - start:run_end - start] = run_depth
+
+        return result
+
+
+class GenomeDepth(object):
+    """Depth over whole contigs as runs of equal depth, including runs of zero depth. The runs are found by
+    sweeping over the block start and end events up to the start of the last read seen, beyond which later reads
+    can still add depth, so memory depends on the reads spanning that frontier and not on the contig length.
+    Contigs without reads are written as one zero depth run at close."""
+
+    def __init__(self, writer, contigs):
+        """
+        :param writer: Receives the runs through write_runs(contig, starts, ends, depths) and close().
+        :param contigs: Tuples of contig name and length in reference order, as from scatter.contig_order.
+        :type contigs: list.
+        """
+
+        self.writer = writer
+        self.contigs = contigs
+        self.contig_lengths = dict(contigs)
+        self.finished = set()
+        self._reset()
+
+    def _reset(self):
+        self.frontier = 0
+        self.active = numpy.zeros(0, dtype=numpy.int64)
+        self.pending_starts = numpy.zeros(0, dtype=numpy.int64)
+        self.pending_ends = numpy.zeros(0, dtype=numpy.int64)
+        self.held = None
+
+    def add(self, contig, read_starts, read_ends, block_starts, block_ends):
+        self.pending_starts = numpy.concatenate((self.pending_starts, block_starts))
+        self.pending_ends = numpy.concatenate((self.pending_ends, block_ends))
+        self._sweep(contig, int(read_starts[-1]))
+
+    def _sweep(self, contig, frontier):
+        if frontier <= self.frontier:
+            return
+        opened = self.pending_starts < frontier
+        opened_ends = self.pending_ends[opened]
+        closing = numpy.concatenate((self.active[self.active < frontier], opened_ends[opened_ends < frontier]))
+        positions = numpy.concatenate((self.pending_starts[opened], closing))
+        deltas = numpy.concatenate((numpy.ones(opened.sum(), dtype=numpy.int64),
+                                    -numpy.ones(len(closing), dtype=numpy.int64)))
+        events, inverse = numpy.unique(positions, return_inverse=True)
+        changes = numpy.bincount(inverse, weights=deltas, minlength=len(events)).astype(numpy.int64)
+        events, changes = events[changes != 0], changes[changes != 0]
+
+        depths = numpy.concatenate(([len(self.active)], len(self.active) + numpy.cumsum(changes)))
+        starts = numpy.concatenate(([self.frontier], events))
+        ends = numpy.concatenate((events, [frontier]))
+        keep = ends > starts
+        self._emit(contig, starts[keep], ends[keep], depths[keep])
+
+        carried = numpy.concatenate((self.active, opened_ends))
+        self.active = carried[carried > frontier]
+        self.pending_starts = self.pending_starts[~opened]
+        self.pending_ends = self.pending_ends[~opened]
+        self.frontier = frontier
+
+    def _emit(self, contig, starts, ends, depths):
+        """Write runs, merging a run with the next when their depths are equal"""
+
+        if self.held is not None:
+            starts = numpy.concatenate(([self.held[0]], starts))
+            ends = numpy.concatenate(([self.held[1]], ends))
+            depths = numpy.concatenate(([self.held[2]], depths))
+        if not len(starts):
+            return
+        first = numpy.ones(len(starts), dtype=bool)
+        first[1:] = depths[1:] != depths[:-1]
+        starts = starts[first]
+        depths = depths[first]
+        ends = numpy.append(starts[1:], ends[-1])
+        self.writer.write_runs(contig, starts[:-1], ends[:-1], depths[:-1])
+        self.held = (starts[-1], ends[-1], depths[-1])
+
+    def finish_contig(self, contig):
+        ends = numpy.concatenate((self.active, self.pending_ends))
+        self._sweep(contig, max([self.contig_lengths.get(contig, 0)] + ([int(ends.max())] if len(ends) else [0])))
+        if self.held is not None:
+            self.writer.write_runs(contig, numpy.array([self.held[0]]), numpy.array([self.held[1]]),
+                                   numpy.array([self.held[2]]))
+        self.finished.add(contig)
+        self._reset()
+
+    def close(self):
+        for contig, length in self.contigs:
+            if contig not in self.finished and length:
+                self.writer.write_runs(contig, numpy.array([0]), numpy.array([length]), numpy.array([0]))
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+
+class DepthStore(object):
+    """Read access to a depth store. Depth arrays are memory mapped when a contig is first queried, so a query
+    reads only the pages of the bases it returns."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.contigs = list()
+        self.targets = dict()
+        with open(os.path.join(directory, INDEX_FILE), 'r') as index:
+            for entry in json.load(index):
+                starts = numpy.array(entry['starts'], dtype=numpy.int64)
+                ends = numpy.array(entry['ends'], dtype=numpy.int64)
+                self.contigs.append(entry['contig'])
+                self.targets[entry['contig']] = (starts, ends, _target_offsets(starts, ends))
+        self.arrays = dict()
+
+    def _depth_array(self, contig):
+        if contig not in self.arrays:
+            self.arrays[contig] = numpy.load(os.path.join(self.directory, "{}.npy".format(contig)), mmap_mode='r')
+
+        return self.arrays[contig]
+
+    def query(self, contig, start, end):
+        """Depth of the targeted bases in a region
+
+        :param contig: Contig name.
+        :type contig: str.
+        :param start: 0-based start.
+        :type start: int.
+        :param end: End, exclusive.
+        :type end: int.
+        :returns:  tuple -- Arrays of the 0-based positions of targeted bases in the region and their depths.
+        """
+
+        if contig not in self.targets:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=DEPTH_DTYPE)
+
+        starts, ends, offsets = self.targets[contig]
+        first = numpy.searchsorted(ends, start, side='right')
+        last = numpy.searchsorted(starts, end, side='left')
+        if first >= last:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=DEPTH_DTYPE)
+
+        clipped_starts = numpy.maximum(starts[first:last], start)
+        clipped_ends = numpy.minimum(ends[first:last], end)
+        positions = numpy.concatenate([numpy.arange(s, e) for s, e in zip(clipped_starts, clipped_ends)])
+        low, high = _bases_before(numpy.array([clipped_starts[0], clipped_ends[-1]]), starts, ends, offsets)
+        depths = numpy.asarray(self._depth_array(contig)[low:high])
+
+        return positions, depths
+
+    def region_depth(self, contig, start, end):
+        """Depth of every base of a region that lies entirely within the targets
+
+        :param contig: Contig name.
+        :type contig: str.
+        :param start: 0-based start.
+        :type start: int.
+        :param end: End, exclusive.
+        :type end: int.
+        :returns:  numpy.ndarray -- The depths.
+        :raises: ValueError
+        """
+
+        positions, depths = self.query(contig, start, end)
+        if len(positions) != end - start:
+            raise ValueError("{}:{}-{} is not entirely within the targets of {}".format(contig, start, end,
+                                                                                       self.directory))
+
+        return depths
+
+    def regions(self):
+        """Iterate over the merged targets as tuples of contig, start, end and depths"""
+
+        for contig in self.contigs:
+            starts, ends, offsets = self.targets[contig]
+            depth = self._depth_array(contig)
+            for i in range(len(starts)):
+                yield contig, int(starts[i]), int(ends[i]), depth[offsets[i]:offsets[i + 1]]
+
+
+def _view_command(config, input_bam, regions=None):
+    command = ["{}".format(config['samtools']['bin']),
+               "view",
+               "-@",
+               "{}".format(config['samtools'].get('num_cores', 1)),
+               "-F",
+               "{}".format(config.get('coverage_exclude_flags', DEFAULT_EXCLUDE_FLAGS)),
+               "-q",
+               "{}".format(config.get('coverage_min_mapq', DEFAULT_MIN_MAPQ))]
+    if regions:
+        command.extend(["-L", "{}".format(regions)])
+    command.append("{}".format(input_bam))
+
+    return command
+
+
+def _output_bytes(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+@resources.declare(cores=resources.tool_cores('samtools'), disk=resources.input_disk(input_factor=0.5))
+def native_base_coverage(job, config, name, samples, input_bam):
+    """Compute per-base depth over the targeted regions in process, as a depth store in place of the per-base text
+    of bedtools_coverage_per_site or sambamba_base_coverage. samtools decodes the BAM, restricted to reads
+    overlapping the targets, and the alignments are streamed into a TargetDepth metric.
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param name: sample/library name.
+    :type name: str.
+    :param samples: The samples configuration dictionary
+    :type samples: dict
+    :param input_bam: The input_bam file name to process.
+    :type input_bam: str.
+    :returns:  str -- The depth store directory.
+    """
+
+    output = "{}.depth".format(name)
+    logfile = "{}.native_base_coverage.log".format(name)
+    regions = samples[name]['regions']
+    command = _view_command(config, input_bam, regions)
+
+    job.fileStore.logToMaster("Native Coverage Command: {}\n".format(command))
+    stream = None
+    if not plan.planning():
+        targets, contig_order = read_targets(regions)
+        stream = AlignmentStream([TargetDepth(output, targets, contig_order)])
+    try:
+        pipeline.run_pipeline([command], logfile, stdout=stream, inputs=[regions, input_bam], outputs=[output])
+        if stream is not None:
+            stream.close()
+    except Exception:
+        if stream is not None:
+            stream.abort()
+        raise
+
+    return output
+
+
+@resources.declare(cores=resources.tool_cores('samtools'), memory=resources.tool_memory('samtools', "4G"),
+                   disk=resources.input_disk(input_factor=0.5))
+def coverage_metrics(job, config, name, samples, input_bam):
+    """Compute region coverage, per-base depth over the targets and genome-wide depth in a single pass over a BAM,
+    in place of sambamba_region_coverage, sambamba_base_coverage and sambamba_total_base_coverage, which each
+    decode the whole BAM. samtools decodes it once and every alignment is parsed once for all three metrics.
+    Region coverage is reported for each threshold of utilities.coverage_thresholds, in the sambamba depth region
+    layout. Each output gets its own logfile and telemetry record, besides those of the decoding step.
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param name: sample/library name.
+    :type name: str.
+    :param samples: The samples configuration dictionary
+    :type samples: dict
+    :param input_bam: The input_bam file name to process.
+    :type input_bam: str.
+    :returns:  dict -- Output names of the region, base and total_base metrics.
+    """
+
+    regions = samples[name]['regions']
+    outputs = {'region': "{}.region_coverage.bed".format(name),
+               'base': "{}.depth".format(name),
+               'total_base': "{}.total_base_coverage.bedgraph.gz".format(name)}
+    logfiles = dict((metric, "{}.{}_coverage.log".format(name, metric)) for metric in outputs)
+    command = _view_command(config, input_bam)
+
+    job.fileStore.logToMaster("Coverage Metrics Command: {}\n".format(command))
+    if plan.planning():
+        pipeline.run_pipeline([command], "{}.coverage_decode.log".format(name), inputs=[regions, input_bam],
+                              outputs=sorted(outputs.values()))
+        return outputs
+
+    thresholds = utilities.coverage_thresholds(config)
+    region_index = intervals.read_bed(regions)
+    targets = dict((contig, region_index.merged(contig)) for contig in region_index.contigs)
+    target_depth = TargetDepth(outputs['base'], targets, region_index.contigs)
+    metrics = [('base', target_depth),
+               ('region', RegionCoverage(outputs['region'], region_index, target_depth, thresholds, name)),
+               ('total_base', GenomeDepth(CoverageRunWriter(outputs['total_base']),
+                                          scatter.contig_order(config['reference'])))]
+
+    start = time.time()
+    stream = AlignmentStream([metric for label, metric in metrics])
+    try:
+        pipeline.run_pipeline([command], "{}.coverage_decode.log".format(name), stdout=stream, inputs=[input_bam],
+                              outputs=list())
+        stream.close()
+    except Exception:
+        stream.abort()
+        raise
+    end = time.time()
+
+    # The metrics share the pass, so start, end and wall time are those of the pass and metric_time is the part of
+    # it spent in the metric
+    for (metric, instance), seconds in zip(metrics, stream.seconds):
+        with open(logfiles[metric], 'a') as log:
+            log.write("{} coverage of {} written to {} in {:.1f}s of a single pass over the BAM taking "
+                      "{:.1f}s\n".format(metric, input_bam, outputs[metric], seconds, end - start))
+        pipeline.write_telemetry(logfiles[metric], {'command': "python depth.coverage_metrics {}".format(metric),
+                                                    'logfile': logfiles[metric], 'start': start, 'end': end,
+                                                    'wall_time': end - start, 'metric_time': seconds,
+                                                    'cached': False, 'returncode': 0,
+                                                    'inputs': [input_bam], 'outputs': [outputs[metric]],
+                                                    'input_bytes': _output_bytes(input_bam),
+                                                    'output_bytes': _output_bytes(outputs[metric])})
+
+    return outputs
@@ -11,9 +11,14 @@
 import sys
 import csv
 from collections import defaultdict
+from ddb_ngsflow import plan
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
+from ddb_ngsflow.coverage import depth
 
 
+@resources.declare(cores=resources.tool_cores('sambamba'), memory=resources.tool_memory('sambamba'),
+                   disk=resources.input_disk())
 def sambamba_region_coverage(job, config, name, samples, input_bam):
     """Run SamBambam to calculate the coverage of targeted regions
     :param config: The configuration dictionary.
@@ -28,10 +33,11 @@ def sambamba_region_coverage(job, config, name, samples, input_bam):
     """
 
     output = "{}.sambamba_regioncoverage.bed".format(name)
-    logfile = "{}.sambamba_coverage.log".format(name)
+    logfile = "{}.sambamba_region_coverage.log".format(name)
 
     command = ["{}".format(config['sambamba']['bin']),
-               "depth region",
+               "depth",
+               "region",
                "-L",
                "{}".format(samples[name]['regions']),
                "-t",
@@ -40,16 +46,16 @@ def sambamba_region_coverage(job, config, name, samples, input_bam):
                "{}".format(config['coverage_threshold']),
                "-T",
                "{}".format(config['coverage_threshold2']),
-               "{}".format(input_bam),
-               ">",
-               "{}".format(output)]
+               "{}".format(input_bam)]
 
     job.fileStore.logToMaster("SamBamba Coverage Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, stdout=output)
 
     return output
 
 
+@resources.declare(cores=resources.tool_cores('sambamba'), memory=resources.tool_memory('sambamba'),
+                   disk=resources.input_disk())
 def sambamba_base_coverage(job, config, name, samples, input_bam):
     """Run SamBambam to calculate the coverage of targeted regions
     :param config: The configuration dictionary.
@@ -60,29 +66,39 @@ def sambamba_base_coverage(job, config, name, samples, input_bam):
     :type samples: dict
     :param samples: The samples configuration dictionary
     :type input_bam: str.
-    :returns:  str -- The output BED file name.
+    :returns:  str -- The output bgzipped, tabix indexed bedGraph name.
     """
 
-    output = "{}.sambamba_base_coverage.bed".format(name)
-    logfile = "{}.sambamba_coverage.log".format(name)
+    output = "{}.sambamba_base_coverage.bed.gz".format(name)
+    logfile = "{}.sambamba_base_coverage.log".format(name)
 
     command = ["{}".format(config['sambamba']['bin']),
-               "depth base",
+               "depth",
+               "base",
                "-L",
                "{}".format(samples[name]['regions']),
                "-z",
                "-t",
                "{}".format(config['sambamba']['num_cores']),
-               "{}".format(input_bam),
-               ">",
-               "{}".format(output)]
+               "{}".format(input_bam)]
 
     job.fileStore.logToMaster("SamBamba Coverage Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    runs = None if plan.planning() else depth.SambambaBaseRuns(depth.CoverageRunWriter(output))
+    try:
+        pipeline.run_pipeline([command], logfile, stdout=runs, inputs=[samples[name]['regions'], input_bam],
+                              outputs=[output, "{}.tbi".format(output)])
+        if runs is not None:
+            runs.close()
+    except Exception:
+        if runs is not None:
+            runs.abort()
+        raise
 
     return output
 
 
+@resources.declare(cores=resources.tool_cores('sambamba'), memory=resources.tool_memory('sambamba'),
+                   disk=resources.input_disk())
 def sambamba_total_base_coverage(job, config, name, samples, input_bam):
     """Run SamBambam to calculate the coverage of targeted regions
     :param config: The configuration dictionary.
@@ -93,22 +109,30 @@ def sambamba_total_base_coverage(job, config, name, samples, input_bam):
     :type samples: dict
     :param samples: The samples configuration dictionary
     :type input_bam: str.
-    :returns:  str -- The output BED file name.
+    :returns:  str -- The output bgzipped, tabix indexed bedGraph name.
     """
 
-    output = "{}.sambamba_total_base_coverage.bed".format(name)
-    logfile = "{}.sambamba_coverage.log".format(name)
+    output = "{}.sambamba_total_base_coverage.bed.gz".format(name)
+    logfile = "{}.sambamba_total_base_coverage.log".format(name)
 
     command = ["{}".format(config['sambamba']['bin']),
-               "depth base",
+               "depth",
+               "base",
                "-z",
                "-t",
                "{}".format(config['sambamba']['num_cores']),
-               "{}".format(input_bam),
-               ">",
-               "{}".format(output)]
+               "{}".format(input_bam)]
 
     job.fileStore.logToMaster("SamBamba Coverage Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    runs = None if plan.planning() else depth.SambambaBaseRuns(depth.CoverageRunWriter(output))
+    try:
+        pipeline.run_pipeline([command], logfile, stdout=runs, inputs=[input_bam],
+                              outputs=[output, "{}.tbi".format(output)])
+        if runs is not None:
+            runs.close()
+    except Exception:
+        if runs is not None:
+            runs.abort()
+        raise
 
     return output
@@ -8,8 +8,10 @@
 """
 
 import pipeline
+import resources
 
 
+@resources.declare(memory=resources.tool_memory('gatk', "4G"), disk=resources.input_disk())
 def diagnosetargets(job, config, name, samples, input_bam):
     """Run GATK's DiagnoseTargets against the supplied region
     :param config: The configuration dictionary.
@@ -50,11 +52,12 @@ def diagnosetargets(job, config, name, samples, input_bam):
                "{}".format(missing_intervals)]
 
     job.fileStore.logToMaster("GATK DiagnoseTargets Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return diagnose_targets_vcf
 
 
+@resources.declare(memory=resources.tool_memory('gatk', "4G"), disk=resources.input_disk())
 def diagnose_pooled_targets(job, config, name, regions, samples, input_bam1, input_bam2):
     """Run GATK's DiagnoseTargets against the supplied region
     :param config: The configuration dictionary.
@@ -99,11 +102,13 @@ def diagnose_pooled_targets(job, config, name, regions, samples, input_bam1, inp
                "{}".format(missing_intervals)]
 
     job.fileStore.logToMaster("GATK DiagnoseTargets Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return diagnose_targets_vcf
 
 
+@resources.declare(cores=resources.tool_cores('gatk-annotate'), memory=resources.tool_memory('gatk-annotate', "8G"),
+                   disk=resources.input_disk())
 def annotate_vcf(job, config, name, input_vcf, input_bam):
     """Run GATK's VariantAnnotation on the specified VCF
     :param config: The configuration dictionary.
@@ -141,11 +146,12 @@ def annotate_vcf(job, config, name, input_vcf, input_bam):
                           "{}".format(output_vcf)]
 
     job.fileStore.logToMaster("GATK VariantAnnotator Command: {}\n".format(annotation_command))
-    pipeline.run_and_log_command(" ".join(annotation_command), annotation_logfile)
+    pipeline.run_pipeline([annotation_command], annotation_logfile)
 
     return output_vcf
 
 
+@resources.declare(memory=resources.tool_memory('gatk-filter', "4G"), disk=resources.input_disk())
 def filter_variants(job, config, name, input_vcf):
     """Run GATK's VariantFilter on the specified VCF
     :param config: The configuration dictionary.
@@ -166,32 +172,33 @@ def filter_variants(job, config, name, input_vcf):
                       "-R",
                       "{}".format(config['reference']),
                       "--filterExpression",
-                      "'MQ0 > {}'".format(config['mq0_threshold']),
+                      "MQ0 > {}".format(config['mq0_threshold']),
                       "--filterName",
-                      "'HighMQ0'",
+                      "HighMQ0",
                       "--filterExpression",
-                      "'DP < {}'".format(config['coverage_threshold']),
+                      "DP < {}".format(config['coverage_threshold']),
                       "--filterName",
-                      "'LowDepth'",
+                      "LowDepth",
                       "--filterExpression",
-                      "'QUAL < {}'".format(config['var_qual_threshold']),
+                      "QUAL < {}".format(config['var_qual_threshold']),
                       "--filterName",
-                      "'LowQual'",
+                      "LowQual",
                       "--filterExpression",
-                      "'MQ < {}'".format(config['map_qual_threshold']),
+                      "MQ < {}".format(config['map_qual_threshold']),
                       "--filterName",
-                      "'LowMappingQual'",
+                      "LowMappingQual",
                       "--variant",
                       "{}".format(input_vcf),
                       "-o",
                       "{}".format(output_vcf)]
 
     job.fileStore.logToMaster("GATK VariantFiltration Command: {}\n".format(filter_command))
-    pipeline.run_and_log_command(" ".join(filter_command), filter_log)
+    pipeline.run_pipeline([filter_command], filter_log)
 
     return output_vcf
 
 
+@resources.declare(memory=resources.tool_memory('picard-dedup', "8G"), disk=resources.input_disk(3))
 def mark_duplicates(job, config, name, input_bam):
     """Run Picard MarkDuplicates
     :param config: The configuration dictionary.
@@ -217,11 +224,12 @@ def mark_duplicates(job, config, name, input_bam):
                "OUTPUT={}".format(output_bam)]
 
     job.fileStore.logToMaster("Picard MarkDuplicates Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return output_bam
 
 
+@resources.declare(memory=resources.tool_memory('picard-add', "4G"), disk=resources.input_disk(3))
 def add_or_replace_readgroups(job, config, name, input_bam):
     """Run Picard's AddOrReplaceReadGroups on the specified BAM
     :param config: The configuration dictionary.
@@ -254,14 +262,16 @@ def add_or_replace_readgroups(job, config, name, input_bam):
                 "INPUT={}".format(output_bam)]
 
     job.fileStore.logToMaster("GATK AddOrReplaceReadGroupsCommand Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     job.fileStore.logToMaster("GATK BuildBamIndex Command: {}\n".format(command2))
-    pipeline.run_and_log_command(" ".join(command2), index_log)
+    pipeline.run_pipeline([command2], index_log)
 
     return output_bam
 
 
+@resources.declare(cores=resources.tool_cores('gatk-realign'), memory=resources.tool_memory('gatk-realign', "8G"),
+                   disk=resources.input_disk())
 def realign_target_creator(job, config, name, input_bam):
     """Run GATK TargetCreator on the specified BAM to identify targets for realignment
     :param config: The configuration dictionary.
@@ -294,11 +304,12 @@ def realign_target_creator(job, config, name, input_bam):
                ]
 
     job.fileStore.logToMaster("GATK RealignerTargetCreator Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), targets_log)
+    pipeline.run_pipeline([command], targets_log)
 
     return targets
 
 
+@resources.declare(memory=resources.tool_memory('gatk-realign', "8G"), disk=resources.input_disk(3))
 def realign_indels(job, config, name, input_bam, targets):
     """Run GATK Indel Realignment on the specified BAM
     :param config: The configuration dictionary.
@@ -334,11 +345,13 @@ def realign_indels(job, config, name, input_bam, targets):
                "{}".format(output_bam)]
 
     job.fileStore.logToMaster("GATK IndelRealigner Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), realign_log)
+    pipeline.run_pipeline([command], realign_log)
 
     return output_bam
 
 
+@resources.declare(cores=resources.tool_cores('gatk-recal'), memory=resources.tool_memory('gatk-recal', "8G"),
+                   disk=resources.input_disk(3))
 def recalibrator(job, config, name, input_bam):
     """Run GATK Recalibrator on the specified BAM
 
@@ -394,17 +407,18 @@ def recalibrator(job, config, name, input_bam):
                   "{}.recalibrated.sorted.bam.bai".format(name)]
 
     job.fileStore.logToMaster("GATK BaseRecalibrator Command: {}\n".format(recal_commands))
-    pipeline.run_and_log_command(" ".join(recal_commands), recal_log)
+    pipeline.run_pipeline([recal_commands], recal_log)
 
     job.fileStore.logToMaster("GATK PrintReads Command: {}\n".format(print_reads_command))
-    pipeline.run_and_log_command(" ".join(print_reads_command), print_log)
+    pipeline.run_pipeline([print_reads_command], print_log)
 
     job.fileStore.logToMaster("GATK Copy Command: {}\n".format(cp_command))
-    pipeline.run_and_log_command(" ".join(cp_command), cp_log)
+    pipeline.run_pipeline([cp_command], cp_log)
 
     return output_bam
 
 
+@resources.declare(memory=resources.tool_memory('picard-merge', "4G"), disk=resources.input_disk(3))
 def merge_sam(job, config, name, input_bams):
     """Run Picard MergeSamFiles
     :param config: The configuration dictionary.
@@ -419,15 +433,13 @@ def merge_sam(job, config, name, input_bams):
     output_sam = "{}.merged.sorted.bam".format(name)
     logfile = "{}.mergesam.log".format(name)
 
-    bam_string = " I=".join(input_bams)
-
     command = ["{}".format(config['picard-merge']['bin']),
-               "MergeSamFiles",
-               "I={}".format(bam_string),
-               "O={}".format(output_sam),
-               "USE_THREADING=True"]
+               "MergeSamFiles"]
+    command.extend(["I={}".format(bam) for bam in input_bams])
+    command.extend(["O={}".format(output_sam),
+                    "USE_THREADING=True"])
 
     job.fileStore.logToMaster("Picard MergeSam Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return output_sam
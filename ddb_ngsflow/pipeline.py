@@ -8,32 +8,887 @@
 
 """
 
+import os
 import sys
+import json
+import time
+import shlex
+import errno
+import shutil
+import socket
+import fcntl
+import signal
+import hashlib
+import resource
+import contextlib
+import threading
 import subprocess as sub
+from collections import deque
 
+import psutil
 
-def run_and_log_command(command, logfile):
+from ddb_ngsflow import plan
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# Setting this environment variable (or passing cache_dir) enables the content-addressed step cache
+CACHE_ENV_VAR = "DDB_NGSFLOW_CACHE_DIR"
+
+# Shell tokens that separate pipeline stages or redirect output and are never file names themselves
+_SHELL_OPERATORS = ("|", ">", ">>", "<", "2>", "&&", ";")
+_REDIRECT_OPERATORS = (">", ">>")
+
+# Kernel buffer requested for the pipes between run_pipeline stages. 1 MiB is the default Linux pipe-max-size and
+# lets a fast producer such as bwa run ahead of samtools instead of blocking on a 64 KiB pipe.
+DEFAULT_PIPE_BUFFER = 1 << 20
+_F_SETPIPE_SZ = 1031
+
+# Child output is moved through the worker in chunks of this size, and only the last lines of stderr are kept in
+# memory for error messages, so worker memory stays flat however much a tool writes
+STREAM_CHUNK_SIZE = 1 << 16
+STDERR_TAIL_LINES = 20
+_STDERR_LINE_LIMIT = 1024
+
+
+def run_and_log_command(command, logfile, stdout=None, cache_dir=None, inputs=None, outputs=None):
     """This function uses the python subprocess method to run the specified command and writes all error to the
-    specified logfile
+    specified logfile. Standard output of the command is streamed to a file or a consumer, or discarded, and never
+    held in memory. If a step cache is enabled, either through cache_dir or the DDB_NGSFLOW_CACHE_DIR environment
+    variable, a previously recorded result for an identical command, tool binary and set of input files is restored
+    instead of re-running the command. Resource usage of every command is appended as one JSON record to the
+    telemetry file next to the logfile. In plan mode (see ddb_ngsflow.plan) the command is only recorded.
 
     :param command: The command-line command to execute.
     :type name: str.
     :param logfile: The logfile to output error messages to.
     :type logfile: str.
+    :param stdout: File to write standard output to, or a callable (or object with a write method) receiving it in
+                   chunks. Discarded if not specified.
+    :type stdout: str.
+    :param cache_dir: Directory of the content-addressed step cache.
+    :type cache_dir: str.
+    :param inputs: Input files of the step. Detected from the command line if not specified.
+    :type inputs: list.
+    :param outputs: Output files or directories of the step. Detected from the command line if not specified, which
+                    misses files a tool writes into a directory. Steps without outputs are never cached.
+    :type outputs: list.
     :returns:  Nothing
     :raises: RuntimeError
 
     """
 
-    with open(logfile, "wb") as err:
+    tokens = _split_command(command)
+    tools = [stage[0] for stage in _split_stages(tokens) if stage]
+
+    candidates, redirected = _file_tokens(tokens)
+    if stdout and not _is_consumer(stdout):
+        redirected.append(stdout)
+
+    _run_step(command, logfile, candidates, redirected, tools, lambda: _execute_command(command, logfile, stdout),
+              cache_dir, inputs, outputs, cacheable=not _is_consumer(stdout))
+
+
+def run_pipeline(stages, logfile, stdin=None, stdout=None, pipe_bufsize=DEFAULT_PIPE_BUFFER, cache_dir=None,
+                 inputs=None, outputs=None):
+    """Run a pipeline of commands without a shell. Every stage is an argv list, consecutive stages are connected
+    with OS pipes and stderr of all stages is written to the logfile. Caching and telemetry behave as for
+    run_and_log_command, with exit code and timing recorded for every stage.
+
+    :param stages: The argv lists of the pipeline stages, in order.
+    :type stages: list.
+    :param logfile: The logfile to output error messages to.
+    :type logfile: str.
+    :param stdin: File to read as standard input of the first stage.
+    :type stdin: str.
+    :param stdout: File to write standard output of the last stage to, or a callable (or object with a write method)
+                   receiving it in chunks. Discarded if not specified. Steps with a consumer are never cached.
+    :type stdout: str.
+    :param pipe_bufsize: Requested kernel buffer size in bytes of the pipes between stages (Linux only).
+    :type pipe_bufsize: int.
+    :param cache_dir: Directory of the content-addressed step cache.
+    :type cache_dir: str.
+    :param inputs: Input files of the step. Detected from the command line if not specified.
+    :type inputs: list.
+    :param outputs: Output files or directories of the step. Detected from the command line if not specified, which
+                    misses files a tool writes into a directory. Steps without outputs are never cached.
+    :type outputs: list.
+    :returns:  list -- Per-stage argv, return code, start, end and wall time.
+    :raises: RuntimeError
+
+    """
+
+    stages = [["{}".format(arg) for arg in stage] for stage in stages]
+    consumer = _is_consumer(stdout)
+    command = render_pipeline(stages, stdin, None if consumer else stdout)
+
+    candidates, redirected = _file_tokens([arg for stage in stages for arg in stage])
+    if stdin:
+        candidates.append(stdin)
+    if stdout and not consumer:
+        redirected.append(stdout)
+
+    usage = _run_step(command, logfile, candidates, redirected, [stage[0] for stage in stages],
+                      lambda: _execute_pipeline(stages, command, logfile, stdin, stdout, pipe_bufsize),
+                      cache_dir, inputs, outputs, cacheable=not consumer)
+
+    return usage.get('stages', list())
+
+
+def render_pipeline(stages, stdin=None, stdout=None):
+    """Render a pipeline as the equivalent, correctly quoted, shell command line for logging
+
+    :param stages: The argv lists of the pipeline stages, in order.
+    :type stages: list.
+    :param stdin: File read as standard input of the first stage.
+    :type stdin: str.
+    :param stdout: File written from standard output of the last stage.
+    :type stdout: str.
+    :returns:  str -- The shell command line.
+    """
+
+    command = " | ".join(" ".join(quote("{}".format(arg)) for arg in stage) for stage in stages)
+    if stdin:
+        command = "{} < {}".format(command, quote(stdin))
+    if stdout:
+        command = "{} > {}".format(command, quote(stdout))
+
+    return command
+
+
+def _run_step(command, logfile, candidates, redirected, tools, execute, cache_dir=None, inputs=None, outputs=None,
+              cacheable=True):
+    """Execute a step through the step cache and record its telemetry, or only record it in plan mode. Returns the
+    telemetry record."""
+
+    if plan.planning():
+        return plan.record_step(command, logfile, candidates, redirected, tools, inputs, outputs)
+
+    start = time.time()
+    cache_dir = (cache_dir or os.environ.get(CACHE_ENV_VAR)) if cacheable else None
+    declared_outputs = _expand_outputs(outputs) if outputs is not None else None
+    detect_inputs = inputs is None
+    if detect_inputs:
+        # Outputs left behind by an earlier run of the same step must not become part of its own key
+        excluded = set(redirected) | set(declared_outputs or list())
+        if cache_dir:
+            excluded.update(_recorded_outputs(cache_dir, command))
+        inputs = [path for path in candidates if os.path.isfile(path) and path not in excluded]
+
+    if cache_dir:
+        key = step_cache_key(command, cache_dir, inputs, tools)
+        manifest = _restore_cached_step(cache_dir, key, command, logfile)
+        if manifest is not None:
+            end = time.time()
+            usage = {'command': command, 'logfile': logfile, 'start': start, 'end': end, 'wall_time': end - start,
+                     'cached': True, 'returncode': 0, 'inputs': inputs,
+                     'outputs': [record['path'] for record in manifest['outputs']]}
+            usage.update({'input_bytes': _total_size(usage['inputs']), 'output_bytes': _total_size(usage['outputs'])})
+            write_telemetry(logfile, usage)
+            return usage
+
+    before = _file_states(candidates + redirected)
+    usage = execute()
+    if declared_outputs is None:
+        outputs = _detect_outputs(candidates + redirected, before)
+    else:
+        outputs = _expand_outputs(outputs)
+
+    consumer_error = usage.pop('consumer_error', None)
+    usage.update({'inputs': inputs, 'outputs': outputs, 'input_bytes': _total_size(inputs),
+                  'output_bytes': _total_size(outputs)})
+    write_telemetry(logfile, usage)
+
+    if usage['returncode']:
+        failed = "".join("Stage {} ({}) exited with code {}. ".format(i + 1, stage['argv'][0], stage['returncode'])
+                         for i, stage in enumerate(usage.get('stages', list()))
+                         if stage['returncode'] and stage['returncode'] != -signal.SIGPIPE)
+        tail = "".join("    {}\n".format(line) for line in usage.get('stderr_tail', list()))
+        if tail:
+            tail = "Last lines of stderr:\n{}".format(tail)
+        raise RuntimeError("An error occurred when executing the commandline: {}. {}"
+                           "Please check the logfile {} for details\n{}".format(command, failed, logfile, tail))
+    if consumer_error is not None:
+        raise consumer_error
+
+    if cache_dir:
+        if detect_inputs and set(inputs) & set(outputs):
+            # Partial outputs of an earlier, uncached run were taken for inputs. Keyed without them, as the next run
+            # of the step will look it up once its outputs are recorded
+            inputs = [path for path in inputs if path not in outputs]
+            key = step_cache_key(command, cache_dir, inputs, tools)
+        _store_cached_step(cache_dir, key, command, outputs)
+
+    return usage
+
+
+def telemetry_file(logfile):
+    """Name of the JSONL telemetry file kept next to a logfile, e.g. sample.bwa-align.telemetry.jsonl for
+    sample.bwa-align.log
+
+    :param logfile: The logfile of a step.
+    :type logfile: str.
+    :returns:  str -- The telemetry file name.
+    """
+
+    return "{}.telemetry.jsonl".format(os.path.splitext(logfile)[0])
+
+
+def write_telemetry(logfile, record):
+    """Append one telemetry record to the telemetry file belonging to logfile
+
+    :param logfile: The logfile of a step.
+    :type logfile: str.
+    :param record: The telemetry record.
+    :type record: dict.
+    :returns:  Nothing
+    """
+
+    record.setdefault('hostname', socket.gethostname())
+    record.setdefault('cwd', os.getcwd())
+    with open(telemetry_file(logfile), "a") as outfile:
+        outfile.write("{}\n".format(json.dumps(record, sort_keys=True)))
+
+
+@contextlib.contextmanager
+def python_step(label, logfile, inputs, outputs):
+    """Time an in-process Python step and write its telemetry record, the same record run_pipeline writes for
+    external commands, so profiles and plans see Python steps too. CPU time covers the Python process and the
+    worker processes it waited for. A step that raises is recorded with returncode 1.
+
+    :param label: Name of the step, as given to plan.record_function, e.g. variation.merge_variant_calls.
+    :type label: str.
+    :param logfile: Logfile name of the step, which identifies sample and stage.
+    :type logfile: str.
+    :param inputs: Input files of the step.
+    :type inputs: list.
+    :param outputs: Output files of the step.
+    :type outputs: list.
+    :returns:  Nothing
+    """
+
+    start = time.time()
+    start_self = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    code = 1
+    try:
+        yield
+        code = 0
+    finally:
+        end_self = resource.getrusage(resource.RUSAGE_SELF)
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        end = time.time()
+        inputs = [path for path in inputs if isinstance(path, str)]
+        outputs = [path for path in outputs if os.path.exists(path)]
+        write_telemetry(logfile, {'command': "python {}".format(label), 'logfile': logfile, 'start': start,
+                                  'end': end, 'wall_time': end - start, 'cached': False, 'returncode': code,
+                                  'user_cpu': (end_self.ru_utime - start_self.ru_utime +
+                                               end_children.ru_utime - start_children.ru_utime),
+                                  'sys_cpu': (end_self.ru_stime - start_self.ru_stime +
+                                              end_children.ru_stime - start_children.ru_stime),
+                                  'inputs': inputs, 'outputs': outputs, 'input_bytes': _total_size(inputs),
+                                  'output_bytes': _total_size(outputs)})
+
+
+def _sample_process_tree(roots, usage, seen):
+    """Add one sample of the resource usage of a set of processes and all of their descendants to usage. Per-process
+    CPU and I/O counters are cumulative, so the last value seen for every pid is kept and summed at the end."""
+
+    processes = dict()
+    for root in roots:
+        try:
+            for process in [root] + root.children(recursive=True):
+                processes[process.pid] = process
+        except psutil.Error:
+            continue
+
+    rss = 0
+    threads = 0
+    for process in processes.values():
+        try:
+            with process.oneshot():
+                rss += process.memory_info().rss
+                threads += process.num_threads()
+                cpu = process.cpu_times()
+                counters = seen.setdefault(process.pid, dict())
+                counters['user_cpu'] = cpu.user
+                counters['sys_cpu'] = cpu.system
+                try:
+                    io = process.io_counters()
+                    counters['read_bytes'] = io.read_bytes
+                    counters['write_bytes'] = io.write_bytes
+                except (psutil.Error, AttributeError, NotImplementedError):
+                    pass
+        except psutil.Error:
+            continue
+
+    usage['peak_rss'] = max(usage['peak_rss'], rss)
+    usage['peak_threads'] = max(usage['peak_threads'], threads)
+
+
+def _monitor_process_tree(pids, usage, finished, interval=0.5):
+    """Poll the process trees rooted at pids until finished is set"""
+
+    seen = dict()
+    roots = list()
+    for pid in pids:
+        try:
+            roots.append(psutil.Process(pid))
+        except psutil.Error:
+            continue
+
+    while not finished.is_set():
+        _sample_process_tree(roots, usage, seen)
+        finished.wait(interval)
+
+    for field in ('user_cpu', 'sys_cpu', 'read_bytes', 'write_bytes'):
+        usage[field] = sum(counters.get(field, 0) for counters in seen.values())
+
+
+def _start_monitor(pids, usage):
+    """Start a daemon thread sampling the resource usage of the given process trees"""
+
+    finished = threading.Event()
+    monitor = threading.Thread(target=_monitor_process_tree, args=(pids, usage, finished))
+    monitor.daemon = True
+    monitor.start()
+
+    return monitor, finished
+
+
+def _finish_usage(usage, command, logfile, start, start_rusage, code):
+    """Stop-time bookkeeping shared by the shell and pipeline executors. Children reaped by a shell are only visible
+    to the monitor while they are alive, rusage of waited-for descendants covers the short-lived ones."""
+
+    end_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage['user_cpu'] = max(usage.get('user_cpu', 0), end_rusage.ru_utime - start_rusage.ru_utime)
+    usage['sys_cpu'] = max(usage.get('sys_cpu', 0), end_rusage.ru_stime - start_rusage.ru_stime)
+
+    end = time.time()
+    usage.update({'command': command, 'logfile': logfile, 'start': start, 'end': end, 'wall_time': end - start,
+                  'cached': False, 'returncode': code})
+
+    return usage
+
+
+def _is_consumer(stdout):
+    """True if stdout is a consumer of the output stream rather than a file name"""
+
+    return callable(stdout) or hasattr(stdout, "write")
+
+
+def _close(handle):
+    if isinstance(handle, int):
+        os.close(handle)
+    else:
+        handle.close()
+
+
+def _open_stdout(stdout):
+    """Open the standard output target of a step. Returns the handle to give the child and, for a consumer, the
+    read end of the pipe to pump into it."""
+
+    if _is_consumer(stdout):
+        read_fd, write_fd = os.pipe()
+        return write_fd, read_fd
+
+    return open(stdout if stdout else os.devnull, "wb"), None
+
+
+def _tee_stderr(read_fd, log, tail):
+    """Copy child stderr into the logfile as it arrives, keeping only the last lines (each truncated) in tail"""
+
+    pending = b""
+    with os.fdopen(read_fd, "rb", 0) as stream:
+        while True:
+            chunk = stream.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            log.write(chunk)
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()[:_STDERR_LINE_LIMIT]
+            tail.extend(line[:_STDERR_LINE_LIMIT] for line in lines)
+    if pending:
+        tail.append(pending)
+    log.flush()
+
+
+def _pump_stdout(read_fd, stdout, errors):
+    """Feed child stdout to a consumer chunk by chunk. If the consumer fails the pipe is closed, so the producer
+    stops on SIGPIPE, and the exception is recorded in errors."""
+
+    consumer = stdout if callable(stdout) else stdout.write
+    with os.fdopen(read_fd, "rb", 0) as stream:
+        while True:
+            chunk = stream.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            try:
+                consumer(chunk)
+            except Exception as e:
+                errors.append(e)
+                break
+
+
+def _start_streams(log, err_read, stdout, out_read, tail, errors):
+    """Start the threads moving stderr into the logfile and stdout into its consumer"""
+
+    threads = [threading.Thread(target=_tee_stderr, args=(err_read, log, tail))]
+    if out_read is not None:
+        threads.append(threading.Thread(target=_pump_stdout, args=(out_read, stdout, errors)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    return threads
+
+
+def _finish_streams(usage, threads, tail, errors):
+    for thread in threads:
+        thread.join()
+    usage['stderr_tail'] = [line.decode("utf-8", "replace") for line in tail]
+    if errors:
+        usage['consumer_error'] = errors[0]
+
+
+def _execute_command(command, logfile, stdout=None):
+    """Run the command through the shell, streaming stdout to its target and stderr to the logfile. Returns the
+    resource usage of the process tree and its return code."""
+
+    usage = {'peak_rss': 0, 'peak_threads': 0}
+    start_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    errors = list()
+
+    with open(logfile, "wb") as log:
         sys.stdout.write("Executing {} and writing to logfile {}\n".format(command, logfile))
-        err.write("Command: {}\n".format(command))
-        p = sub.Popen(command, stdout=sub.PIPE, stderr=err, shell=True)
-        output = p.communicate()
-        code = p.returncode
-        if code:
-            raise RuntimeError("An error occurred when executing the commandline: {}. "
-                               "Please check the logfile {} for details\n".format(command, logfile))
+        log.write("Command: {}\n".format(command).encode("utf-8"))
+        log.flush()
+
+        stdout_handle, out_read = _open_stdout(stdout)
+        err_read, err_write = os.pipe()
+        try:
+            p = sub.Popen(command, stdout=stdout_handle, stderr=err_write, shell=True)
+        except OSError:
+            for fd in (err_read, out_read):
+                if fd is not None:
+                    os.close(fd)
+            raise
+        finally:
+            os.close(err_write)
+            _close(stdout_handle)
+
+        threads = _start_streams(log, err_read, stdout, out_read, tail, errors)
+        monitor, finished = _start_monitor([p.pid], usage)
+        code = p.wait()
+        finished.set()
+        monitor.join()
+        _finish_streams(usage, threads, tail, errors)
+
+    return _finish_usage(usage, command, logfile, start, start_rusage, code)
+
+
+def _restore_sigpipe():
+    """Give pipeline stages the default SIGPIPE disposition so an upstream stage stops when its reader exits"""
+
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+# Python 3 resets SIGPIPE in the child itself (restore_signals), while running Python code between fork and exec is
+# unsafe once the stream threads have started, so the hook is only used on Python 2
+_STAGE_PREEXEC = _restore_sigpipe if sys.version_info[0] < 3 else None
+
+
+def _set_pipe_size(fd, size):
+    """Grow the kernel buffer of a pipe where the platform supports it, ignoring refusals above pipe-max-size"""
+
+    if not size or not sys.platform.startswith("linux"):
+        return
+    try:
+        fcntl.fcntl(fd, getattr(fcntl, "F_SETPIPE_SZ", _F_SETPIPE_SZ), size)
+    except (IOError, OSError):
+        pass
+
+
+def _wait_for_stage(process, stage):
+    process.wait()
+    stage['end'] = time.time()
+    stage['returncode'] = process.returncode
+    stage['wall_time'] = stage['end'] - stage['start']
+
+
+def _execute_pipeline(stages, command, logfile, stdin, stdout, pipe_bufsize):
+    """Start every stage of a pipeline connected by OS pipes and wait for all of them. Returns the resource usage
+    of the pipeline with per-stage return codes and timings, the overall return code is that of the first stage
+    that failed."""
+
+    usage = {'peak_rss': 0, 'peak_threads': 0, 'stages': list()}
+    start_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    errors = list()
+
+    processes = list()
+    with open(logfile, "wb") as log:
+        sys.stdout.write("Executing {} and writing to logfile {}\n".format(command, logfile))
+        log.write("Command: {}\n".format(command).encode("utf-8"))
+        log.flush()
+
+        stdin_handle = open(stdin, "rb") if stdin else None
+        stdout_handle, out_read = _open_stdout(stdout)
+        err_read, err_write = os.pipe()
+        threads = _start_streams(log, err_read, stdout, out_read, tail, errors)
+        upstream = stdin_handle
+        try:
+            for i, argv in enumerate(stages):
+                read_fd = write_fd = None
+                if i < len(stages) - 1:
+                    read_fd, write_fd = os.pipe()
+                    _set_pipe_size(write_fd, pipe_bufsize)
+                stage = {'argv': argv, 'start': time.time()}
+                usage['stages'].append(stage)
+                try:
+                    processes.append(sub.Popen(argv, stdin=upstream,
+                                               stdout=stdout_handle if write_fd is None else write_fd,
+                                               stderr=err_write, close_fds=True, preexec_fn=_STAGE_PREEXEC))
+                except OSError as e:
+                    os.write(err_write, "Could not start stage {} ({}): {}\n".format(i + 1, argv[0], e).encode("utf-8"))
+                    stage.update({'returncode': 127, 'end': time.time(), 'wall_time': 0.0})
+                    for process in processes:
+                        process.kill()
+                    if read_fd is not None:
+                        os.close(read_fd)
+                    break
+                finally:
+                    if write_fd is not None:
+                        os.close(write_fd)
+                    if isinstance(upstream, int):
+                        os.close(upstream)
+                upstream = read_fd
+
+            # Only the children may hold the write ends, so the stream threads see EOF when the last stage exits
+            os.close(err_write)
+            err_write = None
+            _close(stdout_handle)
+            stdout_handle = None
+
+            monitor, finished = _start_monitor([process.pid for process in processes], usage)
+            waiters = list()
+            for process, stage in zip(processes, usage['stages']):
+                waiter = threading.Thread(target=_wait_for_stage, args=(process, stage))
+                waiter.start()
+                waiters.append(waiter)
+            for waiter in waiters:
+                waiter.join()
+            finished.set()
+            monitor.join()
+        finally:
+            if stdin_handle:
+                stdin_handle.close()
+            if err_write is not None:
+                os.close(err_write)
+            if stdout_handle is not None:
+                _close(stdout_handle)
+        _finish_streams(usage, threads, tail, errors)
+
+    # An upstream stage killed by SIGPIPE only means its reader finished early, as with a shell pipeline
+    codes = [stage['returncode'] for stage in usage['stages']
+             if stage['returncode'] and stage['returncode'] != -signal.SIGPIPE]
+
+    return _finish_usage(usage, command, logfile, start, start_rusage, codes[0] if codes else 0)
+
+
+def _split_command(command):
+    """Tokenize a shell command line, falling back to whitespace splitting for unbalanced quoting"""
+
+    try:
+        return shlex.split(command)
+    except ValueError:
+        return command.split()
+
+
+def _split_stages(tokens):
+    """Split the tokens of a shell command line into the argv lists of its pipe separated stages"""
+
+    stages = [list()]
+    for token in tokens:
+        if token == "|":
+            stages.append(list())
+        else:
+            stages[-1].append(token)
+
+    return stages
+
+
+def _file_tokens(tokens):
+    """Return every token of a command line that could name a file, including the value side of KEY=VALUE
+    arguments (Picard style) and redirection targets.
+
+    :param tokens: The tokens of the command line.
+    :type tokens: list.
+    :returns:  tuple -- Candidate file paths in command line order and the targets of output redirections.
+    """
+
+    candidates = list()
+    redirected = list()
+    redirect_next = False
+    for token in tokens:
+        if token in _SHELL_OPERATORS:
+            redirect_next = token in _REDIRECT_OPERATORS
+            continue
+        for redirect in _REDIRECT_OPERATORS:
+            if token.startswith(redirect) and len(token) > len(redirect):
+                token = token[len(redirect):].lstrip(">")
+                redirect_next = True
+        if redirect_next:
+            redirected.append(token)
+            redirect_next = False
+            continue
+        candidates.append(token)
+        if "=" in token:
+            candidates.append(token.split("=", 1)[1])
+
+    return candidates, redirected
+
+
+def _tool_identities(tools):
+    """Identify the binary of every stage of a pipeline by resolved path, size and modification time"""
+
+    identities = list()
+    for tool in tools:
+        path = which(tool) or tool
+        try:
+            stat = os.stat(os.path.realpath(path))
+            identities.append([os.path.realpath(path), stat.st_size, int(stat.st_mtime)])
+        except OSError:
+            identities.append([tool, None, None])
+
+    return identities
+
+
+def _file_states(paths):
+    """Snapshot (size, mtime) of each existing regular file in paths"""
+
+    states = dict()
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            states[path] = (stat.st_size, stat.st_mtime)
+
+    return states
+
+
+def _detect_outputs(candidates, before):
+    """Files named on the command line that were created or modified while it ran"""
+
+    outputs = list()
+    for path, state in sorted(_file_states(candidates).items()):
+        if before.get(path) != state:
+            outputs.append(path)
+
+    return outputs
+
+
+def _expand_outputs(paths):
+    """Output files of a step, with the files below declared output directories in place of the directories"""
+
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+
+    return files
+
+
+def _total_size(paths):
+    """Total size in bytes of the existing files in paths, for the cost model of the planner"""
+
+    return sum(os.path.getsize(path) for path in set(paths) if os.path.isfile(path))
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _write_json_atomic(path, data):
+    """Write a JSON document so concurrent readers never observe a partial file"""
+
+    _makedirs(os.path.dirname(path))
+    temp = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp, "w") as outfile:
+        json.dump(data, outfile, indent=1, sort_keys=True)
+    os.rename(temp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, "r") as infile:
+            return json.load(infile)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def file_fingerprint(path, cache_dir):
+    """Return the SHA1 content digest of a file. Digests are memoized in the cache directory against the file's
+    path, inode, size and modification time so that large BAM and VCF files are only hashed once.
+
+    :param path: File to fingerprint.
+    :type path: str.
+    :param cache_dir: Directory of the content-addressed step cache.
+    :type cache_dir: str.
+    :returns:  str -- Hex digest of the file contents.
+    """
+
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+    state = [stat.st_ino, stat.st_size, stat.st_mtime]
+    memo_file = os.path.join(cache_dir, "fingerprints",
+                             "{}.json".format(hashlib.sha1(real_path.encode("utf-8")).hexdigest()))
+
+    memo = _read_json(memo_file)
+    if memo and memo.get('state') == state:
+        return memo['digest']
+
+    digest = _hash_file(real_path)
+    _write_json_atomic(memo_file, {'path': real_path, 'state': state, 'digest': digest})
+
+    return digest
+
+
+def step_cache_key(command, cache_dir, inputs=None, tools=None):
+    """Compute the content address of a command: the rendered command line, the identity of every tool binary it
+    invokes and the content fingerprints of its input files.
+
+    :param command: The command-line command.
+    :type command: str.
+    :param cache_dir: Directory of the content-addressed step cache.
+    :type cache_dir: str.
+    :param inputs: Input files of the step. Detected from the command line if not specified.
+    :type inputs: list.
+    :param tools: The binary invoked by every stage of the command. Detected from the command line if not specified.
+    :type tools: list.
+    :returns:  str -- Hex digest identifying the step.
+    """
+
+    tokens = _split_command(command)
+    if inputs is None:
+        inputs = [path for path in _file_tokens(tokens)[0] if os.path.isfile(path)]
+    if tools is None:
+        tools = [stage[0] for stage in _split_stages(tokens) if stage]
+
+    key_data = {'command': command,
+                'tools': _tool_identities(tools),
+                'inputs': [[path, file_fingerprint(path, cache_dir)] for path in inputs]}
+
+    return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _object_path(cache_dir, digest):
+    return os.path.join(cache_dir, "objects", digest[:2], digest)
+
+
+def _copy_file(source, destination):
+    """Copy rather than hard link, so tools that later rewrite a file in place can never corrupt the object store"""
+
+    if os.path.lexists(destination):
+        os.remove(destination)
+    shutil.copy2(source, destination)
+
+
+def _store_cached_step(cache_dir, key, command, outputs):
+    """Add the outputs of a successfully executed step to the object store and record the step manifest. Steps that
+    produced no output file are not recorded."""
+
+    records = list()
+    for path in outputs:
+        if not os.path.isfile(path):
+            continue
+        digest = _hash_file(path)
+        stored = _object_path(cache_dir, digest)
+        if not os.path.exists(stored):
+            _makedirs(os.path.dirname(stored))
+            temp = "{}.{}.tmp".format(stored, os.getpid())
+            _copy_file(path, temp)
+            os.rename(temp, stored)
+        records.append({'path': path, 'digest': digest, 'size': os.path.getsize(path)})
+
+    # A manifest without outputs would turn every later run of the step into a no-op that restores nothing
+    if not records:
+        sys.stdout.write("No outputs recorded for {}. Not caching the step\n".format(command))
+        return
+
+    _write_json_atomic(os.path.join(cache_dir, "steps", "{}.json".format(key)),
+                       {'command': command, 'outputs': records, 'created': time.time()})
+    _write_json_atomic(_command_record(cache_dir, command), {'command': command, 'outputs': list(outputs)})
+
+
+def _command_record(cache_dir, command):
+    return os.path.join(cache_dir, "commands", "{}.json".format(hashlib.sha1(command.encode("utf-8")).hexdigest()))
+
+
+def _recorded_outputs(cache_dir, command):
+    """Output files recorded the last time this exact command line was executed"""
+
+    record = _read_json(_command_record(cache_dir, command))
+
+    return record['outputs'] if record else list()
+
+
+def _restore_cached_step(cache_dir, key, command, logfile):
+    """Reuse or restore the recorded outputs of a step. Returns the step manifest, or None if the step has to be
+    executed."""
+
+    manifest = _read_json(os.path.join(cache_dir, "steps", "{}.json".format(key)))
+    if manifest is None:
+        return None
+
+    for record in manifest['outputs']:
+        if not os.path.exists(_object_path(cache_dir, record['digest'])):
+            return None
+
+    restored = list()
+    for record in manifest['outputs']:
+        path = record['path']
+        if os.path.isfile(path) and file_fingerprint(path, cache_dir) == record['digest']:
+            continue
+        if os.path.dirname(path):
+            _makedirs(os.path.dirname(path))
+        _copy_file(_object_path(cache_dir, record['digest']), path)
+        restored.append(path)
+
+    sys.stdout.write("Found cached result {} for {}. Skipping execution\n".format(key, command))
+    with open(logfile, "w") as log:
+        log.write("Command: {}\n".format(command))
+        log.write("Skipped: cached result {} from {}\n".format(key, cache_dir))
+        for path in restored:
+            log.write("Restored: {}\n".format(path))
+
+    return manifest
 
 
 def spawn_batch_jobs(job):
@@ -0,0 +1,426 @@
+"""
+.. module:: plan
+   :platform: Unix, OSX
+   :synopsis: A module for dry-running a workflow: record every command it would execute, assemble the command graph
+   and estimate core-hours and disk from the telemetry of earlier runs or from input file sizes.
+
+.. moduleauthor:: Daniel Gaston <daniel.gaston@dal.ca>
+
+A workflow is planned by running it with the DDB_NGSFLOW_PLAN environment variable set to a plan file, for example
+with the singleMachine batch system:
+
+    DDB_NGSFLOW_PLAN=run.plan.jsonl python workflow.py -c run.config -s samples.config ./jobstore
+
+No command is executed. Every step that would have run, together with its command line, inputs and outputs, is
+appended to the plan file and the wrappers return their output file names as usual, so the whole Toil graph is
+walked. The plan is then estimated with
+
+    python -m ddb_ngsflow.plan run.plan.jsonl --history previous_run_dir --cores-per-node 32
+
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import argparse
+
+from collections import defaultdict
+
+from ddb_ngsflow import profiler
+
+PLAN_ENV_VAR = "DDB_NGSFLOW_PLAN"
+
+# Used for steps that have no telemetry history: one core-hour per 2 GiB of input, a minute of fixed start-up
+# cost and outputs as large as the inputs
+DEFAULT_CORE_SECONDS_PER_GB = 1800.0
+DEFAULT_STEP_SECONDS = 60.0
+DEFAULT_OUTPUT_RATIO = 1.0
+DEFAULT_CORES_PER_NODE = 16
+
+_GB = float(1 << 30)
+_EXTENSION = re.compile(r"\.[A-Za-z][A-Za-z0-9_]*$")
+
+
+def planning():
+    """Whether commands are being planned instead of executed
+
+    :returns:  bool -- True in plan mode.
+    """
+
+    return bool(os.environ.get(PLAN_ENV_VAR))
+
+
+def start_planning(plan_file):
+    """Switch this process, and the Toil workers it starts, to plan mode
+
+    :param plan_file: The plan file steps are appended to.
+    :type plan_file: str.
+    :returns:  Nothing
+    """
+
+    os.environ[PLAN_ENV_VAR] = os.path.abspath(plan_file)
+
+
+def record_step(command, logfile, candidates, redirected=None, tools=None, inputs=None, outputs=None):
+    """Append a step that would have run to the plan file. Inputs and outputs that are not given explicitly are
+    resolved when the plan is assembled, since which files exist depends on the steps recorded before this one.
+
+    :param command: The rendered command line.
+    :type command: str.
+    :param logfile: The logfile of the step.
+    :type logfile: str.
+    :param candidates: Command line tokens that could name files.
+    :type candidates: list.
+    :param redirected: Files written from standard output.
+    :type redirected: list.
+    :param tools: The executables of the step.
+    :type tools: list.
+    :param inputs: Input files of the step, if known.
+    :type inputs: list.
+    :param outputs: Output files of the step, if known.
+    :type outputs: list.
+    :returns:  dict -- A telemetry-like record of the planned step.
+    """
+
+    redirected = redirected or list()
+    tools = tools or list()
+    sizes = dict((path, os.path.getsize(path)) for path in set(candidates + (inputs or list()))
+                 if os.path.isfile(path))
+    record = {'command': command, 'logfile': logfile, 'cwd': os.getcwd(), 'time': time.time(),
+              'candidates': [path for path in candidates if path not in tools and "=" not in path],
+              'redirected': redirected, 'tools': tools, 'inputs': inputs, 'outputs': outputs, 'sizes': sizes}
+
+    # A single write of one line so that concurrent workers appending to the same plan do not interleave
+    with open(os.environ[PLAN_ENV_VAR], 'a') as plan_file:
+        plan_file.write("{}\n".format(json.dumps(record, sort_keys=True)))
+
+    return {'command': command, 'logfile': logfile, 'returncode': 0, 'planned': True, 'stages': list()}
+
+
+def record_function(label, logfile, inputs, outputs):
+    """Record an in-process Python step when planning. Python steps read the files earlier steps produce, so in plan
+    mode they record themselves and return early.
+
+    :param label: Name of the step, e.g. variation.filter_low_support_variants.
+    :type label: str.
+    :param logfile: Logfile name the step would use, which identifies sample and stage.
+    :type logfile: str.
+    :param inputs: Input files of the step.
+    :type inputs: list.
+    :param outputs: Output files of the step.
+    :type outputs: list.
+    :returns:  bool -- True if the step was planned and must not run.
+    """
+
+    if not planning():
+        return False
+
+    inputs = [path for path in inputs if isinstance(path, str)]
+    record_step("python {}".format(label), logfile, list(inputs), tools=["python"], inputs=inputs,
+                outputs=list(outputs))
+
+    return True
+
+
+def load_plan(plan_file):
+    """Read the steps of a plan and resolve their inputs and outputs. A file named by a step is one of its inputs if
+    it existed when the plan was made or an earlier step writes it, and one of its outputs if it is redirected to,
+    or does not exist yet and looks like a file name.
+
+    :param plan_file: The plan file name.
+    :type plan_file: str.
+    :returns:  list -- The step records, in the order they were planned.
+    """
+
+    steps = list()
+    with open(plan_file, 'r') as records:
+        for line in records:
+            if line.strip():
+                steps.append(json.loads(line))
+
+    written = set()
+    for i, step in enumerate(steps):
+        cwd = step['cwd']
+
+        def resolve(paths):
+            return [os.path.normpath(os.path.join(cwd, path)) for path in paths]
+
+        sizes = dict(zip(resolve(step['sizes'].keys()), step['sizes'].values()))
+        candidates = resolve(step['candidates'])
+        redirected = resolve(step['redirected'])
+
+        if step['inputs'] is not None:
+            inputs = resolve(step['inputs'])
+        else:
+            inputs = [path for path in candidates if (path in sizes or path in written) and path not in redirected]
+        if step['outputs'] is not None:
+            outputs = resolve(step['outputs'])
+        else:
+            outputs = redirected + [path for path, token in zip(candidates, step['candidates'])
+                                    if path not in sizes and path not in written and _looks_like_file(token)]
+
+        logname = os.path.basename(step['logfile'])
+        if logname.endswith(".log"):
+            logname = logname[:-4]
+        sample, _, label = logname.partition(".")
+
+        step.update({'id': i, 'sample': sample, 'label': label or sample,
+                     'tool': os.path.basename(step['tools'][0]) if step['tools'] else "",
+                     'inputs': _unique(inputs), 'outputs': _unique(outputs), 'sizes': sizes})
+        written.update(step['outputs'])
+
+    return steps
+
+
+def build_plan_graph(steps):
+    """Connect every planned step to the most recent earlier step writing each of its inputs. Sets 'deps'.
+
+    :param steps: Step records from load_plan.
+    :type steps: list.
+    :returns:  list -- The steps.
+    """
+
+    writer = dict()
+    for step in steps:
+        step['deps'] = sorted(set(writer[path] for path in step['inputs'] if path in writer))
+        for path in step['outputs']:
+            writer[path] = step['id']
+
+    return steps
+
+
+def fit_cost_model(history_steps):
+    """Fit per-stage costs to the steps of earlier runs. Costs are kept per stage label and per tool, as medians of
+    core-seconds per input byte, core-seconds per step, output bytes per input byte and cores in use.
+
+    :param history_steps: Step records from profiler.load_steps.
+    :type history_steps: list.
+    :returns:  dict -- Costs keyed by ('label', label) and ('tool', tool).
+    """
+
+    observations = defaultdict(lambda: defaultdict(list))
+    for step in history_steps:
+        if step.get('cached') or step.get('returncode'):
+            continue
+        core_seconds = step['cores'] * (step['end'] - step['start'])
+        input_bytes = step.get('input_bytes')
+        for key in (('label', step['label']), ('tool', step['tool'])):
+            observed = observations[key]
+            observed['core_seconds'].append(core_seconds)
+            observed['cores'].append(step['cores'])
+            if input_bytes:
+                observed['rate'].append(core_seconds / input_bytes)
+                if step.get('output_bytes') is not None:
+                    observed['output_ratio'].append(step['output_bytes'] / float(input_bytes))
+
+    model = dict()
+    for key, observed in observations.items():
+        model[key] = dict((name, _median(values)) for name, values in observed.items())
+        model[key]['steps'] = len(observed['core_seconds'])
+
+    return model
+
+
+def estimate_step(model, step, input_bytes):
+    """Estimate the cost of one planned step from the fitted costs of its stage label, else of its tool, else from
+    the default per-byte rates
+
+    :param model: Costs from fit_cost_model.
+    :type model: dict.
+    :param step: A planned step.
+    :type step: dict.
+    :param input_bytes: Total size of the step's inputs, measured or estimated.
+    :type input_bytes: int.
+    :returns:  dict -- Core-seconds, cores, wall seconds, output bytes and the source of the estimate.
+    """
+
+    costs = model.get(('label', step['label'])) or model.get(('tool', step['tool']))
+    if costs:
+        source = "history"
+        if 'rate' in costs and input_bytes:
+            core_seconds = costs['rate'] * input_bytes
+        else:
+            core_seconds = costs['core_seconds']
+        output_ratio = costs.get('output_ratio', DEFAULT_OUTPUT_RATIO)
+        cores = max(1.0, costs['cores'])
+    else:
+        source = "input size"
+        core_seconds = DEFAULT_STEP_SECONDS + DEFAULT_CORE_SECONDS_PER_GB * input_bytes / _GB
+        output_ratio = DEFAULT_OUTPUT_RATIO
+        cores = 1.0
+
+    output_bytes = int(output_ratio * input_bytes) if step['outputs'] else 0
+
+    return {'core_seconds': core_seconds, 'cores': cores, 'wall_seconds': core_seconds / cores,
+            'output_bytes': output_bytes, 'source': source}
+
+
+def estimate_plan(steps, model=None, cores_per_node=DEFAULT_CORES_PER_NODE):
+    """Estimate a planned run. Sizes of files that do not exist yet are taken from the estimated outputs of the
+    steps writing them, so estimates propagate down the graph. Disk is counted as the working set of each step
+    (inputs plus outputs) and, for the run, as everything written plus the initial inputs, since the workflows keep
+    their intermediate files.
+
+    :param steps: Step records from build_plan_graph.
+    :type steps: list.
+    :param model: Costs from fit_cost_model. Defaults are used for every step if not specified.
+    :type model: dict.
+    :param cores_per_node: Cores of one node, used to suggest a node count.
+    :type cores_per_node: int.
+    :returns:  dict -- Steps with estimates, per-stage totals, critical path and run totals.
+    """
+
+    model = model or dict()
+    sizes = dict()
+    initial = dict()
+    finish = dict()
+    for step in steps:
+        for path, size in step['sizes'].items():
+            if path not in sizes:
+                sizes[path] = size
+                initial[path] = size
+        input_bytes = sum(sizes.get(path, 0) for path in step['inputs'])
+        estimate = estimate_step(model, step, input_bytes)
+        for path in step['outputs']:
+            sizes[path] = estimate['output_bytes'] // len(step['outputs'])
+
+        step.update(estimate)
+        step['input_bytes'] = input_bytes
+        step['peak_disk'] = input_bytes + estimate['output_bytes']
+        step['ready'] = max([finish[dep] for dep in step['deps']] or [0.0])
+        finish[step['id']] = step['ready'] + step['wall_seconds']
+
+    stages = defaultdict(lambda: {'steps': 0, 'core_hours': 0.0, 'peak_disk': 0, 'output_bytes': 0, 'sources': set()})
+    for step in steps:
+        stage = stages[step['label']]
+        stage['steps'] += 1
+        stage['core_hours'] += step['core_seconds'] / 3600.0
+        stage['peak_disk'] = max(stage['peak_disk'], step['peak_disk'])
+        stage['output_bytes'] += step['output_bytes']
+        stage['sources'].add(step['source'])
+    for stage in stages.values():
+        stage['sources'] = sorted(stage['sources'])
+
+    path = list()
+    if steps:
+        by_id = dict((step['id'], step) for step in steps)
+        step = max(steps, key=lambda candidate: finish[candidate['id']])
+        while step is not None:
+            path.append(step['id'])
+            step = max((by_id[dep] for dep in step['deps']), key=lambda dep: finish[dep['id']]) \
+                if step['deps'] else None
+        path.reverse()
+
+    core_seconds = sum(step['core_seconds'] for step in steps)
+    critical_seconds = max(finish.values()) if finish else 0.0
+    parallelism = core_seconds / critical_seconds if critical_seconds else 0.0
+
+    return {'steps': steps,
+            'stages': dict(stages),
+            'critical_path': path,
+            'core_hours': core_seconds / 3600.0,
+            'critical_path_hours': critical_seconds / 3600.0,
+            'peak_disk': sum(initial.values()) + sum(step['output_bytes'] for step in steps),
+            'parallelism': parallelism,
+            'cores_per_node': cores_per_node,
+            'nodes': int(math.ceil(parallelism / cores_per_node)) if parallelism else 0}
+
+
+def text_report(estimate):
+    """Render an estimated plan as a plain text report
+
+    :param estimate: An estimate from estimate_plan.
+    :type estimate: dict.
+    :returns:  str -- The report.
+    """
+
+    steps = estimate['steps']
+    lines = ["Planned {} steps: {:.2f} core-hours, critical path {:.2f} h, peak disk {}".format(
+        len(steps), estimate['core_hours'], estimate['critical_path_hours'], _size(estimate['peak_disk'])),
+        "Average parallelism {:.1f} cores, about {} node(s) of {} cores to finish in critical path time".format(
+            estimate['parallelism'], estimate['nodes'], estimate['cores_per_node']),
+        "",
+        "{:<40} {:>6} {:>11} {:>11} {:>11}  {}".format("stage", "steps", "core-hours", "peak disk", "written",
+                                                       "estimated from")]
+    for label, stage in sorted(estimate['stages'].items(), key=lambda item: -item[1]['core_hours']):
+        lines.append("{:<40} {:>6} {:>11.2f} {:>11} {:>11}  {}".format(
+            label, stage['steps'], stage['core_hours'], _size(stage['peak_disk']), _size(stage['output_bytes']),
+            ", ".join(stage['sources'])))
+
+    lines.extend(["", "Critical path:"])
+    for step_id in estimate['critical_path']:
+        step = steps[step_id]
+        lines.append("  {:<12} {:<36} {:>8}  {}".format(step['sample'], step['label'],
+                                                         profiler.format_duration(step['wall_seconds']),
+                                                         step['command']))
+
+    lines.extend(["", "Commands:"])
+    for step in steps:
+        deps = ",".join("{}".format(dep) for dep in step['deps']) or "-"
+        lines.append("  [{}] after {}: {}".format(step['id'], deps, step['command']))
+
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    """Command line entry point: python -m ddb_ngsflow.plan PLAN_FILE [--history RUN_DIR ...] [--json plan.json]"""
+
+    parser = argparse.ArgumentParser(description="Assemble and estimate a planned workflow run")
+    parser.add_argument('plan', help="Plan file written in plan mode")
+    parser.add_argument('--history', nargs='*', default=list(), help="Run directories or telemetry files of earlier "
+                                                                    "runs to fit costs to")
+    parser.add_argument('-n', '--cores-per-node', type=int, default=DEFAULT_CORES_PER_NODE, help="Cores per node")
+    parser.add_argument('--json', default=None, help="Write the estimated command graph to this file as JSON")
+    args = parser.parse_args(argv)
+
+    model = fit_cost_model(profiler.load_steps(profiler.find_telemetry(args.history))) if args.history else None
+    estimate = estimate_plan(build_plan_graph(load_plan(args.plan)), model, args.cores_per_node)
+    sys.stdout.write(text_report(estimate))
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(estimate, outfile, indent=2, sort_keys=True)
+
+    return estimate
+
+
+def _looks_like_file(token):
+    """Whether a command line token that names no existing file is plausibly a file the step writes"""
+
+    if not token or token.startswith("-"):
+        return False
+    try:
+        float(token)
+        return False
+    except ValueError:
+        pass
+
+    return "/" in token or bool(_EXTENSION.search(token))
+
+
+def _unique(paths):
+    seen = set()
+
+    return [path for path in paths if not (path in seen or seen.add(path))]
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def _size(size):
+    for unit in ("B", "K", "M", "G"):
+        if abs(size) < 1024:
+            return "{:.0f}{}".format(size, unit) if unit == "B" else "{:.1f}{}".format(size, unit)
+        size /= 1024.0
+
+    return "{:.1f}T".format(size)
+
+
+if __name__ == "__main__":
+    main()
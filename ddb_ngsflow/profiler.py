@@ -0,0 +1,391 @@
+"""
+.. module:: profiler
+   :platform: Unix, OSX
+   :synopsis: A module for profiling a finished workflow run from its step telemetry: executed graph, critical path,
+   per-sample and per-tool timelines and idle gaps.
+
+.. moduleauthor:: Daniel Gaston <daniel.gaston@dal.ca>
+
+
+"""
+
+import os
+import sys
+import json
+import shlex
+import argparse
+
+from collections import defaultdict
+
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
+
+# Gaps shorter than this many seconds are scheduling noise rather than structure
+DEFAULT_MIN_GAP = 5.0
+TEXT_WIDTH = 60
+
+
+def find_telemetry(paths):
+    """Find the telemetry files of a run. Directories are searched recursively, so the shard directories of scattered
+    callers are included.
+
+    :param paths: Telemetry files or run directories.
+    :type paths: list.
+    :returns:  list -- The telemetry file names.
+    """
+
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(".telemetry.jsonl"))
+        else:
+            files.append(path)
+
+    return files
+
+
+def load_steps(telemetry_files):
+    """Read the step records of a run, ordered by start time. Every step gets an id, its sample (the logfile prefix),
+    a label (the rest of the logfile name), its tool (the first executable) and its input and output paths resolved
+    against the directory it ran in.
+
+    :param telemetry_files: The telemetry file names.
+    :type telemetry_files: list.
+    :returns:  list -- The step records.
+    """
+
+    steps = list()
+    for telemetry_file in telemetry_files:
+        with open(telemetry_file, 'r') as records:
+            for line in records:
+                if line.strip():
+                    steps.append(json.loads(line))
+
+    steps.sort(key=lambda step: step['start'])
+    for i, step in enumerate(steps):
+        cwd = step.get('cwd') or os.path.dirname(os.path.abspath(telemetry_files[0]))
+        logname = os.path.basename(step['logfile'])
+        if logname.endswith(".log"):
+            logname = logname[:-4]
+        sample, _, label = logname.partition(".")
+
+        step['id'] = i
+        step['sample'] = sample
+        step['label'] = label or sample
+        step['tool'] = _tool_name(step)
+        step['inputs'] = [os.path.normpath(os.path.join(cwd, path)) for path in step.get('inputs') or list()]
+        step['outputs'] = [os.path.normpath(os.path.join(cwd, path)) for path in step.get('outputs') or list()]
+        wall_time = step.get('wall_time') or 0.0
+        cpu = (step.get('user_cpu') or 0.0) + (step.get('sys_cpu') or 0.0)
+        step['cores'] = max(1.0, cpu / wall_time) if wall_time > 0 and not step.get('cached') else 0.0
+
+    return steps
+
+
+def build_graph(steps):
+    """Reconstruct the executed graph: a step depends on the steps that last wrote each of its inputs before it
+    started. Sets 'deps' on every step.
+
+    :param steps: Step records from load_steps.
+    :type steps: list.
+    :returns:  list -- The steps.
+    """
+
+    writers = defaultdict(list)
+    for step in steps:
+        for path in step['outputs']:
+            writers[path].append(step)
+
+    for step in steps:
+        deps = set()
+        for path in step['inputs']:
+            earlier = [writer for writer in writers.get(path, list())
+                       if writer['id'] != step['id'] and writer['end'] <= step['start']]
+            if earlier:
+                deps.add(max(earlier, key=lambda writer: writer['end'])['id'])
+        step['deps'] = sorted(deps)
+
+    return steps
+
+
+def critical_path(steps):
+    """The executed critical path: starting from the step that finished last, repeatedly follow the dependency that
+    finished last, which is the one that held the step back
+
+    :param steps: Step records from build_graph.
+    :type steps: list.
+    :returns:  list -- Steps of the critical path in execution order, each with the time it waited on its
+               predecessor as 'wait'.
+    """
+
+    if not steps:
+        return list()
+
+    by_id = dict((step['id'], step) for step in steps)
+    run_start = min(step['start'] for step in steps)
+
+    path = list()
+    step = max(steps, key=lambda candidate: candidate['end'])
+    while step is not None:
+        previous = max((by_id[dep] for dep in step['deps']), key=lambda dep: dep['end']) if step['deps'] else None
+        step['wait'] = step['start'] - (previous['end'] if previous else run_start)
+        path.append(step)
+        step = previous
+
+    return list(reversed(path))
+
+
+def idle_gaps(steps, cores=None, min_gap=DEFAULT_MIN_GAP):
+    """Find the periods in which cores were free but no step could run, because every step still to come was
+    waiting for a dependency. Each gap names the running steps the waiting ones were blocked on, which are the
+    candidates for more parallelism.
+
+    :param steps: Step records from build_graph.
+    :type steps: list.
+    :param cores: Cores available to the run. Defaults to the peak number of cores in use.
+    :type cores: float.
+    :param min_gap: Shortest gap reported, in seconds.
+    :type min_gap: float.
+    :returns:  list -- Gaps with start, end, free cores and the blocking step ids.
+    """
+
+    executed = [step for step in steps if not step.get('cached')]
+    if not executed:
+        return list()
+
+    times = sorted(set([step['start'] for step in executed] + [step['end'] for step in executed]))
+    by_id = dict((step['id'], step) for step in steps)
+    segments = list()
+    for start, end in zip(times, times[1:]):
+        running = [step for step in executed if step['start'] <= start and step['end'] >= end]
+        segments.append((start, end, sum(step['cores'] for step in running), running))
+
+    capacity = cores or max(busy for start, end, busy, running in segments)
+
+    gaps = list()
+    for start, end, busy, running in segments:
+        if capacity - busy < 1:
+            continue
+        pending = [step for step in executed if step['start'] >= end]
+        ready = [step for step in pending if all(by_id[dep]['end'] <= start for dep in step['deps'])]
+        if ready:
+            continue
+        blocking = set(dep for step in pending for dep in step['deps'] if by_id[dep]['end'] > start)
+        blocking &= set(step['id'] for step in running)
+        if gaps and gaps[-1]['end'] == start and gaps[-1]['blocking'] == sorted(blocking):
+            gaps[-1]['end'] = end
+            gaps[-1]['free_cores'] = min(gaps[-1]['free_cores'], capacity - busy)
+        else:
+            gaps.append({'start': start, 'end': end, 'free_cores': capacity - busy, 'blocking': sorted(blocking)})
+
+    return [gap for gap in gaps if gap['end'] - gap['start'] >= min_gap]
+
+
+def profile_run(paths, cores=None, min_gap=DEFAULT_MIN_GAP):
+    """Profile a finished run from its telemetry
+
+    :param paths: Telemetry files or run directories.
+    :type paths: list.
+    :param cores: Cores available to the run. Defaults to the peak number of cores in use.
+    :type cores: float.
+    :param min_gap: Shortest idle gap reported, in seconds.
+    :type min_gap: float.
+    :returns:  dict -- Steps, critical path, idle gaps and per-sample and per-tool totals.
+    """
+
+    steps = build_graph(load_steps(find_telemetry(paths)))
+    if not steps:
+        return {'steps': list(), 'critical_path': list(), 'idle_gaps': list(), 'samples': dict(), 'tools': dict(),
+                'start': 0.0, 'end': 0.0, 'cores': cores}
+
+    tools = defaultdict(lambda: {'steps': 0, 'wall_time': 0.0, 'core_hours': 0.0})
+    samples = defaultdict(list)
+    for step in steps:
+        samples[step['sample']].append(step['id'])
+        totals = tools[step['tool']]
+        totals['steps'] += 1
+        totals['wall_time'] += step['end'] - step['start']
+        totals['core_hours'] += step['cores'] * (step['end'] - step['start']) / 3600.0
+
+    return {'steps': steps,
+            'critical_path': [step['id'] for step in critical_path(steps)],
+            'idle_gaps': idle_gaps(steps, cores, min_gap),
+            'samples': dict(samples),
+            'tools': dict(tools),
+            'start': min(step['start'] for step in steps),
+            'end': max(step['end'] for step in steps),
+            'cores': cores}
+
+
+def text_report(profile, width=TEXT_WIDTH):
+    """Render a profile as a plain text report with ASCII timelines
+
+    :param profile: A profile from profile_run.
+    :type profile: dict.
+    :param width: Width of the timeline bars in characters.
+    :type width: int.
+    :returns:  str -- The report.
+    """
+
+    steps = profile['steps']
+    span = max(profile['end'] - profile['start'], 1e-6)
+    lines = ["Run span {} with {} steps, {:.2f} core-hours".format(
+        format_duration(span), len(steps), sum(tool['core_hours'] for tool in profile['tools'].values()))]
+
+    def bar(step):
+        first = int((step['start'] - profile['start']) / span * width)
+        last = max(first + 1, int((step['end'] - profile['start']) / span * width))
+        return "{}{}{}".format(" " * first, "#" * (last - first), " " * (width - last))
+
+    lines.extend(["", "Critical path ({} steps, {} waiting)".format(
+        len(profile['critical_path']), format_duration(sum(steps[i]['wait'] for i in profile['critical_path'])))])
+    for i in profile['critical_path']:
+        step = steps[i]
+        lines.append("  {:<12} {:<32} {:>10} waited {:>8}".format(step['sample'][:12], step['label'][:32],
+                                                                   format_duration(step['end'] - step['start']),
+                                                                   format_duration(step['wait'])))
+
+    for sample in sorted(profile['samples']):
+        lines.extend(["", "Sample {}".format(sample)])
+        for i in profile['samples'][sample]:
+            step = steps[i]
+            marker = "*" if i in profile['critical_path'] else " "
+            lines.append(" {}{:<32} |{}| {}".format(marker, step['label'][:32], bar(step),
+                                                   format_duration(step['end'] - step['start'])))
+
+    lines.extend(["", "Tools"])
+    for tool, totals in sorted(profile['tools'].items(), key=lambda item: -item[1]['wall_time']):
+        lines.append("  {:<24} {:>5} steps {:>10} {:>8.2f} core-hours".format(tool[:24], totals['steps'],
+                                                                              format_duration(totals['wall_time']),
+                                                                              totals['core_hours']))
+
+    lines.extend(["", "Idle gaps (cores free, nothing ready to run)"])
+    if not profile['idle_gaps']:
+        lines.append("  none")
+    for gap in profile['idle_gaps']:
+        blocking = ", ".join("{}:{}".format(steps[i]['sample'], steps[i]['label']) for i in gap['blocking'])
+        lines.append("  +{:<10} {:>10} {:>6.1f} cores free, waiting on {}".format(
+            format_duration(gap['start'] - profile['start']), format_duration(gap['end'] - gap['start']),
+            gap['free_cores'], blocking or "nothing (no further steps)"))
+
+    return "\n".join(lines) + "\n"
+
+
+def html_report(profile):
+    """Render a profile as a static HTML page with Gantt-style timelines
+
+    :param profile: A profile from profile_run.
+    :type profile: dict.
+    :returns:  str -- The HTML page.
+    """
+
+    steps = profile['steps']
+    span = max(profile['end'] - profile['start'], 1e-6)
+
+    def bar(step, css):
+        left = 100.0 * (step['start'] - profile['start']) / span
+        width = max(0.2, 100.0 * (step['end'] - step['start']) / span)
+        title = escape("{} {} ({}): {}".format(step['sample'], step['label'],
+                                               format_duration(step['end'] - step['start']), step['command']), True)
+        return '<div class="bar {}" style="left:{:.3f}%;width:{:.3f}%" title="{}"></div>'.format(css, left, width,
+                                                                                              title)
+
+    def row(name, bars):
+        return '<div class="row"><span class="name">{}</span><div class="track">{}</div></div>'.format(
+            escape(name), "".join(bars))
+
+    gap_bars = "".join('<div class="bar gap" style="left:{:.3f}%;width:{:.3f}%" title="{:.1f} cores free"></div>'.format(
+        100.0 * (gap['start'] - profile['start']) / span, 100.0 * (gap['end'] - gap['start']) / span,
+        gap['free_cores']) for gap in profile['idle_gaps'])
+
+    parts = ["<!DOCTYPE html>", "<html><head><meta charset=\"utf-8\"><title>Run profile</title><style>",
+             "body{font-family:sans-serif;font-size:12px} .row{display:flex;align-items:center;height:16px}",
+             ".name{width:280px;overflow:hidden;white-space:nowrap} .track{position:relative;flex:1;height:12px;"
+             "background:#f4f4f4} .bar{position:absolute;top:0;height:12px;background:#4a7ab0}",
+             ".critical{background:#c0392b} .gap{background:#f1c40f;opacity:0.6} td,th{padding:2px 8px;"
+             "text-align:left}",
+             "</style></head><body>",
+             "<h1>Run profile</h1><p>Span {}, {} steps, {:.2f} core-hours.</p>".format(
+                 format_duration(span), len(steps), sum(tool['core_hours'] for tool in profile['tools'].values())),
+             "<h2>Critical path</h2>",
+             row("critical path", [bar(steps[i], "critical") for i in profile['critical_path']]),
+             row("idle gaps", [gap_bars])]
+
+    parts.append("<h2>Samples</h2>")
+    for sample in sorted(profile['samples']):
+        parts.append("<h3>{}</h3>".format(escape(sample)))
+        for i in profile['samples'][sample]:
+            css = "critical" if i in profile['critical_path'] else ""
+            parts.append(row(steps[i]['label'], [bar(steps[i], css)]))
+
+    parts.append("<h2>Tools</h2>")
+    by_tool = defaultdict(list)
+    for step in steps:
+        by_tool[step['tool']].append(step)
+    for tool in sorted(by_tool):
+        parts.append(row(tool, [bar(step, "critical" if step['id'] in profile['critical_path'] else "")
+                                for step in by_tool[tool]]))
+
+    parts.append("<h2>Idle gaps</h2><table><tr><th>Offset</th><th>Length</th><th>Free cores</th>"
+                 "<th>Waiting on</th></tr>")
+    for gap in profile['idle_gaps']:
+        parts.append("<tr><td>+{}</td><td>{}</td><td>{:.1f}</td><td>{}</td></tr>".format(
+            format_duration(gap['start'] - profile['start']), format_duration(gap['end'] - gap['start']),
+            gap['free_cores'],
+            escape(", ".join("{}:{}".format(steps[i]['sample'], steps[i]['label']) for i in gap['blocking']))))
+    parts.append("</table></body></html>")
+
+    return "\n".join(parts) + "\n"
+
+
+def main(argv=None):
+    """Command line entry point: python -m ddb_ngsflow.profiler RUN_DIR [--cores N] [--html report.html]"""
+
+    parser = argparse.ArgumentParser(description="Profile a finished workflow run from its step telemetry")
+    parser.add_argument('paths', nargs='+', help="Run directories or telemetry files")
+    parser.add_argument('-c', '--cores', type=float, default=None, help="Cores available to the run")
+    parser.add_argument('-g', '--min-gap', type=float, default=DEFAULT_MIN_GAP, help="Shortest idle gap reported")
+    parser.add_argument('--html', default=None, help="Write an HTML report to this file")
+    args = parser.parse_args(argv)
+
+    profile = profile_run(args.paths, args.cores, args.min_gap)
+    sys.stdout.write(text_report(profile))
+    if args.html:
+        with open(args.html, 'w') as outfile:
+            outfile.write(html_report(profile))
+
+
+def _tool_name(step):
+    stages = step.get('stages')
+    if stages:
+        return os.path.basename(stages[0]['argv'][0])
+    try:
+        tokens = shlex.split(step['command'])
+    except ValueError:
+        tokens = step['command'].split()
+
+    return os.path.basename(tokens[0]) if tokens else ""
+
+
+def format_duration(seconds):
+    """Render a duration compactly for reports, e.g. 45s, 3m07s or 2h15m
+
+    :param seconds: The duration in seconds.
+    :type seconds: float.
+    :returns:  str -- The rendered duration.
+    """
+
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "{}s".format(seconds)
+    if seconds < 3600:
+        return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+
+    return "{}h{:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+
+
+if __name__ == "__main__":
+    main()
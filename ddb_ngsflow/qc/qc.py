@@ -8,8 +8,24 @@
 
 """
 
+from ddb_ngsflow import plan
 from ddb_ngsflow import pipeline
 
+# Extensions FastQC strips from an input file name to name its reports
+_FASTQC_EXTENSIONS = (".gz", ".bz2", ".txt", ".fastq", ".fq", ".csfastq", ".sam", ".bam")
+
+
+def fastqc_outputs(fastq):
+    """Reports FastQC writes next to a FastQ file with --extract, declared to the step cache since they are not
+    named on the command line"""
+
+    base = fastq
+    for extension in _FASTQC_EXTENSIONS:
+        if base.endswith(extension):
+            base = base[:-len(extension)]
+
+    return ["{}_fastqc.html".format(base), "{}_fastqc.zip".format(base), "{}_fastqc".format(base)]
+
 
 def run_fastqc(job, config, samples):
     """Run FastQC on provided FastQ files
@@ -27,13 +43,14 @@ def run_fastqc(job, config, samples):
         fastq_files_list.append(samples[sample]['fastq1'])
         fastq_files_list.append(samples[sample]['fastq2'])
 
-    fastq_files_string = " ".join(fastq_files_list)
-    command = ["{}".format(config['fastqc']['bin']),
-               "{}".format(fastq_files_string),
-               "--extract"]
+    command = ["{}".format(config['fastqc']['bin'])]
+    command.extend(fastq_files_list)
+    command.append("--extract")
+
+    outputs = [output for fastq in fastq_files_list for output in fastqc_outputs(fastq)]
 
     job.fileStore.logToMaster("FastQC Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, outputs=outputs)
 
 
 def generate_fastqc_summary_report(job, config, samples):
@@ -45,7 +62,11 @@ def generate_fastqc_summary_report(job, config, samples):
     """
 
     job.fileStore.logToMaster("Parsing FastQC results to run-level summary file\n")
-    with open("{}_fastqc_summary.txt".format(config['run_name']), 'w') as summary_file:
+    summary = "{}_fastqc_summary.txt".format(config['run_name'])
+    if plan.record_function("qc.generate_fastqc_summary_report", "fastqc_summary.log", list(), [summary]):
+        return
+
+    with open(summary, 'w') as summary_file:
         for sample in samples:
             sample_fastq_dirs = list()
             if sample['fastq1']:
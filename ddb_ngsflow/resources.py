@@ -0,0 +1,256 @@
+"""
+.. module:: resources
+   :platform: Unix, OSX
+   :synopsis: A module for declaring the cores, memory and disk each wrapper needs and creating Toil jobs with them.
+
+.. moduleauthor:: Daniel Gaston <daniel.gaston@dal.ca>
+
+
+"""
+
+import os
+
+from toil.job import Job
+from toil.job import Promise
+from toil.job import PromisedRequirement
+
+DEFAULT_CORES = 1
+DEFAULT_MEMORY = "2G"
+DEFAULT_DISK = "2G"
+
+_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def declare(cores=None, memory=None, disk=None):
+    """Declare the resources a wrapper needs. Every requirement is either a constant (an int, or a string such as
+    "8G") or one of the requirements built by tool_cores, tool_memory and input_disk, which are computed from the
+    configuration dictionary and the total size of the job's input files when the job is created.
+
+    :param cores: Cores requirement.
+    :type cores: int.
+    :param memory: Memory requirement.
+    :type memory: str.
+    :param disk: Disk requirement.
+    :type disk: str.
+    :returns:  function -- The decorator.
+    """
+
+    def decorator(func):
+        func.resources = {'cores': cores, 'memory': memory, 'disk': disk}
+        return func
+
+    return decorator
+
+
+def tool_cores(tool, default=DEFAULT_CORES):
+    """Cores requirement read from config[tool]['num_cores']
+
+    :param tool: The tool section of the configuration.
+    :type tool: str.
+    :param default: Cores if the tool has no num_cores setting.
+    :type default: int.
+    :returns:  Requirement.
+    """
+
+    return Requirement(tool=tool, key='num_cores', default=default)
+
+
+def tool_memory(tool, default=DEFAULT_MEMORY, input_factor=0):
+    """Memory requirement read from config[tool]['max_mem'] in gigabytes, as used for Java heap sizes, optionally
+    growing with the size of the inputs
+
+    :param tool: The tool section of the configuration.
+    :type tool: str.
+    :param default: Memory if the tool has no max_mem setting.
+    :type default: str.
+    :param input_factor: Additional bytes of memory per byte of input.
+    :type input_factor: float.
+    :returns:  Requirement.
+    """
+
+    return Requirement(tool=tool, key='max_mem', default=default, unit='G', input_factor=input_factor)
+
+
+def input_disk(input_factor=2, extra=DEFAULT_DISK):
+    """Disk requirement proportional to the total size of the inputs
+
+    :param input_factor: Bytes of disk per byte of input.
+    :type input_factor: float.
+    :param extra: Disk needed on top of that.
+    :type extra: str.
+    :returns:  Requirement.
+    """
+
+    return Requirement(default=extra, unit='B', input_factor=input_factor)
+
+
+class Requirement(object):
+    """A resource requirement computed from the configuration and the input size. Kept as a plain class so that it
+    can be pickled together with a Toil job."""
+
+    def __init__(self, tool=None, key=None, default=None, unit=None, input_factor=0):
+        self.tool = tool
+        self.key = key
+        self.default = default
+        self.unit = unit
+        self.input_factor = input_factor
+
+    def __call__(self, config, input_size):
+        value = self.default
+        if self.tool is not None:
+            value = (config.get(self.tool) or dict()).get(self.key, value)
+        if self.unit is None:
+            return int(value)
+
+        return int(to_bytes(value, self.unit) + self.input_factor * input_size)
+
+
+def to_bytes(value, unit='B'):
+    """Convert a size such as 8, "8G" or "512M" to bytes, reading bare numbers in the given unit
+
+    :param value: The size.
+    :type value: str.
+    :param unit: Unit of bare numbers: B, K, M, G or T.
+    :type unit: str.
+    :returns:  int -- The size in bytes.
+    """
+
+    text = "{}".format(value).strip().upper()
+    if text.endswith("B"):
+        # An explicit byte suffix, as in 8GB, 8GiB or 1B, so a bare number is in bytes whatever the unit
+        text = text[:-1]
+        text = text[:-1] if text.endswith("I") else text
+        unit = 'B'
+    text = text or "0"
+    if text[-1] in _UNITS:
+        return int(float(text[:-1]) * _UNITS[text[-1]])
+
+    return int(float(text) * _UNITS.get(unit, 1))
+
+
+def input_files(func, args, kwargs):
+    """Input files of a wrapper call: every argument naming an existing file, directly or in a list, and the files
+    listed for the sample in samples[name]. Unresolved promises are returned separately.
+
+    :param func: The wrapper.
+    :type func: function.
+    :param args: Positional arguments of the call, without the job.
+    :type args: list.
+    :param kwargs: Keyword arguments of the call.
+    :type kwargs: dict.
+    :returns:  tuple -- File names and promises.
+    """
+
+    call = _call_arguments(func, args, kwargs)
+    values = [value for key, value in call.items() if key not in ('config', 'samples')]
+
+    samples = call.get('samples')
+    if isinstance(samples, dict) and call.get('name') in samples:
+        values.extend(samples[call['name']].values())
+
+    files = list()
+    promises = list()
+    for value in values:
+        for item in (value if isinstance(value, (list, tuple)) else [value]):
+            if isinstance(item, Promise):
+                promises.append(item)
+            elif isinstance(item, str) and os.path.isfile(item):
+                files.append(item)
+
+    return files, promises
+
+
+def requirements(func, *args, **kwargs):
+    """Toil requirements of a wrapper call from its declaration. Requirements depending on the size of inputs that
+    are still promises are returned as PromisedRequirements, evaluated once the promises resolve.
+
+    :param func: The wrapper.
+    :type func: function.
+    :returns:  dict -- cores, memory and disk for Toil.
+    """
+
+    declared = getattr(func, 'resources', None) or dict()
+    config = _call_arguments(func, args, kwargs).get('config') or dict()
+    files, promises = input_files(func, args, kwargs)
+    input_size = _total_size(files)
+
+    defaults = {'cores': DEFAULT_CORES, 'memory': DEFAULT_MEMORY, 'disk': DEFAULT_DISK}
+    requirement = dict()
+    for resource, default in defaults.items():
+        spec = declared.get(resource)
+        if spec is None:
+            spec = default
+        if not isinstance(spec, Requirement):
+            requirement[resource] = int(spec) if resource == 'cores' else to_bytes(spec)
+        elif promises and spec.input_factor:
+            requirement[resource] = PromisedRequirement(_promised_requirement, spec, config, input_size, *promises)
+        else:
+            requirement[resource] = spec(config, input_size)
+
+    return requirement
+
+
+def job_fn(func, *args, **kwargs):
+    """Wrap a job function in a Toil job using its declared resources. Requirements passed explicitly as
+    keyword arguments take precedence.
+
+    :param func: The wrapper.
+    :type func: function.
+    :returns:  Job -- The Toil job.
+    """
+
+    options = requirements(func, *args, **kwargs)
+    options.update(kwargs)
+
+    return Job.wrapJobFn(func, *args, **options)
+
+
+def add_child_job_fn(job, func, *args, **kwargs):
+    """Add a wrapper as a child of job, using its declared resources
+
+    :param job: The parent job.
+    :type job: Job.
+    :param func: The wrapper.
+    :type func: function.
+    :returns:  Job -- The child job.
+    """
+
+    return job.addChild(job_fn(func, *args, **kwargs))
+
+
+def add_follow_on_job_fn(job, func, *args, **kwargs):
+    """Add a wrapper as a follow-on of job, using its declared resources
+
+    :param job: The preceding job.
+    :type job: Job.
+    :param func: The wrapper.
+    :type func: function.
+    :returns:  Job -- The follow-on job.
+    """
+
+    return job.addFollowOn(job_fn(func, *args, **kwargs))
+
+
+def _promised_requirement(spec, config, input_size, *resolved):
+    files = list()
+    for value in resolved:
+        for item in (value if isinstance(value, (list, tuple)) else [value]):
+            if isinstance(item, str) and os.path.isfile(item):
+                files.append(item)
+
+    return spec(config, input_size + _total_size(files))
+
+
+def _call_arguments(func, args, kwargs):
+    """Map the arguments of a wrapper call, excluding the job, to parameter names"""
+
+    func = getattr(func, '__wrapped__', func)
+    argnames = func.__code__.co_varnames[1:func.__code__.co_argcount]
+    call = dict(zip(argnames, args))
+    call.update(kwargs)
+
+    return call
+
+
+def _total_size(files):
+    return sum(os.path.getsize(path) for path in set(files))
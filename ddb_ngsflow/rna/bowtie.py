@@ -10,6 +10,7 @@
 """
 
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
 
 
 def add_additional_options(command_list, config, flags):
@@ -19,6 +20,8 @@ def add_additional_options(command_list, config, flags):
     return command_list
 
 
+@resources.declare(cores=resources.tool_cores('bowtie'), memory=resources.tool_memory('bowtie', "4G"),
+                   disk=resources.input_disk(3))
 def bowtie_unpaired(job, config, name, samples, flags):
     """Align RNA-Seq data to a reference using Bowtie2
     :param config: The configuration dictionary.
@@ -37,20 +40,26 @@ def bowtie_unpaired(job, config, name, samples, flags):
         samples[name]['fastq1'] = samples[name]['unmapped_fastq']
 
     command = ["{}".format(config['bowtie']['bin']),
-               "-x {}".format(config['bowtie']['index']),
-               "-p {}".format(config['bowtie']['num_cores']),
-               "-U {}".format(samples[name]['fastq1']),
-               "-S {}".format(output)
+               "-x",
+               "{}".format(config['bowtie']['index']),
+               "-p",
+               "{}".format(config['bowtie']['num_cores']),
+               "-U",
+               "{}".format(samples[name]['fastq1']),
+               "-S",
+               "{}".format(output)
                ]
 
     command = add_additional_options(command, config, flags)
 
     job.fileStore.logToMaster("Bowtie Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return output
 
 
+@resources.declare(cores=resources.tool_cores('bowtie'), memory=resources.tool_memory('bowtie', "4G"),
+                   disk=resources.input_disk(3))
 def bowtie_paired(job, config, name, samples, flags):
     """Align RNA-Seq data to a reference using Bowtie2
     :param config: The configuration dictionary.
@@ -66,16 +75,21 @@ def bowtie_paired(job, config, name, samples, flags):
     logfile = "{}.bowtie.log".format(name)
 
     command = ["{}".format(config['bowtie']['bin']),
-               "-x {}".format(config['bowtie']['index']),
-               "-p {}".format(config['bowtie']['num_cores']),
-               "-1 {}".format(samples[name]['fastq1']),
-               "-2 {}".format(samples[name]['fastq2']),
-               "-S {}".format(output)
+               "-x",
+               "{}".format(config['bowtie']['index']),
+               "-p",
+               "{}".format(config['bowtie']['num_cores']),
+               "-1",
+               "{}".format(samples[name]['fastq1']),
+               "-2",
+               "{}".format(samples[name]['fastq2']),
+               "-S",
+               "{}".format(output)
                ]
 
     command = add_additional_options(command, config, flags)
 
     job.fileStore.logToMaster("Bowtie Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return output
@@ -12,8 +12,11 @@
 import os
 import sys
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
 
 
+@resources.declare(cores=resources.tool_cores('cufflinks'), memory=resources.tool_memory('cufflinks', "8G"),
+                   disk=resources.input_disk())
 def cufflinks(job, config, name, samples):
     """Transcriptome assembly with cufflinks
     :param config: The configuration dictionary.
@@ -38,16 +41,20 @@ def cufflinks(job, config, name, samples):
     os.chdir(path)
 
     command = ["{}".format(config['cufflinks']['bin']),
-               "-g {}".format(config['transcript_reference']),
-               "-b {}".format(config['reference']),
+               "-g",
+               "{}".format(config['transcript_reference']),
+               "-b",
+               "{}".format(config['reference']),
                "-u",
-               "-p {}".format(config['cufflinks']['num_cores']),
-               "--library-type {}".format(samples[name]['cufflinks_lib']),
+               "-p",
+               "{}".format(config['cufflinks']['num_cores']),
+               "--library-type",
+               "{}".format(samples[name]['cufflinks_lib']),
                "{}".format(samples[name]['bam'])]
 
     if not os.path.isfile("transcripts.gtf"):
         job.fileStore.logToMaster("Cufflinks Command: {}\n".format(command))
-        pipeline.run_and_log_command(" ".join(command), logfile)
+        pipeline.run_pipeline([command], logfile, outputs=[path])
     else:
         job.fileStore.logToMaster("Cufflinks appears to have already executed for {}. Skipping...\n".format(name))
 
@@ -56,6 +63,8 @@ def cufflinks(job, config, name, samples):
     return path
 
 
+@resources.declare(cores=resources.tool_cores('cuffmerge'), memory=resources.tool_memory('cuffmerge', "8G"),
+                   disk=resources.input_disk())
 def cuffmerge(job, config, name, samples, manifest):
     """Merge assembled cufflinks transcriptomes from all samples
     :param config: The configuration dictionary.
@@ -71,13 +80,16 @@ def cuffmerge(job, config, name, samples, manifest):
     logfile = "{}.cuffmerge.log".format(config['run_id'])
 
     command = ["{}".format(config['cuffmerge']['bin']),
-               "-g {}".format(config['transcript_reference']),
-               "-s {}".format(config['reference']),
-               "-p {}".format(config['cuffmerge']['num_cores']),
+               "-g",
+               "{}".format(config['transcript_reference']),
+               "-s",
+               "{}".format(config['reference']),
+               "-p",
+               "{}".format(config['cuffmerge']['num_cores']),
                "{}".format(manifest)]
 
     job.fileStore.logToMaster("Cuffmerge Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     pwd = os.getcwd()
     config['merged_transcript_reference'] = os.path.join(pwd, "merged.gtf")
@@ -85,6 +97,8 @@ def cuffmerge(job, config, name, samples, manifest):
     return stats_root
 
 
+@resources.declare(cores=resources.tool_cores('cuffquant'), memory=resources.tool_memory('cuffquant', "8G"),
+                   disk=resources.input_disk())
 def cuffquant(job, config, name, samples):
     """Run Cuffquant on all samples
     :param config: The configuration dictionary.
@@ -98,20 +112,25 @@ def cuffquant(job, config, name, samples):
     logfile = "{}.cuffquant.log".format(name)
 
     command = ["{}".format(config['cuffquant']['bin']),
-               "-b {}".format(config['reference']),
-               "-p {}".format(config['cuffquant']['num_cores']),
-               "-o ./{}_cuffquant".format(name),
+               "-b",
+               "{}".format(config['reference']),
+               "-p",
+               "{}".format(config['cuffquant']['num_cores']),
+               "-o",
+               "./{}_cuffquant".format(name),
                "-u",
                "{}".format(config['merged_transcript_reference']),
                "{}".format(samples[name]['bam'])
                ]
 
     job.fileStore.logToMaster("Cuffquant Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, outputs=[outdir])
 
     return outdir
 
 
+@resources.declare(cores=resources.tool_cores('cuffquant'), memory=resources.tool_memory('cuffquant', "8G"),
+                   disk=resources.input_disk())
 def cuffnorm(job, config, name, samples):
     """Run Cuffnorm on cuffquant results form all samples
     :param config: The configuration dictionary.
@@ -125,14 +144,16 @@ def cuffnorm(job, config, name, samples):
     logfile = "{}.cuffquant.log".format(name)
 
     command = ["{}".format(config['cuffquant']['bin']),
-               "-b {}".format(config['reference']),
-               "-p {}".format(config['cuffquant']['num_cores']),
+               "-b",
+               "{}".format(config['reference']),
+               "-p",
+               "{}".format(config['cuffquant']['num_cores']),
                "-u",
                "{}".format(config['merged_transcript_reference']),
                "{}".format(samples[name]['bam'])
                ]
 
     job.fileStore.logToMaster("Cuffquant Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return outdir
@@ -11,18 +11,21 @@
 
 import os
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
 
 
 def add_additional_options(command_list, config, flags):
     if 'stranded' in flags:
-        command_list.append("--rna-strandness {}".format(config['library-type']))
+        command_list.extend(["--rna-strandness", "{}".format(config['library-type'])])
 
     if 'max_intron' in flags:
-        command_list.append("--max-intronlen {}".format(config['hisat']['max_intron_size']))
+        command_list.extend(["--max-intronlen", "{}".format(config['hisat']['max_intron_size'])])
 
     return command_list
 
 
+@resources.declare(cores=resources.tool_cores('hisat'), memory=resources.tool_memory('hisat', "8G"),
+                   disk=resources.input_disk(3))
 def hisat_paired(job, config, name, samples, flags):
     """Align RNA-Seq data to a reference using HiSat2
     :param config: The configuration dictionary.
@@ -39,11 +42,15 @@ def hisat_paired(job, config, name, samples, flags):
     temp = "{}.hisat.sort.temp".format(name)
 
     hisat_cmd = ["{}".format(config['hisat']['bin']),
-                 "-p {}".format(config['hisat']['num_cores']),
+                 "-p",
+                 "{}".format(config['hisat']['num_cores']),
                  "--dta",
-                 "-x {}".format(config['hisat']['index']),
-                 "-1 {}".format(samples[name]['fastq1']),
-                 "-2 {}".format(samples[name]['fastq2'])
+                 "-x",
+                 "{}".format(config['hisat']['index']),
+                 "-1",
+                 "{}".format(samples[name]['fastq1']),
+                 "-2",
+                 "{}".format(samples[name]['fastq2'])
                  ]
 
     hisat_cmd = add_additional_options(hisat_cmd, config, flags)
@@ -65,14 +72,16 @@ def hisat_paired(job, config, name, samples, flags):
                 "{}".format(temp),
                 "-"]
 
-    command = "{} | {} | {}".format(" ".join(hisat_cmd), " ".join(view_cmd), " ".join(sort_cmd))
+    command = [hisat_cmd, view_cmd, sort_cmd]
 
-    job.fileStore.logToMaster("HiSat2 Command: {}\n".format(command))
-    pipeline.run_and_log_command(command, logfile)
+    job.fileStore.logToMaster("HiSat2 Command: {}\n".format(pipeline.render_pipeline(command)))
+    pipeline.run_pipeline(command, logfile)
 
     return output
 
 
+@resources.declare(cores=resources.tool_cores('hisat'), memory=resources.tool_memory('hisat', "8G"),
+                   disk=resources.input_disk(3))
 def hisat_unpaired(job, config, name, samples, flags):
     """Align RNA-Seq data to a reference using HiSat2
     :param config: The configuration dictionary.
@@ -92,11 +101,15 @@ def hisat_unpaired(job, config, name, samples, flags):
     temp = "{}.hisat.sort.temp".format(name)
 
     hisat_cmd = ["{}".format(config['hisat']['bin']),
-                 "-p {}".format(config['hisat']['num_cores']),
+                 "-p",
+                 "{}".format(config['hisat']['num_cores']),
                  "--dta",
-                 "-x {}".format(config['hisat']['index']),
-                 "-U {}".format(samples[name]['fastq1']),
-                 "--un {}".format(unaligned)
+                 "-x",
+                 "{}".format(config['hisat']['index']),
+                 "-U",
+                 "{}".format(samples[name]['fastq1']),
+                 "--un",
+                 "{}".format(unaligned)
                  ]
 
     hisat_cmd = add_additional_options(hisat_cmd, config, flags)
@@ -118,9 +131,9 @@ def hisat_unpaired(job, config, name, samples, flags):
                 "{}".format(temp),
                 "-"]
 
-    command = "{} | {} | {}".format(" ".join(hisat_cmd), " ".join(view_cmd), " ".join(sort_cmd))
+    command = [hisat_cmd, view_cmd, sort_cmd]
 
-    job.fileStore.logToMaster("HiSat2 Command: {}\n".format(command))
-    pipeline.run_and_log_command(command, logfile)
+    job.fileStore.logToMaster("HiSat2 Command: {}\n".format(pipeline.render_pipeline(command)))
+    pipeline.run_pipeline(command, logfile)
 
     return output
@@ -10,9 +10,12 @@
 """
 
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
 from exceptions import NotImplementedError
 
 
+@resources.declare(cores=resources.tool_cores('rapmap'), memory=resources.tool_memory('rapmap', "8G"),
+                   disk=resources.input_disk(3))
 def rapmap_quasi_unpaired(job, config, name, samples, flags):
     """Run RapMap Quasi-Mapping procedure on unpaired sequencing data
     :param config: The configuration dictionary.
@@ -27,19 +30,26 @@ def rapmap_quasi_unpaired(job, config, name, samples, flags):
     output = "{}.rapmap.sam".format(name)
     logfile = "{}.rapmap_quasi.log".format(name)
 
-    command = ["{} quasimap".format(config['rapmap']['bin']),
-               "-t {}".format(config['rapmap']['num_cores']),
-               "-i {}".format(config['rapmap']['index']),
-               "-r {}".format(samples[name]['fastq1']),
-               "-o {}".format(output)
+    command = ["{}".format(config['rapmap']['bin']),
+               "quasimap",
+               "-t",
+               "{}".format(config['rapmap']['num_cores']),
+               "-i",
+               "{}".format(config['rapmap']['index']),
+               "-r",
+               "{}".format(samples[name]['fastq1']),
+               "-o",
+               "{}".format(output)
                ]
 
     job.fileStore.logToMaster("RapMap Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return output
 
 
+@resources.declare(cores=resources.tool_cores('rapmap'), memory=resources.tool_memory('rapmap', "8G"),
+                   disk=resources.input_disk(3))
 def rapmap_quasi_paired(job, config, name, samples, flags):
     """Run RapMap Quasi-Mapping procedure on paired-end sequencing data
     :param config: The configuration dictionary.
@@ -54,16 +64,22 @@ def rapmap_quasi_paired(job, config, name, samples, flags):
     output = "{}.rapmap.sam".format(name)
     logfile = "{}.rapmap_quasi.log".format(name)
 
-    command = ["{} quasimap".format(config['rapmap']['bin']),
-               "-t {}".format(config['rapmap']['num_cores']),
-               "-i {}".format(config['rapmap']['index']),
-               "-1 {}".format(samples[name]['fastq1']),
-               "-2 {}".format(samples[name]['fastq2']),
-               "-o {}".format(output)
+    command = ["{}".format(config['rapmap']['bin']),
+               "quasimap",
+               "-t",
+               "{}".format(config['rapmap']['num_cores']),
+               "-i",
+               "{}".format(config['rapmap']['index']),
+               "-1",
+               "{}".format(samples[name]['fastq1']),
+               "-2",
+               "{}".format(samples[name]['fastq2']),
+               "-o",
+               "{}".format(output)
                ]
 
     job.fileStore.logToMaster("RapMap Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return output
 
@@ -85,7 +101,7 @@ def rapmap_pseudo_unpaired(job, config, name, samples, flags):
     command = []
 
     # job.fileStore.logToMaster("RapMap Command: {}\n".format(command))
-    # pipeline.run_and_log_command(" ".join(command), logfile)
+    # pipeline.run_pipeline([command], logfile)
 
     return NotImplementedError
 
@@ -107,6 +123,6 @@ def rapmap_pseudo_paired(job, config, name, samples, flags):
     command = []
 
     # job.fileStore.logToMaster("RapMap Command: {}\n".format(command))
-    # pipeline.run_and_log_command(" ".join(command), logfile)
+    # pipeline.run_pipeline([command], logfile)
 
     return NotImplementedError
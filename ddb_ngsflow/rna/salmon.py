@@ -10,8 +10,11 @@
 """
 
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
 
 
+@resources.declare(cores=resources.tool_cores('salmon'), memory=resources.tool_memory('salmon', "8G"),
+                   disk=resources.input_disk())
 def salmonVB_paired(job, config, name, samples):
     """Run Salmon Quasi-Mapping with Paired-End data using the VB optimization algorithm
     :param config: The configuration dictionary.
@@ -26,25 +29,35 @@ def salmonVB_paired(job, config, name, samples):
     output_dir = "{}.salmon.output".format(name)
     logfile = "{}.salmon.log".format(name)
 
-    command = ["{} quant".format(config['salmon']['bin']),
-               "-i {}".format(config['salmon']['index']),
-               "-l {}".format(samples[name]['library_type']),
-               "-p {}".format(config['salmon']['num_cores']),
+    command = ["{}".format(config['salmon']['bin']),
+               "quant",
+               "-i",
+               "{}".format(config['salmon']['index']),
+               "-l",
+               "{}".format(samples[name]['library_type']),
+               "-p",
+               "{}".format(config['salmon']['num_cores']),
                "--useVBOpt",
-               "--numBootstraps {}".format(config['salmon']['num_bootstraps']),
+               "--numBootstraps",
+               "{}".format(config['salmon']['num_bootstraps']),
                "--biasCorrect",
                "--useFSPD",
-               "-1 {}".format(samples[name]['fastq1']),
-               "-2 {}".format(samples[name]['fastq2']),
-               "-o {}".format(output_dir)
+               "-1",
+               "{}".format(samples[name]['fastq1']),
+               "-2",
+               "{}".format(samples[name]['fastq2']),
+               "-o",
+               "{}".format(output_dir)
                ]
 
     job.fileStore.logToMaster("Salmon Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, outputs=[output_dir])
 
     return output_dir
 
 
+@resources.declare(cores=resources.tool_cores('salmon'), memory=resources.tool_memory('salmon', "8G"),
+                   disk=resources.input_disk())
 def salmonEM_paired(job, config, name, samples):
     """Run Salmon Quasi-Mapping with Paired-End data using the EM optimization algorithm
     :param config: The configuration dictionary.
@@ -59,24 +72,34 @@ def salmonEM_paired(job, config, name, samples):
     output_dir = "{}.salmon.output".format(name)
     logfile = "{}.salmon.log".format(name)
 
-    command = ["{} quant".format(config['salmon']['bin']),
-               "-i {}".format(config['salmon']['index']),
-               "-l {}".format(samples[name]['library_type']),
-               "-p {}".format(config['salmon']['num_cores']),
-               "--numBootstraps {}".format(config['salmon']['num_bootstraps']),
+    command = ["{}".format(config['salmon']['bin']),
+               "quant",
+               "-i",
+               "{}".format(config['salmon']['index']),
+               "-l",
+               "{}".format(samples[name]['library_type']),
+               "-p",
+               "{}".format(config['salmon']['num_cores']),
+               "--numBootstraps",
+               "{}".format(config['salmon']['num_bootstraps']),
                "--biasCorrect",
                "--useFSPD",
-               "-1 {}".format(samples[name]['fastq1']),
-               "-2 {}".format(samples[name]['fastq2']),
-               "-o {}".format(output_dir)
+               "-1",
+               "{}".format(samples[name]['fastq1']),
+               "-2",
+               "{}".format(samples[name]['fastq2']),
+               "-o",
+               "{}".format(output_dir)
                ]
 
     job.fileStore.logToMaster("Salmon Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, outputs=[output_dir])
 
     return output_dir
 
 
+@resources.declare(cores=resources.tool_cores('salmon'), memory=resources.tool_memory('salmon', "8G"),
+                   disk=resources.input_disk())
 def salmonVB_unpaired(job, config, name, samples):
     """Run Salmon Quasi-Mapping with single-end data using the VB optimization algorithm
     :param config: The configuration dictionary.
@@ -91,24 +114,33 @@ def salmonVB_unpaired(job, config, name, samples):
     output_dir = "{}.salmon.output".format(name)
     logfile = "{}.salmon.log".format(name)
 
-    command = ["{} quant".format(config['salmon']['bin']),
-               "-i {}".format(config['salmon']['index']),
-               "-l {}".format(samples[name]['library_type']),
-               "-p {}".format(config['salmon']['num_cores']),
+    command = ["{}".format(config['salmon']['bin']),
+               "quant",
+               "-i",
+               "{}".format(config['salmon']['index']),
+               "-l",
+               "{}".format(samples[name]['library_type']),
+               "-p",
+               "{}".format(config['salmon']['num_cores']),
                "--useVBOpt",
-               "--numBootstraps {}".format(config['salmon']['num_bootstraps']),
+               "--numBootstraps",
+               "{}".format(config['salmon']['num_bootstraps']),
                "--biasCorrect",
                "--useFSPD",
-               "-r {}".format(samples[name]['fastq1']),
-               "-o {}".format(output_dir)
+               "-r",
+               "{}".format(samples[name]['fastq1']),
+               "-o",
+               "{}".format(output_dir)
                ]
 
     job.fileStore.logToMaster("Salmon Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, outputs=[output_dir])
 
     return output_dir
 
 
+@resources.declare(cores=resources.tool_cores('salmon'), memory=resources.tool_memory('salmon', "8G"),
+                   disk=resources.input_disk())
 def salmonEM_unpaired(job, config, name, samples):
     """Run Salmon Quasi-Mapping with single end data using the EM optimization algorithm
     :param config: The configuration dictionary.
@@ -123,23 +155,32 @@ def salmonEM_unpaired(job, config, name, samples):
     output_dir = "{}.salmon_quant".format(name)
     logfile = "{}.salmon.log".format(name)
 
-    command = ["{} quant".format(config['salmon']['bin']),
-               "-i {}".format(config['salmon']['index']),
-               "-l {}".format(samples[name]['library_type']),
-               "-p {}".format(config['salmon']['num_cores']),
-               "--numBootstraps {}".format(config['salmon']['num_bootstraps']),
+    command = ["{}".format(config['salmon']['bin']),
+               "quant",
+               "-i",
+               "{}".format(config['salmon']['index']),
+               "-l",
+               "{}".format(samples[name]['library_type']),
+               "-p",
+               "{}".format(config['salmon']['num_cores']),
+               "--numBootstraps",
+               "{}".format(config['salmon']['num_bootstraps']),
                "--biasCorrect",
                "--useFSPD",
-               "-r {}".format(samples[name]['fastq1']),
-               "-o {}".format(output_dir)
+               "-r",
+               "{}".format(samples[name]['fastq1']),
+               "-o",
+               "{}".format(output_dir)
                ]
 
     job.fileStore.logToMaster("Salmon Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, outputs=[output_dir])
 
     return output_dir
 
 
+@resources.declare(cores=resources.tool_cores('salmon'), memory=resources.tool_memory('salmon', "8G"),
+                   disk=resources.input_disk())
 def salmonAlignEM(job, config, name, samples):
     """Run Salmon Quasi-Mapping with single end data using the EM optimization algorithm
     :param config: The configuration dictionary.
@@ -154,18 +195,24 @@ def salmonAlignEM(job, config, name, samples):
     output_dir = "{}.salmon_quant".format(name)
     logfile = "{}.salmon.log".format(name)
 
-    command = ["{} quant".format(config['salmon']['bin']),
-               "-t {}".format(config['salmon']['transcripts']),
-               "-l {}".format(samples[name]['library_type']),
-               "-p {}".format(config['salmon']['num_cores']),
+    command = ["{}".format(config['salmon']['bin']),
+               "quant",
+               "-t",
+               "{}".format(config['salmon']['transcripts']),
+               "-l",
+               "{}".format(samples[name]['library_type']),
+               "-p",
+               "{}".format(config['salmon']['num_cores']),
                # "--numBootstraps {}".format(config['salmon']['num_bootstraps']),
                "--biasCorrect",
                "--useFSPD",
-               "-a {}".format(samples[name]['bam']),
-               "-o {}".format(output_dir)
+               "-a",
+               "{}".format(samples[name]['bam']),
+               "-o",
+               "{}".format(output_dir)
                ]
 
     job.fileStore.logToMaster("Salmon Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, outputs=[output_dir])
 
     return output_dir
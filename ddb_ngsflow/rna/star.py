@@ -10,37 +10,59 @@
 """
 
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
 
 
 def add_additional_options(command_list, config, flags):
     if 'compressed' in flags:
-        command_list.append("--readFilesCommand {}".format(config['compression']))
+        command_list.append("--readFilesCommand")
+        command_list.extend("{}".format(config['compression']).split())
 
     if 'encode_options' in flags:
-        encode_options = ["--outFilterType BySJout",
-                          "--outFilterMultimapNmax 20",
-                          "--alignSJDBoverhangMin 1",
-                          "--outFilterMismatchNMax 999",
-                          "--alignIntronMin 20",
-                          "--alignIntronMax 1000000",
-                          "--alignMatesGapMax 1000000"]
+        encode_options = ["--outFilterType",
+                          "BySJout",
+                          "--outFilterMultimapNmax",
+                          "20",
+                          "--alignSJDBoverhangMin",
+                          "1",
+                          "--outFilterMismatchNMax",
+                          "999",
+                          "--alignIntronMin",
+                          "20",
+                          "--alignIntronMax",
+                          "1000000",
+                          "--alignMatesGapMax",
+                          "1000000"]
         command_list.extend(encode_options)
 
     if 'unstranded' in flags:
-        command_list.append("--outSAMstrandField intronMotif")
+        command_list.extend(["--outSAMstrandField", "intronMotif"])
 
     if 'removeNonCanonical' in flags:
-        command_list.append("--outFilterIntronMotifs RemoveNoncanonical")
+        command_list.extend(["--outFilterIntronMotifs", "RemoveNoncanonical"])
 
     if 'cufflinks' in flags:
-        command_list.append("--alignEndsType EndToEnd")
+        command_list.extend(["--alignEndsType", "EndToEnd"])
 
     if 'limit_bam_sort_ram' in flags:
-        command_list.append("--limitBAMsortRAM 1041088739")
+        command_list.extend(["--limitBAMsortRAM", "1041088739"])
 
     return command_list
 
 
+def star_outputs(prefix, command):
+    """Files STAR writes under its output prefix, declared to the step cache since they are not named on the command
+    line"""
+
+    suffixes = ["Aligned.sortedByCoord.out.bam", "Log.final.out", "Log.out", "Log.progress.out", "SJ.out.tab"]
+    if "--outReadsUnmapped" in command:
+        suffixes.extend(["Unmapped.out.mate1", "Unmapped.out.mate2"])
+
+    return ["{}{}".format(prefix, suffix) for suffix in suffixes]
+
+
+@resources.declare(cores=resources.tool_cores('star'), memory=resources.tool_memory('star', "32G"),
+                   disk=resources.input_disk(3))
 def star_paired(job, config, name, samples, flags):
     """Align RNA-Seq data to a reference using STAR
     :param config: The configuration dictionary.
@@ -57,21 +79,31 @@ def star_paired(job, config, name, samples, flags):
     output_file = "{}Aligned.sortedByCoord.out.bam".format(output)
 
     command = ["{}".format(config['star']['bin']),
-               "--genomeDir {}".format(config['star']['index']),
-               "--runThreadN {}".format(config['star']['num_cores']),
-               "--readFilesIn {} {}".format(samples[name]['fastq1'], samples[name]['fastq2']),
-               "--outFileNamePrefix {}".format(output),
-               "--outReadsUnmapped Fastx",
-               "--outSAMtype BAM SortedByCoordinate"
+               "--genomeDir",
+               "{}".format(config['star']['index']),
+               "--runThreadN",
+               "{}".format(config['star']['num_cores']),
+               "--readFilesIn",
+               "{}".format(samples[name]['fastq1']),
+               "{}".format(samples[name]['fastq2']),
+               "--outFileNamePrefix",
+               "{}".format(output),
+               "--outReadsUnmapped",
+               "Fastx",
+               "--outSAMtype",
+               "BAM",
+               "SortedByCoordinate"
                ]
 
     command = add_additional_options(command, config, flags)
 
     job.fileStore.logToMaster("STAR Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, outputs=star_outputs(output, command))
 
     return output_file
 
+@resources.declare(cores=resources.tool_cores('star'), memory=resources.tool_memory('star', "32G"),
+                   disk=resources.input_disk(3))
 def star_paired_illumina_minimal(job, config, name, samples, flags):
     """Align RNA-Seq data to a reference using STAR
     :param config: The configuration dictionary.
@@ -88,32 +120,57 @@ def star_paired_illumina_minimal(job, config, name, samples, flags):
     output_file = "{}Aligned.sortedByCoord.out.bam".format(output)
 
     command = ["{}".format(config['star']['bin']),
-               "--genomeDir {}".format(config['star']['index']),
-               "--runThreadN {}".format(config['star']['num_cores']),
-               "--readFilesIn {} {}".format(samples[name]['fastq1'], samples[name]['fastq2']),
-               "--outFileNamePrefix {}".format(output),
+               "--genomeDir",
+               "{}".format(config['star']['index']),
+               "--runThreadN",
+               "{}".format(config['star']['num_cores']),
+               "--readFilesIn",
+               "{}".format(samples[name]['fastq1']),
+               "{}".format(samples[name]['fastq2']),
+               "--outFileNamePrefix",
+               "{}".format(output),
                # "--outReadsUnmapped Fastx",
-               "--outSAMtype BAM SortedByCoordinate"
-               "--outSAMmapqUnique 50",
-               "--outFilterType BySJout",
-               "--outSJfilterCountUniqueMin -1 2 2 2",
-               "--outSJfilterCountTotalMin -1 2 2 2",
-               "--outFilterIntronMotifs RemoveNoncanonical",
-               "--chimSegmentMin 12",
-               "--chimJunctionOverhangMin 12",
-               "--chimScoreDropMax 30",
-               "--chimSegmentReadGapMax 5",
-               "--chimScoreSeparation 5"
+               "--outSAMtype",
+               "BAM",
+               "SortedByCoordinate",
+               "--outSAMmapqUnique",
+               "50",
+               "--outFilterType",
+               "BySJout",
+               "--outSJfilterCountUniqueMin",
+               "-1",
+               "2",
+               "2",
+               "2",
+               "--outSJfilterCountTotalMin",
+               "-1",
+               "2",
+               "2",
+               "2",
+               "--outFilterIntronMotifs",
+               "RemoveNoncanonical",
+               "--chimSegmentMin",
+               "12",
+               "--chimJunctionOverhangMin",
+               "12",
+               "--chimScoreDropMax",
+               "30",
+               "--chimSegmentReadGapMax",
+               "5",
+               "--chimScoreSeparation",
+               "5"
                ]
 
     command = add_additional_options(command, config, flags)
 
     job.fileStore.logToMaster("STAR Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, outputs=star_outputs(output, command))
 
     return output_file
 
 
+@resources.declare(cores=resources.tool_cores('star'), memory=resources.tool_memory('star', "32G"),
+                   disk=resources.input_disk(3))
 def star_unpaired(job, config, name, samples, flags):
     """Align RNA-Seq data to a reference using STAR
     :param config: The configuration dictionary.
@@ -130,17 +187,24 @@ def star_unpaired(job, config, name, samples, flags):
     output_file = "{}Aligned.sortedByCoord.out.bam".format(output)
 
     command = ["{}".format(config['star']['bin']),
-               "--genomeDir {}".format(config['star']['index']),
-               "--runThreadN {}".format(config['star']['num_cores']),
-               "--readFilesIn {}".format(samples[name]['fastq1']),
-               "--outFileNamePrefix {}".format(output),
-               "--outReadsUnmapped Fastx",
-               "--outSAMtype BAM SortedByCoordinate"
+               "--genomeDir",
+               "{}".format(config['star']['index']),
+               "--runThreadN",
+               "{}".format(config['star']['num_cores']),
+               "--readFilesIn",
+               "{}".format(samples[name]['fastq1']),
+               "--outFileNamePrefix",
+               "{}".format(output),
+               "--outReadsUnmapped",
+               "Fastx",
+               "--outSAMtype",
+               "BAM",
+               "SortedByCoordinate"
                ]
 
     command = add_additional_options(command, config, flags)
 
     job.fileStore.logToMaster("STAR Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, outputs=star_outputs(output, command))
 
     return output_file
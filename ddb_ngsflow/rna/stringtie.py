@@ -11,6 +11,7 @@
 
 import os
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
 
 
 def add_additional_options(command_list, config, flags):
@@ -20,6 +21,8 @@ def add_additional_options(command_list, config, flags):
     return command_list
 
 
+@resources.declare(cores=resources.tool_cores('stringtie'), memory=resources.tool_memory('stringtie', "4G"),
+                   disk=resources.input_disk())
 def stringtie_first(job, config, name, samples, flags):
     """Perform transcript assembly and quantification with StringTie
     :param config: The configuration dictionary.
@@ -38,21 +41,28 @@ def stringtie_first(job, config, name, samples, flags):
 
     command = ["{}".format(config['stringtie']['bin']),
                "{}".format(samples[name]['bam']),
-               "-p {}".format(config['stringtie']['num_cores']),
-               "-G {}".format(config['transcript_reference']),
-               "-f 0.05",
-               "-m 100",
-               "-o {}".format(outfile)
+               "-p",
+               "{}".format(config['stringtie']['num_cores']),
+               "-G",
+               "{}".format(config['transcript_reference']),
+               "-f",
+               "0.05",
+               "-m",
+               "100",
+               "-o",
+               "{}".format(outfile)
                ]
 
     command = add_additional_options(command, config, flags)
 
     job.fileStore.logToMaster("StringTie Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return outfile
 
 
+@resources.declare(cores=resources.tool_cores('stringtie'), memory=resources.tool_memory('stringtie', "4G"),
+                   disk=resources.input_disk())
 def stringtie(job, config, name, samples, flags):
     """Perform transcript assembly and quantification with StringTie
     :param config: The configuration dictionary.
@@ -77,24 +87,32 @@ def stringtie(job, config, name, samples, flags):
 
     command = ["{}".format(config['stringtie']['bin']),
                "{}".format(samples[name]['bam']),
-               "-p {}".format(config['stringtie']['num_cores']),
-               "-G {}".format(config['merged_transcript_reference']),
-               "-A {}".format(abundances_file),
-               "-f 0.05",
-               "-m 100",
+               "-p",
+               "{}".format(config['stringtie']['num_cores']),
+               "-G",
+               "{}".format(config['merged_transcript_reference']),
+               "-A",
+               "{}".format(abundances_file),
+               "-f",
+               "0.05",
+               "-m",
+               "100",
                "-B",
                "-e",
-               "-o {}".format(full_path_outfile)
+               "-o",
+               "{}".format(full_path_outfile)
                ]
 
     command = add_additional_options(command, config, flags)
 
     job.fileStore.logToMaster("StringTie Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return outfile
 
 
+@resources.declare(cores=resources.tool_cores('stringtie'), memory=resources.tool_memory('stringtie', "4G"),
+                   disk=resources.input_disk())
 def stringtie_merge(job, config, samples, flags, transcripts_list):
     """Perform transcript assembly and quantification with StringTie
     :param config: The configuration dictionary.
@@ -114,14 +132,17 @@ def stringtie_merge(job, config, samples, flags, transcripts_list):
     command = ["{}".format(config['stringtie']['bin']),
                "{}".format(transcripts_list),
                "--merge",
-               "-p {}".format(config['stringtie']['num_cores']),
-               "-G {}".format(config['transcript_reference']),
-               "-o {}".format(outfile)
+               "-p",
+               "{}".format(config['stringtie']['num_cores']),
+               "-G",
+               "{}".format(config['transcript_reference']),
+               "-o",
+               "{}".format(outfile)
                ]
 
     command = add_additional_options(command, config, flags)
 
     job.fileStore.logToMaster("StringTie Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return outfile
@@ -0,0 +1,451 @@
+"""
+.. module:: scatter
+   :platform: Unix, OSX
+   :synopsis: A module for running variant callers as region shards in parallel and gathering their results.
+
+.. moduleauthor:: Daniel Gaston <daniel.gaston@dal.ca>
+
+
+"""
+
+import os
+import gzip
+import copy
+import heapq
+import functools
+
+from ddb_ngsflow import plan
+from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
+from ddb_ngsflow.utils import bgzf
+
+# Number of shards a declared caller is split into unless config['<caller>']['shards'] or config['scatter_shards']
+# says otherwise. A value of 1 runs the caller as a single job, so scattering is opt-in.
+DEFAULT_SHARDS = 1
+
+
+def scatter_by_regions(caller):
+    """Declare a variant caller wrapper as scatter-gather capable. The wrapper must take config, name and samples
+    (reading its target regions from samples[name]['regions']) and return the name of its output VCF. When the
+    decorated wrapper runs as a Toil job with more than one shard configured, the regions BED, or the whole reference
+    if the sample has no regions, is split into balanced shards, the wrapper runs on every shard as a child job in
+    its own working directory, with the resources it declares, and a follow-on job gathers the shard VCFs. Either
+    way the decorated wrapper returns {name}.{caller}.vcf.gz, sorted, bgzipped and tabix indexed.
+
+    :param caller: Caller name, used for config lookup and output file names.
+    :type caller: str.
+    :returns:  function -- The decorator.
+    """
+
+    def decorator(func):
+        argnames = func.__code__.co_varnames[1:func.__code__.co_argcount]
+
+        @functools.wraps(func)
+        def wrapper(job, *args, **kwargs):
+            shard_dir = kwargs.pop('scatter_shard_dir', None)
+            call = dict(zip(argnames, args))
+            call.update(kwargs)
+
+            if shard_dir:
+                return _run_shard(job, func, call, shard_dir)
+
+            shards = num_shards(call['config'], caller)
+            if shards < 2:
+                return _index_output(job, call['config'], call['name'], caller, func(job, **call))
+
+            return _scatter(job, wrapper, caller, call, shards)
+
+        wrapper.__wrapped__ = func
+        return wrapper
+
+    return decorator
+
+
+def num_shards(config, caller):
+    """Number of region shards configured for a caller
+
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param caller: caller name.
+    :type caller: str.
+    :returns:  int -- The number of shards.
+    """
+
+    tool_config = config.get(caller) or dict()
+
+    return int(tool_config.get('shards', config.get('scatter_shards', DEFAULT_SHARDS)))
+
+
+def contig_order(reference):
+    """Read the contig order of a reference from its samtools faidx index, if there is one
+
+    :param reference: The reference FASTA file name.
+    :type reference: str.
+    :returns:  list -- Tuples of contig name and length, in reference order.
+    """
+
+    fai = "{}.fai".format(reference)
+    contigs = list()
+    if os.path.exists(fai):
+        with open(fai, 'r') as index:
+            for line in index:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) > 1:
+                    contigs.append((fields[0], int(fields[1])))
+
+    return contigs
+
+
+def read_regions(regions):
+    """Read the intervals of a BED file, skipping track, browser and comment lines
+
+    :param regions: The BED file name.
+    :type regions: str.
+    :returns:  list -- Lists of the fields of every interval, with integer start and end.
+    """
+
+    intervals = list()
+    with open(regions, 'r') as bed:
+        for line in bed:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            fields[1] = int(fields[1])
+            fields[2] = int(fields[2])
+            intervals.append(fields)
+
+    return intervals
+
+
+def split_regions(intervals, shards, output_dir, contigs=None):
+    """Split intervals into contiguous, genomically ordered shards of roughly equal total length and write each
+    shard as a BED file. Intervals longer than a shard are cut into pieces so that no shard is left empty.
+
+    :param intervals: Intervals as returned by read_regions.
+    :type intervals: list.
+    :param shards: The number of shards.
+    :type shards: int.
+    :param output_dir: Directory to write the shard BED files to.
+    :type output_dir: str.
+    :param contigs: Contig names in sort order. Contigs are ordered by first appearance if not specified.
+    :type contigs: list.
+    :returns:  list -- The shard BED file names, in genomic order.
+    """
+
+    rank = contig_rank(contigs or [fields[0] for fields in intervals])
+    intervals = sorted(intervals, key=lambda fields: (rank(fields[0]), fields[1], fields[2]))
+
+    total = sum(fields[2] - fields[1] for fields in intervals)
+    shards = max(1, min(shards, total))
+    target = max(1, -(-total // shards))
+
+    pieces = list()
+    for fields in intervals:
+        start = fields[1]
+        while fields[2] - start > target:
+            pieces.append([fields[0], start, start + target])
+            start += target
+        pieces.append([fields[0], start] + fields[2:])
+
+    _makedirs(output_dir)
+    shard_files = list()
+    handle = None
+    filled = 0
+    for fields in pieces:
+        if handle is None or (filled >= target * len(shard_files) and len(shard_files) < shards):
+            if handle is not None:
+                handle.close()
+            shard_files.append(os.path.join(output_dir, "shard-{:03d}.bed".format(len(shard_files))))
+            handle = open(shard_files[-1], 'w')
+        handle.write("{}\n".format("\t".join("{}".format(field) for field in fields)))
+        filled += fields[2] - fields[1]
+    if handle is not None:
+        handle.close()
+
+    return shard_files
+
+
+def merge_sorted_vcfs(vcf_files, output_vcf, contigs=None):
+    """Merge VCF files covering disjoint regions into one position sorted VCF. Meta-information lines of all inputs
+    are kept once, records are streamed through a k-way merge and identical records called in more than one shard
+    (variants spanning a shard boundary) are written once. An output ending in .gz is written as BGZF and tabix
+    indexed in the same pass.
+
+    :param vcf_files: The VCF files to merge, plain or gzipped.
+    :type vcf_files: list.
+    :param output_vcf: The output VCF file name, plain or .gz.
+    :type output_vcf: str.
+    :param contigs: Contig names in sort order. Contigs are ordered by first appearance if not specified.
+    :type contigs: list.
+    :returns:  int -- The number of records written.
+    """
+
+    meta = list()
+    seen = set()
+    column_header = None
+    for vcf_file in vcf_files:
+        with open_vcf(vcf_file) as vcf:
+            for line in vcf:
+                if line.startswith("##"):
+                    if line not in seen:
+                        seen.add(line)
+                        meta.append(line)
+                elif line.startswith("#"):
+                    column_header = column_header or line
+                else:
+                    break
+
+    rank = contig_rank(contigs or list())
+    written = 0
+    indexed = output_vcf.endswith(".gz")
+    output = bgzf.IndexedVcfWriter(output_vcf) if indexed else open(output_vcf, 'w')
+    write_record = output.write_record if indexed else output.write
+    try:
+        for line in meta + ([column_header] if column_header else list()):
+            if indexed:
+                output.write_header(line)
+            else:
+                output.write(line)
+
+        last_position = None
+        written_here = set()
+        for key, line in heapq.merge(*[vcf_records(vcf_file, rank) for vcf_file in vcf_files]):
+            position = key[:2]
+            if position != last_position:
+                last_position = position
+                written_here = set()
+            if key in written_here:
+                continue
+            written_here.add(key)
+            write_record(line if line.endswith("\n") else "{}\n".format(line))
+            written += 1
+    except Exception:
+        output.close()
+        _remove_output(output_vcf)
+        raise
+    output.close()
+
+    return written
+
+
+def _remove_output(output_vcf):
+    for path in (output_vcf, "{}.tbi".format(output_vcf)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@resources.declare(disk=resources.input_disk(2))
+def gather_vcfs(job, config, name, caller, shard_vcfs, contigs=None):
+    """Gather the shard VCFs of a scattered caller into one sorted, bgzipped and tabix indexed VCF, written and
+    indexed in a single pass
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param name: sample name.
+    :type name: str.
+    :param caller: caller name.
+    :type caller: str.
+    :param shard_vcfs: The shard VCF file names, in genomic order.
+    :type shard_vcfs: list.
+    :param contigs: Contig names in sort order.
+    :type contigs: list.
+    :returns:  str -- The output vcf file name.
+    """
+
+    bgzip_vcf = "{}.{}.vcf.gz".format(name, caller)
+
+    vcf_files = list()
+    for shard_vcf in shard_vcfs:
+        if isinstance(shard_vcf, str) and os.path.exists(shard_vcf):
+            vcf_files.append(shard_vcf)
+        else:
+            job.fileStore.logToMaster("No output found for {} shard {} of sample {}\n".format(caller, shard_vcf,
+                                                                                              name))
+
+    job.fileStore.logToMaster("Gathering {} {} shard VCFs into {}\n".format(len(vcf_files), caller, bgzip_vcf))
+    logfile = "{}.{}.gather.log".format(name, caller)
+    outputs = [bgzip_vcf, "{}.tbi".format(bgzip_vcf)]
+    if not plan.record_function("scatter.merge_sorted_vcfs", logfile, shard_vcfs, outputs):
+        with pipeline.python_step("scatter.merge_sorted_vcfs", logfile, vcf_files, outputs):
+            merge_sorted_vcfs(vcf_files, bgzip_vcf, contigs)
+
+    return bgzip_vcf
+
+
+def _index_output(job, config, name, caller, output_vcf):
+    """Sort, bgzip and tabix index the VCF of an unscattered caller run, so that it matches the output of a gather.
+    Anything but an existing VCF, such as an exception returned by the wrapper, is passed on as it is."""
+
+    if not isinstance(output_vcf, str) or not (plan.planning() or os.path.exists(output_vcf)):
+        return output_vcf
+
+    bgzip_vcf = "{}.{}.vcf.gz".format(name, caller)
+    logfile = "{}.{}.index.log".format(name, caller)
+    outputs = [bgzip_vcf, "{}.tbi".format(bgzip_vcf)]
+    if not plan.record_function("scatter.merge_sorted_vcfs", logfile, [output_vcf], outputs):
+        job.fileStore.logToMaster("Indexing {} output {} as {}\n".format(caller, output_vcf, bgzip_vcf))
+        contigs = [contig for contig, length in contig_order(config['reference'])]
+        with pipeline.python_step("scatter.merge_sorted_vcfs", logfile, [output_vcf], outputs):
+            merge_sorted_vcfs([output_vcf], bgzip_vcf, contigs)
+
+    return bgzip_vcf
+
+
+def _absolute_paths(value):
+    """Resolve relative paths of existing files and directories in a call, including those nested in the samples
+    and config dictionaries, since shards run in their own directories"""
+
+    if isinstance(value, dict):
+        return dict((key, _absolute_paths(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_absolute_paths(item) for item in value]
+    if isinstance(value, str) and value and os.path.exists(value):
+        return os.path.abspath(value)
+
+    return value
+
+
+def _scatter(job, wrapper, caller, call, shards):
+    """Split the regions of a caller invocation into shards, add a child job per shard and a follow-on gather job.
+    Returns the promise of the gathered VCF."""
+
+    config = call['config']
+    name = call['name']
+    samples = copy.deepcopy(call.get('samples') or dict())
+    work_dir = os.path.abspath("{}.{}.shards".format(name, caller))
+
+    contigs = contig_order(config['reference'])
+    regions = samples.get(name, dict()).get('regions')
+    if regions:
+        intervals = read_regions(regions)
+    else:
+        intervals = [[contig, 0, length] for contig, length in contigs]
+    contig_names = [contig for contig, length in contigs] or _first_seen([fields[0] for fields in intervals])
+
+    shard_beds = split_regions(intervals, shards, work_dir, contig_names)
+    job.fileStore.logToMaster("Scattering {} for sample {} over {} region shards\n".format(caller, name,
+                                                                                         len(shard_beds)))
+
+    # Shards run in their own directories, so relative input paths have to be resolved first
+    call = _absolute_paths(call)
+    samples = _absolute_paths(samples)
+
+    shard_vcfs = list()
+    for i, shard_bed in enumerate(shard_beds):
+        shard_samples = copy.deepcopy(samples)
+        shard_samples.setdefault(name, dict())['regions'] = shard_bed
+        shard_call = dict(call)
+        shard_call['samples'] = shard_samples
+        shard_call['scatter_shard_dir'] = os.path.join(work_dir, "{:03d}".format(i))
+        shard_vcfs.append(resources.add_child_job_fn(job, wrapper, **shard_call).rv())
+
+    return resources.add_follow_on_job_fn(job, gather_vcfs, config, name, caller, shard_vcfs, contig_names).rv()
+
+
+def _run_shard(job, func, call, shard_dir):
+    """Run a caller wrapper on one shard inside its own working directory. Returns the absolute output path."""
+
+    _makedirs(shard_dir)
+    cwd = os.getcwd()
+    os.chdir(shard_dir)
+    try:
+        output = func(job, **call)
+        if isinstance(output, str):
+            output = os.path.abspath(output)
+    finally:
+        os.chdir(cwd)
+
+    return output
+
+
+def contig_rank(contigs):
+    """Sort key for contig names: position in contigs, unknown contigs after all known ones in name order
+
+    :param contigs: Contig names in sort order.
+    :type contigs: list.
+    :returns:  function -- The sort key.
+    """
+
+    ranks = dict((contig, i) for i, contig in enumerate(_first_seen(contigs)))
+
+    def rank(contig):
+        return (0, ranks[contig], "") if contig in ranks else (1, 0, contig)
+
+    return rank
+
+
+def _first_seen(names):
+    seen = set()
+    ordered = list()
+    for name in names:
+        if name not in seen:
+            seen.add(name)
+            ordered.append(name)
+
+    return ordered
+
+
+def open_vcf(vcf_file):
+    """Open a plain, gzipped or bgzipped VCF for reading text
+
+    :param vcf_file: The VCF file name.
+    :type vcf_file: str.
+    :returns:  file -- The open file.
+    """
+
+    if vcf_file.endswith(".gz"):
+        return gzip.open(vcf_file, 'rt')
+
+    return open(vcf_file, 'r')
+
+
+def _record_key(line, rank):
+    fields = line.split("\t", 5)
+
+    return rank(fields[0]), int(fields[1]), fields[3], fields[4]
+
+
+def vcf_records(vcf_file, rank, presorted=False):
+    """Yield (sort key, line) for the records of a VCF in sorted order. The file is streamed if it is already sorted
+    and only loaded and sorted in memory if it is not. Sort keys are contig rank, position, REF and ALT.
+
+    :param vcf_file: The VCF file name, plain or gzipped.
+    :type vcf_file: str.
+    :param rank: Contig sort key from contig_rank.
+    :type rank: function.
+    :param presorted: Stream the file in a single pass without checking its order first, failing on the first
+                      record out of order.
+    :type presorted: bool.
+    :returns:  generator -- Tuples of sort key and record line.
+    :raises: ValueError
+    """
+
+    in_order = True
+    previous = None
+    if not presorted:
+        with open_vcf(vcf_file) as vcf:
+            for line in vcf:
+                if line.startswith("#") or not line.strip():
+                    continue
+                key = _record_key(line, rank)[:2]
+                if previous is not None and key < previous:
+                    in_order = False
+                    break
+                previous = key
+
+    previous = None
+    with open_vcf(vcf_file) as vcf:
+        records = ((_record_key(line, rank), line) for line in vcf if not line.startswith("#") and line.strip())
+        if not in_order:
+            records = iter(sorted(records))
+        for record in records:
+            if presorted:
+                if previous is not None and record[0][:2] < previous:
+                    raise ValueError("{} is not sorted at {}:{}".format(vcf_file, record[1].split("\t", 1)[0],
+                                                                         record[0][1]))
+                previous = record[0][:2]
+            yield record
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
@@ -0,0 +1,562 @@
+"""
+.. module:: bgzf
+   :platform: Unix, OSX
+   :synopsis: A module for writing and reading BGZF files and building tabix indexes while writing, so that stages
+   can produce compressed, indexed output in the same pass that creates it.
+
+.. moduleauthor:: Daniel Gaston <daniel.gaston@dal.ca>
+
+
+"""
+
+import os
+import zlib
+import struct
+
+# Uncompressed bytes per block. Kept below 64 KiB, as bgzip does, so that a block of incompressible data still fits
+# the 16 bit block size field.
+BLOCK_SIZE = 0xff00
+COMPRESS_LEVEL = 6
+
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00"
+             b"\x00\x00\x00\x00")
+
+_HEADER = struct.Struct("<4BI2BH2BHH")
+_TRAILER = struct.Struct("<II")
+
+# Tabix presets: (format, sequence column, begin column, end column), columns 1-based, end column 0 if none
+TABIX_VCF = (2, 1, 2, 0)
+TABIX_BED = (0x10000, 1, 2, 3)
+
+_MIN_SHIFT = 14
+_DEPTH = 5
+_META_BIN = 37450
+
+
+def compress_block(data, level=COMPRESS_LEVEL):
+    """Compress up to BLOCK_SIZE bytes into one complete BGZF block
+
+    :param data: The uncompressed bytes.
+    :type data: bytes.
+    :param level: zlib compression level.
+    :type level: int.
+    :returns:  bytes -- The block.
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    header = _HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + _HEADER.size + _TRAILER.size - 1)
+
+    return header + compressed + _TRAILER.pack(zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def read_block(handle):
+    """Read the next BGZF block of a file opened in binary mode
+
+    :param handle: The open file.
+    :type handle: file.
+    :returns:  tuple -- The raw block bytes and the uncompressed data, or None at the end of the file.
+    :raises: ValueError
+    """
+
+    header = handle.read(_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _HEADER.size:
+        raise ValueError("Truncated BGZF block header")
+
+    fields = _HEADER.unpack(header)
+    if fields[:4] != (31, 139, 8, 4) or fields[8:10] != (66, 67):
+        raise ValueError("Not a BGZF block")
+    rest = handle.read(fields[11] + 1 - _HEADER.size)
+    block = header + rest
+    data = zlib.decompress(rest[:-_TRAILER.size], -15)
+
+    return block, data
+
+
+class BgzfWriter(object):
+    """A binary file object writing BGZF blocks. tell() returns the virtual offset of the next byte written, which
+    is what tabix indexes refer to."""
+
+    def __init__(self, filename, level=COMPRESS_LEVEL):
+        self.handle = open(filename, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.block_offset = 0
+        self.ended = False
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        self.buffer.extend(data)
+        while len(self.buffer) >= BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def write_raw(self, block):
+        """Copy an already compressed BGZF block. Pending data is flushed into a block of its own first."""
+
+        self.flush()
+        self.handle.write(block)
+        self.block_offset += len(block)
+        self.ended = block == EOF_BLOCK
+
+    def copy_blocks(self, handle, chunk_size=1 << 20):
+        """Copy the rest of an open BGZF file verbatim, without decompressing it. Pending data is flushed into a
+        block of its own first."""
+
+        self.flush()
+        tail = b""
+        while True:
+            chunk = handle.read(chunk_size)
+            if not chunk:
+                break
+            self.handle.write(chunk)
+            self.block_offset += len(chunk)
+            tail = (tail + chunk)[-len(EOF_BLOCK):]
+        self.ended = self.ended if not tail else tail == EOF_BLOCK
+
+    def tell(self):
+        return (self.block_offset << 16) | len(self.buffer)
+
+    def flush(self):
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        if not self.ended:
+            self.handle.write(EOF_BLOCK)
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_block(self, data):
+        block = compress_block(data, self.level)
+        self.handle.write(block)
+        self.block_offset += len(block)
+        self.ended = False
+
+
+def region_to_bin(begin, end):
+    """The smallest bin of the UCSC/tabix binning scheme containing the 0-based, half-open interval [begin, end)"""
+
+    end -= 1
+    for level in range(_DEPTH, 0, -1):
+        shift = _MIN_SHIFT + 3 * (_DEPTH - level)
+        if begin >> shift == end >> shift:
+            return ((1 << 3 * level) - 1) // 7 + (begin >> shift)
+
+    return 0
+
+
+def region_to_bins(begin, end):
+    """All bins of the UCSC/tabix binning scheme that may hold records overlapping [begin, end)"""
+
+    end -= 1
+    bins = [0]
+    for level in range(1, _DEPTH + 1):
+        shift = _MIN_SHIFT + 3 * (_DEPTH - level)
+        offset = ((1 << 3 * level) - 1) // 7
+        bins.extend(range(offset + (begin >> shift), offset + (end >> shift) + 1))
+
+    return bins
+
+
+class TabixIndex(object):
+    """A tabix index built from records added in sorted order while their file is written"""
+
+    def __init__(self, preset=TABIX_VCF, meta="#", skip=0):
+        self.preset = preset
+        self.meta = meta
+        self.skip = skip
+        self.names = list()
+        self.references = dict()
+        self.unmapped = 0
+
+    def add(self, contig, begin, end, start_offset, end_offset):
+        """Index a record
+
+        :param contig: Sequence name.
+        :type contig: str.
+        :param begin: 0-based start of the record.
+        :type begin: int.
+        :param end: 0-based, exclusive end of the record.
+        :type end: int.
+        :param start_offset: Virtual offset of the start of the record.
+        :type start_offset: int.
+        :param end_offset: Virtual offset just after the record.
+        :type end_offset: int.
+        :returns:  Nothing
+        :raises: ValueError
+        """
+
+        reference = self.references.get(contig)
+        if reference is None:
+            reference = {'bins': dict(), 'linear': list(), 'last': -1, 'first_offset': start_offset,
+                         'last_offset': end_offset, 'records': 0}
+            self.references[contig] = reference
+            self.names.append(contig)
+        elif self.names[-1] != contig:
+            raise ValueError("Records of {} are not contiguous".format(contig))
+        if begin < reference['last']:
+            raise ValueError("Records are not sorted at {}:{}".format(contig, begin + 1))
+        reference['last'] = begin
+        end = max(end, begin + 1)
+
+        chunks = reference['bins'].setdefault(region_to_bin(begin, end), list())
+        if chunks and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+
+        linear = reference['linear']
+        last_window = (end - 1) >> _MIN_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(begin >> _MIN_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start_offset
+
+        reference['last_offset'] = end_offset
+        reference['records'] += 1
+
+    def write(self, filename):
+        """Write the index, BGZF compressed, as a .tbi file"""
+
+        names = b"".join(name.encode("utf-8") + b"\0" for name in self.names)
+        parts = [b"TBI\1", struct.pack("<8i", len(self.names), self.preset[0], self.preset[1], self.preset[2],
+                                        self.preset[3], ord(self.meta), self.skip, len(names)), names]
+        for name in self.names:
+            reference = self.references[name]
+            bins = sorted(reference['bins'].items())
+            parts.append(struct.pack("<i", len(bins) + 1))
+            for bin_number, chunks in bins:
+                parts.append(struct.pack("<Ii", bin_number, len(chunks)))
+                parts.extend(struct.pack("<QQ", start, end) for start, end in chunks)
+            parts.append(struct.pack("<IiQQQQ", _META_BIN, 2, reference['first_offset'], reference['last_offset'],
+                                     reference['records'], 0))
+
+            linear = list()
+            previous = 0
+            for offset in reference['linear']:
+                previous = offset if offset is not None else previous
+                linear.append(previous)
+            parts.append(struct.pack("<i", len(linear)))
+            parts.extend(struct.pack("<Q", offset) for offset in linear)
+        parts.append(struct.pack("<Q", self.unmapped))
+
+        with BgzfWriter(filename) as index:
+            index.write(b"".join(parts))
+
+
+def is_bgzf(filename):
+    """Whether a file starts with a BGZF block
+
+    :param filename: The file name.
+    :type filename: str.
+    :returns:  bool -- True for BGZF files.
+    """
+
+    with open(filename, 'rb') as handle:
+        header = handle.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return False
+    fields = _HEADER.unpack(header)
+
+    return fields[:4] == (31, 139, 8, 4) and fields[8:10] == (66, 67)
+
+
+def read_data(filename):
+    """Decompress a whole BGZF file, e.g. an index, into memory"""
+
+    parts = list()
+    with open(filename, 'rb') as handle:
+        while True:
+            result = read_block(handle)
+            if result is None:
+                break
+            parts.append(result[1])
+
+    return b"".join(parts)
+
+
+def remap_tabix_index(index_file, output_file, remap):
+    """Rewrite a tabix index for a file whose blocks have moved, mapping every virtual offset through remap
+
+    :param index_file: The .tbi file of the original file.
+    :type index_file: str.
+    :param output_file: The .tbi file to write.
+    :type output_file: str.
+    :param remap: Function from an old virtual offset to the new one.
+    :type remap: function.
+    :returns:  Nothing
+    :raises: ValueError
+    """
+
+    data = read_data(index_file)
+    if data[:4] != b"TBI\1":
+        raise ValueError("{} is not a tabix index".format(index_file))
+
+    header = struct.unpack_from("<8i", data, 4)
+    position = 4 + 32 + header[7]
+    parts = [data[:position]]
+    for reference in range(header[0]):
+        bins = struct.unpack_from("<i", data, position)[0]
+        parts.append(data[position:position + 4])
+        position += 4
+        for i in range(bins):
+            bin_number, chunks = struct.unpack_from("<Ii", data, position)
+            parts.append(data[position:position + 8])
+            position += 8
+            for chunk in range(chunks):
+                start, end = struct.unpack_from("<QQ", data, position)
+                position += 16
+                # The second pair of the metadata pseudo-bin holds record counts, not offsets
+                if bin_number != _META_BIN or chunk == 0:
+                    start, end = remap(start), remap(end)
+                parts.append(struct.pack("<QQ", start, end))
+        intervals = struct.unpack_from("<i", data, position)[0]
+        parts.append(data[position:position + 4])
+        position += 4
+        for offset in struct.unpack_from("<{}Q".format(intervals), data, position):
+            parts.append(struct.pack("<Q", remap(offset)))
+        position += 8 * intervals
+    parts.append(data[position:])
+
+    with BgzfWriter(output_file) as index:
+        index.write(b"".join(parts))
+
+
+def read_tabix_index(index_file):
+    """Read the bins and linear index of every sequence of a tabix index
+
+    :param index_file: The .tbi file name.
+    :type index_file: str.
+    :returns:  dict -- Sequence names, preset and per sequence bins (bin number to chunk list) and linear offsets.
+    :raises: ValueError
+    """
+
+    data = read_data(index_file)
+    if data[:4] != b"TBI\1":
+        raise ValueError("{} is not a tabix index".format(index_file))
+
+    header = struct.unpack_from("<8i", data, 4)
+    names = [name.decode("utf-8") for name in data[36:36 + header[7]].split(b"\0")[:header[0]]]
+    position = 36 + header[7]
+    references = dict()
+    for name in names:
+        bins = dict()
+        for i in range(struct.unpack_from("<i", data, position)[0]):
+            bin_number, chunks = struct.unpack_from("<Ii", data, position + 4)
+            position += 8
+            offsets = struct.unpack_from("<{}Q".format(2 * chunks), data, position + 4)
+            position += 16 * chunks
+            if bin_number != _META_BIN:
+                bins[bin_number] = list(zip(offsets[0::2], offsets[1::2]))
+        intervals = struct.unpack_from("<i", data, position + 4)[0]
+        linear = struct.unpack_from("<{}Q".format(intervals), data, position + 8)
+        position += 8 + 8 * intervals
+        references[name] = {'bins': bins, 'linear': linear}
+
+    return {'names': names, 'preset': header[1:5], 'meta': chr(header[5]), 'skip': header[6],
+            'references': references}
+
+
+def query_chunks(index, contig, begin, end):
+    """Virtual offset ranges of a BGZF file that hold all its records overlapping a region, merged and in order
+
+    :param index: A tabix index from read_tabix_index.
+    :type index: dict.
+    :param contig: Sequence name.
+    :type contig: str.
+    :param begin: 0-based start.
+    :type begin: int.
+    :param end: End, exclusive.
+    :type end: int.
+    :returns:  list -- Tuples of start and end virtual offsets.
+    """
+
+    reference = index['references'].get(contig)
+    if reference is None or end <= begin:
+        return list()
+
+    linear = reference['linear']
+    window = begin >> _MIN_SHIFT
+    minimum = linear[window] if window < len(linear) else (linear[-1] if linear else 0)
+    chunks = sorted(chunk for bin_number in region_to_bins(begin, end)
+                    for chunk in reference['bins'].get(bin_number, list()) if chunk[1] > minimum)
+
+    merged = list()
+    for start, stop in chunks:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+
+    return [tuple(chunk) for chunk in merged]
+
+
+def read_chunk(handle, start, end):
+    """Uncompressed bytes between two virtual offsets of an open BGZF file
+
+    :param handle: The file, opened in binary mode.
+    :type handle: file.
+    :param start: Virtual offset of the first byte.
+    :type start: int.
+    :param end: Virtual offset just after the last byte.
+    :type end: int.
+    :returns:  bytes -- The data.
+    """
+
+    handle.seek(start >> 16)
+    parts = list()
+    block_offset = start >> 16
+    while block_offset <= end >> 16:
+        result = read_block(handle)
+        if result is None:
+            break
+        data = result[1]
+        if block_offset == end >> 16:
+            data = data[:end & 0xffff]
+        if block_offset == start >> 16:
+            data = data[start & 0xffff:]
+        parts.append(data)
+        block_offset += len(result[0])
+
+    return b"".join(parts)
+
+
+class IndexedBedWriter(object):
+    """Write sorted BED-like records as BGZF and build their tabix index in the same pass"""
+
+    def __init__(self, filename, level=COMPRESS_LEVEL, preset=TABIX_BED):
+        self.filename = filename
+        self.output = BgzfWriter(filename, level)
+        self.index = TabixIndex(preset)
+
+    def write_header(self, header):
+        self.output.write(header)
+
+    def write_record(self, contig, begin, end, line):
+        """Write one record line, including its line end, covering the 0-based interval [begin, end)"""
+
+        start_offset = self.output.tell()
+        self.output.write(line)
+        self.index.add(contig, begin, end, start_offset, self.output.tell())
+
+    def close(self):
+        self.output.close()
+        self.index.write("{}.tbi".format(self.filename))
+
+    def abort(self):
+        """Close the output after a failure without writing an index, and remove it along with any index left by an
+        earlier run"""
+
+        if not self.output.handle.closed:
+            self.output.close()
+        for path in (self.filename, "{}.tbi".format(self.filename)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def vcf_record_interval(line):
+    """0-based, half-open interval of a VCF record: from POS over the REF allele, or to INFO END if further
+
+    :param line: The VCF record.
+    :type line: str.
+    :returns:  tuple -- Contig, begin and end.
+    """
+
+    fields = line.split("\t", 8)
+    begin = int(fields[1]) - 1
+    end = begin + len(fields[3])
+    info = fields[7] if len(fields) > 7 else ""
+    if "END=" in info:
+        for entry in info.split(";"):
+            if entry.startswith("END="):
+                try:
+                    end = max(end, int(entry[4:]))
+                except ValueError:
+                    pass
+
+    return fields[0], begin, end
+
+
+class IndexedVcfWriter(object):
+    """Write a sorted VCF as BGZF and build its tabix index in the same pass. Besides writing header and records
+    explicitly, VCF text can be passed to write() in arbitrary chunks, so that the writer can be the stdout consumer
+    of a pipeline."""
+
+    def __init__(self, filename, level=COMPRESS_LEVEL):
+        self.filename = filename
+        self.output = BgzfWriter(filename, level)
+        self.index = TabixIndex(TABIX_VCF)
+        self.pending = b""
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        lines = (self.pending + data).split(b"\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self._write_line(line)
+
+    def write_header(self, header):
+        self.output.write(header)
+
+    def write_record(self, line):
+        if not line.endswith("\n"):
+            line = "{}\n".format(line)
+        contig, begin, end = vcf_record_interval(line)
+        start_offset = self.output.tell()
+        self.output.write(line)
+        self.index.add(contig, begin, end, start_offset, self.output.tell())
+
+    def close(self):
+        if self.pending:
+            self._write_line(self.pending)
+            self.pending = b""
+        self.output.close()
+        self.index.write("{}.tbi".format(self.filename))
+
+    def abort(self):
+        """Close the output after a failure without writing an index, and remove it along with any index left by an
+        earlier run, so that no truncated VCF is taken for a finished one"""
+
+        self.output.close()
+        for path in (self.filename, "{}.tbi".format(self.filename)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _write_line(self, line):
+        line = line.decode("utf-8")
+        if line.startswith("#"):
+            self.write_header("{}\n".format(line))
+        elif line.strip():
+            self.write_record(line)
@@ -0,0 +1,149 @@
+"""
+.. module:: intervals
+   :platform: Unix, OSX
+   :synopsis: A module for genomic interval overlap queries in process, in place of bedtools. Intervals are kept as
+   sorted NumPy arrays of starts and ends per contig and queried with binary search.
+
+.. moduleauthor:: Daniel Gaston <daniel.gaston@dal.ca>
+
+
+"""
+
+import numpy
+
+from ddb_ngsflow import scatter
+
+
+class IntervalIndex(object):
+    """Intervals of one or more contigs with their BED fields. Coordinates are 0-based and half open. Besides the
+    sorted starts and ends, each contig keeps the running maximum of the ends, which is sorted as well: the first
+    interval that can overlap a position is found by binary search on it, and the last by binary search on the
+    starts."""
+
+    def __init__(self, intervals):
+        """
+        :param intervals: Lists of fields with contig, integer start and end first, as from scatter.read_regions.
+        :type intervals: list.
+        """
+
+        self.contigs = list()
+        by_contig = dict()
+        for interval in intervals:
+            if interval[0] not in by_contig:
+                by_contig[interval[0]] = list()
+                self.contigs.append(interval[0])
+            by_contig[interval[0]].append(interval)
+
+        self.starts = dict()
+        self.ends = dict()
+        self.max_ends = dict()
+        self.fields = dict()
+        self._merged = dict()
+        for contig in self.contigs:
+            ordered = sorted(by_contig[contig], key=lambda interval: (interval[1], interval[2]))
+            self.fields[contig] = ordered
+            self.starts[contig] = numpy.array([interval[1] for interval in ordered], dtype=numpy.int64)
+            self.ends[contig] = numpy.array([interval[2] for interval in ordered], dtype=numpy.int64)
+            self.max_ends[contig] = numpy.maximum.accumulate(self.ends[contig])
+
+    def __len__(self):
+        return sum(len(starts) for starts in self.starts.values())
+
+    def overlapping(self, contig, start, end):
+        """Intervals overlapping a region
+
+        :param contig: Contig name.
+        :type contig: str.
+        :param start: 0-based start.
+        :type start: int.
+        :param end: End, exclusive.
+        :type end: int.
+        :returns:  list -- Fields of the overlapping intervals, in start order.
+        """
+
+        if contig not in self.starts:
+            return list()
+        first = numpy.searchsorted(self.max_ends[contig], start, side='right')
+        last = numpy.searchsorted(self.starts[contig], end, side='left')
+        ends = self.ends[contig]
+
+        return [self.fields[contig][i] for i in range(first, last) if ends[i] > start]
+
+    def join(self, contig, starts, ends):
+        """Overlaps of many regions of a contig with the intervals at once
+
+        :param contig: Contig name.
+        :type contig: str.
+        :param starts: 0-based starts of the regions.
+        :type starts: numpy.ndarray.
+        :param ends: Exclusive ends of the regions.
+        :type ends: numpy.ndarray.
+        :returns:  tuple -- Arrays of region and interval indices of every overlapping pair, ordered by region and
+                   interval start. Interval indices refer to fields[contig].
+        """
+
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        if contig not in self.starts or not len(starts):
+            return empty, empty
+
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        first = numpy.searchsorted(self.max_ends[contig], starts, side='right')
+        last = numpy.searchsorted(self.starts[contig], ends, side='left')
+        counts = numpy.maximum(last - first, 0)
+
+        regions = numpy.repeat(numpy.arange(len(starts)), counts)
+        within = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        candidates = numpy.repeat(first, counts) + within
+        hits = self.ends[contig][candidates] > starts[regions]
+
+        return regions[hits], candidates[hits]
+
+    def contains(self, contig, positions):
+        """Whether 0-based positions fall within any interval
+
+        :param contig: Contig name.
+        :type contig: str.
+        :param positions: 0-based positions.
+        :type positions: numpy.ndarray.
+        :returns:  numpy.ndarray -- Boolean mask.
+        """
+
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        if contig not in self.starts:
+            return numpy.zeros(len(positions), dtype=bool)
+        if contig not in self._merged:
+            self._merged[contig] = self.merged(contig)
+        merged_starts, merged_ends = self._merged[contig]
+        index = numpy.searchsorted(merged_starts, positions, side='right') - 1
+
+        return (index >= 0) & (positions < merged_ends[numpy.maximum(index, 0)])
+
+    def merged(self, contig):
+        """Starts and ends of the union of the intervals of a contig, with overlapping and adjacent intervals merged
+
+        :param contig: Contig name.
+        :type contig: str.
+        :returns:  tuple -- Arrays of starts and ends.
+        """
+
+        starts = self.starts[contig]
+        max_ends = self.max_ends[contig]
+        if not len(starts):
+            return starts, max_ends
+        new = numpy.ones(len(starts), dtype=bool)
+        new[1:] = starts[1:] > max_ends[:-1]
+        boundaries = numpy.flatnonzero(new)
+
+        return starts[boundaries], max_ends[numpy.append(boundaries[1:] - 1, len(starts) - 1)]
+
+
+def read_bed(bed_file):
+    """Index the intervals of a BED file
+
+    :param bed_file: The BED file name.
+    :type bed_file: str.
+    :returns:  IntervalIndex.
+    """
+
+    return IntervalIndex(scatter.read_regions(bed_file))
@@ -0,0 +1,248 @@
+"""
+.. module:: reheader
+   :platform: Unix, OSX
+   :synopsis: A module for rewriting the header of a VCF without rewriting its records. For bgzipped VCFs only the
+   blocks holding the header are recompressed, the remaining blocks are copied byte for byte and an existing tabix
+   index is carried over with its offsets adjusted.
+
+.. moduleauthor:: Daniel Gaston <daniel.gaston@dal.ca>
+
+
+"""
+
+import os
+import re
+import gzip
+import shutil
+
+from ddb_ngsflow.utils import bgzf
+
+_CONTIG = re.compile(r"^##contig=<ID=([^,>]+)")
+
+
+def rewrite_header(input_vcf, output_vcf, *transforms):
+    """Write a copy of a VCF with a rewritten header. Each transform is called with the header lines, including the
+    #CHROM line and without line endings, and returns the new lines. A bgzipped input with a bgzipped output only
+    has its header blocks recompressed, and its tabix index, if any, is rewritten next to the output.
+
+    :param input_vcf: The input VCF, plain or bgzipped.
+    :type input_vcf: str.
+    :param output_vcf: The output VCF. Bgzipped if the name ends with .gz.
+    :type output_vcf: str.
+    :returns:  str -- The output vcf file name.
+    """
+
+    if bgzf.is_bgzf(input_vcf) and output_vcf.endswith(".gz"):
+        _rewrite_bgzf(input_vcf, output_vcf, transforms)
+        return output_vcf
+
+    opener = gzip.open if input_vcf.endswith(".gz") else open
+    with opener(input_vcf, 'rb') as vcf:
+        header = list()
+        line = vcf.readline()
+        while line.startswith(b"#"):
+            header.append(line)
+            if line.startswith(b"#CHROM"):
+                line = b""
+                break
+            line = vcf.readline()
+
+        new_header = _transform(b"".join(header), transforms)
+        output = bgzf.BgzfWriter(output_vcf) if output_vcf.endswith(".gz") else open(output_vcf, 'wb')
+        try:
+            output.write(new_header)
+            output.write(line)
+            shutil.copyfileobj(vcf, output, bgzf.BLOCK_SIZE)
+        finally:
+            output.close()
+
+    return output_vcf
+
+
+def rename_samples(names):
+    """Transform renaming sample columns
+
+    :param names: New sample names by old name.
+    :type names: dict.
+    :returns:  function -- The transform.
+    """
+
+    def transform(lines):
+        columns = lines[-1].split("\t")
+        if columns[0] == "#CHROM":
+            lines[-1] = "\t".join(columns[:9] + [names.get(column, column) for column in columns[9:]])
+        return lines
+
+    return transform
+
+
+def set_field_number(section, field, number):
+    """Transform changing the Number of an INFO or FORMAT field, e.g. to declare FORMAT AD as Number=R
+
+    :param section: INFO or FORMAT.
+    :type section: str.
+    :param field: Field ID.
+    :type field: str.
+    :param number: The new Number.
+    :type number: str.
+    :returns:  function -- The transform.
+    """
+
+    pattern = re.compile(r"^(##{}=<ID={},Number=)[^,>]+".format(section, re.escape(field)))
+
+    def transform(lines):
+        return [pattern.sub(lambda match: "{}{}".format(match.group(1), number), line) for line in lines]
+
+    return transform
+
+
+def set_contigs(contigs):
+    """Transform replacing the ##contig lines, e.g. with the contigs of the reference. The new lines take the place
+    of the first existing contig line, or go before the #CHROM line.
+
+    :param contigs: Tuples of contig name and a list of (key, value) attributes such as length.
+    :type contigs: list.
+    :returns:  function -- The transform.
+    """
+
+    contig_lines = ["##contig=<{}>".format(",".join(["ID={}".format(name)] +
+                                                    ["{}={}".format(key, value) for key, value in attributes]))
+                    for name, attributes in contigs]
+
+    def transform(lines):
+        kept = list()
+        position = None
+        for line in lines:
+            if _CONTIG.match(line):
+                position = len(kept) if position is None else position
+                continue
+            kept.append(line)
+        if position is None:
+            position = len(kept) - 1 if kept and kept[-1].startswith("#CHROM") else len(kept)
+        return kept[:position] + contig_lines + kept[position:]
+
+    return transform
+
+
+def contigs_from_fai(fai_file):
+    """Contigs and lengths of a samtools faidx index, for set_contigs
+
+    :param fai_file: The .fai file name.
+    :type fai_file: str.
+    :returns:  list -- Tuples of contig name and attributes.
+    """
+
+    contigs = list()
+    with open(fai_file, 'r') as index:
+        for line in index:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) > 1:
+                contigs.append((fields[0], [("length", fields[1])]))
+
+    return contigs
+
+
+def contigs_from_dict(dict_file):
+    """Contigs of a Picard sequence dictionary with length, assembly and MD5 checksum as UpdateVcfSequenceDictionary
+    writes them, for set_contigs
+
+    :param dict_file: The .dict file name.
+    :type dict_file: str.
+    :returns:  list -- Tuples of contig name and attributes.
+    """
+
+    keys = (("LN", "length"), ("AS", "assembly"), ("M5", "md5"), ("SP", "species"))
+    contigs = list()
+    with open(dict_file, 'r') as dictionary:
+        for line in dictionary:
+            if not line.startswith("@SQ"):
+                continue
+            tags = dict(field.split(":", 1) for field in line.rstrip("\n").split("\t")[1:] if ":" in field)
+            if 'SN' in tags:
+                contigs.append((tags['SN'], [(name, tags[tag]) for tag, name in keys if tag in tags]))
+
+    return contigs
+
+
+def _transform(header, transforms):
+    lines = header.decode("utf-8").splitlines()
+    for transform in transforms:
+        lines = transform(lines)
+
+    return "".join("{}\n".format(line) for line in lines).encode("utf-8")
+
+
+def _header_end(data):
+    """Offset just after the #CHROM line, or the first record, in data. None if the header may continue beyond."""
+
+    offset = 0
+    while offset < len(data):
+        if data[offset:offset + 1] != b"#":
+            return offset
+        newline = data.find(b"\n", offset)
+        if newline < 0:
+            return None
+        column_header = data.startswith(b"#CHROM", offset)
+        offset = newline + 1
+        if column_header:
+            return offset
+
+    return None
+
+
+def _rewrite_bgzf(input_vcf, output_vcf, transforms):
+    """Recompress the blocks up to the end of the header with the new header, copy the rest verbatim and carry the
+    tabix index over"""
+
+    with open(input_vcf, 'rb') as vcf:
+        data = b""
+        block_start = 0
+        block_length = 0
+        block_data_start = 0
+        end = None
+        while end is None:
+            block_start += block_length
+            result = bgzf.read_block(vcf)
+            if result is None:
+                end = len(data)
+                break
+            block_length = len(result[0])
+            block_data_start = len(data)
+            data += result[1]
+            end = _header_end(data)
+
+        output = bgzf.BgzfWriter(output_vcf)
+        output.write(_transform(data[:end], transforms))
+        output.flush()
+
+        # The records sharing the last header block go into blocks of their own, so old offsets into that block
+        # map onto them directly
+        remainder = data[end:]
+        pieces = list()
+        for start in range(0, len(remainder), bgzf.BLOCK_SIZE):
+            pieces.append((output.block_offset, start))
+            output.write(remainder[start:start + bgzf.BLOCK_SIZE])
+            output.flush()
+        copied_start = output.block_offset
+        output.copy_blocks(vcf)
+        output.close()
+
+    index = "{}.tbi".format(input_vcf)
+    if not os.path.exists(index):
+        return
+
+    header_block = block_start
+    header_offset = end - block_data_start
+    old_copied_start = block_start + block_length
+
+    def remap(offset):
+        block, within = offset >> 16, offset & 0xffff
+        if block >= old_copied_start:
+            return (block - old_copied_start + copied_start) << 16 | within
+        if block != header_block or not pieces:
+            return copied_start << 16 if block == header_block else 0
+        position = max(within - header_offset, 0)
+        new_block, start = [piece for piece in pieces if piece[1] <= position][-1]
+        return new_block << 16 | (position - start)
+
+    bgzf.remap_tabix_index(index, "{}.tbi".format(output_vcf), remap)
@@ -10,12 +10,22 @@
 
 import csv
 import sys
-import pybedtools
+import time
+import numpy
+import itertools
 import multiprocessing
 
 from collections import defaultdict
 
+from ddb_ngsflow import plan
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import scatter
+from ddb_ngsflow.coverage import cohort
+from ddb_ngsflow.utils import bgzf
+from ddb_ngsflow.utils import intervals
+
+# Records are checked against the regions in batches of this many
+ON_TARGET_BATCH_SIZE = 100000
 
 
 def readsort_bam(job, config, name, samples):
@@ -42,20 +52,121 @@ def bedtools_coverage_per_site(job, config, name, input_bam):
                 "-a",
                 "{}".format(config['regions']),
                 "-b",
-                "{}".format(input_bam),
-                ">",
-                "{}".format(output)]
+                "{}".format(input_bam)]
 
     job.fileStore.logToMaster("BedTools Coverage Command: {}\n".format(coverage))
-    pipeline.run_and_log_command(" ".join(coverage), logfile)
+    pipeline.run_pipeline([coverage], logfile, stdout=output)
 
     return output
 
 
+def coverage_thresholds(config):
+    """Depth thresholds of the coverage summaries: config['coverage_thresholds'] if given, else the thresholds
+    sambamba is run with
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :returns:  list -- The thresholds, ascending.
+    """
+
+    if config.get('coverage_thresholds'):
+        return sorted(int(threshold) for threshold in config['coverage_thresholds'])
+
+    return sorted(int(config[key]) for key in ('coverage_threshold', 'coverage_threshold2') if key in config)
+
+
+def _per_site_blocks(handle, block_lines):
+    """Read per-site coverage lines in blocks. Yields the region of every line and the depths as an array."""
+
+    while True:
+        lines = list(itertools.islice(handle, block_lines))
+        if not lines:
+            return
+        regions = list()
+        depths = numpy.empty(len(lines), dtype=numpy.int64)
+        for i, line in enumerate(lines):
+            region, position, depth = line.rstrip("\n").rsplit("\t", 2)
+            regions.append(region)
+            depths[i] = int(depth)
+        yield regions, depths
+
+
+def _write_region_summaries(outfile, regions, depths, thresholds):
+    """Write one summary line per group of consecutive bases of the same region. Returns the number of lines."""
+
+    starts = [0] + [i for i in range(1, len(regions)) if regions[i] != regions[i - 1]]
+    bounds = numpy.append(starts, len(regions))
+    lengths = numpy.diff(bounds)
+    means = numpy.add.reduceat(depths, starts) / lengths.astype(float)
+    minimums = numpy.minimum.reduceat(depths, starts)
+    maximums = numpy.maximum.reduceat(depths, starts)
+    fractions = [numpy.add.reduceat(depths >= threshold, starts) / lengths.astype(float)
+                 for threshold in thresholds]
+
+    for i, start in enumerate(starts):
+        fields = regions[start].split("\t")
+        outfile.write("{}\t{}\t{}\t{}\t{}\t{:.2f}\t{:.1f}\t{}\t{}{}\n".format(
+            fields[0], fields[1], fields[2], fields[3] if len(fields) > 3 else ".", lengths[i], means[i],
+            numpy.median(depths[bounds[i]:bounds[i + 1]]), minimums[i], maximums[i],
+            "".join("\t{:.4f}".format(fraction[i]) for fraction in fractions)))
+
+    return len(starts)
+
+
 def bedtools_coverage_to_summary(job, config, name, input_file):
-    """Summarize outputs from BedTools coverage results"""
+    """Summarize the per-site output of bedtools_coverage_per_site by region: number of bases, mean, median, minimum
+    and maximum depth and the fraction of bases at or above each threshold of coverage_thresholds. The input is read
+    in blocks of config['coverage_summary_block_lines'] lines (default 1000000) and only the bases of the region
+    still being read are carried from one block to the next, so memory does not grow with the input.
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param name: sample name.
+    :type name: str.
+    :param input_file: The per-site coverage file name to process.
+    :type input_file: str.
+    :returns:  str -- The summary file name.
+    """
 
-    raise NotImplementedError
+    output = "{}.bedtools_coverage_summary.txt".format(name)
+    logfile = "{}.bedtools_coverage_summary.log".format(name)
+    if plan.record_function("utilities.bedtools_coverage_to_summary", logfile, [input_file], [output]):
+        return output
+
+    thresholds = coverage_thresholds(config)
+    block_lines = int(config.get('coverage_summary_block_lines', 1000000))
+    with pipeline.python_step("utilities.bedtools_coverage_to_summary", logfile, [input_file], [output]):
+        summarized = _summarize_per_site(input_file, output, thresholds, block_lines)
+
+    job.fileStore.logToMaster("Summarized coverage of {} regions from {} in {}\n".format(summarized, input_file,
+                                                                                         output))
+
+    return output
+
+
+def _summarize_per_site(input_file, output, thresholds, block_lines):
+    """Write the region summaries of a per-site coverage file. Returns the number of regions summarized."""
+
+    summarized = 0
+    with open(input_file, 'r') as per_site, open(output, 'w') as outfile:
+        outfile.write("chrom\tstart\tend\tname\tbases\tmean\tmedian\tmin\tmax{}\n".format(
+            "".join("\tfraction_{}x".format(threshold) for threshold in thresholds)))
+        carried_regions = list()
+        carried_depths = numpy.zeros(0, dtype=numpy.int64)
+        for regions, depths in _per_site_blocks(per_site, block_lines):
+            regions = carried_regions + regions
+            depths = numpy.concatenate((carried_depths, depths))
+
+            # The last region may continue in the next block
+            last = len(regions) - 1
+            while last > 0 and regions[last - 1] == regions[-1]:
+                last -= 1
+            if last:
+                summarized += _write_region_summaries(outfile, regions[:last], depths[:last], thresholds)
+            carried_regions = regions[last:]
+            carried_depths = depths[last:]
+        if carried_regions:
+            summarized += _write_region_summaries(outfile, carried_regions, carried_depths, thresholds)
+
+    return summarized
 
 
 def read_coverage(job, config, name, vcf):
@@ -69,40 +180,90 @@ def read_coverage(job, config, name, vcf):
     """
 
     sample_coverage = defaultdict(dict)
-
-    targeted_regions = pybedtools.BedTool(config['regions'])
-    coverage_data = pybedtools.BedTool(vcf)
-    intersections = coverage_data.intersect(targeted_regions, loj=True)
-
-    for region in intersections:
-        sample_coverage[region[13]]['filter_field'] = region[6]
-        reads_data = region[9].split(":")
-        sample_coverage[region[13]]['filter_field'] = region[6]
-        sample_coverage[region[13]]['depth_field'] = reads_data[-3]
-        sample_coverage[region[13]]['low_field'] = reads_data[-2]
-        sample_coverage[region[13]]['zero_field'] = reads_data[-1]
+    if plan.record_function("utilities.read_coverage", "{}.read_coverage.log".format(name), [config['regions'], vcf],
+                            list()):
+        return sample_coverage
+
+    targeted_regions = intervals.read_bed(config['regions'])
+    records = defaultdict(list)
+    contigs = list()
+    with scatter.open_vcf(vcf) as coverage_data:
+        for line in coverage_data:
+            if line.startswith("#") or not line.strip():
+                continue
+            contig, start, end = bgzf.vcf_record_interval(line)
+            if contig not in records:
+                contigs.append(contig)
+            fields = line.rstrip("\n").split("\t")
+            records[contig].append((start, end, fields[6], fields[9]))
+
+    # Records are keyed by the name of every target they overlap, and by "." if they overlap none, as with a left
+    # outer join of the records with the targets
+    for contig in contigs:
+        starts = numpy.array([record[0] for record in records[contig]], dtype=numpy.int64)
+        ends = numpy.array([record[1] for record in records[contig]], dtype=numpy.int64)
+        matched, targets = targeted_regions.join(contig, starts, ends)
+        names = [list() for record in records[contig]]
+        for record, target in zip(matched, targets):
+            target_fields = targeted_regions.fields[contig][target]
+            names[record].append(target_fields[3] if len(target_fields) > 3 else ".")
+
+        for record, region_names in zip(records[contig], names):
+            reads_data = record[3].split(":")
+            for region_name in region_names or ["."]:
+                sample_coverage[region_name]['filter_field'] = record[2]
+                sample_coverage[region_name]['depth_field'] = reads_data[-3]
+                sample_coverage[region_name]['low_field'] = reads_data[-2]
+                sample_coverage[region_name]['zero_field'] = reads_data[-1]
 
     return sample_coverage
 
 
 def generate_coverage_summary(job, config, samples):
-    """Take Summarized DiagnoseTargets data and generate a coverage summary
+    """Take Summarized DiagnoseTargets data and generate a coverage summary. With config['cohort_coverage'] set to
+    a cohort coverage store directory, the results are also appended to the store as run config['run_id'].
     :param config: The configuration dictionary.
     :type config: dict.
     :param samples: summarized sample results.
     :type samples: dict.
     """
+    if plan.record_function("utilities.generate_coverage_summary", "coverage_summary.log", list(),
+                            ["sample_coverage_summary.txt"]):
+        return
+
+    if config.get('cohort_coverage'):
+        regions = sorted(set(region for sample in samples for region in samples[sample]))
+        store = cohort.open_cohort(config['cohort_coverage'], regions)
+        run_id = config.get('run_id') or time.strftime("%Y%m%d-%H%M%S")
+        unknown = store.append_run(run_id, samples)
+        job.fileStore.logToMaster("Appended {} samples to cohort coverage store {} as run {}, {} regions not in the "
+                                  "store\n".format(len(samples), config['cohort_coverage'], run_id, unknown))
+
     with open("sample_coverage_summary.txt", 'w') as outfile:
         for sample in samples:
             for target in samples[sample].keys():
                 targets_list = target.split("\t")
                 target_string = ",".join(targets_list)
-                if 'COVERAGE' in samples[sample][target]['filter_field'] or 'NO_READS' in samples[sample][target]['filter_field']:
-                    outfile.write("{sample}\t{region}\t{filter}\n".format(sample=sample, region=target_string, filter=samples[sample][target]['filter_field']))
+                filter_field = samples[sample][target]['filter_field']
+                if 'COVERAGE' in filter_field or 'NO_READS' in filter_field:
+                    outfile.write("{sample}\t{region}\t{filter}\n".format(sample=sample, region=target_string,
+                                                                           filter=filter_field))
+
+
+def _write_on_target(outfile, contig, batch, targeted_regions):
+    positions = numpy.array([int(line.split("\t", 2)[1]) - 1 for line in batch], dtype=numpy.int64)
+    kept = targeted_regions.contains(contig, positions)
+    for line, keep in zip(batch, kept):
+        if keep:
+            outfile.write(line)
+
+    return int(kept.sum())
 
 
 def bcftools_filter_variants_regions(job, config, name, samples, input_vcf):
-    """Use bcftools to filter vcf file to only variants found within the specified regions file
+    """Filter a vcf file to only variants found within the specified regions file, sorted in the contig order of
+    the reference. Variant positions are looked up in an interval index of the regions in batches, in place of
+    bgzip, tabix, bcftools isec and vcf-sort.
     :param config: The configuration dictionary.
     :type config: dict.
     :param sample: sample name.
@@ -112,52 +273,65 @@ def bcftools_filter_variants_regions(job, config, name, samples, input_vcf):
     :returns:  str -- The output vcf file name.
     """
 
-    filtered_vcf = "{}.on_target.vcf".format(name)
     sorted_vcf = "{}.on_target_sorted.vcf".format(name)
-    bgzipped_vcf = "{}.gz".format(input_vcf)
     logfile = "{}.on_target_filter.log".format(name)
-    sort_logfile = "{}.on_target_sorted.log".format(name)
+    inputs = [samples[name]['regions'], input_vcf]
+    if plan.record_function("utilities.bcftools_filter_variants_regions", logfile, inputs, [sorted_vcf]):
+        return sorted_vcf
 
-    bgzip_and_tabix_vcf(job, input_vcf)
+    contigs = [contig for contig, length in scatter.contig_order(config['reference'])]
+    with pipeline.python_step("utilities.bcftools_filter_variants_regions", logfile, inputs, [sorted_vcf]):
+        kept = _filter_on_target(input_vcf, sorted_vcf, intervals.read_bed(samples[name]['regions']), contigs)
 
-    filter_command = ["{}".format(config['bcftools']['bin']),
-                      "isec",
-                      "-T",
-                      "{}".format(samples[name]['regions']),
-                      "{}".format(bgzipped_vcf),
-                      ">",
-                      "{}".format(filtered_vcf)]
+    job.fileStore.logToMaster("Kept {} variants of {} within {}\n".format(kept, input_vcf,
+                                                                          samples[name]['regions']))
 
-    sort_command = ["cat",
-                    "{}".format(filtered_vcf),
-                    "|",
-                    "{}".format(config['vcftools_sort']['bin']),
-                    "-c",
-                    ">",
-                    "{}".format(sorted_vcf)
-                    ]
+    return sorted_vcf
 
-    job.fileStore.logToMaster("BCFTools isec command for filtering to only target regions: {}\n".format(filter_command))
-    pipeline.run_and_log_command(" ".join(filter_command), logfile)
 
-    job.fileStore.logToMaster("VCFTools-sort command for filtering to only target regions: {}\n".format(sort_command))
-    pipeline.run_and_log_command(" ".join(sort_command), sort_logfile)
+def _filter_on_target(input_vcf, sorted_vcf, targeted_regions, contigs):
+    """Write the records of input_vcf within targeted_regions to sorted_vcf in the order of contigs. Returns the
+    number of records written."""
 
-    return sorted_vcf
+    rank = scatter.contig_rank(contigs)
+    kept = 0
+    with open(sorted_vcf, 'w') as outfile:
+        with scatter.open_vcf(input_vcf) as vcf:
+            for line in vcf:
+                if not line.startswith("#"):
+                    break
+                outfile.write(line)
+
+        contig = None
+        batch = list()
+        for key, line in scatter.vcf_records(input_vcf, rank):
+            record_contig = line.split("\t", 1)[0]
+            if record_contig != contig or len(batch) >= ON_TARGET_BATCH_SIZE:
+                if batch:
+                    kept += _write_on_target(outfile, contig, batch, targeted_regions)
+                contig = record_contig
+                batch = list()
+            batch.append(line)
+        if batch:
+            kept += _write_on_target(outfile, contig, batch, targeted_regions)
+
+    return kept
 
 
 def _bgzip_and_tabix_vcf_instructions(infile):
     """Generate instructions and logfile for bgzip and tabix"""
 
-    bgzip_command = "bgzip -c %s > %s.gz" % (infile, infile)
+    bgzip_command = ["bgzip", "-c", infile]
     bgzip_logfile = "%s.bgzip.log" % infile
+    bgzip_output = "%s.gz" % infile
 
-    tabix_command = "tabix -p vcf %s.gz" % infile
+    tabix_command = ["tabix", "-p", "vcf", "%s.gz" % infile]
     tabix_logfile = "%s.tabix.log" % infile
 
     bgzip_instructions = list()
     bgzip_instructions.append(bgzip_command)
     bgzip_instructions.append(bgzip_logfile)
+    bgzip_instructions.append(bgzip_output)
 
     tabix_instructions = list()
     tabix_instructions.append(tabix_command)
@@ -180,7 +354,7 @@ def bgzip_and_tabix_vcf(job, infile):
     bgzip_instructions, tabix_instructions = _bgzip_and_tabix_vcf_instructions(infile)
 
     job.fileStore.logToMaster("BGzip Command: {}\n".format(bgzip_instructions[0]))
-    pipeline.run_and_log_command(bgzip_instructions[0], bgzip_instructions[1])
+    pipeline.run_pipeline([bgzip_instructions[0]], bgzip_instructions[1], stdout=bgzip_instructions[2])
 
     job.fileStore.logToMaster("Tabix Command: {}\n".format(tabix_instructions[0]))
-    pipeline.run_and_log_command(tabix_instructions[0], tabix_instructions[1])
+    pipeline.run_pipeline([tabix_instructions[0]], tabix_instructions[1])
@@ -7,9 +7,13 @@
 """
 
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
+from ddb_ngsflow import scatter
 
 
-def freebayes_single(job, config, name, input_bam):
+@scatter.scatter_by_regions("freebayes")
+@resources.declare(memory=resources.tool_memory('freebayes', "4G"), disk=resources.input_disk())
+def freebayes_single(job, config, name, input_bam, samples=None):
     """Run FreeBayes without a matched normal sample
     :param config: The configuration dictionary.
     :type config: dict.
@@ -17,6 +21,8 @@ def freebayes_single(job, config, name, input_bam):
     :type name: str.
     :param input_bam: The input_bam file name to process.
     :type input_bam: str.
+    :param samples: samples configuration dictionary. Calling is limited to samples[name]['regions'] if present.
+    :type samples: dict
     :returns:  str -- The output vcf file name.
     """
 
@@ -34,13 +40,18 @@ def freebayes_single(job, config, name, input_bam):
                "--report-genotype-likelihood-max",
                "--allele-balance-priors-off",
                "--use-duplicate-reads",
-               "--min-repeat-entropy 1",
+               "--min-repeat-entropy",
+               "1",
                "-v",
-               "{}".format(freebayes_vcf),
-               "{}".format(input_bam)]
+               "{}".format(freebayes_vcf)]
+
+    if samples and samples.get(name, dict()).get('regions'):
+        command.extend(["--targets", "{}".format(samples[name]['regions'])])
+
+    command.append("{}".format(input_bam))
 
     job.fileStore.logToMaster("FreeBayes Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return freebayes_vcf
 
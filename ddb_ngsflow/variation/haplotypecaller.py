@@ -8,8 +8,10 @@
 """
 
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
 
 
+@resources.declare(memory=resources.tool_memory('gatk-haplotypecaller', "8G"), disk=resources.input_disk())
 def haplotypecaller_single(job, config, name, samples, input_bam):
     """Generate gVCF files for a sample using the HaplotypeCaller
     :param config: The configuration dictionary.
@@ -37,18 +39,23 @@ def haplotypecaller_single(job, config, name, samples, input_bam):
                "{}".format(input_bam),
                "-L",
                "{}".format(samples[name]['regions']),
-               "--emitRefConfidence GVCF",
-               "--variant_index_type LINEAR",
-               "--variant_index_parameter 128000",
+               "--emitRefConfidence",
+               "GVCF",
+               "--variant_index_type",
+               "LINEAR",
+               "--variant_index_parameter",
+               "128000",
                "-o",
                "{}".format(gvcf)]
 
     job.fileStore.logToMaster("HaplotypeCaller Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return gvcf
 
 
+@resources.declare(cores=resources.tool_cores('gatk-jointgenotyper'), memory=resources.tool_memory('gatk-jointgenotyper', "8G"),
+                   disk=resources.input_disk())
 def joint_variant_calling(job, config, name, samples):
     """Create a cohort VCF file based on joint calling from gVCF files
     :param config: The configuration dictionary.
@@ -67,27 +74,26 @@ def joint_variant_calling(job, config, name, samples):
 
     gvcfs = list()
     for sample in samples:
-        gvcfs.append("--variant {}.haplotypecaller.g.vcf".format(sample))
-
-    gvcf_string = " ".join(gvcfs)
+        gvcfs.extend(["--variant", "{}.haplotypecaller.g.vcf".format(sample)])
 
     command = ["{}".format(config['gatk-jointgenotyper']['bin']),
                "-T",
                "GenotypeGVCFs",
                "-R",
-               "{}".format(config['reference']),
-               "{}".format(gvcf_string),
-               "-nt",
-               "{}".format(config['gatk-jointgenotyper']['num_cores']),
-               "-o",
-               "{}".format(vcf)]
+               "{}".format(config['reference'])]
+    command.extend(gvcfs)
+    command.extend(["-nt",
+                    "{}".format(config['gatk-jointgenotyper']['num_cores']),
+                    "-o",
+                    "{}".format(vcf)])
 
     job.fileStore.logToMaster("GenotypeVCFs Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return vcf
 
 
+@resources.declare(memory=resources.tool_memory('gatk-haplotypecaller', "8G"), disk=resources.input_disk())
 def haplotypecaller_amplicon(job, config, name, samples, input_bam):
     """Generate gVCF files for a sample using the HaplotypeCaller
     :param config: The configuration dictionary.
@@ -115,19 +121,25 @@ def haplotypecaller_amplicon(job, config, name, samples, input_bam):
                "{}".format(input_bam),
                "-L",
                "{}".format(samples[name]['regions']),
-               "-drf DuplicateRead",
-               "--emitRefConfidence GVCF",
-               "--variant_index_type LINEAR",
-               "--variant_index_parameter 128000",
+               "-drf",
+               "DuplicateRead",
+               "--emitRefConfidence",
+               "GVCF",
+               "--variant_index_type",
+               "LINEAR",
+               "--variant_index_parameter",
+               "128000",
                "-o",
                "{}".format(gvcf)]
 
     job.fileStore.logToMaster("HaplotypeCaller Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return gvcf
 
 
+@resources.declare(cores=resources.tool_cores('gatk-jointgenotyper'), memory=resources.tool_memory('gatk-jointgenotyper', "8G"),
+                   disk=resources.input_disk())
 def joint_variant_calling_amplicon(job, config, name, samples):
     """Create a cohort VCF file based on joint calling from gVCF files
     :param config: The configuration dictionary.
@@ -146,23 +158,22 @@ def joint_variant_calling_amplicon(job, config, name, samples):
 
     gvcfs = list()
     for sample in samples:
-        gvcfs.append("--variant {}.haplotypecaller.g.vcf".format(sample))
-
-    gvcf_string = " ".join(gvcfs)
+        gvcfs.extend(["--variant", "{}.haplotypecaller.g.vcf".format(sample)])
 
     command = ["{}".format(config['gatk-jointgenotyper']['bin']),
                "-T",
                "GenotypeGVCFs",
                "-R",
-               "{}".format(config['reference']),
-               "{}".format(gvcf_string),
-               "-nt",
-               "{}".format(config['gatk-jointgenotyper']['num_cores']),
-               "-drf DuplicateRead",
-               "-o",
-               "{}".format(vcf)]
+               "{}".format(config['reference'])]
+    command.extend(gvcfs)
+    command.extend(["-nt",
+                    "{}".format(config['gatk-jointgenotyper']['num_cores']),
+                    "-drf",
+                    "DuplicateRead",
+                    "-o",
+                    "{}".format(vcf)])
 
     job.fileStore.logToMaster("GenotypeVCFs Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return vcf
@@ -28,11 +28,9 @@ def indelminer_single(job, config, name, input_bam):
 
     command = ["{}".format(config['indelminer']['bin']),
                "{}".format(config['reference']),
-               "sample={}".format(input_bam),
-               ">",
-               "{}".format(indelminer_vcf)]
+               "sample={}".format(input_bam)]
 
     job.fileStore.logToMaster("IndelMiner Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile, stdout=indelminer_vcf)
 
     return indelminer_vcf
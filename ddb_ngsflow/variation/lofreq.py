@@ -8,8 +8,11 @@
 """
 
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
 
 
+@resources.declare(cores=resources.tool_cores('lofreq'), memory=resources.tool_memory('lofreq'),
+                   disk=resources.input_disk())
 def run_lowfreq(job, config, name, input_bam):
     """Run LoFreq on an an unmatched tumour sample and call somatic variants
     :param config: The configuration dictionary.
@@ -28,7 +31,7 @@ def run_lowfreq(job, config, name, input_bam):
                "somatic",
                "-t",
                "{}".format(input_bam),
-               "--call-indels"
+               "--call-indels",
                "-f",
                "{}".format(config['reference']),
                "--threads",
@@ -39,4 +42,4 @@ def run_lowfreq(job, config, name, input_bam):
                "{}".format(vcf)]
 
     job.fileStore.logToMaster("LoFreq Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
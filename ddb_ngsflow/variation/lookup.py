@@ -0,0 +1,414 @@
+"""
+.. module:: lookup
+   :platform: Unix, OSX
+   :synopsis: A module for a node-local, memory-mapped lookup index of population allele frequencies and ClinVar
+   significance keyed by (chrom, pos, ref, alt), built once from the annotation source VCFs.
+
+.. moduleauthor:: Daniel Gaston <daniel.gaston@dal.ca>
+
+Sources are configured as, for example:
+
+    config['lookup_index'] = {'dir': "/local/lookup_index",
+                              'sources': {'exac': {'vcf': "ExAC.r0.3.sites.vep.vcf.gz", 'info': "AF"},
+                                          'esp': {'vcf': "ESP6500SI.all.snps_indels.vcf.gz", 'info': "MAF"},
+                                          'clinvar': {'vcf': "clinvar.vcf.gz", 'info': "CLNSIG",
+                                                      'type': "category"}}}
+
+Every source is stored as an open addressing hash table of 64 bit variant keys with a parallel value array, in .npy
+files that are memory mapped when read, so a lookup touches a couple of pages whatever the size of the source. A
+source is only rebuilt when its VCF changes, and sources that are no longer configured are removed.
+
+Alleles are trimmed to their minimal representation before they are keyed, so the padded alleles of a multi-allelic
+record match the same variant called on its own. Shifting indels to their leftmost position needs the reference,
+so source VCFs must be left-aligned, e.g. with vt normalize, as the VCFs of the pipeline are.
+
+"""
+
+import os
+import json
+import struct
+import hashlib
+
+import numpy
+
+from ddb_ngsflow import plan
+from ddb_ngsflow import pipeline
+from ddb_ngsflow import scatter
+
+FREQUENCY = "frequency"
+CATEGORY = "category"
+
+# Hash tables are kept at most half full, so probe sequences stay short
+_LOAD_FACTOR = 0.5
+
+# Version of the variant keys, part of the source fingerprint so that sources keyed differently are rebuilt
+KEY_VERSION = 2
+
+
+def normalize_alleles(pos, ref, alt):
+    """Trim the bases an allele pair shares at its end, then at its start, keeping at least one base of each, as vt
+    normalize does short of left-shifting through repeats. Symbolic and missing alleles are left as they are.
+
+    :param pos: 1-based VCF position.
+    :type pos: int.
+    :param ref: Reference allele.
+    :type ref: str.
+    :param alt: Alternate allele.
+    :type alt: str.
+    :returns:  tuple -- Position, reference and alternate allele.
+    """
+
+    pos = int(pos)
+    ref = ref.upper()
+    alt = alt.upper()
+    if alt.startswith("<") or alt in ("*", ".") or "[" in alt or "]" in alt:
+        return pos, ref, alt
+
+    while len(ref) > 1 and len(alt) > 1 and ref[-1] == alt[-1]:
+        ref = ref[:-1]
+        alt = alt[:-1]
+    while len(ref) > 1 and len(alt) > 1 and ref[0] == alt[0]:
+        ref = ref[1:]
+        alt = alt[1:]
+        pos += 1
+
+    return pos, ref, alt
+
+
+def variant_key(chrom, pos, ref, alt):
+    """64 bit key of a variant. Contig names are compared without a chr prefix, so that sources named 1 and chr1
+    agree, and alleles are trimmed with normalize_alleles.
+
+    :param chrom: Contig name.
+    :type chrom: str.
+    :param pos: 1-based VCF position.
+    :type pos: int.
+    :param ref: Reference allele.
+    :type ref: str.
+    :param alt: Alternate allele.
+    :type alt: str.
+    :returns:  int -- The key, never 0.
+    """
+
+    if chrom.startswith("chr"):
+        chrom = chrom[3:]
+    text = "{}\t{}\t{}\t{}".format(chrom, *normalize_alleles(pos, ref, alt))
+    key = struct.unpack("<Q", hashlib.md5(text.encode("utf-8")).digest()[:8])[0]
+
+    return key or 1
+
+
+def source_fingerprint(source):
+    """Identity of a source VCF and its settings, compared to decide whether a source has to be rebuilt"""
+
+    stat = os.stat(source['vcf'])
+
+    return {'vcf': os.path.abspath(source['vcf']), 'size': stat.st_size, 'mtime': int(stat.st_mtime),
+            'info': source['info'], 'type': source.get('type', FREQUENCY), 'keys': KEY_VERSION}
+
+
+def read_source(source):
+    """Read the keys and values of a source VCF. A frequency is taken per alternate allele when the INFO field has
+    one value per allele, a category is the INFO value as a string.
+
+    :param source: The source settings: vcf, info and type.
+    :type source: dict.
+    :returns:  tuple -- Lists of keys and values.
+    """
+
+    prefix = "{}=".format(source['info'])
+    category = source.get('type', FREQUENCY) == CATEGORY
+    keys = list()
+    values = list()
+    with scatter.open_vcf(source['vcf']) as vcf:
+        for line in vcf:
+            if line.startswith("#"):
+                continue
+            fields = line.split("\t", 8)
+            value = None
+            for entry in fields[7].rstrip("\n").split(";"):
+                if entry.startswith(prefix):
+                    value = entry[len(prefix):]
+                    break
+            if value is None or value == ".":
+                continue
+
+            alts = fields[4].split(",")
+            per_allele = value.split(",") if not category else [value] * len(alts)
+            for i, alt in enumerate(alts):
+                allele_value = per_allele[i] if len(per_allele) == len(alts) else per_allele[0]
+                if not category:
+                    try:
+                        allele_value = float(allele_value)
+                    except ValueError:
+                        continue
+                keys.append(variant_key(fields[0], fields[1], fields[3], alt))
+                values.append(allele_value)
+
+    return keys, values
+
+
+def build_table(keys, values, dtype):
+    """Build an open addressing hash table with linear probing. Insertion is vectorised: in every round each pending
+    key claims its current slot, one key per free slot wins and the others move on to the next slot. Repeated keys
+    keep the largest value.
+
+    :param keys: Variant keys.
+    :type keys: numpy.ndarray.
+    :param values: Values of the keys.
+    :type values: numpy.ndarray.
+    :param dtype: Type of the value array.
+    :type dtype: numpy.dtype.
+    :returns:  tuple -- Key and value arrays of the table.
+    """
+
+    keys = numpy.asarray(keys, dtype=numpy.uint64)
+    values = numpy.asarray(values, dtype=dtype)
+    order = numpy.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    last = numpy.ones(len(keys), dtype=bool)
+    last[:-1] = keys[1:] != keys[:-1]
+    keys, values = keys[last], values[last]
+
+    size = 1
+    while size * _LOAD_FACTOR < max(len(keys), 1):
+        size <<= 1
+    mask = numpy.uint64(size - 1)
+    table_keys = numpy.zeros(size, dtype=numpy.uint64)
+    table_values = numpy.zeros(size, dtype=dtype)
+
+    pending = numpy.arange(len(keys))
+    slots = keys & mask
+    while len(pending):
+        free = table_keys[slots[pending]] == 0
+        candidates = pending[free]
+        claimed, first = numpy.unique(slots[candidates], return_index=True)
+        winners = candidates[first]
+        table_keys[claimed] = keys[winners]
+        table_values[claimed] = values[winners]
+
+        placed = numpy.zeros(len(keys), dtype=bool)
+        placed[winners] = True
+        pending = pending[~placed[pending]]
+        slots[pending] = (slots[pending] + numpy.uint64(1)) & mask
+
+    return table_keys, table_values
+
+
+def _source_files(index_dir, name):
+    return [os.path.join(index_dir, "{}{}".format(name, suffix)) for suffix in (".json", ".keys.npy", ".values.npy")]
+
+
+def build_lookup_index(index_dir, sources, rebuild=False):
+    """Build or update the lookup index. Only sources whose VCF or settings changed since they were last built are
+    read again, and sources of the index that are not in sources any more are removed.
+
+    :param index_dir: The index directory, ideally on node-local disk.
+    :type index_dir: str.
+    :param sources: Source settings by name, each with vcf, info and optionally type ("frequency" or "category").
+    :type sources: dict.
+    :param rebuild: Rebuild every source.
+    :type rebuild: bool.
+    :returns:  list -- Names of the sources that were built.
+    """
+
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+
+    for name in _index_sources(index_dir):
+        if name not in sources:
+            for path in _source_files(index_dir, name):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    built = list()
+    for name, source in sorted(sources.items()):
+        fingerprint = source_fingerprint(source)
+        meta_file = os.path.join(index_dir, "{}.json".format(name))
+        if not rebuild and os.path.exists(meta_file):
+            with open(meta_file, 'r') as meta:
+                if json.load(meta).get('fingerprint') == fingerprint:
+                    continue
+
+        keys, values = read_source(source)
+        vocabulary = list()
+        if fingerprint['type'] == CATEGORY:
+            vocabulary = [None] + sorted(set(values))
+            codes = dict((value, i) for i, value in enumerate(vocabulary))
+            table_keys, table_values = build_table(keys, [codes[value] for value in values], numpy.uint16)
+        else:
+            table_keys, table_values = build_table(keys, values, numpy.float32)
+
+        # Written under temporary names and renamed, so readers never see a half written source
+        for suffix, array in (("keys", table_keys), ("values", table_values)):
+            path = os.path.join(index_dir, "{}.{}.npy".format(name, suffix))
+            numpy.save("{}.tmp.npy".format(path[:-4]), array)
+            os.rename("{}.tmp.npy".format(path[:-4]), path)
+        with open("{}.tmp".format(meta_file), 'w') as meta:
+            json.dump({'fingerprint': fingerprint, 'variants': len(keys), 'vocabulary': vocabulary}, meta)
+        os.rename("{}.tmp".format(meta_file), meta_file)
+        built.append(name)
+
+    return built
+
+
+def _index_sources(index_dir):
+    """Names of the sources built in an index directory"""
+
+    return sorted(name[:-5] for name in os.listdir(index_dir) if name.endswith(".json"))
+
+
+class LookupIndex(object):
+    """Read access to a lookup index. Sources are memory mapped, so the index can be opened cheaply in every job
+    and process on a node and shares the page cache between them."""
+
+    def __init__(self, index_dir, max_aaf=0.01, sources=None):
+        """
+        :param index_dir: The index directory.
+        :type index_dir: str.
+        :param max_aaf: Highest allele frequency of a rare variant.
+        :type max_aaf: float.
+        :param sources: Names of the sources to use. Every source of the index if not specified.
+        :type sources: list.
+        """
+
+        self.max_aaf = max_aaf
+        self.sources = dict()
+        available = _index_sources(index_dir)
+        missing = sorted(set(sources or list()) - set(available))
+        if missing:
+            raise ValueError("Sources {} are not in lookup index {}. Build it with update_lookup_index "
+                             "first".format(", ".join(missing), index_dir))
+        for name in (sorted(sources) if sources is not None else available):
+            with open(os.path.join(index_dir, "{}.json".format(name)), 'r') as meta:
+                meta = json.load(meta)
+            keys = numpy.load(os.path.join(index_dir, "{}.keys.npy".format(name)), mmap_mode='r')
+            values = numpy.load(os.path.join(index_dir, "{}.values.npy".format(name)), mmap_mode='r')
+            self.sources[name] = {'keys': keys, 'values': values, 'mask': len(keys) - 1,
+                                  'type': meta['fingerprint']['type'], 'vocabulary': meta['vocabulary']}
+
+    def lookup(self, name, key):
+        """Value of a variant key in a source, or None if the source does not have the variant"""
+
+        source = self.sources[name]
+        keys = source['keys']
+        slot = key & source['mask']
+        while True:
+            found = int(keys[slot])
+            if found == key:
+                value = source['values'][slot]
+                return source['vocabulary'][value] if source['type'] == CATEGORY else float(value)
+            if found == 0:
+                return None
+            slot = (slot + 1) & source['mask']
+
+    def frequency(self, chrom, pos, ref, alt):
+        """Highest allele frequency of a variant over the frequency sources, or None if none of them has it"""
+
+        key = variant_key(chrom, pos, ref, alt)
+        found = [self.lookup(name, key) for name, source in self.sources.items() if source['type'] == FREQUENCY]
+        found = [value for value in found if value is not None]
+
+        return max(found) if found else None
+
+    def clinvar(self, chrom, pos, ref, alt):
+        """ClinVar significance of a variant from the category sources, or None if it is not in ClinVar"""
+
+        key = variant_key(chrom, pos, ref, alt)
+        for name, source in sorted(self.sources.items()):
+            if source['type'] == CATEGORY:
+                value = self.lookup(name, key)
+                if value is not None:
+                    return value
+
+        return None
+
+    def is_rare(self, chrom, pos, ref, alt):
+        frequency = self.frequency(chrom, pos, ref, alt)
+
+        return frequency is None or frequency <= self.max_aaf
+
+    def in_clinvar(self, chrom, pos, ref, alt):
+        return self.clinvar(chrom, pos, ref, alt) is not None
+
+
+def open_lookup_index(config):
+    """The lookup index configured in config['lookup_index'], or None if there is none
+
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :returns:  LookupIndex.
+    """
+
+    settings = config.get('lookup_index')
+    if not settings or not os.path.isdir(settings['dir']):
+        return None
+
+    sources = list(settings['sources']) if 'sources' in settings else None
+
+    return LookupIndex(settings['dir'], float(settings.get('max_aaf', 0.01)), sources)
+
+
+def update_lookup_index(job, config):
+    """Build the lookup index configured in config['lookup_index'], rebuilding only sources that changed
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :returns:  str -- The index directory.
+    """
+
+    settings = config['lookup_index']
+    if plan.record_function("lookup.build_lookup_index", "lookup_index.log",
+                            [source['vcf'] for source in settings['sources'].values()], [settings['dir']]):
+        return settings['dir']
+
+    built = build_lookup_index(settings['dir'], settings['sources'])
+    job.fileStore.logToMaster("Lookup index {}: rebuilt {}\n".format(settings['dir'], ", ".join(built) or "nothing"))
+
+    return settings['dir']
+
+
+def filter_common_variants(job, config, sample, input_vcf):
+    """Remove common variants that are not in ClinVar from a VCF before it is loaded into GEMINI, using the lookup
+    index instead of annotating them first
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param input_vcf: The input_vcf file name to process.
+    :type input_vcf: str.
+    :returns:  str -- The output vcf file name.
+    """
+
+    output_vcf = "{}.uncommon.vcf".format(sample)
+    logfile = "{}.filter_common.log".format(sample)
+    if plan.record_function("lookup.filter_common_variants", logfile, [input_vcf], [output_vcf]):
+        return output_vcf
+
+    index = open_lookup_index(config)
+    with pipeline.python_step("lookup.filter_common_variants", logfile, [input_vcf], [output_vcf]):
+        kept, removed = _filter_common(index, input_vcf, output_vcf)
+
+    job.fileStore.logToMaster("Removed {} common variants from {}, kept {}\n".format(removed, input_vcf, kept))
+
+    return output_vcf
+
+
+def _filter_common(index, input_vcf, output_vcf):
+    """Write the records of input_vcf with a rare or ClinVar allele to output_vcf. Returns the numbers of records
+    kept and removed."""
+
+    kept = 0
+    removed = 0
+    with scatter.open_vcf(input_vcf) as vcf, open(output_vcf, 'w') as output:
+        for line in vcf:
+            if not line.startswith("#"):
+                fields = line.split("\t", 5)
+                alts = fields[4].split(",")
+                if not any(index.in_clinvar(fields[0], fields[1], fields[3], alt) or
+                           index.is_rare(fields[0], fields[1], fields[3], alt) for alt in alts):
+                    removed += 1
+                    continue
+                kept += 1
+            output.write(line)
+
+    return kept, removed
@@ -8,6 +8,8 @@
 """
 
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
+from ddb_ngsflow import scatter
 
 
 def mutect_pon():
@@ -22,6 +24,8 @@ def mutect_matched():
     raise NotImplementedError()
 
 
+@scatter.scatter_by_regions("mutect")
+@resources.declare(memory=resources.tool_memory('mutect', "8G"), disk=resources.input_disk())
 def mutect_single(job, config, name, samples, input_bam):
     """Run MuTect on an an unmatched tumour sample and call somatic variants
     :param config: The configuration dictionary.
@@ -71,25 +75,22 @@ def mutect_single(job, config, name, samples, input_bam):
                       "-vcf",
                       "{}".format(temp_mutect)]
 
-    subset_command = ["cat",
-                      "{}".format(temp_mutect),
-                      "|",
-                      "{}".format(config['vcftools_subset']['bin']),
+    subset_command = ["{}".format(config['vcftools_subset']['bin']),
                       "-e",
                       "-c",
-                      "{}".format(name),
-                      ">",
-                      "{}".format(mutect_vcf)]
+                      "{}".format(name)]
 
     job.fileStore.logToMaster("MuTect Command: {}\n".format(mutect_command))
-    pipeline.run_and_log_command(" ".join(mutect_command), mutect_logfile)
+    pipeline.run_pipeline([mutect_command], mutect_logfile)
 
     job.fileStore.logToMaster("Subset Command: {}\n".format(subset_command))
-    pipeline.run_and_log_command(" ".join(subset_command), subset_log)
+    pipeline.run_pipeline([subset_command], subset_log, stdin=temp_mutect, stdout=mutect_vcf)
 
     return mutect_vcf
 
 
+@resources.declare(cores=resources.tool_cores('gatk3.5'), memory=resources.tool_memory('gatk3.5', "8G"),
+                   disk=resources.input_disk())
 def mutect2_single(job, config, name, samples, input_bam):
     """Run MuTect on an an unmatched tumour sample and call somatic variants
     :param config: The configuration dictionary.
@@ -113,8 +114,10 @@ def mutect2_single(job, config, name, samples, input_bam):
                       "{}".format(config['dbsnp']),
                       "--cosmic",
                       "{}".format(config['cosmic']),
-                      "-drf DuplicateRead",
-                      "-ip 100",
+                      "-drf",
+                      "DuplicateRead",
+                      "-ip",
+                      "100",
                       "-L",
                       "{}".format(samples[name]['regions']),
                       "-nct",
@@ -125,9 +128,9 @@ def mutect2_single(job, config, name, samples, input_bam):
                       "{}".format(mutect_vcf)]
 
     job.fileStore.logToMaster("MuTect2 Command: {}\n".format(mutect_command))
-    pipeline.run_and_log_command(" ".join(mutect_command), mutect_logfile)
+    pipeline.run_pipeline([mutect_command], mutect_logfile)
 
     # job.fileStore.logToMaster("Subset Command: {}\n".format(subset_command))
-    # pipeline.run_and_log_command(" ".join(subset_command), subset_log)
+    # pipeline.run_pipeline([subset_command], subset_log)
 
     return mutect_vcf
@@ -7,8 +7,11 @@
 """
 
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
 
 
+@resources.declare(cores=resources.tool_cores('pisces'), memory=resources.tool_memory('pisces', "8G"),
+                   disk=resources.input_disk())
 def pisces(job, config, name, input_bam):
     """Run Pisces on a single sample
     :param config: The configuration dictionary.
@@ -50,6 +53,6 @@ def pisces(job, config, name, input_bam):
                "True"]
 
     job.fileStore.logToMaster("Pisces Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return output_vcf
@@ -8,9 +8,14 @@
 """
 
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
+from ddb_ngsflow import scatter
 
 
 # This needs to be fixed, new regions need to be defined for all targeted panels to use this
+@scatter.scatter_by_regions("platypus")
+@resources.declare(cores=resources.tool_cores('platypus'), memory=resources.tool_memory('platypus', "4G"),
+                   disk=resources.input_disk())
 def platypus_single(job, config, name, samples, input_bam):
     """Run Platypus on an an unmatched tumour sample and call somatic variants
     :param config: The configuration dictionary.
@@ -41,6 +46,6 @@ def platypus_single(job, config, name, samples, input_bam):
                         "--output={}".format(platypus_vcf)]
 
     job.fileStore.logToMaster("Platypus Command: {}\n".format(platypus_command))
-    pipeline.run_and_log_command(" ".join(platypus_command), platypus_log)
+    pipeline.run_pipeline([platypus_command], platypus_log)
 
     return platypus_vcf
@@ -10,10 +10,17 @@
 
 import os
 
+from ddb_ngsflow import plan
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
+from ddb_ngsflow import scatter
+from ddb_ngsflow.utils import reheader
 from toil.job import JobException
 
 
+@scatter.scatter_by_regions("scalpel")
+@resources.declare(cores=resources.tool_cores('scalpel'), memory=resources.tool_memory('scalpel', "8G"),
+                   disk=resources.input_disk())
 def scalpel_single(job, config, name, samples, input_bam):
     """Run Scalpel on an an unmatched tumour sample and call somatic variants
     :param config: The configuration dictionary.
@@ -30,7 +37,6 @@ def scalpel_single(job, config, name, samples, input_bam):
     scalpel_vcf = os.path.join(output_dir, "variants.indel.vcf")
     fixed_vcf = "{}.scalpel.vcf".format(name)
     logfile = "{}.scalpel.log".format(name)
-    logfile2 = "{}.scalpel_fix.log".format(name)
 
     scalpel_command = ["{}".format(config['scalpel']['bin']),
                        "--single",
@@ -52,23 +58,20 @@ def scalpel_single(job, config, name, samples, input_bam):
                        "--dir",
                        "{}".format(output_dir)]
 
-    fix_sample_name_command = ["cat",
-                               "{}".format(scalpel_vcf),
-                               "|",
-                               "sed",
-                               "'s/sample/{}/g'".format(name),
-                               ">",
-                               "{}".format(fixed_vcf)]
-
     job.fileStore.logToMaster("Scalpel Command: {}\n".format(scalpel_command))
-    pipeline.run_and_log_command(" ".join(scalpel_command), logfile)
+    pipeline.run_pipeline([scalpel_command], logfile, outputs=[output_dir])
 
-    job.fileStore.logToMaster("Scalpel Fix Command: {}\n".format(fix_sample_name_command))
-    pipeline.run_and_log_command(" ".join(fix_sample_name_command), logfile2)
+    # Only the header names the sample, so the records are copied as they are
+    job.fileStore.logToMaster("Renaming sample column of {} to {}\n".format(scalpel_vcf, name))
+    fix_logfile = "{}.scalpel_fix.log".format(name)
+    if not plan.record_function("reheader.rename_samples", fix_logfile, [scalpel_vcf], [fixed_vcf]) and \
+            os.path.exists(scalpel_vcf):
+        with pipeline.python_step("reheader.rename_samples", fix_logfile, [scalpel_vcf], [fixed_vcf]):
+            reheader.rewrite_header(scalpel_vcf, fixed_vcf, reheader.rename_samples({'sample': name}))
 
     file_path = os.path.join(cwd, fixed_vcf)
-    if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-        return scalpel_vcf
+    if plan.planning() or (os.path.exists(file_path) and os.path.getsize(file_path) > 0):
+        return fixed_vcf
     else:
         job.fileStore.logToMaster("Scalpel ran into a problem and no output was generated for file {}. Check logfile"
                                   "{} for details\n".format(scalpel_vcf, logfile))
@@ -28,18 +28,17 @@ def run_delly2_single(job, config, name, input_bam):
 
         delly_vcfs.append(output_vcf)
 
-        delly_command = list()
-        delly_command.append(delly_command_core)
-        delly_command.append("-t",
-                             "{}".format(mut_type),
-                             "-o",
-                             "{}".format(output_vcf),
-                             "{}".format(input_bam))
+        delly_command = list(delly_command_core)
+        delly_command.extend(["-t",
+                              "{}".format(mut_type),
+                              "-o",
+                              "{}".format(output_vcf),
+                              "{}".format(input_bam)])
 
         job.fileStore.logToMaster("Running Delly: {}\n".format(delly_command))
-        pipeline.run_and_log_command(" ".join(delly_command), logfile)
+        pipeline.run_pipeline([delly_command], logfile)
 
     job.fileStore.logToMaster("Merging delly output with command: {}\n".format(merge_command))
-    pipeline.run_and_log_command(" ".join(merge_command), merge_log)
+    pipeline.run_pipeline([merge_command], merge_log)
 
     return merged_vcf
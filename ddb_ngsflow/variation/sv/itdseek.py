@@ -24,11 +24,9 @@ def run_flt3_itdseek(job, config, name):
     itdseek_command = ["{}".format(config['itdseek']['bin']),
                        "{}.rg.sorted.bam".format(name),
                        "{}".format(config['reference']),
-                       "{}".format(config['samtools-0.19']['bin']),
-                       ">",
-                       "{}".format(itdseek_vcf)]
+                       "{}".format(config['samtools-0.19']['bin'])]
 
     job.fileStore.logToMaster("ITDSeek Command: {}\n".format(itdseek_command))
-    pipeline.run_and_log_command(" ".join(itdseek_command), itdseek_logfile)
+    pipeline.run_pipeline([itdseek_command], itdseek_logfile, stdout=itdseek_vcf)
 
     return itdseek_vcf
@@ -33,9 +33,9 @@ def manta(job, config, name, input_bam):
     manta_command = ()
 
     job.fileStore.logToMaster("Manta Configuration Command: {}\n".format(manta_command))
-    pipeline.run_and_log_command(" ".join(manta_config_command), manta_config_log)
+    pipeline.run_pipeline([manta_config_command], manta_config_log)
 
     job.fileStore.logToMaster("Manta Command: {}\n".format(manta_command))
-    pipeline.run_and_log_command(" ".join(manta_command), manta_log)
+    pipeline.run_pipeline([manta_command], manta_log)
 
     return manta_vcf
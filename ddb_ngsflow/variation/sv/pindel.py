@@ -9,8 +9,11 @@
 """
 
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
 
 
+@resources.declare(cores=resources.tool_cores('pindel'), memory=resources.tool_memory('pindel', "8G"),
+                   disk=resources.input_disk())
 def run_pindel(job, config, name, input_bam):
     """Run Pindel caller for InDel Detection
     :param config: The configuration dictionary.
@@ -64,9 +67,9 @@ def run_pindel(job, config, name, input_bam):
                           "{}".format(output_vcf))
 
     job.fileStore.logToMaster("Pindel Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     job.fileStore.logToMaster("Pindel2vcf Command: {}\n".format(pindel2vcf_command))
-    pipeline.run_and_log_command(" ".join(pindel2vcf_command), vcf_logfile)
+    pipeline.run_pipeline([pindel2vcf_command], vcf_logfile)
 
     return output_vcf
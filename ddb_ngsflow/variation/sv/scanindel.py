@@ -41,6 +41,6 @@ def scanindel(job, config, name, samples, input_bam):
                "{}".format(samples[name]['regions']))
 
     job.fileStore.logToMaster("ScanIndel Configuration Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    pipeline.run_pipeline([command], logfile)
 
     return output_vcf
@@ -9,6 +9,7 @@
 """
 
 from ddb_ngsflow import pipeline
+from ddb_ngsflow import resources
 
 
 def vardict_matched():
@@ -17,6 +18,8 @@ def vardict_matched():
     raise NotImplementedError()
 
 
+@resources.declare(cores=resources.tool_cores('vardict'), memory=resources.tool_memory('vardict', "8G"),
+                   disk=resources.input_disk())
 def vardict_single(job, config, name, samples, input_bam):
     """Run VarDict on an an unmatched tumour sample and call somatic variants
     :param config: The configuration dictionary.
@@ -65,11 +68,9 @@ def vardict_single(job, config, name, samples, input_bam):
     vcfsort = ["{}".format(config['vcftools_sort']['bin']),
                "-c"]
 
-    command = ("{vardict} | {strandbias} | {vardict2vcf} | "
-               "{sort} > {vcf}".format(vardict=" ".join(vardict), strandbias=config['vardict_strandbias']['bin'],
-                                       vardict2vcf=" ".join(vardict2vcf), sort=" ".join(vcfsort), vcf=vardict_vcf))
+    command = [vardict, ["{}".format(config['vardict_strandbias']['bin'])], vardict2vcf, vcfsort]
 
-    job.fileStore.logToMaster("VarDict Command: {}\n".format(command))
-    pipeline.run_and_log_command(command, logfile)
+    job.fileStore.logToMaster("VarDict Command: {}\n".format(pipeline.render_pipeline(command, stdout=vardict_vcf)))
+    pipeline.run_pipeline(command, logfile, stdout=vardict_vcf)
 
     return vardict_vcf
@@ -9,60 +9,145 @@
 """
 
 import os
+import re
 import sys
+import time
+import heapq
+import numpy
+import shutil
+import itertools
+import multiprocessing
 import cyvcf2
 
-from ddb import gemini_interface
 from gemini import GeminiQuery
+from ddb_ngsflow import plan
 from ddb_ngsflow import pipeline
-from ddb import vcf_parsing
+from ddb_ngsflow import resources
+from ddb_ngsflow import scatter
+from ddb_ngsflow.utils import bgzf
+from ddb_ngsflow.utils import reheader
+from ddb_ngsflow.variation import lookup
 from cyvcf2 import VCF
-from cyvcf2 import Writer
 
+# Where each caller reports the read depth of the alternate allele: the FORMAT field and the position of the first
+# alternate allele's value in it for the first sample (AD style fields start with the reference depth)
+LOW_SUPPORT_ALT_DEPTH = {'freebayes': ('AO', 0),
+                         'mutect': ('AD', 1),
+                         'vardict': ('VD', 0),
+                         'scalpel': ('AD', 1),
+                         'platypus': ('NV', 0),
+                         'pindel': ('AD', 1)}
+LOW_SUPPORT_MIN_ALT_DEPTH = 5.0
+LOW_SUPPORT_MAX_LENGTH = 1000
+
+# Records are read into batches of this size and the thresholds are applied with array operations. cyvcf2 only reads
+# FORMAT values one record at a time, so gathering a batch still costs one format() call per record. With more than
+# one core the contigs of an indexed VCF are filtered in chunks of this many bases.
+LOW_SUPPORT_BATCH_SIZE = 10000
+LOW_SUPPORT_CHUNK_SIZE = 10000000
+
+# Columns of the variant report, and the report filters: variants seen in ESP, 1000 Genomes or ExAC at an allele
+# frequency above REPORT_MAX_AAF are common, and variants of these impact severities do not affect the protein. These
+# are the var_is_rare and var_is_protein_effecting rules of ddb.gemini_interface, written as SQL.
+REPORT_COLUMNS = ["chrom", "start", "end", "ref", "alt", "vcf_id", "rs_ids", "cosmic_ids", "filter", "qual",
+                  "qual_depth", "depth", "gene", "transcript", "exon", "codon_change", "aa_change", "biotype", "impact",
+                  "impact_so", "impact_severity", "aa_length", "is_lof", "is_conserved", "pfam_domain", "in_omim",
+                  "clinvar_sig", "clinvar_disease_name", "clinvar_origin", "clinvar_causal_allele", "clinvar_dbsource",
+                  "clinvar_dbsource_id", "clinvar_on_diag_assay", "rmsk", "in_segdup", "strand_bias", "rms_map_qual",
+                  "in_hom_run", "num_mapq_zero", "num_reads_w_dels", "grc", "gms_illumina", "in_cse", "num_alleles",
+                  "allele_count", "haplotype_score", "is_somatic", "somatic_score", "aaf_esp_ea", "aaf_esp_aa",
+                  "aaf_esp_aa", "aaf_esp_all", "aaf_1kg_amr", "aaf_1kg_eas", "aaf_1kg_sas", "aaf_1kg_afr",
+                  "aaf_1kg_eur", "aaf_1kg_all", "aaf_exac_all", "aaf_adj_exac_all", "aaf_adj_exac_afr",
+                  "aaf_adj_exac_amr", "aaf_adj_exac_eas", "aaf_adj_exac_fin", "aaf_adj_exac_nfe", "aaf_adj_exac_oth",
+                  "aaf_adj_exac_sas", "max_aaf_all", "in_esp", "in_1kg", "in_exac"]
+REPORT_MAX_AAF = 0.01
+REPORT_EXCLUDED_SEVERITIES = ("LOW",)
+
+# INFO field listing the callers supporting each merged call
+ENSEMBLE_INFO_TAG = "CALLERS"
+_META_ID = re.compile(r"^##(\w+)=<ID=([^,>]+)")
+_META_FIELD = re.compile(r'(\w+)=("[^"]*"|[^,>]*)')
+
+
+def _sql_string(value):
+    return "'{}'".format("{}".format(value).replace("'", "''"))
+
+
+def build_report_query(genes=None, annotation_filters=True):
+    """Build the variant report query. The report filters are part of the WHERE clause, so SQLite only returns
+    passing variants: variants in ClinVar are kept, as are rare, protein effecting variants. With genes, variants
+    must also be in one of them, which SQLite looks up in a temporary index of the IN list.
+    :param genes: Gene names to restrict the report to.
+    :type genes: list.
+    :param annotation_filters: Filter on the frequency and ClinVar annotations of the database. Without them the
+    report filters are left to a lookup index.
+    :type annotation_filters: bool.
+    :returns:  str -- The query.
+    """
+
+    rare = "(COALESCE(in_esp, 0) = 0 AND COALESCE(in_1kg, 0) = 0 AND COALESCE(in_exac, 0) = 0 " \
+           "OR max_aaf_all IS NULL OR max_aaf_all <= {})".format(REPORT_MAX_AAF)
+    protein_effecting = "(impact_severity IS NULL OR impact_severity NOT IN ({}))".format(
+        ", ".join(_sql_string(severity) for severity in REPORT_EXCLUDED_SEVERITIES))
+    conditions = ["(clinvar_sig IS NOT NULL OR ({} AND {}))".format(rare, protein_effecting)]
+    if not annotation_filters:
+        conditions = list()
+    if genes:
+        conditions.insert(0, "gene IN ({})".format(", ".join(_sql_string(gene) for gene in sorted(set(genes)))))
+
+    query = "SELECT {} FROM variants".format(", ".join(REPORT_COLUMNS))
+
+    return "{} WHERE {}".format(query, " AND ".join(conditions)) if conditions else query
+
+
+def _lookup_report_filter(rows, index):
+    """The report filters of build_report_query, with frequencies and ClinVar significance taken from a lookup
+    index rather than the annotations of the database"""
+
+    for row in rows:
+        # GEMINI starts are 0-based, the index is keyed on VCF positions
+        variant = (row['chrom'], int(row['start']) + 1, row['ref'], row['alt'])
+        if index.in_clinvar(*variant):
+            yield row
+        elif row['impact_severity'] not in REPORT_EXCLUDED_SEVERITIES and index.is_rare(*variant):
+            yield row
 
-def _run_gemini_query_and_filter(db, genes):
-    """Use the GeminiQuery API to filter results based on severity and specific annotations
+
+def _run_gemini_query_and_filter(db, genes, query=None, index=None):
+    """Use the GeminiQuery API to select the variants passing the report filters based on severity and specific
+    annotations. Rows are streamed from the database cursor.
     :param db: GEMINI database.
     :type db: str.
-    :returns:  tuple -- The header line for the requested columns and all rows that pass filters.
+    :param genes: Gene names to restrict the report to.
+    :type genes: list.
+    :param query: The report query, if already built with build_report_query.
+    :type query: str.
+    :param index: Lookup index to take frequencies and ClinVar significance from instead of the database.
+    :type index: lookup.LookupIndex.
+    :returns:  tuple -- The header line for the requested columns and an iterator over the rows that pass filters.
     """
 
-    query = "SELECT chrom, start, end, ref, alt, vcf_id, rs_ids, cosmic_ids, filter, qual, qual_depth, depth, " \
-            "gene, transcript, exon, codon_change, aa_change, biotype, impact, impact_so, impact_severity, " \
-            "aa_length, is_lof, is_conserved, pfam_domain, in_omim, clinvar_sig, clinvar_disease_name, " \
-            "clinvar_origin, clinvar_causal_allele, clinvar_dbsource, clinvar_dbsource_id, clinvar_on_diag_assay, " \
-            "rmsk, in_segdup, strand_bias, rms_map_qual, in_hom_run, num_mapq_zero, num_reads_w_dels, grc, " \
-            "gms_illumina, in_cse, num_alleles, allele_count, haplotype_score, is_somatic, somatic_score, " \
-            "aaf_esp_ea, aaf_esp_aa, aaf_esp_aa, aaf_esp_all, aaf_1kg_amr, aaf_1kg_eas, aaf_1kg_sas, aaf_1kg_afr, " \
-            "aaf_1kg_eur, aaf_1kg_all, aaf_exac_all, aaf_adj_exac_all, aaf_adj_exac_afr, aaf_adj_exac_amr, " \
-            "aaf_adj_exac_eas, aaf_adj_exac_fin, aaf_adj_exac_nfe, aaf_adj_exac_oth, aaf_adj_exac_sas, " \
-            "max_aaf_all, in_esp, in_1kg, in_exac FROM variants"
-    # "(gts).(*), (gt_depths).(*), (gt_ref_depths).(*), (gt_alt_depths).(*), " \
     gq = GeminiQuery(db)
-    gq.run(query)
-    header = gq.header
-    passing_rows = []
-    print header
-
-    # Filter out variants with minor allele frequencies above the threshold but
-    # retain any that are above the threshold but in COSMIC or in ClinVar and not listed as benign.
-    for variant_data in gq:
-        if genes:
-            if not gemini_interface.var_in_gene(variant_data, genes):
-                continue
-        # Right now removing this. Many benign and synonymous variants are in cosmic
-        # if _var_is_in_cosmic(variant_data):
-        #     passing_rows.append(variant_data)
-        #     continue
-        if gemini_interface.var_is_in_clinvar(variant_data):
-            # Removed is_benign check temporarily. Some variants not annotated with up to date annotations
-            passing_rows.append(variant_data)
-            continue
-        if gemini_interface.var_is_rare(variant_data):
-            if gemini_interface.var_is_protein_effecting(variant_data):
-                passing_rows.append(variant_data)
+    gq.run(query or build_report_query(genes, index is None))
+    if index is not None:
+        return gq.header, _lookup_report_filter(gq, index)
+
+    return gq.header, iter(gq)
 
-    return header, passing_rows
+
+def _write_variant_report(name, database, genes, query=None, index=None):
+    """Write the variant report of one database. Returns the number of variants written."""
+
+    filename = "{}.variant_report.txt".format(name)
+    header, variants = _run_gemini_query_and_filter(database, genes, query, index)
+    written = 0
+    with open(filename, 'w') as outfile:
+        outfile.write("{}\n".format(header))
+        for variant in variants:
+            outfile.write("{}\n".format(variant))
+            written += 1
+
+    return written
 
 
 def generate_variant_report(job, config, name, genes, database):
@@ -77,11 +162,99 @@ def generate_variant_report(job, config, name, genes, database):
     """
 
     filename = "{}.variant_report.txt".format(name)
-    header, variants = _run_gemini_query_and_filter(database, genes)
-    with open(filename, 'w') as outfile:
-        outfile.write("{}\n".format(header))
-        for variant in variants:
-            outfile.write("{}\n".format(variant))
+    if plan.record_function("variation.generate_variant_report", "{}.variant_report.log".format(name), [database],
+                            [filename]):
+        return
+
+    written = _write_variant_report(name, database, genes, index=lookup.open_lookup_index(config))
+    job.fileStore.logToMaster("Wrote {} variants from {} to {}\n".format(written, database, filename))
+
+
+# Report queries of a batch by gene set, built once by the parent and handed to every pool worker when it starts,
+# and the lookup index each worker maps
+_batch_queries = dict()
+_batch_index = None
+
+
+def _init_report_worker(queries, config):
+    global _batch_index
+    _batch_queries.update(queries)
+    _batch_index = lookup.open_lookup_index(config)
+
+
+def _batch_report_worker(task):
+    name, database, gene_set = task
+    start = time.time()
+    try:
+        written = _write_variant_report(name, database, None, _batch_queries[gene_set], _batch_index)
+        error = None
+    except Exception as e:
+        written = 0
+        error = "{}: {}".format(type(e).__name__, e)
+
+    return {'sample': name, 'database': database, 'variants': written, 'seconds': time.time() - start,
+            'error': error}
+
+
+@resources.declare(cores=resources.tool_cores('gemini'))
+def generate_variant_reports(job, config, reports):
+    """Generate the variant reports of many GEMINI databases concurrently with a process pool of
+    config['gemini']['num_cores'] workers. Each distinct gene list is turned into a report query once and shared
+    with the workers. Writes the time taken and variants reported for every database to
+    variant_report_summary.txt and logs an aggregate summary.
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param reports: Tuples of sample name, GEMINI database and gene list (or None) to report on.
+    :type reports: list.
+    :returns:  list -- Per-database results with sample, database, variants, seconds and error.
+    :raises: RuntimeError
+    """
+
+    summary_file = "variant_report_summary.txt"
+    if plan.record_function("variation.generate_variant_reports", "variant_reports.log",
+                            [database for name, database, genes in reports],
+                            ["{}.variant_report.txt".format(name) for name, database, genes in reports] +
+                            [summary_file]):
+        return list()
+
+    annotation_filters = lookup.open_lookup_index(config) is None
+    queries = dict()
+    tasks = list()
+    for name, database, genes in reports:
+        gene_set = frozenset(genes or list())
+        if gene_set not in queries:
+            queries[gene_set] = build_report_query(gene_set, annotation_filters)
+        tasks.append((name, database, gene_set))
+
+    processes = max(1, min(int((config.get('gemini') or dict()).get('num_cores', 1)), len(tasks)))
+    job.fileStore.logToMaster("Generating {} variant reports with {} processes\n".format(len(tasks), processes))
+    start = time.time()
+    pool = multiprocessing.Pool(processes, _init_report_worker, (queries, config))
+    try:
+        results = pool.map(_batch_report_worker, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    with open(summary_file, 'w') as summary:
+        summary.write("sample\tdatabase\tvariants\tseconds\terror\n")
+        for result in results:
+            summary.write("{}\t{}\t{}\t{:.2f}\t{}\n".format(result['sample'], result['database'], result['variants'],
+                                                          result['seconds'], result['error'] or ""))
+
+    failed = [result for result in results if result['error']]
+    seconds = [result['seconds'] for result in results]
+    job.fileStore.logToMaster("Generated {} variant reports ({} variants) in {:.1f}s: {:.1f}s per database on "
+                              "average, {:.1f}s at most, {:.1f}x speedup over running them one by one\n".format(
+                                  len(results) - len(failed), sum(result['variants'] for result in results), elapsed,
+                                  sum(seconds) / max(len(seconds), 1), max(seconds or [0.0]),
+                                  sum(seconds) / elapsed if elapsed > 0 else 1.0))
+    if failed:
+        raise RuntimeError("Variant reports failed for {}. See {} for details".format(
+            ", ".join(result['sample'] for result in failed), summary_file))
+
+    return results
 
 
 def vt_normalization(job, config, sample, caller, input_vcf):
@@ -100,33 +273,85 @@ def vt_normalization(job, config, sample, caller, input_vcf):
     output_vcf = "{}.{}.normalized.vcf".format(sample, caller)
     logfile = "{}.{}.vt_normalization.log".format(sample, caller)
 
-    normalization = ["zless",
-                     "{}".format(input_vcf),
-                     "|",
-                     "sed",
-                     "'s/ID=AD,Number=./ID=AD,Number=R/'",
-                     "|",
-                     "{}".format(config['vt']['bin']),
-                     "decompose",
-                     "-s",
-                     "-",
-                     "|",
-                     "{}".format(config['vt']['bin']),
-                     "normalize",
-                     "-r",
-                     "{}".format(config['reference']),
-                     "-",
-                     ">",
-                     "{}".format(output_vcf)]
-
-    job.fileStore.logToMaster("VT Command: {}\n".format(normalization))
-    pipeline.run_and_log_command(" ".join(normalization), logfile)
+    normalization = [["gzip",
+                      "-cdf",
+                      "{}".format(input_vcf)],
+                     ["sed",
+                      "1,/^#CHROM/s/ID=AD,Number=./ID=AD,Number=R/"],
+                     ["{}".format(config['vt']['bin']),
+                      "decompose",
+                      "-s",
+                      "-"],
+                     ["{}".format(config['vt']['bin']),
+                      "normalize",
+                      "-r",
+                      "{}".format(config['reference']),
+                      "-"]]
+
+    job.fileStore.logToMaster("VT Command: {}\n".format(pipeline.render_pipeline(normalization, stdout=output_vcf)))
+    pipeline.run_pipeline(normalization, logfile, stdout=output_vcf)
+
+    return output_vcf
+
+
+@resources.declare(cores=resources.tool_cores('vt'), disk=resources.input_disk())
+def normalize_bgzip_tabix_vcf(job, config, sample, caller, input_vcf):
+    """Decompose and left normalize variants and write them bgzipped and tabix indexed in a single pass. This fuses
+    vt_normalization and bgzip_tabix_vcf: a bgzipped input is decompressed with config['vt']['num_cores'] threads,
+    the AD header line is patched without rewriting the records, and the normalized stream is compressed and indexed
+    as it arrives, so the output only touches disk once.
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param caller: caller name.
+    :type caller: str.
+    :param input_vcf: The input_vcf file name to process.
+    :type input_vcf: str.
+    :returns:  str -- The output vcf file name.
+    """
+
+    output_vcf = "{}.{}.normalized.vcf.gz".format(sample, caller)
+    logfile = "{}.{}.vt_normalization.log".format(sample, caller)
+
+    # Only lines up to the column header are substituted, so records pass through sed untouched
+    normalization = [["sed",
+                      "1,/^#CHROM/s/ID=AD,Number=./ID=AD,Number=R/"],
+                     ["{}".format(config['vt']['bin']),
+                      "decompose",
+                      "-s",
+                      "-"],
+                     ["{}".format(config['vt']['bin']),
+                      "normalize",
+                      "-r",
+                      "{}".format(config['reference']),
+                      "-"]]
+    if input_vcf.endswith(".gz"):
+        normalization.insert(0, ["bgzip",
+                                 "-@",
+                                 "{}".format(config['vt'].get('num_cores', 1)),
+                                 "-cd",
+                                 "{}".format(input_vcf)])
+    else:
+        normalization[0].append("{}".format(input_vcf))
+
+    job.fileStore.logToMaster("VT Command: {}\n".format(pipeline.render_pipeline(normalization, stdout=output_vcf)))
+    if plan.planning():
+        pipeline.run_pipeline(normalization, logfile, stdout=output_vcf, inputs=[input_vcf],
+                              outputs=[output_vcf, "{}.tbi".format(output_vcf)])
+        return output_vcf
+
+    # The index is only written once the pipeline succeeded, a failed run leaves neither VCF nor index behind
+    with bgzf.IndexedVcfWriter(output_vcf) as output:
+        pipeline.run_pipeline(normalization, logfile, stdout=output, inputs=[input_vcf],
+                              outputs=[output_vcf, "{}.tbi".format(output_vcf)])
 
     return output_vcf
 
 
 def bgzip_tabix_vcf(job, config, sample, caller, input_vcf):
-    """BGZip and Tabix an input VCF file
+    """BGZip and Tabix an input VCF file. A bgzipped input, such as the output of a scatter decorated caller, is
+    returned as it is, indexed if it has no index yet.
     :param config: The configuration dictionary.
     :type config: dict.
     :param sample: sample name.
@@ -136,12 +361,17 @@ def bgzip_tabix_vcf(job, config, sample, caller, input_vcf):
     :returns:  str -- The output vcf file name.
     """
 
+    # Scatter decorated callers already return bgzipped, indexed VCFs
+    if input_vcf.endswith(".gz"):
+        if not plan.planning() and not os.path.exists("{}.tbi".format(input_vcf)):
+            pipeline.run_pipeline([["tabix", "-p", "vcf", "{}".format(input_vcf)]],
+                                  "{}.{}.tabix.log".format(sample, caller))
+        return input_vcf
+
     bgzip_vcf = "{}.gz".format(input_vcf)
     bgzip_cmd = ["bgzip",
                  "-c",
-                 "{}".format(input_vcf),
-                 ">",
-                 "{}".format(bgzip_vcf)]
+                 "{}".format(input_vcf)]
 
     tabix_cmd = ["tabix",
                  "-p",
@@ -152,16 +382,16 @@ def bgzip_tabix_vcf(job, config, sample, caller, input_vcf):
     tabix_logfile = "{}.{}.tabix.log".format(sample, caller)
 
     job.fileStore.logToMaster("Bgzip Command: {}\n".format(bgzip_cmd))
-    pipeline.run_and_log_command(" ".join(bgzip_cmd), bgzip_logfile)
+    pipeline.run_pipeline([bgzip_cmd], bgzip_logfile, stdout=bgzip_vcf)
 
     job.fileStore.logToMaster("Tabix Command: {}\n".format(tabix_cmd))
-    pipeline.run_and_log_command(" ".join(tabix_cmd), tabix_logfile)
+    pipeline.run_pipeline([tabix_cmd], tabix_logfile)
 
     return bgzip_vcf
 
 
 def add_refcontig_info_header(job, config, sample, caller, input_vcf):
-    """Use BCFTools to add contig info from reference to VCF
+    """Add contig info from the reference index to a VCF, rewriting only its header
     :param config: The configuration dictionary.
     :type config: dict.
     :param sample: sample name.
@@ -172,23 +402,21 @@ def add_refcontig_info_header(job, config, sample, caller, input_vcf):
     """
 
     output_vcf = "{}.{}.rehead.vcf.gz".format(sample, caller)
-    logfile = "{}.{}.bcftools_rehead.log".format(sample, caller)
-    command = ["bcftools-1.9dev",
-               "reheader",
-               "-f",
-               "{}.fai".format(config['reference']),
-               "-o",
-               "{}".format(output_vcf),
-               "{}".format(input_vcf)]
-
-    job.fileStore.logToMaster("BCFTools Reheader Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    fai = "{}.fai".format(config['reference'])
+    logfile = "{}.{}.rehead.log".format(sample, caller)
+    if plan.record_function("reheader.set_contigs", logfile, [input_vcf, fai], [output_vcf]):
+        return output_vcf
+
+    job.fileStore.logToMaster("Setting contig header lines of {} from {}\n".format(input_vcf, fai))
+    with pipeline.python_step("reheader.set_contigs", logfile, [input_vcf, fai], [output_vcf]):
+        reheader.rewrite_header(input_vcf, output_vcf, reheader.set_contigs(reheader.contigs_from_fai(fai)))
 
     return output_vcf
 
 
 def PicardUpdateVCFDict(job, config, sample, caller, input_vcf):
-    """Use Picard to add contig info from reference to VCF
+    """Add contig info from the reference sequence dictionary to a VCF, as Picard UpdateVcfSequenceDictionary does,
+    rewriting only its header
     :param config: The configuration dictionary.
     :type config: dict.
     :param sample: sample name.
@@ -200,22 +428,116 @@ def PicardUpdateVCFDict(job, config, sample, caller, input_vcf):
 
     output_vcf = "{}.{}.rehead.vcf".format(sample, caller)
     logfile = "{}.{}.picard_rehead.log".format(sample, caller)
+    if plan.record_function("reheader.set_contigs", logfile, [input_vcf, config['dict']], [output_vcf]):
+        return output_vcf
 
-    command = ["{}".format(config['picard']['bin']),
-               "UpdateVcfSequenceDictionary",
-               "INPUT={}".format(input_vcf),
-               "OUTPUT={}".format(output_vcf),
-               "SEQUENCE_DICTIONARY={}".format(config['dict'])]
-
-    job.fileStore.logToMaster("Picard Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile)
+    job.fileStore.logToMaster("Setting contig header lines of {} from {}\n".format(input_vcf, config['dict']))
+    with pipeline.python_step("reheader.set_contigs", logfile, [input_vcf, config['dict']], [output_vcf]):
+        reheader.rewrite_header(input_vcf, output_vcf,
+                                reheader.set_contigs(reheader.contigs_from_dict(config['dict'])))
 
     return output_vcf
 
 
+def _alt_depth(variant, field, index):
+    """Alternate allele depth of the first sample of a record, read with one cyvcf2 format() call"""
+
+    values = variant.format(field)
+    if values is None or values.shape[1] <= index:
+        return numpy.nan
+
+    return values[0, index]
+
+
+def _write_supported_variants(output, batch, field, index):
+    """Evaluate the low support thresholds on a batch of records at once and write the records that pass. Only the
+    comparisons are vectorised: the depths are still read record by record, as cyvcf2 has no batch FORMAT reader.
+    Returns the number of records written."""
+
+    if not batch:
+        return 0
+
+    depths = numpy.fromiter((_alt_depth(variant, field, index) for variant in batch), dtype=numpy.float64,
+                            count=len(batch))
+    lengths = numpy.fromiter((variant.end - variant.start for variant in batch), dtype=numpy.int64, count=len(batch))
+
+    # Missing values are NaN or, for integer fields, a large negative sentinel, so they fail the depth threshold
+    passing = numpy.flatnonzero((depths >= LOW_SUPPORT_MIN_ALT_DEPTH) & (lengths <= LOW_SUPPORT_MAX_LENGTH))
+    for i in passing:
+        output.write(str(batch[i]))
+
+    return len(passing)
+
+
+def _filter_low_support_region(task):
+    """Filter the records of one region of a VCF, or of the whole file if region is None, and write the passing
+    records to body_file, after header if one is given. Runs in a pool worker. Returns the numbers of records read
+    and written."""
+
+    input_vcf, caller, region, start, end, body_file, header = task
+    field, index = LOW_SUPPORT_ALT_DEPTH[caller]
+
+    vcf = VCF(input_vcf)
+    var_in_region = 0
+    var_passed = 0
+    batch = list()
+    with open(body_file, 'w') as body:
+        if header is not None:
+            body.write(header)
+        for variant in (vcf(region) if region else vcf):
+            # Region queries return every record overlapping the region. Only those starting in it are kept, so
+            # that records spanning a chunk boundary are written once.
+            if region and not start <= variant.start < end:
+                continue
+            batch.append(variant)
+            if len(batch) == LOW_SUPPORT_BATCH_SIZE:
+                var_passed += _write_supported_variants(body, batch, field, index)
+                var_in_region += len(batch)
+                batch = list()
+        var_passed += _write_supported_variants(body, batch, field, index)
+        var_in_region += len(batch)
+    vcf.close()
+
+    return var_in_region, var_passed
+
+
+def _contig_lengths(header):
+    """Lengths of the contigs declared in a VCF header, whatever the order of the keys of the contig lines"""
+
+    lengths = dict()
+    for line in header.splitlines():
+        if line.startswith("##contig=<"):
+            fields = dict(_META_FIELD.findall(line[len("##contig=<"):]))
+            if 'ID' in fields and fields.get('length', "").isdigit():
+                lengths[fields['ID']] = int(fields['length'])
+
+    return lengths
+
+
+def _low_support_chunks(vcf, chunk_size):
+    """Split the contigs of an indexed VCF into regions of at most chunk_size bases, in contig order. Contigs without
+    a declared length are one region each. Returns tuples of region string and 0-based start and end."""
+
+    lengths = _contig_lengths(vcf.raw_header)
+    chunks = list()
+    for contig in vcf.seqnames:
+        length = lengths.get(contig)
+        if length is None:
+            chunks.append((contig, 0, sys.maxsize))
+            continue
+        for start in range(0, length, chunk_size):
+            end = min(start + chunk_size, length)
+            chunks.append(("{}:{}-{}".format(contig, start + 1, end), start, end))
+
+    return chunks
+
+
+@resources.declare(cores=resources.tool_cores('low_support_filter'))
 def filter_low_support_variants(job, config, sample, caller, input_vcf):
     """Filter out very low quality calls from BGZipped VCFs so they are not
-    included in database
+    included in database. If config['low_support_filter']['num_cores'] is above 1 and the VCF is tabix indexed,
+    the contigs are split into chunks that are filtered concurrently by a process pool through region queries and
+    concatenated in coordinate order.
     :param config: The configuration dictionary.
     :type config: dict.
     :param sample: sample name.
@@ -226,47 +548,162 @@ def filter_low_support_variants(job, config, sample, caller, input_vcf):
     """
 
     output_vcf = "{}.{}.low_support_filtered.vcf".format(sample, caller)
+    logfile = "{}.{}.low_support_filter.log".format(sample, caller)
+    if plan.record_function("variation.filter_low_support_variants", logfile, [input_vcf], [output_vcf]):
+        return output_vcf
 
     job.fileStore.logToMaster("Filtering VCF {}\n".format(input_vcf))
-    parse_functions = {'mutect': vcf_parsing.parse_mutect_vcf_record_alt,
-                       'freebayes': vcf_parsing.parse_freebayes_vcf_record_alt,
-                       'vardict': vcf_parsing.parse_vardict_vcf_record_alt,
-                       'scalpel': vcf_parsing.parse_scalpel_vcf_record_alt,
-                       'platypus': vcf_parsing.parse_platypus_vcf_record_alt,
-                       'pindel': vcf_parsing.parse_pindel_vcf_record_alt}
+    with pipeline.python_step("variation.filter_low_support_variants", logfile, [input_vcf], [output_vcf]):
+        counts = _filter_low_support(job, config, caller, input_vcf, output_vcf)
 
-    vcf = VCF(input_vcf)
-    writer = Writer(output_vcf, vcf)
-
-    var_in_file = 0
-    for variant in vcf:
-        var_in_file += 1
-        pass_filter = True
-        var_info = parse_functions[caller](variant)
-        var_length = variant.end - variant.start
-        if float(var_info['Alt_Depth']) < 5.0:
-            pass_filter = False
-        if var_length > 1000:
-            pass_filter = False
-        if pass_filter:
-            writer.write_record(variant)
-
-    writer.close()
-
-    # Hack for cases where there are no variants in a given VCF file
-    if var_in_file < 1:
-        uncompressed_vcf = input_vcf.rstrip(".gz")
-        command = ["cp",
-                   "{}".format(uncompressed_vcf),
-                   "{}".format(output_vcf)]
-        logfile = "{}.low_support_filter.log".format(sample)
-        pipeline.run_and_log_command(" ".join(command), logfile)
+    job.fileStore.logToMaster("Kept {} of {} variants in {}\n".format(sum(passed for read, passed in counts),
+                                                                    sum(read for read, passed in counts), input_vcf))
 
     return output_vcf
 
 
+def _filter_low_support(job, config, caller, input_vcf, output_vcf):
+    """Filter input_vcf into output_vcf, in region chunks when configured. Returns the (read, passed) counts of
+    each chunk."""
+
+    filter_config = config.get('low_support_filter') or dict()
+    num_cores = int(filter_config.get('num_cores', 1))
+    indexed = any(os.path.exists("{}{}".format(input_vcf, suffix)) for suffix in (".tbi", ".csi"))
+
+    vcf = VCF(input_vcf)
+    header = vcf.raw_header
+    chunks = list()
+    if num_cores > 1 and indexed:
+        chunks = _low_support_chunks(vcf, int(filter_config.get('chunk_size', LOW_SUPPORT_CHUNK_SIZE)))
+    vcf.close()
+
+    # The header is always written, so a VCF without variants gives a valid header-only output
+    if len(chunks) > 1:
+        chunk_dir = "{}.chunks".format(output_vcf)
+        if not os.path.isdir(chunk_dir):
+            os.makedirs(chunk_dir)
+        tasks = [(input_vcf, caller, region, start, end, os.path.join(chunk_dir, "{:05d}.vcf".format(i)), None)
+                 for i, (region, start, end) in enumerate(chunks)]
+
+        job.fileStore.logToMaster("Filtering {} regions of {} with {} processes\n".format(len(tasks), input_vcf,
+                                                                                        num_cores))
+        pool = multiprocessing.Pool(min(num_cores, len(tasks)))
+        try:
+            counts = pool.map(_filter_low_support_region, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        with open(output_vcf, 'w') as output:
+            output.write(header)
+            for task in tasks:
+                with open(task[5], 'r') as body:
+                    shutil.copyfileobj(body, output)
+        shutil.rmtree(chunk_dir)
+    else:
+        # A single region is filtered straight into the output, without a copy through a chunk file
+        counts = [_filter_low_support_region((input_vcf, caller, None, 0, 0, output_vcf, header))]
+
+    return counts
+
+
+def _vcf_header(vcf_file):
+    """Meta-information lines and column header line of a VCF"""
+
+    meta = list()
+    column_header = None
+    with scatter.open_vcf(vcf_file) as vcf:
+        for line in vcf:
+            if line.startswith("##"):
+                meta.append(line)
+                continue
+            if line.startswith("#"):
+                column_header = line
+            break
+
+    return meta, column_header
+
+
+def _tagged_records(vcf_file, index, rank):
+    for key, line in scatter.vcf_records(vcf_file, rank, presorted=True):
+        yield key, index, line
+
+
+def _tag_callers(line, names):
+    fields = line.rstrip("\n").split("\t")
+    tag = "{}={}".format(ENSEMBLE_INFO_TAG, ",".join(names))
+    fields[7] = tag if fields[7] in ("", ".") else "{};{}".format(fields[7], tag)
+
+    return "{}\n".format("\t".join(fields))
+
+
+def merge_caller_vcfs(vcf_files, callers, output_vcf, contigs=None, numpass=1):
+    """Merge the sorted VCFs of several callers for one sample in a single streaming pass. Records are matched on
+    contig, position, REF and ALT through a k-way merge, calls made by fewer than numpass callers are dropped, and
+    the record of the first caller (in the order given) is written with the supporting callers in the CALLERS INFO
+    field. The output is BGZF compressed and tabix indexed as it is written. Header lines of all inputs are kept,
+    once per ID.
+
+    :param vcf_files: The caller VCF files, plain or gzipped, each sorted.
+    :type vcf_files: list.
+    :param callers: Caller names, in the same order as vcf_files.
+    :type callers: list.
+    :param output_vcf: The output .vcf.gz file name.
+    :type output_vcf: str.
+    :param contigs: Contig names in sort order. Taken from the ##contig lines of the inputs if not specified.
+    :type contigs: list.
+    :param numpass: Number of callers a variant must be called by.
+    :type numpass: int.
+    :returns:  int -- The number of records written.
+    :raises: ValueError
+    """
+
+    fileformat = None
+    meta = list()
+    defined = set()
+    header_contigs = list()
+    column_header = None
+    for vcf_file in vcf_files:
+        lines, columns = _vcf_header(vcf_file)
+        column_header = column_header or columns
+        for line in lines:
+            if line.startswith("##fileformat="):
+                fileformat = fileformat or line
+                continue
+            match = _META_ID.match(line)
+            key = match.groups() if match else line
+            if key in defined:
+                continue
+            defined.add(key)
+            meta.append(line)
+            if match and match.group(1) == "contig":
+                header_contigs.append(match.group(2))
+    if ('INFO', ENSEMBLE_INFO_TAG) not in defined:
+        meta.append('##INFO=<ID={},Number=.,Type=String,Description="Variant callers supporting the call">\n'.format(
+            ENSEMBLE_INFO_TAG))
+
+    rank = scatter.contig_rank(contigs or header_contigs)
+    records = heapq.merge(*[_tagged_records(vcf_file, i, rank) for i, vcf_file in enumerate(vcf_files)])
+
+    written = 0
+    with bgzf.IndexedVcfWriter(output_vcf) as output:
+        output.write_header("{}{}{}".format(fileformat or "##fileformat=VCFv4.2\n", "".join(meta),
+                                            column_header or "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"))
+        for key, calls in itertools.groupby(records, key=lambda record: record[0]):
+            calls = list(calls)
+            supporting = sorted(set(record[1] for record in calls))
+            if len(supporting) < numpass:
+                continue
+            output.write_record(_tag_callers(calls[0][2], [callers[index] for index in supporting]))
+            written += 1
+
+    return written
+
+
+@resources.declare(disk=resources.input_disk())
 def merge_variant_calls(job, config, sample, callers, vcf_files):
-    """Merge variant calls from multiple variant callers
+    """Merge variant calls from multiple variant callers into one sorted, bgzipped and tabix indexed VCF. A variant
+    is kept if at least config['ensemble']['numpass'] callers (default 1) called it.
     :param config: The configuration dictionary.
     :type config: dict.
     :param sample: sample name.
@@ -278,56 +715,18 @@ def merge_variant_calls(job, config, sample, callers, vcf_files):
     :returns:  str -- The output vcf file name.
     """
 
-    merged_vcf = "{}.merged.vcf.gz".format(sample)
-    uncompressed_vcf = "{}.merged.vcf".format(sample)
-    sorted_vcf = "{}.merged.sorted.vcf".format(sample)
-
-    logfile1 = "{}.merging.log".format(sample)
-    logfile2 = "{}.uncompress-merging.log".format(sample)
-    logfile3 = "{}.merged_sort.log".format(sample)
-
-    vcf_files_string = " ".join(vcf_files)
-
-    command = ["{}".format(config['ensemble']['bin']),
-               "ensemble",
-               "-c",
-               "{}".format(config['ensemble']['num_cores']),
-               "--numpass",
-               "1",
-               "--names",
-               "{}".format(callers),
-               "{}".format(merged_vcf),
-               "{}".format(config['reference']),
-               "{}".format(vcf_files_string)]
-
-    command2 = ["bgzip",
-                "-cd",
-                "{}".format(merged_vcf),
-                ">",
-                "{}".format(uncompressed_vcf)]
-
-    command3 = ["{}".format(config['picard']['bin']),
-                "SortVcf",
-                "SEQUENCE_DICTIONARY={}".format(config['dict']),
-                "OUTPUT={}".format(sorted_vcf),
-                "INPUT={}".format(uncompressed_vcf)]
-
-    sys.stderr.write("Running commands: \n")
-    sys.stderr.write("bcbio-variation-recall Command: {}\n".format(command))
-    sys.stderr.write("Uncompression Command: {}\n".format(command2))
-    sys.stderr.write("Sort Command: {}\n".format(command3))
-
-    job.fileStore.logToMaster("bcbio-variation-recall Command: {}\n".format(command))
-    pipeline.run_and_log_command(" ".join(command), logfile1)
-
-    job.fileStore.logToMaster("Uncompression Command: {}\n".format(command2))
-    pipeline.run_and_log_command(" ".join(command2), logfile2)
-
-    job.fileStore.logToMaster("Sort Command: {}\n".format(command3))
-    pipeline.run_and_log_command(" ".join(command3), logfile3)
-
-    # The Index file created by Picard often causes problems with the GATK
-    index_file = "{}.idx".format(sorted_vcf)
-    os.remove(index_file)
-
-    return sorted_vcf
+    merged_vcf = "{}.merged.sorted.vcf.gz".format(sample)
+    numpass = int((config.get('ensemble') or dict()).get('numpass', 1))
+    if plan.record_function("variation.merge_variant_calls", "{}.merging.log".format(sample), vcf_files,
+                            [merged_vcf, "{}.tbi".format(merged_vcf)]):
+        return merged_vcf
+
+    contigs = [contig for contig, length in scatter.contig_order(config['reference'])]
+    job.fileStore.logToMaster("Merging {} calls of {} with numpass {} into {}\n".format(callers, sample, numpass,
+                                                                                       merged_vcf))
+    with pipeline.python_step("variation.merge_variant_calls", "{}.merging.log".format(sample), vcf_files,
+                              [merged_vcf, "{}.tbi".format(merged_vcf)]):
+        written = merge_caller_vcfs(vcf_files, callers.split(","), merged_vcf, contigs, numpass)
+    job.fileStore.logToMaster("Wrote {} merged variants to {}\n".format(written, merged_vcf))
+
+    return merged_vcf
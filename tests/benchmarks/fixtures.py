@@ -0,0 +1,254 @@
+"""
+Synthetic, deterministic inputs for the benchmark suite: caller VCFs, targeted regions BED files, DiagnoseTargets
+VCFs and GEMINI query rows. Sizes scale from a gene panel (about 1k records) to an exome or beyond (1M records).
+"""
+
+import os
+import json
+import random
+import sqlite3
+
+CONTIGS = [("chr{}".format(i), length) for i, length in
+           enumerate([249250621, 243199373, 198022430, 191154276, 180915260, 171115067, 159138663, 146364022,
+                      141213431, 135534747, 135006516, 133851895, 115169878, 107349540, 102531392, 90354753,
+                      81195210, 78077248, 59128983, 63025520, 48129895, 51304566], 1)]
+
+BASES = "ACGT"
+
+# Per-caller FORMAT layouts carrying the alternate allele depth the low support filter reads
+CALLER_FORMATS = {
+    'freebayes': ("GT:DP:AD:RO:QR:AO:QA", "0/1:{dp}:{ref},{alt}:{ref}:{rq}:{alt}:{aq}"),
+    'mutect': ("GT:AD:BQ:DP:FA", "0/1:{ref},{alt}:30:{dp}:{af:.3f}"),
+    'vardict': ("GT:DP:VD:AD:AF:RD:ALD", "0/1:{dp}:{alt}:{ref},{alt}:{af:.3f}:{ref},0:{alt},0"),
+    'scalpel': ("GT:AD:DP", "0/1:{ref},{alt}:{dp}"),
+    'platypus': ("GT:GL:GOF:GQ:NR:NV", "0/1:-1,0,-1:3:99:{dp}:{alt}"),
+    'pindel': ("GT:AD", "0/1:{ref},{alt}"),
+}
+
+# Declared types of the FORMAT fields above, Integer unless listed
+FORMAT_TYPES = {'GT': "String", 'FA': "Float", 'AF': "Float", 'GL': "Float"}
+
+
+def _positions(records, rng):
+    """Sorted, distinct (contig, position) pairs spread over the genome in proportion to contig length"""
+
+    total = sum(length for contig, length in CONTIGS)
+    counts = [records * length // total for contig, length in CONTIGS]
+    for i in range(records - sum(counts)):
+        counts[i % len(counts)] += 1
+
+    positions = list()
+    for (contig, length), count in zip(CONTIGS, counts):
+        step = max(1, length // max(count, 1))
+        positions.extend((contig, 10000 + i * step + rng.randint(0, max(step // 2, 1))) for i in range(count))
+
+    return positions
+
+
+def write_caller_vcf(path, records, caller='freebayes', sample='SAMPLE', seed=0):
+    """Write a position sorted VCF of SNVs and short indels in the FORMAT layout of a caller. About a quarter of
+    the records have fewer than 5 alternate reads and a small fraction are long deletions, so the low support filter
+    has work to do.
+    """
+
+    rng = random.Random(seed)
+    format_keys, format_values = CALLER_FORMATS[caller]
+    with open(path, 'w') as vcf:
+        vcf.write("##fileformat=VCFv4.1\n")
+        vcf.write("##source=ddb_ngsflow_benchmark_{}\n".format(caller))
+        for contig, length in CONTIGS:
+            vcf.write("##contig=<ID={},length={}>\n".format(contig, length))
+        vcf.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Total depth">\n')
+        vcf.write('##INFO=<ID=END,Number=1,Type=Integer,Description="End position">\n')
+        for key in format_keys.split(":"):
+            vcf.write('##FORMAT=<ID={},Number=.,Type={},Description="{}">\n'.format(key, FORMAT_TYPES.get(key, "Integer"),
+                                                                                   key))
+        vcf.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{}\n".format(sample))
+
+        for contig, position in _positions(records, rng):
+            dp = rng.randint(10, 500)
+            alt = rng.randint(1, 4) if rng.random() < 0.25 else rng.randint(5, dp)
+            ref_base = rng.choice(BASES)
+            kind = rng.random()
+            if kind < 0.01:
+                ref = ref_base + "".join(rng.choice(BASES) for _ in range(rng.randint(1001, 1500)))
+                alt_allele = ref_base
+            elif kind < 0.1:
+                ref = ref_base + "".join(rng.choice(BASES) for _ in range(rng.randint(1, 10)))
+                alt_allele = ref_base
+            else:
+                ref = ref_base
+                alt_allele = rng.choice([base for base in BASES if base != ref_base])
+            values = format_values.format(dp=dp, ref=dp - alt, alt=alt, af=float(alt) / dp, rq=(dp - alt) * 30,
+                                          aq=alt * 30)
+            vcf.write("{}\t{}\t.\t{}\t{}\t{}\tPASS\tDP={};END={}\t{}\t{}\n".format(
+                contig, position, ref, alt_allele, rng.randint(20, 3000), dp, position + len(ref) - 1, format_keys,
+                values))
+
+    return path
+
+
+def write_regions_bed(path, regions, seed=0):
+    """Write a sorted four column BED of exon-sized targets named after synthetic genes"""
+
+    rng = random.Random(seed)
+    with open(path, 'w') as bed:
+        for i, (contig, position) in enumerate(_positions(regions, rng)):
+            bed.write("{}\t{}\t{}\tGENE{}_exon{}\n".format(contig, position, position + rng.randint(80, 400),
+                                                            i // 10, i % 10))
+
+    return path
+
+
+def write_diagnose_targets_vcf(path, regions_bed, sample='SAMPLE', seed=0):
+    """Write a GATK DiagnoseTargets style VCF with one record per target of a regions BED. About one target in ten
+    fails with LOW_COVERAGE, COVERAGE_GAPS or NO_READS.
+    """
+
+    rng = random.Random(seed)
+    with open(path, 'w') as vcf:
+        vcf.write("##fileformat=VCFv4.1\n")
+        vcf.write('##FILTER=<ID=LOW_COVERAGE,Description="Low coverage">\n')
+        vcf.write('##FILTER=<ID=COVERAGE_GAPS,Description="Coverage gaps">\n')
+        vcf.write('##FILTER=<ID=NO_READS,Description="No reads">\n')
+        vcf.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{}\n".format(sample))
+        with open(regions_bed, 'r') as bed:
+            for line in bed:
+                contig, start, end = line.split("\t")[:3]
+                roll = rng.random()
+                if roll < 0.03:
+                    status, depth, low, zero = "NO_READS", 0.0, 0, int(end) - int(start)
+                elif roll < 0.1:
+                    status = rng.choice(["LOW_COVERAGE", "COVERAGE_GAPS"])
+                    depth, low, zero = rng.uniform(1, 20), rng.randint(1, 50), rng.randint(0, 20)
+                else:
+                    status, depth, low, zero = "PASS", rng.uniform(50, 1000), 0, 0
+                vcf.write("{}\t{}\t.\tN\t<DT>\t.\t{}\tEND={};IDP={:.2f};IGC=0.500\tFT:IDP:LL:ZL\t"
+                          "{}:{:.2f}:{}:{}\n".format(contig, int(start) + 1, status, end, depth, status, depth, low,
+                                                     zero))
+
+    return path
+
+
+def write_sam(path, reads, seed=0):
+    """Write coordinate sorted SAM records of 100 base reads, as samtools view prints them. Most reads align
+    without gaps, the others are soft clipped, carry an indel or are spliced.
+    """
+
+    rng = random.Random(seed)
+    cigars = ["100M"] * 16 + ["5S95M", "40M2I58M", "50M3D50M", "50M500N50M"]
+    with open(path, 'w') as sam:
+        for i, (contig, position) in enumerate(_positions(reads, rng)):
+            sequence = "".join(rng.choice(BASES) for _ in range(100))
+            sam.write("read{}\t{}\t{}\t{}\t60\t{}\t=\t{}\t250\t{}\t{}\tNM:i:0\tAS:i:100\n".format(
+                i, rng.choice([99, 147, 83, 163]), contig, position, rng.choice(cigars), position + 150, sequence,
+                "F" * 100))
+
+    return path
+
+
+def write_gemini_rows(path, rows, seed=0):
+    """Write synthetic GEMINI variant rows, one JSON object per line, covering every column the report query uses"""
+
+    rng = random.Random(seed)
+    impacts = [("missense_variant", "MED"), ("stop_gained", "HIGH"), ("synonymous_variant", "LOW"),
+               ("intron_variant", "LOW"), ("frameshift_variant", "HIGH"), ("splice_region_variant", "MED")]
+    with open(path, 'w') as outfile:
+        for i, (contig, position) in enumerate(_positions(rows, rng)):
+            impact, severity = rng.choice(impacts)
+            common = rng.random() < 0.5
+            in_clinvar = rng.random() < 0.05
+            frequency = rng.uniform(0.05, 0.5) if common else (rng.uniform(0, 0.01) if rng.random() < 0.5 else None)
+            row = {'chrom': contig, 'start': position - 1, 'end': position, 'ref': rng.choice(BASES),
+                   'alt': rng.choice(BASES), 'vcf_id': None, 'rs_ids': "rs{}".format(i) if common else None,
+                   'cosmic_ids': "COSM{}".format(i) if rng.random() < 0.1 else None, 'filter': None,
+                   'qual': rng.uniform(20, 3000), 'qual_depth': rng.uniform(1, 40), 'depth': rng.randint(10, 500),
+                   'gene': "GENE{}".format(i // 10), 'transcript': "ENST{:011d}".format(i // 10),
+                   'exon': "{}/12".format(i % 12 + 1), 'codon_change': "c.{}A>G".format(i),
+                   'aa_change': "p.K{}E".format(i), 'biotype': "protein_coding", 'impact': impact,
+                   'impact_so': impact, 'impact_severity': severity, 'aa_length': "{}/800".format(i % 800),
+                   'is_lof': 1 if severity == "HIGH" else 0, 'is_conserved': rng.randint(0, 1),
+                   'pfam_domain': None, 'in_omim': rng.randint(0, 1),
+                   'clinvar_sig': rng.choice(["pathogenic", "benign", "uncertain"]) if in_clinvar else None,
+                   'clinvar_disease_name': "Disease" if in_clinvar else None, 'clinvar_origin': None,
+                   'clinvar_causal_allele': None, 'clinvar_dbsource': None, 'clinvar_dbsource_id': None,
+                   'clinvar_on_diag_assay': None, 'rmsk': None, 'in_segdup': 0, 'strand_bias': rng.random(),
+                   'rms_map_qual': 60.0, 'in_hom_run': 0, 'num_mapq_zero': 0, 'num_reads_w_dels': 0, 'grc': None,
+                   'gms_illumina': None, 'in_cse': 0, 'num_alleles': 2, 'allele_count': 1,
+                   'haplotype_score': None, 'is_somatic': 0, 'somatic_score': None, 'max_aaf_all': frequency,
+                   'in_esp': int(common), 'in_1kg': int(common), 'in_exac': int(common)}
+            for column in ('aaf_esp_ea', 'aaf_esp_aa', 'aaf_esp_all', 'aaf_1kg_amr', 'aaf_1kg_eas', 'aaf_1kg_sas',
+                           'aaf_1kg_afr', 'aaf_1kg_eur', 'aaf_1kg_all', 'aaf_exac_all', 'aaf_adj_exac_all',
+                           'aaf_adj_exac_afr', 'aaf_adj_exac_amr', 'aaf_adj_exac_eas', 'aaf_adj_exac_fin',
+                           'aaf_adj_exac_nfe', 'aaf_adj_exac_oth', 'aaf_adj_exac_sas'):
+                row[column] = frequency
+            outfile.write("{}\n".format(json.dumps(row, sort_keys=True)))
+
+    return path
+
+
+def write_gemini_db(rows_path):
+    """Load rows written by write_gemini_rows into a SQLite variants table next to them, as GEMINI stores them"""
+
+    path = "{}.sqlite".format(rows_path)
+    if os.path.exists(path):
+        return path
+
+    connection = sqlite3.connect(path)
+    with open(rows_path, 'r') as rows:
+        columns = None
+        for line in rows:
+            row = json.loads(line)
+            if columns is None:
+                columns = sorted(row)
+                connection.execute("CREATE TABLE variants ({})".format(", ".join(columns)))
+            connection.execute("INSERT INTO variants VALUES ({})".format(", ".join("?" for column in columns)),
+                               [row[column] for column in columns])
+    connection.commit()
+    connection.close()
+
+    return path
+
+
+class SyntheticGeminiRow(object):
+    """A result row printing as tab separated values, like a GeminiRow"""
+
+    def __init__(self, columns, values):
+        self.columns = columns
+        self.values = values
+
+    def __getitem__(self, column):
+        return self.values[self.columns.index(column)]
+
+    def __str__(self):
+        return "\t".join("{}".format(value) for value in self.values)
+
+
+class SyntheticGeminiQuery(object):
+    """Stand-in for gemini.GeminiQuery over rows written by write_gemini_rows, so the Python side of the report
+    query can be measured without building an annotated GEMINI database. Queries run against a SQLite copy of the
+    rows, so WHERE clauses are applied as GEMINI would, and results are streamed from the cursor."""
+
+    def __init__(self, db):
+        self.db = write_gemini_db(db) if db.endswith(".jsonl") else db
+        self.cursor = None
+        self.columns = list()
+
+    def run(self, query, *args, **kwargs):
+        self.cursor = sqlite3.connect(self.db).execute(query)
+        self.columns = [description[0] for description in self.cursor.description]
+
+    @property
+    def header(self):
+        return "\t".join(self.columns)
+
+    def __iter__(self):
+        for values in self.cursor:
+            yield SyntheticGeminiRow(self.columns, values)
+
+
+def fixture_path(directory, name):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    return os.path.join(directory, name)
@@ -0,0 +1,265 @@
+"""
+Benchmarks for the in-process Python stages of the workflows. Every stage runs on synthetic inputs of increasing
+size in a fresh child process, so that peak memory is measured per stage and size. Results are printed as a table
+and can be appended as JSON lines to a results file to compare runs over time:
+
+    python tests/benchmarks/run_benchmarks.py --sizes 1000 100000 --output benchmarks.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import platform
+import traceback
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import fixtures  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+SAMPLE = "SAMPLE"
+
+
+class _FileStore(object):
+    def logToMaster(self, message):
+        pass
+
+
+class BenchmarkJob(object):
+    """The part of a Toil job the stages touch"""
+
+    fileStore = _FileStore()
+
+
+def _caller_vcf(directory, size):
+    path = fixtures.fixture_path(directory, "freebayes.{}.vcf".format(size))
+    if not os.path.exists(path):
+        fixtures.write_caller_vcf(path, size, 'freebayes', SAMPLE)
+
+    return path
+
+
+def _regions(directory, size):
+    bed = fixtures.fixture_path(directory, "regions.{}.bed".format(size))
+    vcf = fixtures.fixture_path(directory, "diagnose_targets.{}.vcf".format(size))
+    if not os.path.exists(bed):
+        fixtures.write_regions_bed(bed, size)
+    if not os.path.exists(vcf):
+        fixtures.write_diagnose_targets_vcf(vcf, bed, SAMPLE)
+
+    return bed, vcf
+
+
+def _gemini_rows(directory, size):
+    path = fixtures.fixture_path(directory, "gemini_rows.{}.jsonl".format(size))
+    if not os.path.exists(path):
+        fixtures.write_gemini_rows(path, size)
+
+    return fixtures.write_gemini_db(path)
+
+
+def prepare_filter_low_support(directory, size):
+    return {'vcf': _caller_vcf(directory, size)}
+
+
+def run_filter_low_support(inputs):
+    from ddb_ngsflow.variation import variation
+
+    variation.filter_low_support_variants(BenchmarkJob(), dict(), SAMPLE, 'freebayes', inputs['vcf'])
+
+
+def prepare_gemini_query(directory, size):
+    return {'rows': _gemini_rows(directory, size)}
+
+
+def run_gemini_query(inputs):
+    from ddb_ngsflow.variation import variation
+
+    variation.GeminiQuery = fixtures.SyntheticGeminiQuery
+    header, rows = variation._run_gemini_query_and_filter(inputs['rows'], None)
+    for row in rows:
+        pass
+
+
+def prepare_read_coverage(directory, size):
+    bed, vcf = _regions(directory, size)
+
+    return {'regions': bed, 'vcf': vcf}
+
+
+def run_read_coverage(inputs):
+    from ddb_ngsflow.utils import utilities
+
+    utilities.read_coverage(BenchmarkJob(), {'regions': inputs['regions']}, SAMPLE, inputs['vcf'])
+
+
+def prepare_coverage_summary(directory, size):
+    bed, vcf = _regions(directory, size)
+
+    return {'regions': bed, 'vcf': vcf, 'samples': 8}
+
+
+def run_coverage_summary(inputs):
+    from ddb_ngsflow.utils import utilities
+
+    # Built here rather than through read_coverage so that this stage is measured on its own
+    coverage = dict()
+    with open(inputs['regions'], 'r') as bed, open(inputs['vcf'], 'r') as vcf:
+        records = (line for line in vcf if not line.startswith("#"))
+        for target, record in zip(bed, records):
+            fields = record.rstrip("\n").split("\t")
+            reads = fields[9].split(":")
+            coverage[target.rstrip("\n")] = {'filter_field': fields[6], 'depth_field': reads[-3],
+                                             'low_field': reads[-2], 'zero_field': reads[-1]}
+    samples = dict(("{}{}".format(SAMPLE, i), coverage) for i in range(inputs['samples']))
+
+    start = time.time()
+    utilities.generate_coverage_summary(BenchmarkJob(), dict(), samples)
+
+    return time.time() - start
+
+
+def prepare_alignment_stream(directory, size):
+    sam = fixtures.fixture_path(directory, "reads.{}.sam".format(size))
+    if not os.path.exists(sam):
+        fixtures.write_sam(sam, size)
+    bed, vcf = _regions(directory, max(size // 100, 10))
+
+    return {'sam': sam, 'regions': bed}
+
+
+def run_alignment_stream(inputs):
+    from ddb_ngsflow import pipeline
+    from ddb_ngsflow.coverage import depth
+    from ddb_ngsflow.utils import intervals
+
+    # The metrics of coverage_metrics, fed in the chunks the pipeline executor passes on
+    regions = intervals.read_bed(inputs['regions'])
+    targets = dict((contig, regions.merged(contig)) for contig in regions.contigs)
+    target_depth = depth.TargetDepth("{}.depth".format(SAMPLE), targets, regions.contigs)
+    stream = depth.AlignmentStream([target_depth,
+                                    depth.RegionCoverage("region_coverage.bed", regions, target_depth, [20, 100],
+                                                         SAMPLE),
+                                    depth.GenomeDepth(depth.CoverageRunWriter("total_base.bedgraph.gz"),
+                                                      fixtures.CONTIGS)])
+    with open(inputs['sam'], 'rb') as sam:
+        for chunk in iter(lambda: sam.read(pipeline.STREAM_CHUNK_SIZE), b""):
+            stream.write(chunk)
+    stream.close()
+
+
+STAGES = [
+    ('variation.filter_low_support_variants', prepare_filter_low_support, run_filter_low_support),
+    ('variation._run_gemini_query_and_filter', prepare_gemini_query, run_gemini_query),
+    ('utilities.read_coverage', prepare_read_coverage, run_read_coverage),
+    ('utilities.generate_coverage_summary', prepare_coverage_summary, run_coverage_summary),
+    ('depth.AlignmentStream', prepare_alignment_stream, run_alignment_stream),
+]
+
+
+def _max_rss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _measure(run, inputs, work_dir, queue):
+    """Child process body: run one stage and report wall time and memory"""
+
+    try:
+        os.chdir(work_dir)
+        baseline = _max_rss_bytes()
+        start = time.time()
+        timed = run(inputs)
+        seconds = time.time() - start if timed is None else timed
+        queue.put({'status': "ok", 'seconds': seconds, 'peak_rss': _max_rss_bytes(),
+                   'peak_rss_increase': _max_rss_bytes() - baseline})
+    except ImportError as e:
+        queue.put({'status': "skipped", 'reason': "{}".format(e)})
+    except Exception:
+        queue.put({'status': "error", 'reason': traceback.format_exc()})
+
+
+def run_benchmark(name, prepare, run, size, fixtures_dir):
+    """Run one stage at one size in a child process
+
+    :param name: Stage name.
+    :type name: str.
+    :param prepare: Function creating the inputs for a size.
+    :type prepare: function.
+    :param run: Function running the stage on the inputs.
+    :type run: function.
+    :param size: Number of records.
+    :type size: int.
+    :param fixtures_dir: Directory holding the generated inputs.
+    :type fixtures_dir: str.
+    :returns:  dict -- The benchmark result.
+    """
+
+    inputs = prepare(fixtures_dir, size)
+    work_dir = tempfile.mkdtemp(prefix="ddb_ngsflow_benchmark_")
+    queue = multiprocessing.Queue()
+    try:
+        child = multiprocessing.Process(target=_measure, args=(run, inputs, work_dir, queue))
+        child.start()
+        result = queue.get()
+        child.join()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    result.update({'stage': name, 'records': size})
+    if result['status'] == "ok":
+        result['records_per_second'] = size / result['seconds'] if result['seconds'] > 0 else None
+
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the in-process Python stages on synthetic data")
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="Record counts")
+    parser.add_argument('-t', '--stages', nargs='+', default=None, help="Stage names, or substrings of them")
+    parser.add_argument('-f', '--fixtures-dir', default=None, help="Keep generated inputs here between runs")
+    parser.add_argument('-o', '--output', default=None, help="Append results as JSON lines to this file")
+    args = parser.parse_args(argv)
+
+    fixtures_dir = args.fixtures_dir or tempfile.mkdtemp(prefix="ddb_ngsflow_fixtures_")
+    stages = [stage for stage in STAGES if not args.stages or any(part in stage[0] for part in args.stages)]
+    environment = {'timestamp': time.time(), 'hostname': socket.gethostname(), 'python': platform.python_version()}
+
+    results = list()
+    sys.stdout.write("{:<44} {:>9} {:>10} {:>14} {:>12}\n".format("stage", "records", "seconds", "records/s",
+                                                                  "peak MiB"))
+    for name, prepare, run in stages:
+        for size in args.sizes:
+            result = run_benchmark(name, prepare, run, size, fixtures_dir)
+            result.update(environment)
+            results.append(result)
+            if result['status'] == "ok":
+                sys.stdout.write("{:<44} {:>9} {:>10.3f} {:>14.0f} {:>12.1f}\n".format(
+                    name, size, result['seconds'], result['records_per_second'] or 0,
+                    result['peak_rss'] / float(1 << 20)))
+            else:
+                sys.stdout.write("{:<44} {:>9} {}: {}\n".format(name, size, result['status'],
+                                                              (result['reason'].strip().splitlines() or [""])[-1]))
+            sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'a') as outfile:
+            for result in results:
+                outfile.write("{}\n".format(json.dumps(result, sort_keys=True)))
+    if not args.fixtures_dir:
+        shutil.rmtree(fixtures_dir, ignore_errors=True)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import pytest
+
+
+class FileStore(object):
+    def logToMaster(self, message):
+        pass
+
+
+class Job(object):
+    fileStore = FileStore()
+
+
+@pytest.fixture
+def job():
+    """Stand-in for the Toil job passed to wrappers, dropping their log messages"""
+
+    return Job()
+
+
+@pytest.fixture
+def toil_job():
+    """A Toil job with the stand-in file store, for wrappers that add child or follow-on jobs"""
+
+    toil_job_module = pytest.importorskip("toil.job")
+
+    class ToilJob(toil_job_module.Job):
+        fileStore = FileStore()
+
+    return ToilJob()
@@ -0,0 +1,45 @@
+import os
+import re
+import importlib
+
+import pytest
+
+from benchmarks import fixtures
+from benchmarks import run_benchmarks
+
+
+def test_fixtures_scale(tmpdir):
+    vcf = fixtures.write_caller_vcf(str(tmpdir.join("calls.vcf")), 250, 'mutect')
+    bed = fixtures.write_regions_bed(str(tmpdir.join("regions.bed")), 120)
+    targets = fixtures.write_diagnose_targets_vcf(str(tmpdir.join("targets.vcf")), bed)
+
+    with open(vcf) as records:
+        assert len([line for line in records if not line.startswith("#")]) == 250
+    with open(targets) as records:
+        assert len([line for line in records if not line.startswith("#")]) == 120
+
+
+def test_synthetic_gemini_query(tmpdir):
+    rows = fixtures.write_gemini_rows(str(tmpdir.join("rows.jsonl")), 50)
+    query = fixtures.SyntheticGeminiQuery(rows)
+    query.run("SELECT chrom, start, gene FROM variants")
+
+    assert query.header == "chrom\tstart\tgene"
+    assert len([row for row in query]) == 50
+
+
+def test_benchmark_smoke(tmpdir):
+    results = run_benchmarks.main(['--sizes', '200', '--fixtures-dir', str(tmpdir)])
+
+    assert len(results) == len(run_benchmarks.STAGES)
+    for result in results:
+        if result['status'] == "skipped":
+            # Only a stage whose optional dependency is really not installed may be skipped
+            missing = re.match(r"No module named '([^']+)'", result['reason'])
+            assert missing, result['reason']
+            with pytest.raises(ImportError):
+                importlib.import_module(missing.group(1))
+        else:
+            assert result['status'] == "ok", result.get('reason')
+            assert result['seconds'] > 0
+    assert os.listdir(str(tmpdir))
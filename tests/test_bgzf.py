@@ -0,0 +1,108 @@
+import gzip
+import random
+
+import pytest
+
+from ddb_ngsflow.utils import bgzf
+
+HEADER = "##fileformat=VCFv4.2\n##contig=<ID=chr1>\n##contig=<ID=chr2>\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+
+
+def _records():
+    rng = random.Random(1)
+    records = list()
+    for contig in ("chr1", "chr2"):
+        position = 1
+        for i in range(3000):
+            position += rng.randint(1, 300)
+            info = "END={}".format(position + 5000) if i % 500 == 0 else "DP={}".format(rng.randint(1, 99))
+            records.append("{}\t{}\t.\tA\tG\t50\tPASS\t{}\n".format(contig, position, info))
+
+    return records
+
+
+def _write_vcf(path, records):
+    # Written in chunks that split lines, as a pipeline consumer receives them
+    text = HEADER + "".join(records)
+    with bgzf.IndexedVcfWriter(path) as vcf:
+        for start in range(0, len(text), 1000):
+            vcf.write(text[start:start + 1000])
+
+    return path
+
+
+def _overlapping(records, contig, begin, end):
+    intervals = [bgzf.vcf_record_interval(record) for record in records]
+
+    return [record for record, (name, start, stop) in zip(records, intervals)
+            if name == contig and start < end and stop > begin]
+
+
+def test_indexed_vcf_writer_queries_match_a_scan(tmpdir):
+    records = _records()
+    vcf = _write_vcf(str(tmpdir.join("calls.vcf.gz")), records)
+
+    assert bgzf.is_bgzf(vcf)
+    with gzip.open(vcf, 'rt') as text:
+        assert text.read() == HEADER + "".join(records)
+    index = bgzf.read_tabix_index("{}.tbi".format(vcf))
+    assert index['names'] == ["chr1", "chr2"]
+    with open(vcf, 'rb') as handle:
+        for contig, begin, end in (("chr1", 0, 100), ("chr1", 20000, 90000), ("chr2", 150000, 150300),
+                                   ("chr2", 10 ** 7, 10 ** 7 + 10), ("chr3", 0, 100)):
+            expected = _overlapping(records, contig, begin, end)
+            lines = b"".join(bgzf.read_chunk(handle, start, stop)
+                             for start, stop in bgzf.query_chunks(index, contig, begin, end))
+            # Chunks may hold records around the region too, but never miss one overlapping it
+            wanted = set(expected)
+            assert [line for line in lines.decode("utf-8").splitlines(True) if line in wanted] == expected
+
+
+def test_indexes_are_read_by_pysam(tmpdir):
+    pysam = pytest.importorskip("pysam")
+    records = _records()
+    vcf = _write_vcf(str(tmpdir.join("calls.vcf.gz")), records)
+    bed = str(tmpdir.join("depth.bed.gz"))
+    with bgzf.IndexedBedWriter(bed) as output:
+        for i in range(5000):
+            output.write_record("chr1", 10 * i, 10 * i + 10, "chr1\t{}\t{}\t{}\n".format(10 * i, 10 * i + 10, i))
+
+    with pysam.TabixFile(vcf) as tabix:
+        assert ["{}\n".format(line) for line in tabix.fetch("chr1", 20000, 90000)] == \
+            _overlapping(records, "chr1", 20000, 90000)
+    with pysam.TabixFile(bed) as tabix:
+        assert [line.split("\t")[3] for line in tabix.fetch("chr1", 25005, 25025)] == ["2500", "2501", "2502"]
+
+
+def test_remapping_an_index_through_the_identity_keeps_it(tmpdir):
+    vcf = _write_vcf(str(tmpdir.join("calls.vcf.gz")), _records())
+
+    bgzf.remap_tabix_index("{}.tbi".format(vcf), str(tmpdir.join("copy.tbi")), lambda offset: offset)
+
+    assert bgzf.read_tabix_index(str(tmpdir.join("copy.tbi"))) == bgzf.read_tabix_index("{}.tbi".format(vcf))
+
+
+def test_abort_removes_the_output_and_a_stale_index(tmpdir):
+    vcf = str(tmpdir.join("calls.vcf.gz"))
+    tmpdir.join("calls.vcf.gz.tbi").write("stale")
+
+    with pytest.raises(RuntimeError):
+        with bgzf.IndexedVcfWriter(vcf) as output:
+            output.write(HEADER)
+            raise RuntimeError("pipeline failed")
+
+    assert not tmpdir.join("calls.vcf.gz").exists()
+    assert not tmpdir.join("calls.vcf.gz.tbi").exists()
+
+
+def test_is_bgzf(tmpdir):
+    with gzip.open(str(tmpdir.join("plain.gz")), 'wb') as plain:
+        plain.write(b"text\n")
+    tmpdir.join("text").write("text\n")
+    with bgzf.BgzfWriter(str(tmpdir.join("empty.gz"))):
+        pass
+
+    assert not bgzf.is_bgzf(str(tmpdir.join("plain.gz")))
+    assert not bgzf.is_bgzf(str(tmpdir.join("text")))
+    assert bgzf.is_bgzf(str(tmpdir.join("empty.gz")))
+    assert bgzf.read_data(str(tmpdir.join("empty.gz"))) == b""
@@ -0,0 +1,101 @@
+import os
+import gzip
+
+import pytest
+
+pytest.importorskip("toil")
+
+from toil.job import Job, EncapsulatedJob  # noqa: E402
+
+from ddb_ngsflow.align import bwa  # noqa: E402
+
+
+def _noop(job):
+    pass
+
+
+def _write_fastq(path, reads, mate):
+    records = "".join("@read{}/{}\nACGT\n+\nFFFF\n".format(i, mate) for i in range(reads))
+    with (gzip.open(path, 'wb') if path.endswith(".gz") else open(path, 'wb')) as fastq:
+        fastq.write(records.encode("utf-8"))
+
+    return path
+
+
+def _read(path):
+    with (gzip.open(path, 'rb') if path.endswith(".gz") else open(path, 'rb')) as handle:
+        return handle.read().decode("utf-8")
+
+
+@pytest.mark.parametrize("suffix", [".fastq", ".fastq.gz"])
+def test_split_fastq_cuts_at_record_boundaries(tmpdir, suffix, monkeypatch):
+    monkeypatch.setattr(bwa, "SPLIT_BLOCK_SIZE", 7)
+    fastq = _write_fastq(str(tmpdir.join("R1" + suffix)), 10, 1)
+
+    chunks, reads = bwa.split_fastq(fastq, 4, str(tmpdir.join("S1")))
+
+    assert reads == 10
+    assert [os.path.basename(chunk) for chunk in chunks] == ["S1.{:04d}{}".format(i, suffix) for i in range(3)]
+    assert [_read(chunk).count("\n") for chunk in chunks] == [16, 16, 8]
+    assert "".join(_read(chunk) for chunk in chunks) == _read(fastq)
+
+
+def test_split_fastq_pair_checks_the_mates(tmpdir):
+    fastq1 = _write_fastq(str(tmpdir.join("R1.fastq.gz")), 5, 1)
+    fastq2 = _write_fastq(str(tmpdir.join("R2.fastq.gz")), 5, 2)
+
+    pairs = bwa.split_fastq_pair(fastq1, fastq2, 2, str(tmpdir.join("S1")))
+
+    assert [tuple(os.path.basename(chunk) for chunk in pair) for pair in pairs] == \
+        [("S1.R1.{:04d}.fastq.gz".format(i), "S1.R2.{:04d}.fastq.gz".format(i)) for i in range(3)]
+    with pytest.raises(ValueError):
+        bwa.split_fastq_pair(fastq1, _write_fastq(str(tmpdir.join("short.fastq.gz")), 4, 2), 2,
+                             str(tmpdir.join("S2")))
+    with pytest.raises(ValueError):
+        bwa.split_fastq_pair(_write_fastq(str(tmpdir.join("E1.fastq")), 0, 1),
+                             _write_fastq(str(tmpdir.join("E2.fastq")), 0, 2), 2, str(tmpdir.join("S3")))
+
+
+def _successors(job, ids):
+    # Jobs whose requirements depend on promises are encapsulated by Toil
+    successors = [job._registry[successor_id] for successor_id in ids]
+
+    return [getattr(successor, 'encapsulatedJob', successor).userFunctionName for successor in successors]
+
+
+def test_split_fastq_chunks_aligns_chunks_before_the_merge(tmpdir, toil_job):
+    tmpdir.chdir()
+    config = {'reference': "ref.fa", 'bwa': {'bin': "bwa", 'num_cores': 1, 'chunk_reads': 2},
+              'samtools': {'bin': "samtools"}}
+    samples = {'S1': {'fastq1': _write_fastq("R1.fastq.gz", 5, 1), 'fastq2': _write_fastq("R2.fastq.gz", 5, 2)},
+               'S2': {'fastq1': _write_fastq("E1.fastq", 0, 1), 'fastq2': _write_fastq("E2.fastq", 0, 2)}}
+
+    bwa.split_fastq_chunks(toil_job, config, "S1", samples)
+
+    assert _successors(toil_job, toil_job.description.childIDs) == ["align_chunk"] * 3
+    assert _successors(toil_job, toil_job.description.followOnIDs) == ["merge_chunk_bams"]
+    assert len(tmpdir.join("S1.bwa.chunks").listdir()) == 6
+    with pytest.raises(ValueError):
+        bwa.split_fastq_chunks(toil_job, config, "S2", samples)
+    with pytest.raises(ValueError):
+        bwa.merge_chunk_bams(toil_job, config, "S2", list(), "S2.bwa.chunks")
+
+
+def test_jobs_after_a_chunked_sample_wait_for_the_merged_bam(toil_job):
+    config = {'bwa': {'bin': "bwa", 'num_cores': 1}}
+    samples = {'S1': {'fastq1': "R1.fastq.gz", 'fastq2': "R2.fastq.gz"}}
+
+    assert bwa.bwa_mem_job(config, "S1", samples).userFunctionName == "run_bwa_mem"
+
+    config['bwa']['chunk_reads'] = 1000000
+    with pytest.raises(ValueError):
+        bwa.run_bwa_mem(toil_job, config, "S1", samples)
+    align_job = bwa.bwa_mem_job(config, "S1", samples)
+    next_job = align_job.addChild(Job.wrapJobFn(_noop))
+
+    # The chunk and merge jobs are successors of the encapsulated job, so they finish before its follow-on, which
+    # the jobs added after the sample hang from
+    assert isinstance(align_job, EncapsulatedJob)
+    assert align_job.encapsulatedJob.userFunctionName == "split_fastq_chunks"
+    assert list(align_job.description.followOnIDs) == [align_job.encapsulatedFollowOn.jobStoreID]
+    assert list(align_job.encapsulatedFollowOn.description.childIDs) == [next_job.jobStoreID]
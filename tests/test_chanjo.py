@@ -0,0 +1,75 @@
+import sqlite3
+import threading
+
+import pytest
+
+pytest.importorskip("toil")
+
+from ddb_ngsflow.coverage import chanjo  # noqa: E402
+
+HEADER = "# chrom\tchromStart\tchromEnd\tF3\treadCount\tmeanCoverage\tpercentage1\tpercentage20\tsampleName\n"
+
+
+def _write_coverage(path, sample, rows):
+    with open(path, 'w') as coverage:
+        coverage.write(HEADER)
+        for chrom, start, end, name, reads, mean, low, high in rows:
+            coverage.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(chrom, start, end, name, reads, mean, low,
+                                                                         high, sample))
+
+    return path
+
+
+ROWS = [("chr1", 100, 200, "BRCA1_1", 50, 30.0, 100.0, 80.0), ("chr1", 300, 500, "BRCA1_2", 90, 25.0, 100.0, 50.0),
+        ("chr2", 0, 100, "TP53_1", 10, 5.0, 60.0, 0.0)]
+
+
+def test_load_region_coverage_and_query_genes(tmpdir):
+    connection = chanjo.connect(str(tmpdir.join("coverage.sqlite")))
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+
+    assert chanjo.load_region_coverage(connection, _write_coverage(str(tmpdir.join("S1.bed")), "S1", ROWS),
+                                       group="run1", batch_size=2) == 3
+    chanjo.load_region_coverage(connection, _write_coverage(str(tmpdir.join("S2.bed")), "S2", ROWS[:2]))
+
+    completeness = chanjo.gene_completeness(connection, 20, genes=["BRCA1"])
+    assert [(sample, gene) for sample, gene, percentage, mean in completeness] == [("S1", "BRCA1"),
+                                                                                   ("S2", "BRCA1")]
+    assert abs(completeness[0][2] - (80.0 * 100 + 50.0 * 200) / 300) < 1e-9
+    assert chanjo.incomplete_regions(connection, 1, samples=["S1"]) == [("S1", "TP53", "chr2", 0, 100, "TP53_1",
+                                                                         60.0)]
+    assert connection.execute("SELECT sample_group FROM sample WHERE name = 'S1'").fetchone()[0] == "run1"
+
+
+def test_failed_load_keeps_the_previous_coverage(tmpdir):
+    connection = chanjo.connect(str(tmpdir.join("coverage.sqlite")))
+    chanjo.load_region_coverage(connection, _write_coverage(str(tmpdir.join("S1.bed")), "S1", ROWS))
+    loaded = connection.execute("SELECT loaded FROM sample").fetchone()[0]
+
+    broken = _write_coverage(str(tmpdir.join("S1.broken.bed")), "S1", ROWS[:2])
+    with open(broken, 'a') as coverage:
+        coverage.write("chr2\t0\t100\tTP53_1\tmany\t5.0\t60.0\t0.0\tS1\n")
+    with pytest.raises(ValueError):
+        chanjo.load_region_coverage(connection, broken, batch_size=1)
+
+    assert connection.execute("SELECT loaded FROM sample").fetchone()[0] == loaded
+    assert connection.execute("SELECT COUNT(*) FROM coverage").fetchone()[0] == 3
+    assert connection.execute("SELECT COUNT(*) FROM completeness").fetchone()[0] == 6
+
+
+def test_concurrent_loads_wait_for_the_write_lock(tmpdir):
+    db_file = str(tmpdir.join("coverage.sqlite"))
+    chanjo.connect(db_file).close()
+    coverage = _write_coverage(str(tmpdir.join("S1.bed")), "S1", ROWS)
+    holder = sqlite3.connect(db_file, isolation_level=None, check_same_thread=False)
+    holder.execute("BEGIN IMMEDIATE")
+
+    with pytest.raises(sqlite3.OperationalError):
+        chanjo.load_region_coverage(chanjo.connect(db_file, timeout=0.1), coverage)
+
+    timer = threading.Timer(0.5, holder.execute, ("COMMIT",))
+    timer.start()
+    try:
+        assert chanjo.load_region_coverage(chanjo.connect(db_file, timeout=30), coverage) == 3
+    finally:
+        timer.join()
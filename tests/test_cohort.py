@@ -0,0 +1,70 @@
+import os
+
+import numpy
+
+from ddb_ngsflow.coverage import cohort
+
+
+def _coverage(filter_field, depth):
+    return {'filter_field': filter_field, 'depth_field': depth}
+
+
+RUN1 = {'S2': {'A': _coverage("PASS", "30.0"), 'B': _coverage("LOW_COVERAGE", "5.0"), 'X': _coverage("PASS", "1")},
+        'S1': {'A': _coverage("PASS", "10.0"), 'B': _coverage("NO_READS", "0.0"), 'C': _coverage(".", "n/a")}}
+RUN2 = {'S3': {'A': _coverage("POOR_QUALITY;LOW_COVERAGE", "2.0"), 'B': _coverage("PASS", "20.0"),
+               'C': _coverage("PASS", "40.0")}}
+
+
+def test_status_code():
+    assert cohort.status_code("PASS") == cohort.PASS
+    assert cohort.status_code(".") == cohort.PASS
+    assert cohort.status_code("NO_READS;LOW_COVERAGE") == cohort.NO_READS
+    assert cohort.status_code("POOR_QUALITY") == cohort.OTHER_FILTER
+
+
+def test_append_runs_and_query(tmpdir):
+    directory = str(tmpdir.join("store"))
+    store = cohort.open_cohort(directory, ["A", "B", "C"])
+
+    assert store.append_run("run1", RUN1) == 1
+    assert store.append_run("run2", RUN2) == 0
+
+    store = cohort.open_cohort(directory, ["ignored"])
+    assert store.regions == ["A", "B", "C"]
+    assert store.samples == ["S1", "S2", "S3"]
+    assert list(store.status[:, 2]) == [cohort.PASS, cohort.MISSING, cohort.PASS]
+    fractions = store.failure_fraction()
+    assert numpy.allclose(fractions, [1.0 / 3, 2.0 / 3, 0.0])
+    assert store.failing_regions(0.5) == [("B", 2.0 / 3)]
+    assert numpy.allclose(store.mean_depth(), [14.0, 25.0 / 3, 40.0])
+    assert store.sample_failures() == [("S1", 1), ("S2", 1), ("S3", 1)]
+
+    assert store.run_rows(1) == slice(2, 3)
+    assert store.failing_regions(0.5, last_runs=1) == [("A", 1.0)]
+    assert numpy.allclose(store.mean_depth(last_runs=1), [2.0, 20.0, 40.0])
+
+
+def test_append_overwrites_rows_of_an_interrupted_append(tmpdir):
+    directory = str(tmpdir.join("store"))
+    store = cohort.CohortCoverage.create(directory, ["A", "B", "C"])
+    store.append_run("run1", RUN1)
+    for name in ("depth.f4", "status.u1"):
+        with open(os.path.join(directory, name), 'ab') as matrix:
+            matrix.write(b"\0" * 12)
+
+    store.append_run("run2", RUN2)
+
+    assert os.path.getsize(os.path.join(directory, "status.u1")) == 9
+    assert list(cohort.CohortCoverage(directory).status[2]) == [cohort.LOW_COVERAGE, cohort.PASS, cohort.PASS]
+
+
+def test_main_reports_failing_regions(tmpdir, capsys):
+    directory = str(tmpdir.join("store"))
+    store = cohort.open_cohort(directory, ["A", "B", "C"])
+    store.append_run("run1", RUN1)
+    store.append_run("run2", RUN2)
+
+    assert cohort.main([directory, "--min-fraction", "0.5"]) == [("B", 2.0 / 3)]
+    output = capsys.readouterr().out.splitlines()
+    assert output[0] == "# 3 samples of 2 runs, 1 regions failing in more than 50% of samples"
+    assert output[2] == "B\t0.667\t8.3"
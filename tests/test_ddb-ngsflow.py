@@ -1,6 +1,6 @@
 
-import ddb-ngsflow
+import ddb_ngsflow
 
 
 def test_main():
-    assert ddb-ngsflow  # use your library here
+    assert ddb_ngsflow  # use your library here
@@ -0,0 +1,174 @@
+import os
+import json
+
+import numpy
+import pytest
+
+pytest.importorskip("toil")
+
+from ddb_ngsflow import pipeline  # noqa: E402
+from ddb_ngsflow.coverage import depth  # noqa: E402
+
+
+def _sam_line(contig, pos, cigar, name="read"):
+    return "{}\t0\t{}\t{}\t60\t{}\t*\t0\t0\t*\t*\n".format(name, contig, pos, cigar)
+
+
+def _samtools(directory, sam_lines, exit_code=0):
+    """A samtools stand-in printing fixed alignments and recording its arguments"""
+
+    sam = os.path.join(directory, "reads.sam")
+    with open(sam, 'w') as reads:
+        reads.writelines(sam_lines)
+    script = os.path.join(directory, "samtools")
+    with open(script, 'w') as handle:
+        handle.write("#!/bin/sh\necho \"$@\" > {0}/samtools.args\ncat {1}\nexit {2}\n".format(directory, sam,
+                                                                                           exit_code))
+    os.chmod(script, 0o755)
+
+    return script
+
+
+def _setup(tmpdir, sam_lines, exit_code=0):
+    tmpdir.chdir()
+    tmpdir.join("ref.fa.fai").write("chr1\t1000\t6\t60\t61\nchr2\t500\t1100\t60\t61\n")
+    tmpdir.join("regions.bed").write("chr1\t100\t200\tGENE1_1\nchr1\t150\t300\tGENE1_2\nchr2\t0\t50\tGENE2_1\n")
+    config = {'reference': "ref.fa", 'coverage_thresholds': [1, 2],
+              'samtools': {'bin': _samtools(str(tmpdir), sam_lines, exit_code)}}
+
+    return config, {'S1': {'regions': "regions.bed"}}
+
+
+def test_coverage_metrics_excludes_mapq_zero_and_records_consistent_telemetry(tmpdir, job):
+    config, samples = _setup(tmpdir, [_sam_line("chr1", 101, "50M"), _sam_line("chr1", 181, "10M100N10M"),
+                                      _sam_line("chr2", 11, "5M")])
+
+    outputs = depth.coverage_metrics(job, config, "S1", samples, "S1.bam")
+
+    assert "-q 1" in tmpdir.join("samtools.args").read()
+    store = depth.DepthStore(outputs['base'])
+    assert list(store.region_depth("chr1", 100, 103)) == [1, 1, 1]
+    assert list(store.region_depth("chr1", 185, 195)) == [1] * 5 + [0] * 5
+    with open(outputs['region']) as regions:
+        lines = [line.rstrip("\n").split("\t") for line in regions]
+    assert [fields[4] for fields in lines[1:]] == ["2", "1", "1"]
+    for metric in ('region', 'base', 'total_base'):
+        with open(pipeline.telemetry_file("S1.{}_coverage.log".format(metric))) as telemetry:
+            record = json.loads(telemetry.readline())
+        assert record['wall_time'] == record['end'] - record['start']
+        assert 0 <= record['metric_time'] <= record['wall_time']
+
+
+def test_coverage_metrics_removes_partial_outputs_when_decoding_fails(tmpdir, job):
+    config, samples = _setup(tmpdir, [_sam_line("chr1", 101, "50M")], exit_code=1)
+    # Outputs of an earlier run must not survive either
+    tmpdir.join("S1.region_coverage.bed").write("stale")
+    tmpdir.join("S1.total_base_coverage.bedgraph.gz.tbi").write("stale")
+
+    with pytest.raises(RuntimeError):
+        depth.coverage_metrics(job, config, "S1", samples, "S1.bam")
+
+    for output in ("S1.region_coverage.bed", "S1.depth", "S1.total_base_coverage.bedgraph.gz",
+                   "S1.total_base_coverage.bedgraph.gz.tbi"):
+        assert not tmpdir.join(output).exists()
+
+
+def test_native_base_coverage_removes_the_depth_store_when_decoding_fails(tmpdir, job):
+    config, samples = _setup(tmpdir, [_sam_line("chr1", 101, "50M")], exit_code=1)
+
+    with pytest.raises(RuntimeError):
+        depth.native_base_coverage(job, config, "S1", samples, "S1.bam")
+
+    assert not tmpdir.join("S1.depth").exists()
+
+
+def test_alignment_blocks_split_at_splice_gaps():
+    assert depth.alignment_blocks(11, "5S10M2I5M3D4M") == [(10, 32)]
+    assert depth.alignment_blocks(1, "10M100N10M") == [(0, 10), (110, 120)]
+    assert depth.alignment_blocks(1, "5S") == list()
+
+
+def test_target_depth_matches_brute_force(tmpdir):
+    random = numpy.random.RandomState(5)
+    starts = numpy.sort(random.randint(1, 5000, 400))
+    cigars = [["{}M".format(random.randint(20, 150))] if i % 4 else
+              ["{}M".format(random.randint(5, 50)), "{}N".format(random.randint(1, 300)),
+               "{}M".format(random.randint(5, 50))] for i in range(len(starts))]
+    targets = {'chr1': (numpy.array([100, 1000, 4000]), numpy.array([900, 1500, 4800]))}
+    target_depth = depth.TargetDepth(str(tmpdir.join("S1.depth")), targets, ["chr1"])
+    stream = depth.AlignmentStream([target_depth], batch_size=50)
+    expected = numpy.zeros(6000, dtype=numpy.int64)
+    for start, cigar in zip(starts, cigars):
+        for block_start, block_end in depth.alignment_blocks(int(start), "".join(cigar)):
+            expected[block_start:block_end] += 1
+        stream.write(_sam_line("chr1", start, "".join(cigar)))
+    stream.close()
+
+    store = depth.DepthStore(str(tmpdir.join("S1.depth")))
+    for target_start, target_end in zip(*targets['chr1']):
+        assert list(store.region_depth("chr1", target_start, target_end)) == \
+            list(expected[target_start:target_end])
+
+
+def test_parse_alignments_matches_alignment_blocks():
+    random = numpy.random.RandomState(7)
+    operations = ["M", "I", "D", "N", "S", "=", "X"]
+    lines = ["@HD\tVN:1.6\tSO:coordinate\n", "@SQ\tSN:chr1\tLN:1000\n"]
+    expected = list()
+    for i in range(300):
+        contig = "chr1" if i < 150 else "chr10" if i < 250 else "chr2"
+        cigar = "".join("{}{}".format(random.randint(0, 120), operations[random.randint(len(operations))])
+                        for _ in range(random.randint(1, 6)))
+        if i % 25 == 0:
+            cigar = "*"
+        lines.append(_sam_line(contig, 1000 + i, cigar, name="read{}".format(i)))
+        if cigar != "*":
+            expected.append((contig, depth.alignment_blocks(1000 + i, cigar)))
+
+    alignments = depth.parse_alignments("".join(lines).encode("utf-8"))
+
+    assert alignments['contigs'] == [("chr1", 0), ("chr10", 144), ("chr2", 240)]
+    assert list(alignments['positions']) == [1000 + i for i in range(300) if i % 25]
+    blocks = [list() for _ in expected]
+    for read, start, end in zip(alignments['block_reads'], alignments['block_starts'], alignments['block_ends']):
+        blocks[read].append((start, end))
+    assert blocks == [read_blocks for contig, read_blocks in expected]
+    spans = [(read_blocks[0][0], read_blocks[-1][1]) for contig, read_blocks in expected if read_blocks]
+    assert list(zip(alignments['read_starts'], alignments['read_ends'])) == spans
+
+
+class _Collector(object):
+    def __init__(self):
+        self.blocks = list()
+        self.contigs = list()
+
+    def add(self, contig, read_starts, read_ends, block_starts, block_ends):
+        self.blocks.extend((contig, start, end) for start, end in zip(block_starts, block_ends))
+
+    def finish_contig(self, contig):
+        self.contigs.append(contig)
+
+    def close(self):
+        pass
+
+
+def test_alignment_stream_parses_in_blocks_and_rejects_unsorted_alignments():
+    lines = [_sam_line("chr1", 1 + 10 * i, "5M3N5M") for i in range(40)] + [_sam_line("chr2", 7, "4M")]
+    collector = _Collector()
+    stream = depth.AlignmentStream([collector], batch_size=7, parse_size=64)
+    text = "".join(lines)
+    for start in range(0, len(text), 50):
+        stream.write(text[start:start + 50])
+    stream.close()
+
+    expected = [("chr1", 10 * i + offset, 10 * i + offset + 5) for i in range(40) for offset in (0, 8)]
+    assert collector.blocks == expected + [("chr2", 6, 10)]
+    assert collector.contigs == ["chr1", "chr2"]
+
+    for unsorted in ([_sam_line("chr1", 50, "5M"), _sam_line("chr1", 40, "5M")],
+                     [_sam_line("chr1", 50, "5M"), _sam_line("chr2", 1, "5M"), _sam_line("chr1", 60, "5M")]):
+        stream = depth.AlignmentStream([_Collector()], parse_size=1)
+        with pytest.raises(ValueError):
+            for line in unsorted:
+                stream.write(line)
+            stream.close()
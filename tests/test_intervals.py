@@ -0,0 +1,57 @@
+import numpy
+import pytest
+
+pytest.importorskip("toil")
+
+from ddb_ngsflow.utils import intervals  # noqa: E402
+
+
+def _random_intervals(seed, count):
+    random = numpy.random.RandomState(seed)
+    starts = random.randint(0, 10000, count)
+    lengths = random.randint(1, 500, count)
+    return [["chr{}".format(1 + i % 2), int(start), int(start + length), "r{}".format(i)]
+            for i, (start, length) in enumerate(zip(starts, lengths))]
+
+
+def test_overlapping_and_join_match_brute_force():
+    regions = _random_intervals(1, 300)
+    index = intervals.IntervalIndex(regions)
+    queries = numpy.random.RandomState(2).randint(0, 10500, (200, 2))
+    starts = queries.min(axis=1)
+    ends = queries.max(axis=1) + 1
+
+    pairs = set()
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        expected = sorted((fields[1], fields[2], fields[3]) for fields in regions
+                          if fields[0] == "chr1" and fields[1] < end and fields[2] > start)
+        found = index.overlapping("chr1", start, end)
+        assert sorted((fields[1], fields[2], fields[3]) for fields in found) == expected
+        pairs.update((i, fields[3]) for fields in found)
+    joined_regions, joined_intervals = index.join("chr1", starts, ends)
+
+    assert set((region, index.fields["chr1"][interval][3])
+               for region, interval in zip(joined_regions, joined_intervals)) == pairs
+    assert index.overlapping("chrX", 0, 100) == list()
+
+
+def test_contains_and_merged():
+    index = intervals.IntervalIndex([["chr1", 10, 20], ["chr1", 15, 30], ["chr1", 30, 40], ["chr1", 50, 60],
+                                     ["chr2", 0, 5]])
+
+    merged_starts, merged_ends = index.merged("chr1")
+
+    assert list(merged_starts) == [10, 50] and list(merged_ends) == [40, 60]
+    assert list(index.contains("chr1", [9, 10, 39, 40, 55, 60])) == [False, True, True, False, True, False]
+    assert list(index.contains("chr3", [1, 2])) == [False, False]
+    assert len(index) == 5 and index.contigs == ["chr1", "chr2"]
+
+
+def test_read_bed(tmpdir):
+    bed = tmpdir.join("regions.bed")
+    bed.write("chr2\t100\t200\tB\nchr1\t0\t10\tA\n")
+
+    index = intervals.read_bed(str(bed))
+
+    assert index.contigs == ["chr2", "chr1"]
+    assert index.overlapping("chr2", 150, 151) == [["chr2", 100, 200, "B"]]
@@ -0,0 +1,82 @@
+import os
+
+import numpy
+import pytest
+
+pytest.importorskip("toil")
+
+from ddb_ngsflow.variation import lookup  # noqa: E402
+
+HEADER = "##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+
+
+def _write_source(path, records):
+    with open(path, 'w') as vcf:
+        vcf.write(HEADER)
+        for contig, pos, ref, alt, info in records:
+            vcf.write("{}\t{}\t.\t{}\t{}\t.\tPASS\t{}\n".format(contig, pos, ref, alt, info))
+
+    return path
+
+
+def test_normalize_alleles_trims_shared_bases():
+    assert lookup.normalize_alleles(100, "CTT", "CT") == (100, "CT", "C")
+    assert lookup.normalize_alleles(100, "GAC", "GTC") == (101, "A", "T")
+    assert lookup.normalize_alleles("7", "ac", "acgt") == (8, "C", "CGT")
+    assert lookup.normalize_alleles(7, "A", "<DEL>") == (7, "A", "<DEL>")
+    assert lookup.variant_key("chr1", 100, "CTT", "CT") == lookup.variant_key("1", "100", "CT", "C")
+
+
+def test_build_table_finds_every_key():
+    keys = numpy.random.RandomState(3).randint(1, 1 << 62, 5000).astype(numpy.uint64)
+    keys[10] = keys[20]
+    values = numpy.arange(len(keys), dtype=numpy.float32)
+
+    table_keys, table_values = lookup.build_table(keys, values, numpy.float32)
+
+    mask = len(table_keys) - 1
+    for key, value in list(zip(keys, values))[:500]:
+        slot = int(key) & mask
+        while table_keys[slot] != key:
+            assert table_keys[slot] != 0
+            slot = (slot + 1) & mask
+        assert table_values[slot] == (20 if key == keys[20] else value)
+
+
+def test_index_matches_multiallelic_sources_and_drops_removed_sources(tmpdir):
+    exac = _write_source(str(tmpdir.join("exac.vcf")), [("1", 100, "GAT", "GT,GAAT", "AF=0.2,0.001"),
+                                                        ("1", 200, "C", "T", "AF=0.5")])
+    clinvar = _write_source(str(tmpdir.join("clinvar.vcf")), [("chr1", 200, "C", "T", "CLNSIG=5")])
+    index_dir = str(tmpdir.join("index"))
+    sources = {'exac': {'vcf': exac, 'info': "AF"},
+               'clinvar': {'vcf': clinvar, 'info': "CLNSIG", 'type': lookup.CATEGORY}}
+
+    assert lookup.build_lookup_index(index_dir, sources) == ["clinvar", "exac"]
+    assert lookup.build_lookup_index(index_dir, sources) == list()
+
+    index = lookup.LookupIndex(index_dir)
+    # Both alleles of the multi-allelic record, as a caller reports them on their own
+    assert abs(index.frequency("chr1", 100, "GA", "G") - 0.2) < 1e-6
+    assert abs(index.frequency("1", 100, "G", "GA") - 0.001) < 1e-6
+    assert index.clinvar("1", 200, "C", "T") == "5"
+    assert index.is_rare("1", 300, "A", "G") and not index.is_rare("1", 100, "GA", "G")
+
+    del sources['clinvar']
+    lookup.build_lookup_index(index_dir, sources)
+    assert sorted(os.listdir(index_dir)) == ["exac.json", "exac.keys.npy", "exac.values.npy"]
+    assert lookup.LookupIndex(index_dir).clinvar("1", 200, "C", "T") is None
+
+
+def test_open_lookup_index_loads_only_configured_sources(tmpdir):
+    exac = _write_source(str(tmpdir.join("exac.vcf")), [("1", 200, "C", "T", "AF=0.5")])
+    esp = _write_source(str(tmpdir.join("esp.vcf")), [("1", 200, "C", "T", "MAF=0.9")])
+    index_dir = str(tmpdir.join("index"))
+    lookup.build_lookup_index(index_dir, {'exac': {'vcf': exac, 'info': "AF"}, 'esp': {'vcf': esp, 'info': "MAF"}})
+
+    index = lookup.open_lookup_index({'lookup_index': {'dir': index_dir,
+                                                       'sources': {'exac': {'vcf': exac, 'info': "AF"}}}})
+
+    assert sorted(index.sources) == ["exac"]
+    assert index.frequency("1", 200, "C", "T") == 0.5
+    with pytest.raises(ValueError):
+        lookup.LookupIndex(index_dir, sources=["exac", "gnomad"])
@@ -0,0 +1,170 @@
+import os
+import json
+
+import pytest
+
+from ddb_ngsflow import pipeline
+
+
+def _records(logfile):
+    with open(pipeline.telemetry_file(logfile)) as telemetry:
+        return [json.loads(line) for line in telemetry]
+
+
+def test_cache_restores_declared_output_directory(tmpdir):
+    tmpdir.chdir()
+    cache_dir = str(tmpdir.join("cache"))
+    tmpdir.join("in.txt").write("input\n")
+    command = [["sh", "-c", "mkdir -p outdir/sub && cp in.txt outdir/sub/copy.txt && echo done > outdir/done"]]
+
+    pipeline.run_pipeline(command, "step.log", cache_dir=cache_dir, inputs=["in.txt"], outputs=["outdir"])
+    tmpdir.join("outdir").remove()
+    pipeline.run_pipeline(command, "step.log", cache_dir=cache_dir, inputs=["in.txt"], outputs=["outdir"])
+
+    records = _records("step.log")
+    assert [record['cached'] for record in records] == [False, True]
+    assert tmpdir.join("outdir", "sub", "copy.txt").read() == "input\n"
+    assert tmpdir.join("outdir", "done").read() == "done\n"
+
+
+def test_step_without_outputs_is_not_cached(tmpdir):
+    tmpdir.chdir()
+    cache_dir = str(tmpdir.join("cache"))
+    tmpdir.join("in.txt").write("input\n")
+    command = [["sh", "-c", "cat in.txt > /dev/null"]]
+
+    pipeline.run_pipeline(command, "step.log", cache_dir=cache_dir, inputs=["in.txt"])
+    pipeline.run_pipeline(command, "step.log", cache_dir=cache_dir, inputs=["in.txt"])
+
+    assert [record['cached'] for record in _records("step.log")] == [False, False]
+    assert not os.path.isdir(os.path.join(cache_dir, "steps"))
+
+
+def test_stale_partial_output_does_not_defeat_the_cache(tmpdir):
+    tmpdir.chdir()
+    cache_dir = str(tmpdir.join("cache"))
+    tmpdir.join("in.txt").write("input\n")
+    tmpdir.join("out.txt").write("partial")
+
+    for i in range(3):
+        pipeline.run_pipeline([["cp", "in.txt", "out.txt"]], "copy.log", cache_dir=cache_dir)
+
+    assert [record['cached'] for record in _records("copy.log")] == [False, True, True]
+    assert tmpdir.join("out.txt").read() == "input\n"
+
+
+def test_cache_misses_when_an_input_changes(tmpdir):
+    tmpdir.chdir()
+    cache_dir = str(tmpdir.join("cache"))
+    tmpdir.join("in.txt").write("input\n")
+
+    pipeline.run_pipeline([["cp", "in.txt", "out.txt"]], "copy.log", cache_dir=cache_dir)
+    tmpdir.join("in.txt").write("changed input\n")
+    pipeline.run_pipeline([["cp", "in.txt", "out.txt"]], "copy.log", cache_dir=cache_dir)
+
+    assert [record['cached'] for record in _records("copy.log")] == [False, False]
+    assert tmpdir.join("out.txt").read() == "changed input\n"
+
+
+def test_failed_step_is_not_cached(tmpdir):
+    tmpdir.chdir()
+    cache_dir = str(tmpdir.join("cache"))
+
+    with pytest.raises(RuntimeError):
+        pipeline.run_pipeline([["sh", "-c", "echo partial > out.txt; exit 3"]], "fail.log", cache_dir=cache_dir,
+                              outputs=["out.txt"])
+
+    assert not os.path.isdir(os.path.join(cache_dir, "steps"))
+
+
+def test_pipeline_streams_between_stages(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join("in.txt").write("b\na\nc\n")
+
+    stages = pipeline.run_pipeline([["cat"], ["sort"]], "sort.log", stdin="in.txt", stdout="out.txt")
+
+    assert tmpdir.join("out.txt").read() == "a\nb\nc\n"
+    assert [stage['returncode'] for stage in stages] == [0, 0]
+    assert tmpdir.join("sort.log").read().startswith("Command: cat | sort < in.txt > out.txt")
+
+
+def test_pipeline_ignores_sigpipe_of_upstream_stage(tmpdir):
+    tmpdir.chdir()
+
+    stages = pipeline.run_pipeline([["yes"], ["head", "-n", "3"]], "head.log", stdout="out.txt")
+
+    assert tmpdir.join("out.txt").read() == "y\ny\ny\n"
+    assert stages[1]['returncode'] == 0
+    assert stages[0]['returncode'] in (0, -pipeline.signal.SIGPIPE)
+
+
+def test_pipeline_reports_failed_stage_and_stderr_tail(tmpdir):
+    tmpdir.chdir()
+
+    with pytest.raises(RuntimeError) as error:
+        pipeline.run_pipeline([["sh", "-c", "echo first problem >&2; exit 4"], ["cat"]], "fail.log")
+
+    assert "Stage 1 (sh) exited with code 4" in str(error.value)
+    assert "first problem" in str(error.value)
+    assert "first problem" in tmpdir.join("fail.log").read()
+    assert _records("fail.log")[0]['returncode'] == 4
+
+
+def test_pipeline_reports_missing_executable(tmpdir):
+    tmpdir.chdir()
+
+    with pytest.raises(RuntimeError) as error:
+        pipeline.run_pipeline([["cat"], ["ddb-ngsflow-no-such-tool"]], "missing.log", stdin=os.devnull)
+
+    assert "exited with code 127" in str(error.value)
+
+
+def test_pipeline_streams_stdout_to_consumer(tmpdir):
+    tmpdir.chdir()
+    chunks = list()
+
+    pipeline.run_pipeline([["sh", "-c", "seq 1 100000"]], "seq.log", stdout=chunks.append)
+
+    assert b"".join(chunks).split() == [("{}".format(i)).encode("ascii") for i in range(1, 100001)]
+
+
+def test_telemetry_records_inputs_outputs_and_usage(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join("in.txt").write("x" * 1000)
+
+    pipeline.run_pipeline([["cp", "in.txt", "out.txt"]], "copy.log")
+
+    record = _records("copy.log")[0]
+    assert record['inputs'] == ["in.txt"]
+    assert record['outputs'] == ["out.txt"]
+    assert record['input_bytes'] == record['output_bytes'] == 1000
+    assert record['returncode'] == 0 and not record['cached']
+    assert record['end'] >= record['start']
+    assert record['stages'][0]['argv'] == ["cp", "in.txt", "out.txt"]
+
+
+def test_run_and_log_command_runs_through_shell(tmpdir):
+    tmpdir.chdir()
+
+    pipeline.run_and_log_command("echo hello | tr a-z A-Z", "shell.log", stdout="out.txt")
+
+    assert tmpdir.join("out.txt").read() == "HELLO\n"
+    assert _records("shell.log")[0]['command'] == "echo hello | tr a-z A-Z"
+
+
+def test_python_step_records_telemetry_of_successful_and_failed_steps(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join("in.txt").write("x" * 100)
+
+    with pipeline.python_step("test.copy", "S1.copy.log", ["in.txt"], ["out.txt"]):
+        tmpdir.join("out.txt").write("y" * 40)
+    with pytest.raises(ValueError):
+        with pipeline.python_step("test.fail", "S1.fail.log", ["in.txt"], ["missing.txt"]):
+            raise ValueError("failed")
+
+    record = _records("S1.copy.log")[0]
+    assert record['command'] == "python test.copy"
+    assert (record['input_bytes'], record['output_bytes']) == (100, 40)
+    assert record['returncode'] == 0 and record['wall_time'] == record['end'] - record['start']
+    failed = _records("S1.fail.log")[0]
+    assert failed['returncode'] == 1 and failed['outputs'] == list()
@@ -0,0 +1,59 @@
+import json
+
+from ddb_ngsflow import plan
+from ddb_ngsflow import pipeline
+from ddb_ngsflow import profiler
+
+
+def _step(directory, logfile, start, end, inputs, outputs, cpu=None):
+    record = {'command': "tool {}".format(logfile), 'logfile': logfile, 'cwd': directory, 'start': start, 'end': end,
+              'wall_time': end - start, 'user_cpu': cpu if cpu is not None else end - start, 'sys_cpu': 0.0,
+              'inputs': inputs, 'outputs': outputs, 'cached': False, 'returncode': 0}
+    with open("{}/{}".format(directory, pipeline.telemetry_file(logfile)), 'a') as telemetry:
+        telemetry.write("{}\n".format(json.dumps(record)))
+
+
+def test_profile_reconstructs_graph_critical_path_and_gaps(tmpdir):
+    directory = str(tmpdir)
+    _step(directory, "S1.bwa-align.log", 0.0, 100.0, ["S1.fastq"], ["S1.bam"], cpu=400.0)
+    _step(directory, "S2.bwa-align.log", 0.0, 40.0, ["S2.fastq"], ["S2.bam"])
+    _step(directory, "S1.freebayes.log", 130.0, 150.0, ["S1.bam"], ["S1.vcf"])
+
+    profile = profiler.profile_run([directory], min_gap=1.0)
+
+    labels = [(step['sample'], step['label']) for step in profile['steps']]
+    path = [labels[i] for i in profile['critical_path']]
+    call = profile['steps'][labels.index(("S1", "freebayes"))]
+    assert path == [("S1", "bwa-align"), ("S1", "freebayes")]
+    assert call['deps'] == [labels.index(("S1", "bwa-align"))]
+    assert call['wait'] == 30.0
+    # While S1 aligns on 4 of the 5 cores the run reached, its variant calling cannot start
+    assert [(gap['start'], gap['end']) for gap in profile['idle_gaps']] == [(40.0, 100.0), (130.0, 150.0)]
+    assert profile['idle_gaps'][0]['blocking'] == [labels.index(("S1", "bwa-align"))]
+    assert profile['steps'][labels.index(("S1", "bwa-align"))]['cores'] == 4.0
+    assert "Critical path (2 steps, 30s waiting)" in profiler.text_report(profile)
+
+
+def test_format_duration():
+    assert profiler.format_duration(45.2) == "45s"
+    assert profiler.format_duration(187) == "3m07s"
+    assert profiler.format_duration(8100) == "2h15m"
+
+
+def test_plan_records_commands_without_running_them(tmpdir, monkeypatch):
+    tmpdir.chdir()
+    tmpdir.join("reads.fastq").write("x" * 4096)
+    monkeypatch.setenv(plan.PLAN_ENV_VAR, str(tmpdir.join("run.plan.jsonl")))
+
+    pipeline.run_pipeline([["aligner", "reads.fastq"]], "S1.align.log", stdout="S1.sam")
+    pipeline.run_pipeline([["caller", "S1.sam"]], "S1.call.log", stdout="S1.vcf")
+    assert plan.record_function("variation.filter", "S1.filter.log", ["S1.vcf"], ["S1.filtered.vcf"])
+
+    steps = plan.build_plan_graph(plan.load_plan(str(tmpdir.join("run.plan.jsonl"))))
+    estimate = plan.estimate_plan(steps)
+
+    assert not tmpdir.join("S1.sam").exists()
+    assert [step['deps'] for step in steps] == [[], [0], [1]]
+    assert estimate['critical_path'] == [0, 1, 2]
+    assert steps[0]['input_bytes'] == 4096
+    assert "Critical path:" in plan.text_report(estimate)
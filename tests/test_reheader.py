@@ -0,0 +1,78 @@
+import gzip
+
+import pytest
+
+from ddb_ngsflow.utils import bgzf
+from ddb_ngsflow.utils import reheader
+
+HEADER = ("##fileformat=VCFv4.2\n"
+          "##contig=<ID=chr1>\n"
+          "##FORMAT=<ID=AD,Number=.,Type=Integer,Description=\"Allelic depths\">\n"
+          "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample\n")
+
+
+def _record(contig, pos):
+    return "{}\t{}\t.\tA\tC\t50\tPASS\t.\tAD\t10,{}\n".format(contig, pos, pos % 17)
+
+
+def _write_indexed(path, records):
+    writer = bgzf.IndexedVcfWriter(path)
+    writer.write_header(HEADER)
+    for line in records:
+        writer.write_record(line)
+    writer.close()
+
+    return path
+
+
+def test_rewrite_header_of_plain_vcf(tmpdir):
+    vcf = tmpdir.join("in.vcf")
+    vcf.write(HEADER + _record("chr1", 10))
+    output = str(tmpdir.join("out.vcf"))
+
+    reheader.rewrite_header(str(vcf), output, reheader.rename_samples({'sample': "S1"}),
+                            reheader.set_field_number("FORMAT", "AD", "R"))
+
+    lines = tmpdir.join("out.vcf").read().splitlines(True)
+    assert lines[2] == "##FORMAT=<ID=AD,Number=R,Type=Integer,Description=\"Allelic depths\">\n"
+    assert lines[3].rstrip("\n").split("\t")[-1] == "S1"
+    assert lines[4] == _record("chr1", 10)
+
+
+def test_set_contigs_from_fai_and_dict(tmpdir):
+    fai = tmpdir.join("ref.fa.fai")
+    fai.write("chr1\t5000\t6\t60\t61\nchr2\t300\t5100\t60\t61\n")
+    dictionary = tmpdir.join("ref.dict")
+    dictionary.write("@HD\tVN:1.5\n@SQ\tSN:chr1\tLN:5000\tM5:abc\tAS:GRCh37\n")
+
+    from_fai = reheader.set_contigs(reheader.contigs_from_fai(str(fai)))(HEADER.splitlines())
+    from_dict = reheader.set_contigs(reheader.contigs_from_dict(str(dictionary)))(HEADER.splitlines())
+
+    assert from_fai[1:3] == ["##contig=<ID=chr1,length=5000>", "##contig=<ID=chr2,length=300>"]
+    assert from_dict[1] == "##contig=<ID=chr1,length=5000,assembly=GRCh37,md5=abc>"
+    assert from_fai[-1].startswith("#CHROM")
+
+
+def test_rewrite_header_of_bgzf_keeps_records_and_index_usable(tmpdir):
+    pysam = pytest.importorskip("pysam")
+    records = [_record("chr1", pos) for pos in range(1, 200000, 13)] + [_record("chr2", 7)]
+    input_vcf = _write_indexed(str(tmpdir.join("in.vcf.gz")), records)
+    fai = tmpdir.join("ref.fa.fai")
+    fai.write("chr1\t250000\t6\t60\t61\nchr2\t300\t254200\t60\t61\n")
+    output = str(tmpdir.join("out.vcf.gz"))
+
+    reheader.rewrite_header(input_vcf, output, reheader.set_contigs(reheader.contigs_from_fai(str(fai))))
+
+    assert bgzf.is_bgzf(output)
+    with gzip.open(output, 'rt') as vcf:
+        lines = vcf.readlines()
+    assert "##contig=<ID=chr2,length=300>\n" in lines
+    assert [line for line in lines if not line.startswith("#")] == records
+    tabix = pysam.TabixFile(output)
+    try:
+        assert len(list(tabix.fetch("chr1", 100000, 100100))) == \
+            len([pos for pos in range(1, 200000, 13) if 100000 < pos <= 100100])
+        assert len(list(tabix.fetch("chr1", 0, 40))) == 4
+        assert len(list(tabix.fetch("chr2"))) == 1
+    finally:
+        tabix.close()
@@ -0,0 +1,87 @@
+import pytest
+
+pytest.importorskip("toil")
+
+from toil.job import Job, PromisedRequirement  # noqa: E402
+
+from ddb_ngsflow import resources  # noqa: E402
+
+GIB = 1 << 30
+
+
+@resources.declare(cores=4, memory="3G", disk="1G")
+def constant_step(job, config, name, samples):
+    pass
+
+
+@resources.declare(cores=resources.tool_cores('bwa'), memory=resources.tool_memory('bwa', "8G"),
+                   disk=resources.input_disk(2))
+def tool_step(job, config, name, samples, input_bam):
+    pass
+
+
+def undeclared_step(job, config, name):
+    pass
+
+
+def _file(tmpdir, name, size):
+    path = tmpdir.join(name)
+    path.write("x" * size)
+
+    return str(path)
+
+
+def test_to_bytes():
+    assert resources.to_bytes(8, 'G') == 8 * GIB
+    assert resources.to_bytes("8G") == 8 * GIB
+    assert resources.to_bytes(" 512m ") == 512 << 20
+    assert resources.to_bytes("1.5K") == 1536
+    assert resources.to_bytes("8GB", 'M') == 8 * GIB
+    assert resources.to_bytes("8GiB") == 8 * GIB
+    assert resources.to_bytes("2T") == 2 << 40
+    assert resources.to_bytes("1B", 'G') == 1
+    assert resources.to_bytes("100") == 100
+    assert resources.to_bytes("") == 0
+
+
+def test_constant_and_default_requirements():
+    assert resources.requirements(constant_step, dict(), "S1", dict()) == {'cores': 4, 'memory': 3 * GIB,
+                                                                            'disk': GIB}
+    assert resources.requirements(undeclared_step, dict(), "S1") == \
+        {'cores': resources.DEFAULT_CORES, 'memory': resources.to_bytes(resources.DEFAULT_MEMORY),
+         'disk': resources.to_bytes(resources.DEFAULT_DISK)}
+
+
+def test_config_derived_requirements_and_input_scaled_disk(tmpdir):
+    samples = {'S1': {'fastq1': _file(tmpdir, "R1.fastq", 1000), 'fastq2': _file(tmpdir, "R2.fastq", 3000),
+                      'regions': "missing.bed"},
+               'S2': {'fastq1': _file(tmpdir, "other.fastq", 100000)}}
+    input_bam = _file(tmpdir, "S1.bam", 500)
+
+    requirement = resources.requirements(tool_step, {'bwa': {'num_cores': 8, 'max_mem': 16}}, "S1", samples,
+                                         input_bam)
+    assert requirement == {'cores': 8, 'memory': 16 * GIB,
+                           'disk': resources.to_bytes(resources.DEFAULT_DISK) + 2 * (1000 + 3000 + 500)}
+
+    requirement = resources.requirements(tool_step, dict(), "S1", samples, input_bam=input_bam)
+    assert (requirement['cores'], requirement['memory']) == (resources.DEFAULT_CORES, 8 * GIB)
+
+
+def test_promised_inputs_defer_input_scaled_requirements(tmpdir):
+    promise = Job.wrapJobFn(undeclared_step, dict(), "S1").rv()
+    samples = {'S1': {'fastq1': _file(tmpdir, "R1.fastq", 1000)}}
+
+    requirement = resources.requirements(tool_step, {'bwa': {'num_cores': 2}}, "S1", samples, promise)
+
+    assert (requirement['cores'], requirement['memory']) == (2, 8 * GIB)
+    assert isinstance(requirement['disk'], PromisedRequirement)
+    # Once the promise resolves to a file, its size is added to the sizes known when the job was created
+    bam = _file(tmpdir, "S1.bam", 500)
+    assert resources._promised_requirement(resources.input_disk(2), dict(), 1000, bam) == \
+        resources.to_bytes(resources.DEFAULT_DISK) + 2 * 1500
+
+
+def test_job_fn_keyword_requirements_override_declared_ones():
+    job = resources.job_fn(constant_step, dict(), "S1", dict(), cores=2, disk=5 * GIB)
+
+    assert (job.cores, job.memory, job.disk) == (2, 3 * GIB, 5 * GIB)
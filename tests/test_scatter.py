@@ -0,0 +1,119 @@
+import gzip
+import os
+
+import pytest
+
+pytest.importorskip("toil")
+
+from ddb_ngsflow import pipeline  # noqa: E402
+from ddb_ngsflow import scatter  # noqa: E402
+from ddb_ngsflow.utils import bgzf  # noqa: E402
+
+HEADER = ("##fileformat=VCFv4.2\n"
+          "##contig=<ID=chr1,length=100000>\n"
+          "##contig=<ID=chr2,length=100000>\n"
+          "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+
+
+def _write_vcf(path, records, header=HEADER):
+    with open(path, 'w') as vcf:
+        vcf.write(header)
+        for contig, pos, ref, alt in records:
+            vcf.write("{}\t{}\t.\t{}\t{}\t50\tPASS\t.\n".format(contig, pos, ref, alt))
+
+    return path
+
+
+def _records(vcf_file):
+    with scatter.open_vcf(vcf_file) as vcf:
+        return [line for line in vcf if not line.startswith("#")]
+
+
+def _query(vcf_file, contig, begin, end):
+    index = bgzf.read_tabix_index("{}.tbi".format(vcf_file))
+    lines = list()
+    with open(vcf_file, 'rb') as handle:
+        for start, stop in bgzf.query_chunks(index, contig, begin, end):
+            lines.extend(bgzf.read_chunk(handle, start, stop).decode("utf-8").splitlines())
+
+    return [line for line in lines if begin < int(line.split("\t")[1]) <= end]
+
+
+def test_split_regions_balances_and_keeps_every_base(tmpdir):
+    intervals = [["chr2", 0, 100], ["chr1", 500, 1500], ["chr1", 0, 100]]
+
+    shards = scatter.split_regions(intervals, 4, str(tmpdir), ["chr1", "chr2"])
+
+    pieces = [scatter.read_regions(shard) for shard in shards]
+    assert len(shards) == 4
+    assert all(pieces)
+    flat = [fields for shard in pieces for fields in shard]
+    assert [fields[0] for fields in flat] == sorted([fields[0] for fields in flat])
+    assert sum(fields[2] - fields[1] for fields in flat) == 1200
+    # A shard is closed once the running total reaches its share, so it holds less than two shares
+    assert max(sum(fields[2] - fields[1] for fields in shard) for shard in pieces) < 600
+
+
+def test_merge_sorted_vcfs_orders_by_reference_and_drops_shard_duplicates(tmpdir):
+    first = _write_vcf(str(tmpdir.join("a.vcf")), [("chr1", 10, "A", "C"), ("chr1", 300, "G", "T")])
+    second = _write_vcf(str(tmpdir.join("b.vcf")), [("chr2", 5, "A", "G"), ("chr1", 300, "G", "T"),
+                                                    ("chr1", 400, "C", "A")])
+    output = str(tmpdir.join("merged.vcf"))
+
+    written = scatter.merge_sorted_vcfs([first, second], output, ["chr1", "chr2"])
+
+    positions = [tuple(line.split("\t")[:2]) for line in _records(output)]
+    assert written == 4
+    assert positions == [("chr1", "10"), ("chr1", "300"), ("chr1", "400"), ("chr2", "5")]
+    with open(output) as vcf:
+        assert vcf.read().startswith(HEADER)
+
+
+def test_merge_sorted_vcfs_writes_indexed_bgzf(tmpdir):
+    records = [("chr1", pos, "A", "C") for pos in range(1, 50000, 7)] + [("chr2", 17, "G", "A")]
+    shard = _write_vcf(str(tmpdir.join("shard.vcf")), records)
+    output = str(tmpdir.join("merged.vcf.gz"))
+
+    scatter.merge_sorted_vcfs([shard], output, ["chr1", "chr2"])
+
+    assert bgzf.is_bgzf(output)
+    assert os.path.exists("{}.tbi".format(output))
+    with gzip.open(output, 'rt') as vcf:
+        assert len([line for line in vcf if not line.startswith("#")]) == len(records)
+    assert [int(line.split("\t")[1]) for line in _query(output, "chr1", 20000, 20050)] == \
+        [pos for pos in range(1, 50000, 7) if 20000 < pos <= 20050]
+    assert len(_query(output, "chr2", 0, 100)) == 1
+
+
+def test_unscattered_caller_returns_indexed_vcf(tmpdir, job):
+    tmpdir.chdir()
+    tmpdir.join("ref.fa.fai").write("chr1\t100000\t6\t60\t61\nchr2\t100000\t101700\t60\t61\n")
+
+    @scatter.scatter_by_regions("testcaller")
+    def caller(job, config, name, samples):
+        return _write_vcf("{}.testcaller.vcf".format(name), [("chr2", 5, "A", "G"), ("chr1", 10, "A", "C")])
+
+    output = caller(job, {'reference': "ref.fa"}, "S1", {'S1': dict()})
+
+    assert output == "S1.testcaller.vcf.gz"
+    assert [line.split("\t")[0] for line in _records(output)] == ["chr1", "chr2"]
+    assert os.path.exists("S1.testcaller.vcf.gz.tbi")
+    assert os.path.exists(pipeline.telemetry_file("S1.testcaller.index.log"))
+
+
+def test_scatter_is_opt_in():
+    assert scatter.num_shards({}, "freebayes") == 1
+    assert scatter.num_shards({'scatter_shards': 8}, "freebayes") == 8
+    assert scatter.num_shards({'scatter_shards': 8, 'freebayes': {'shards': 2}}, "freebayes") == 2
+
+
+def test_absolute_paths_resolves_nested_sample_files(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join("regions.bed").write("chr1\t0\t10\n")
+
+    resolved = scatter._absolute_paths({'S1': {'regions': "regions.bed", 'lanes': ["regions.bed"],
+                                               'name': "not-a-file"}})
+
+    assert resolved['S1']['regions'] == str(tmpdir.join("regions.bed"))
+    assert resolved['S1']['lanes'] == [str(tmpdir.join("regions.bed"))]
+    assert resolved['S1']['name'] == "not-a-file"
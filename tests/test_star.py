@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip("toil")
+
+from ddb_ngsflow.rna import star  # noqa: E402
+
+
+def test_additional_options_are_separate_arguments():
+    flags = ["compressed", "encode_options", "unstranded", "removeNonCanonical", "cufflinks", "limit_bam_sort_ram"]
+
+    command = star.add_additional_options(["STAR"], {'compression': "gunzip -c"}, flags)
+
+    assert command[1:3] == ["--readFilesCommand", "gunzip"]
+    assert command[command.index("--alignMatesGapMax") + 1] == "1000000"
+    for argument in command:
+        assert " " not in argument
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+pytest.importorskip("toil")
+
+from ddb_ngsflow import pipeline  # noqa: E402
+from ddb_ngsflow.utils import utilities  # noqa: E402
+
+
+def test_coverage_summary_carries_regions_across_blocks(tmpdir, job):
+    tmpdir.chdir()
+    depths = {("chr1", 0, 5, "GENE1_1"): [10, 20, 30, 0, 40], ("chr1", 100, 103, "GENE1_2"): [5, 5, 50]}
+    with open("S1.per_site.txt", 'w') as per_site:
+        for region in sorted(depths):
+            for i, depth in enumerate(depths[region]):
+                per_site.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(region[0], region[1], region[2], region[3], i + 1,
+                                                                 depth))
+
+    output = utilities.bedtools_coverage_to_summary(job, {'coverage_thresholds': [20, 10],
+                                                            'coverage_summary_block_lines': 2},
+                                                    "S1", "S1.per_site.txt")
+
+    with open(output) as summary:
+        lines = [line.rstrip("\n").split("\t") for line in summary]
+    assert lines[0][-2:] == ["fraction_10x", "fraction_20x"]
+    assert lines[1] == ["chr1", "0", "5", "GENE1_1", "5", "20.00", "20.0", "0", "40", "0.8000", "0.6000"]
+    assert lines[2] == ["chr1", "100", "103", "GENE1_2", "3", "20.00", "5.0", "5", "50", "0.3333", "0.3333"]
+    with open(pipeline.telemetry_file("S1.bedtools_coverage_summary.log")) as telemetry:
+        record = json.loads(telemetry.readline())
+    assert record['command'] == "python utilities.bedtools_coverage_to_summary"
+    assert record['outputs'] == [output]
+
+
+def test_on_target_filter_sorts_by_reference_and_keeps_targeted_records(tmpdir, job):
+    tmpdir.chdir()
+    tmpdir.join("ref.fa.fai").write("chr2\t1000\t6\t60\t61\nchr1\t1000\t1100\t60\t61\n")
+    tmpdir.join("regions.bed").write("chr1\t9\t20\nchr2\t0\t5\n")
+    tmpdir.join("calls.vcf").write("##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n" +
+                                   "".join("{}\t{}\t.\tA\tC\t50\tPASS\t.\n".format(contig, pos)
+                                           for contig, pos in [("chr1", 9), ("chr1", 10), ("chr1", 20),
+                                                               ("chr1", 21), ("chr2", 5), ("chr2", 6)]))
+
+    output = utilities.bcftools_filter_variants_regions(job, {'reference': "ref.fa"}, "S1",
+                                                        {'S1': {'regions': "regions.bed"}}, "calls.vcf")
+
+    with open(output) as vcf:
+        lines = vcf.readlines()
+    assert lines[1].startswith("#CHROM")
+    assert [tuple(line.split("\t")[:2]) for line in lines[2:]] == [("chr2", "5"), ("chr1", "10"), ("chr1", "20")]
+    assert tmpdir.join(pipeline.telemetry_file("S1.on_target_filter.log")).exists()
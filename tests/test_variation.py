@@ -0,0 +1,116 @@
+import os
+import json
+
+import pytest
+
+pytest.importorskip("cyvcf2")
+pytest.importorskip("gemini")
+pytest.importorskip("toil")
+
+from ddb_ngsflow import pipeline  # noqa: E402
+from ddb_ngsflow import scatter  # noqa: E402
+from ddb_ngsflow.variation import variation  # noqa: E402
+
+HEADER = ("##fileformat=VCFv4.2\n"
+          "##contig=<ID=chr1,assembly=b37,length=50000>\n"
+          "##contig=<ID=chr2,length=30000,assembly=b37>\n"
+          "##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n"
+          "##FORMAT=<ID=AD,Number=R,Type=Integer,Description=\"Allelic depths\">\n"
+          "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n")
+
+
+def _write_calls(path, count):
+    records = list()
+    for i in range(count):
+        contig = "chr1" if i % 3 else "chr2"
+        pos = 1 + (i * 37) % 29000
+        alt_depth = i % 9
+        ref, alt = ("A", "C") if i % 11 else ("A" * 1200, "A")
+        records.append((contig, pos, "{}\t{}\t.\t{}\t{}\t50\tPASS\t.\tGT:AD\t0/1:10,{}\n".format(
+            contig, pos, ref, alt, alt_depth)))
+    with open(path, 'w') as vcf:
+        vcf.write(HEADER)
+        for contig, pos, line in sorted(records, key=lambda record: (record[0], record[1])):
+            vcf.write(line)
+
+    return path
+
+
+def _body(vcf_file):
+    with scatter.open_vcf(vcf_file) as vcf:
+        return [line for line in vcf if not line.startswith("#")]
+
+
+def _expected(vcf_file):
+    kept = list()
+    for line in _body(vcf_file):
+        fields = line.split("\t")
+        if int(fields[9].split(":")[1].split(",")[1]) >= 5 and len(fields[3]) <= 1000:
+            kept.append(line)
+
+    return kept
+
+
+def test_contig_lengths_do_not_depend_on_key_order():
+    assert variation._contig_lengths(HEADER) == {'chr1': 50000, 'chr2': 30000}
+
+
+def test_filter_low_support_variants_single_core(tmpdir, job):
+    tmpdir.chdir()
+    calls = _write_calls("calls.vcf", 500)
+
+    output = variation.filter_low_support_variants(job, {}, "S1", "mutect", calls)
+
+    assert _body(output) == _expected(calls)
+    assert not os.path.exists("{}.chunks".format(output))
+    with open(output) as vcf:
+        header = [line for line in vcf if line.startswith("#")]
+    assert "##contig=<ID=chr2,length=30000,assembly=b37>\n" in header
+    assert header[-1] == HEADER.splitlines(True)[-1]
+    with open(pipeline.telemetry_file("S1.mutect.low_support_filter.log")) as telemetry:
+        record = json.loads(telemetry.readline())
+    assert record['command'] == "python variation.filter_low_support_variants"
+    assert record['outputs'] == [output] and record['returncode'] == 0
+
+
+def test_filter_low_support_variants_in_region_chunks(tmpdir, job):
+    tmpdir.chdir()
+    calls = _write_calls("calls.vcf", 500)
+    indexed = "calls.vcf.gz"
+    scatter.merge_sorted_vcfs([calls], indexed, ["chr1", "chr2"])
+    config = {'low_support_filter': {'num_cores': 3, 'chunk_size': 7000}}
+
+    output = variation.filter_low_support_variants(job, config, "S1", "mutect", indexed)
+
+    assert sorted(_body(output)) == sorted(_expected(calls))
+    assert [line.split("\t")[0] for line in _body(output)] == \
+        ["chr1"] * len([line for line in _expected(calls) if line.startswith("chr1")]) + \
+        ["chr2"] * len([line for line in _expected(calls) if line.startswith("chr2")])
+    assert not os.path.exists("{}.chunks".format(output))
+
+
+def _vt(path, body):
+    with open(path, 'w') as script:
+        script.write("#!/bin/sh\n{}\n".format(body))
+    os.chmod(path, 0o755)
+
+    return os.path.abspath(path)
+
+
+def test_normalize_bgzip_tabix_vcf_indexes_only_successful_runs(tmpdir, job):
+    tmpdir.chdir()
+    calls = _write_calls("calls.vcf", 50)
+    config = {'reference': "ref.fa", 'vt': {'bin': _vt("vt", "cat")}}
+
+    output = variation.normalize_bgzip_tabix_vcf(job, config, "S1", "mutect", calls)
+
+    assert os.path.exists("{}.tbi".format(output))
+    assert _body(output) == _body(calls)
+    with scatter.open_vcf(output) as vcf:
+        assert "##FORMAT=<ID=AD,Number=R" in vcf.read()
+
+    config['vt']['bin'] = _vt("vt-fail", "cat > /dev/null; exit 3")
+    with pytest.raises(RuntimeError):
+        variation.normalize_bgzip_tabix_vcf(job, config, "S1", "mutect", calls)
+    assert not os.path.exists(output)
+    assert not os.path.exists("{}.tbi".format(output))